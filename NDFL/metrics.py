@@ -0,0 +1,60 @@
+# NDFL/metrics.py
+"""
+Метрики приложения (счётчики и гистограммы prometheus_client) для страницы /metrics/.
+
+Если при запуске процесса задана переменная окружения PROMETHEUS_MULTIPROC_DIR, prometheus_client
+работает в многопроцессном режиме: каждый процесс (воркеры gunicorn, процессы пулов, команды) пишет
+значения в свои файлы этого каталога, а страница суммирует их через MultiProcessCollector.
+Каталог нужно очищать перед запуском приложения (см. docker-compose.yml). Без переменной
+отдаются значения только текущего процесса.
+"""
+import os
+
+from django.http import HttpResponse, HttpResponseForbidden
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest
+from prometheus_client import multiprocess
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# Метрики приложения
+PARSER_RUN_SECONDS = Histogram(
+    'ndfl_parser_run_seconds', 'Длительность расчёта по отчётам брокера.', ('broker', 'mode'),
+    buckets=DURATION_BUCKETS,
+)
+PARSER_RUNS = Counter(
+    'ndfl_parser_runs', 'Расчёты по отчётам брокера (outcome: ok, parsing_error или exception).',
+    ('broker', 'mode', 'outcome'),
+)
+RATE_LOOKUPS = Counter(
+    'ndfl_rate_lookups',
+    'Поиск курса ЦБ на дату: exact — в БД, fetched — загружен с ЦБ, alias — курс ближайшей даты публикации ЦБ, '
+    'nearest — ближайший предыдущий курс из БД, missing — курса нет.',
+    ('result',),
+)
+RATE_CACHE_LOOKUPS = Counter(
+    'ndfl_rate_cache_lookups', 'Точные курсы ЦБ из кэша расчёта (RunContext): hit или miss.', ('result',),
+)
+CBR_REQUEST_SECONDS = Histogram(
+    'ndfl_cbr_request_seconds', 'Длительность запросов к cbr.ru (endpoint: daily или dynamic).',
+    ('endpoint', 'outcome'), buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30),
+)
+PDF_RENDER_SECONDS = Histogram(
+    'ndfl_pdf_render_seconds', 'Длительность построения PDF-отчёта.', ('backend',),
+    buckets=DURATION_BUCKETS,
+)
+
+
+def metrics_registry():
+    """Реестр для страницы метрик: сумма файлов всех процессов в многопроцессном режиме, иначе REGISTRY."""
+    if 'PROMETHEUS_MULTIPROC_DIR' not in os.environ:
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+def metrics_view(request):
+    """Метрики для Prometheus; только для сотрудников (is_staff)."""
+    if not (request.user.is_active and request.user.is_staff):
+        return HttpResponseForbidden()
+    return HttpResponse(generate_latest(metrics_registry()), content_type=CONTENT_TYPE_LATEST)
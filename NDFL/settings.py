@@ -26,6 +26,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'rest_framework',
     'reports_to_ndfl.apps.ReportsToNdflConfig', # Ваше приложение
     'currency_CBRF.apps.CurrencyCbrfConfig',
 ]
@@ -56,6 +57,15 @@ TEMPLATES = [
             ],
         },
     },
+    {
+        # Тяжёлые таблицы отчёта (см. reports_to_ndfl/report_templates.py)
+        'BACKEND': 'django.template.backends.jinja2.Jinja2',
+        'DIRS': [],
+        'APP_DIRS': True,
+        'OPTIONS': {
+            'environment': 'reports_to_ndfl.jinja2_env.environment',
+        },
+    },
 ]
 
 WSGI_APPLICATION = 'NDFL.wsgi.application'
@@ -117,4 +127,64 @@ LOGOUT_REDIRECT_URL = 'login'
 # Настройки API Центрального Банка РФ
 CBRF_API_BASE_URL = "http://www.cbr.ru/scripts/"
 CBRF_API_TIMEOUT_DAILY = 10  # Таймаут для XML_daily.asp в секундах
-CBRF_API_TIMEOUT_PERIOD = 30 # Таймаут для XML_dynamic.asp в секундах
\ No newline at end of file
+CBRF_API_TIMEOUT_PERIOD = 30 # Таймаут для XML_dynamic.asp в секундах
+
+# Максимальное число одновременных запросов к ЦБ РФ при параллельной загрузке курсов
+CBRF_API_CONCURRENCY = 8
+# Предзагружать недостающие курсы пачкой перед обработкой отчетов
+CBRF_RATES_WARM_UP = True
+
+# Фоновая синхронизация курсов (manage.py sync_rates --daemon)
+CBRF_SYNC_INTERVAL_SECONDS = 6 * 3600  # Интервал между циклами синхронизации
+CBRF_SYNC_HORIZON_DAYS = 1100          # Глубина поиска пропусков в курсах (дней)
+CBRF_SYNC_CURRENCIES = None            # Список CharCode для синхронизации; None — все валюты из БД
+
+# Загружаемые отчеты крупнее этого размера сразу пишутся во временный файл, а не держатся в памяти
+FILE_UPLOAD_MAX_MEMORY_SIZE = 256 * 1024
+# Число потоков для разбора и сохранения файлов при загрузке нескольких отчетов
+REPORT_UPLOAD_WORKERS = 4
+
+# Прогонять FIFO только по инструментам, связанным с продажами целевого года (конвертации, ISIN)
+NDFL_FIFO_RELEVANCE_PRUNING = True
+# Число процессов для FIFO по семействам инструментов (None — по числу ядер, 1 — без пула процессов)
+NDFL_FIFO_WORKERS = None
+# Пул процессов для FIFO включается начиная с этого числа операций
+NDFL_FIFO_PARALLEL_MIN_OPERATIONS = 5000
+# Векторный (NumPy) FIFO для простых инструментов IB: только длинные позиции, без корп. действий и опционов
+NDFL_FIFO_VECTORIZED = False
+# Сколько примеров сообщений хранить для каждого вида диагностики расчёта (остальные только считаются)
+NDFL_DIAGNOSTICS_SAMPLE_SIZE = 5
+# Построение PDF-отчёта: 'xhtml2pdf' — из HTML-шаблона pdf_report.html, 'reportlab' — напрямую из flowables ReportLab
+NDFL_PDF_BACKEND = 'xhtml2pdf'
+# PDF ('reportlab') пишется во временный файл: до этого размера в памяти, больше — на диске
+NDFL_PDF_SPOOL_MAX_SIZE = 5 * 1024 * 1024
+# Длинные таблицы PDF ('reportlab') выводятся частями по столько строк: время вёрстки растёт линейно, а не квадратично
+NDFL_PDF_TABLE_CHUNK_ROWS = 100
+# Строить PDF-отчёт по разделам (сводка, 1530, 1532, дивиденды, РЕПО, прочие) и склеивать с оглавлением и номерами страниц
+NDFL_PDF_RENDER_BY_SECTIONS = False
+# При построении по разделам длинные разделы операций делятся на части примерно по столько операций
+NDFL_PDF_SECTION_MAX_EVENTS = 2000
+# Число процессов для построения частей PDF (1 — в текущем процессе)
+NDFL_PDF_RENDER_WORKERS = 1
+# Загрузка xhtml2pdf/ReportLab, шрифтов и шаблонов PDF: 'lazy' — при первом PDF (быстрый старт процесса),
+# 'eager' — при старте приложения (для gunicorn --preload). Сравнение: python manage.py benchmark_startup
+NDFL_PDF_WARMUP = os.environ.get('NDFL_PDF_WARMUP', 'lazy')
+
+# JSON API (reports_to_ndfl/api.py): доступ по JWT (POST /api/token/)
+REST_FRAMEWORK = {
+    'DEFAULT_AUTHENTICATION_CLASSES': [
+        'rest_framework_simplejwt.authentication.JWTAuthentication',
+    ],
+    'DEFAULT_PERMISSION_CLASSES': [
+        'rest_framework.permissions.IsAuthenticated',
+    ],
+}
+# Число потоков для расчётов, поставленных в очередь через API (0 — считать сразу в запросе)
+NDFL_API_PROCESSING_WORKERS = 2
+# Версия кода расчёта в сохранённых результатах (yearly_results.CALCULATOR_VERSION), например тег
+# релиза; без неё — хэш исходников расчёта, который считается один раз при старте процесса
+NDFL_CALCULATOR_VERSION = os.environ.get('NDFL_CALCULATOR_VERSION') or None
+
+# Метрики Prometheus (NDFL/metrics.py, страница /metrics/ для is_staff) настраиваются не здесь, а переменной
+# окружения PROMETHEUS_MULTIPROC_DIR: prometheus_client читает её при импорте и тогда суммирует значения всех
+# процессов (воркеры gunicorn, процессы пулов). Каталог нужно очищать перед каждым запуском приложения
@@ -5,11 +5,15 @@ from django.conf import settings # Для MEDIA_URL в DEBUG режиме
 from django.conf.urls.static import static # Для MEDIA_URL в DEBUG режиме
 from django.views.generic import RedirectView
 
+from .metrics import metrics_view
+
 urlpatterns = [
     path('', RedirectView.as_view(url='/reports/', permanent=False)),  # Редирект на главную
     path('admin/', admin.site.urls),
     path('reports/', include('reports_to_ndfl.urls')),
     path('currency/', include('currency_CBRF.urls')),
+    path('api/', include('reports_to_ndfl.api_urls')),  # JSON API (JWT)
+    path('metrics/', metrics_view, name='metrics'),  # Метрики Prometheus (только is_staff)
     path('accounts/', include('django.contrib.auth.urls')), # <--- ДОБАВИТЬ для стандартных URLов входа/выхода
 ]
 
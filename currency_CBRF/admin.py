@@ -1,3 +1,10 @@
+# currency_CBRF/admin.py
 from django.contrib import admin
 
-# Register your models here.
+from .models import RateSyncState
+
+
+@admin.register(RateSyncState)
+class RateSyncStateAdmin(admin.ModelAdmin):
+    list_display = ('currency', 'covered_from', 'covered_to', 'last_synced_at', 'last_rates_created', 'last_error')
+    readonly_fields = ('currency', 'covered_from', 'covered_to', 'last_synced_at', 'last_rates_created', 'last_error')
@@ -0,0 +1,146 @@
+# currency_CBRF/async_client.py
+import asyncio
+import functools
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.conf import settings
+
+from .services import _timed_cbr_get, parse_daily_rates_xml, parse_period_rates_xml
+
+
+class AsyncCBRClient:
+    """
+    Асинхронный клиент API ЦБ РФ для параллельной загрузки курсов.
+
+    Число одновременных запросов ограничено семафором (CBRF_API_CONCURRENCY).
+    HTTP-запросы и разбор XML в windows-1251 выполняются в пуле потоков,
+    поэтому event loop не блокируется. Клиент не обращается к БД:
+    сохранение курсов выполняет вызывающий код.
+
+    Использование:
+        async with AsyncCBRClient() as client:
+            results = await client.fetch_daily_many(dates)
+    """
+
+    def __init__(self, concurrency=None, base_url=None, timeout_daily=None, timeout_period=None):
+        self.concurrency = max(1, int(concurrency or getattr(settings, 'CBRF_API_CONCURRENCY', 8)))
+        self.base_url = base_url or getattr(settings, 'CBRF_API_BASE_URL', "http://www.cbr.ru/scripts/")
+        self.timeout_daily = timeout_daily or getattr(settings, 'CBRF_API_TIMEOUT_DAILY', 10)
+        self.timeout_period = timeout_period or getattr(settings, 'CBRF_API_TIMEOUT_PERIOD', 30)
+        self._executor = None
+        self._semaphore = None
+
+    async def __aenter__(self):
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='cbr-client')
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._executor.shutdown(wait=True)
+        self._executor = None
+        self._semaphore = None
+
+    async def _run_in_executor(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    async def _get_xml_content(self, url, params, timeout):
+        endpoint = 'dynamic' if url.endswith('XML_dynamic.asp') else 'daily'
+        async with self._semaphore:
+            response = await self._run_in_executor(_timed_cbr_get, endpoint, url, params, timeout)
+        return response.content
+
+    async def fetch_daily(self, date_obj=None):
+        """
+        Курсы всех валют на дату (XML_daily.asp).
+        Возвращает кортеж (parsed_rates_list, rates_date_object) или (None, None) при ошибке,
+        как и services.fetch_daily_rates, но без сохранения в БД.
+        """
+        params = {'date_req': date_obj.strftime('%d/%m/%Y')} if date_obj else {}
+        try:
+            content = await self._get_xml_content(self.base_url + "XML_daily.asp", params, self.timeout_daily)
+            return await self._run_in_executor(_parse_daily_content, content)
+        except (requests.exceptions.RequestException, ET.ParseError, UnicodeDecodeError):
+            return None, None
+
+    async def fetch_period(self, cbr_id, date_from, date_to):
+        """
+        Динамика курса одной валюты за период (XML_dynamic.asp).
+        Возвращает список словарей или None при ошибке, как services.fetch_period_rates.
+        """
+        params = {
+            'date_req1': date_from.strftime('%d/%m/%Y'),
+            'date_req2': date_to.strftime('%d/%m/%Y'),
+            'VAL_NM_RQ': cbr_id,
+        }
+        try:
+            content = await self._get_xml_content(self.base_url + "XML_dynamic.asp", params, self.timeout_period)
+            return await self._run_in_executor(_parse_period_content, content, cbr_id)
+        except (requests.exceptions.RequestException, ET.ParseError, UnicodeDecodeError):
+            return None
+
+    async def fetch_daily_many(self, dates):
+        """Параллельно загружает курсы на набор дат. Возвращает {date: (parsed_rates_list, rates_date_object)}."""
+        unique_dates = sorted(set(dates))
+        results = await asyncio.gather(*(self.fetch_daily(d) for d in unique_dates))
+        return dict(zip(unique_dates, results))
+
+    async def fetch_period_many(self, cbr_ids, date_from, date_to):
+        """Параллельно загружает динамику курсов по нескольким валютам. Возвращает {cbr_id: list | None}."""
+        unique_ids = list(dict.fromkeys(cbr_ids))
+        results = await asyncio.gather(*(self.fetch_period(cbr_id, date_from, date_to) for cbr_id in unique_ids))
+        return dict(zip(unique_ids, results))
+
+    async def fetch_period_ranges(self, period_requests):
+        """
+        Параллельно загружает динамику курсов для набора запросов (cbr_id, date_from, date_to).
+        Возвращает {(cbr_id, date_from, date_to): list | None}.
+        """
+        unique_requests = list(dict.fromkeys(period_requests))
+        results = await asyncio.gather(*(self.fetch_period(*period_request) for period_request in unique_requests))
+        return dict(zip(unique_requests, results))
+
+
+def _parse_daily_content(content):
+    return parse_daily_rates_xml(content.decode('windows-1251'))
+
+
+def _parse_period_content(content, cbr_id):
+    return parse_period_rates_xml(content.decode('windows-1251'), cbr_id)
+
+
+def _run_sync(coro):
+    """Выполняет корутину из синхронного кода (views, management-команды)."""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    # Уже внутри работающего event loop (например, под ASGI) — запускаем в отдельном потоке
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coro).result()
+
+
+def fetch_daily_rates_for_dates(dates, concurrency=None):
+    """Синхронная обертка над AsyncCBRClient.fetch_daily_many."""
+    async def _fetch():
+        async with AsyncCBRClient(concurrency=concurrency) as client:
+            return await client.fetch_daily_many(dates)
+    return _run_sync(_fetch())
+
+
+def fetch_period_rates_for_currencies(cbr_ids, date_from, date_to, concurrency=None):
+    """Синхронная обертка над AsyncCBRClient.fetch_period_many."""
+    async def _fetch():
+        async with AsyncCBRClient(concurrency=concurrency) as client:
+            return await client.fetch_period_many(cbr_ids, date_from, date_to)
+    return _run_sync(_fetch())
+
+
+def fetch_period_rates_for_ranges(period_requests, concurrency=None):
+    """Синхронная обертка над AsyncCBRClient.fetch_period_ranges."""
+    async def _fetch():
+        async with AsyncCBRClient(concurrency=concurrency) as client:
+            return await client.fetch_period_ranges(period_requests)
+    return _run_sync(_fetch())
@@ -1,7 +1,8 @@
 from django.core.management.base import BaseCommand, CommandError
 from django.utils import timezone
 from datetime import datetime, timedelta
-from currency_CBRF.services import fetch_daily_rates, fetch_period_rates
+from currency_CBRF.services import bump_rates_revision, fetch_daily_rates
+from currency_CBRF.async_client import fetch_daily_rates_for_dates, fetch_period_rates_for_currencies
 from currency_CBRF.models import Currency, ExchangeRate
 from decimal import Decimal
 
@@ -29,12 +30,25 @@ class Command(BaseCommand):
             type=str,
             help='Список кодов валют (CharCode) через запятую для загрузки (например, "USD,EUR"). По умолчанию все из БД.'
         )
+        parser.add_argument(
+            '--dates',
+            type=str,
+            help='Список дат в формате YYYY-MM-DD через запятую. Ежедневные курсы на эти даты загружаются параллельно.'
+        )
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=None,
+            help='Максимальное число одновременных запросов к ЦБ РФ (по умолчанию CBRF_API_CONCURRENCY).'
+        )
 
     def handle(self, *args, **options):
         target_date_str = options['date']
         start_date_str = options['start_date']
         end_date_str = options['end_date']
         currencies_str = options['currencies']
+        dates_str = options['dates']
+        self.concurrency = options['concurrency']
 
         target_currencies = None
         if currencies_str:
@@ -46,7 +60,9 @@ class Command(BaseCommand):
             target_currencies = Currency.objects.all()
 
 
-        if start_date_str and end_date_str:
+        if dates_str:
+            self._fetch_daily_rates_for_dates(dates_str)
+        elif start_date_str and end_date_str:
             self._fetch_historical_rates(start_date_str, end_date_str, target_currencies)
         elif target_date_str:
             try:
@@ -70,7 +86,29 @@ class Command(BaseCommand):
             return
 
         self.stdout.write(self.style.SUCCESS(f"Получены курсы на {rates_date_obj.strftime('%Y-%m-%d')}."))
+        self._save_daily_rates(daily_data, rates_date_obj)
+
+    def _fetch_daily_rates_for_dates(self, dates_str):
+        """Параллельная загрузка ежедневных курсов на список дат через AsyncCBRClient."""
+        try:
+            dates = sorted({datetime.strptime(d.strip(), '%Y-%m-%d').date() for d in dates_str.split(',') if d.strip()})
+        except ValueError:
+            raise CommandError(f"Неверный формат дат: {dates_str}. Используйте YYYY-MM-DD через запятую.")
+        if not dates:
+            raise CommandError("Не указано ни одной даты в --dates.")
+
+        self.stdout.write(f"Параллельный запрос ежедневных курсов на {len(dates)} дат(ы)...")
+        fetched_by_date = fetch_daily_rates_for_dates(dates, concurrency=self.concurrency)
+        for requested_date in dates:
+            daily_data, rates_date_obj = fetched_by_date.get(requested_date, (None, None))
+            if not daily_data or not rates_date_obj:
+                self.stdout.write(self.style.ERROR(f"Не удалось получить ежедневные курсы на {requested_date.strftime('%Y-%m-%d')}."))
+                continue
+            self.stdout.write(self.style.SUCCESS(f"Получены курсы на {rates_date_obj.strftime('%Y-%m-%d')} (запрошено {requested_date.strftime('%Y-%m-%d')})."))
+            self._save_daily_rates(daily_data, rates_date_obj)
 
+    def _save_daily_rates(self, daily_data, rates_date_obj):
+        """Сохраняет курсы, полученные из XML_daily.asp, с обновлением справочника валют."""
         saved_count = 0
         updated_count = 0
         new_currencies_count = 0
@@ -99,6 +137,8 @@ class Command(BaseCommand):
                 saved_count += 1
             else:
                 updated_count += 1
+        if daily_data:
+            bump_rates_revision([rates_date_obj])
         
         if new_currencies_count > 0:
             self.stdout.write(f"Добавлено новых валют в справочник: {new_currencies_count}.")
@@ -116,9 +156,6 @@ class Command(BaseCommand):
         if start_dt > end_dt:
             raise CommandError("Начальная дата периода не может быть позже конечной даты.")
 
-        cbr_start_date = start_dt.strftime('%d/%m/%Y')
-        cbr_end_date = end_dt.strftime('%d/%m/%Y')
-
         if not target_currencies_qs or not target_currencies_qs.exists():
             self.stdout.write(self.style.WARNING("Нет валют в БД для загрузки исторических данных. Сначала заполните справочник валют (например, запустив команду без параметров даты)."))
             return
@@ -126,13 +163,20 @@ class Command(BaseCommand):
         total_saved_for_period = 0
         total_updated_for_period = 0
 
+        currencies_with_ids = []
         for currency in target_currencies_qs:
             if not currency.cbr_id:
                 self.stdout.write(self.style.WARNING(f"У валюты {currency.char_code} отсутствует ID ЦБ РФ. Пропуск загрузки истории."))
                 continue
+            currencies_with_ids.append(currency)
+
+        self.stdout.write(f"Параллельный запрос истории для {len(currencies_with_ids)} валют(ы) за период {start_date_str} - {end_date_str}...")
+        period_data_by_cbr_id = fetch_period_rates_for_currencies(
+            [currency.cbr_id for currency in currencies_with_ids], start_dt, end_dt, concurrency=self.concurrency
+        )
 
-            self.stdout.write(f"Запрос истории для {currency.char_code} ({currency.cbr_id}) за период {start_date_str} - {end_date_str}...")
-            period_data = fetch_period_rates(currency.cbr_id, cbr_start_date, cbr_end_date)
+        for currency in currencies_with_ids:
+            period_data = period_data_by_cbr_id.get(currency.cbr_id)
 
             if period_data is None: 
                 self.stdout.write(self.style.ERROR(f"Ошибка при получении истории для {currency.char_code}."))
@@ -157,6 +201,7 @@ class Command(BaseCommand):
                     current_currency_saved += 1
                 else:
                     current_currency_updated += 1
+            bump_rates_revision(rate_data['date'] for rate_data in period_data)
             
             self.stdout.write(f"Для {currency.char_code}: сохранено новых курсов {current_currency_saved}, обновлено существующих {current_currency_updated}.")
             total_saved_for_period += current_currency_saved
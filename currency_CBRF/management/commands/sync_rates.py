@@ -0,0 +1,91 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+
+from currency_CBRF.services import sync_exchange_rates
+
+
+class Command(BaseCommand):
+    help = (
+        'Инкрементальная синхронизация курсов ЦБ РФ: загружает последние курсы, находит пропуски '
+        'за заданный горизонт и догружает их пачкой. С --daemon работает постоянно по расписанию.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--daemon',
+            action='store_true',
+            help='Работать постоянно, повторяя синхронизацию каждые --interval секунд.'
+        )
+        parser.add_argument(
+            '--interval',
+            type=int,
+            default=None,
+            help='Интервал между циклами синхронизации в секундах (по умолчанию CBRF_SYNC_INTERVAL_SECONDS).'
+        )
+        parser.add_argument(
+            '--horizon-days',
+            type=int,
+            default=None,
+            help='Глубина поиска пропусков в днях от последней даты курсов ЦБ (по умолчанию CBRF_SYNC_HORIZON_DAYS).'
+        )
+        parser.add_argument(
+            '--currencies',
+            type=str,
+            help='Список кодов валют (CharCode) через запятую (например, "USD,EUR"). По умолчанию CBRF_SYNC_CURRENCIES или все из БД.'
+        )
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=None,
+            help='Максимальное число одновременных запросов к ЦБ РФ (по умолчанию CBRF_API_CONCURRENCY).'
+        )
+
+    def handle(self, *args, **options):
+        interval = options['interval'] or getattr(settings, 'CBRF_SYNC_INTERVAL_SECONDS', 6 * 3600)
+        horizon_days = options['horizon_days'] or getattr(settings, 'CBRF_SYNC_HORIZON_DAYS', 1100)
+        if interval <= 0 or horizon_days <= 0:
+            raise CommandError("--interval и --horizon-days должны быть положительными.")
+
+        char_codes = getattr(settings, 'CBRF_SYNC_CURRENCIES', None)
+        if options['currencies']:
+            char_codes = [code.strip().upper() for code in options['currencies'].split(',') if code.strip()]
+
+        if not options['daemon']:
+            self._run_cycle(horizon_days, char_codes, options['concurrency'])
+            return
+
+        self.stdout.write(f"Запуск синхронизации курсов в режиме демона, интервал {interval} с.")
+        try:
+            while True:
+                close_old_connections()
+                try:
+                    self._run_cycle(horizon_days, char_codes, options['concurrency'])
+                except Exception as e:
+                    # Демон не должен завершаться из-за единичного сбоя (сеть, БД)
+                    self.stdout.write(self.style.ERROR(f"Ошибка цикла синхронизации: {e}"))
+                finally:
+                    close_old_connections()
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            self.stdout.write("Синхронизация курсов остановлена.")
+
+    def _run_cycle(self, horizon_days, char_codes, concurrency):
+        self.stdout.write(f"Синхронизация курсов за последние {horizon_days} дн....")
+        stats = sync_exchange_rates(horizon_days=horizon_days, char_codes=char_codes, concurrency=concurrency)
+        if stats.get('error'):
+            self.stdout.write(self.style.ERROR(stats['error']))
+            return stats
+
+        self.stdout.write(self.style.SUCCESS(f"Последние курсы ЦБ на {stats['rates_date'].strftime('%Y-%m-%d')}."))
+        if stats['new_currencies']:
+            self.stdout.write(f"Добавлено новых валют в справочник: {stats['new_currencies']}.")
+        self.stdout.write(
+            f"Проверено валют: {stats['currencies_checked']}, с пропусками: {stats['currencies_with_gaps']}. "
+            f"Сохранено курсов: {stats['daily_created'] + stats['backfilled']}."
+        )
+        if stats['failed_char_codes']:
+            self.stdout.write(self.style.WARNING(f"Не удалось догрузить пропуски для: {', '.join(stats['failed_char_codes'])}."))
+        return stats
@@ -0,0 +1,31 @@
+# Generated by Django 4.2.30 on 2026-10-19 00:01
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('currency_CBRF', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RateSyncState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('covered_from', models.DateField(blank=True, null=True, verbose_name='Сверено с')),
+                ('covered_to', models.DateField(blank=True, null=True, verbose_name='Сверено по')),
+                ('last_synced_at', models.DateTimeField(blank=True, null=True, verbose_name='Последняя синхронизация')),
+                ('last_rates_created', models.PositiveIntegerField(default=0, verbose_name='Создано курсов при последней синхронизации')),
+                ('last_error', models.CharField(blank=True, default='', max_length=255, verbose_name='Последняя ошибка')),
+                ('currency', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='sync_state', to='currency_CBRF.currency', verbose_name='Валюта')),
+            ],
+            options={
+                'verbose_name': 'Состояние синхронизации курсов',
+                'verbose_name_plural': 'Состояния синхронизации курсов',
+                'ordering': ['currency__char_code'],
+            },
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 4.2.30 on 2026-10-19 01:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('currency_CBRF', '0002_ratesyncstate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RatesRevision',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('year', models.IntegerField(unique=True, verbose_name='Год дат курсов')),
+                ('revision', models.PositiveBigIntegerField(default=0, verbose_name='Номер изменения')),
+            ],
+            options={
+                'verbose_name': 'Версия курсов за год',
+                'verbose_name_plural': 'Версии курсов по годам',
+                'ordering': ['year'],
+            },
+        ),
+    ]
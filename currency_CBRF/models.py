@@ -37,3 +37,43 @@ class ExchangeRate(models.Model):
         if self.nominal == 0: # Предотвращение деления на ноль
             return self.value 
         return self.value / self.nominal
+
+
+class RateSyncState(models.Model):
+    """
+    Состояние фоновой синхронизации курсов (manage.py sync_rates) по одной валюте.
+    Диапазон [covered_from, covered_to] уже сверен с ЦБ: каждый календарный день в нем
+    либо имеет курс в ExchangeRate, либо ЦБ курса для него не публиковал.
+    """
+    currency = models.OneToOneField(Currency, on_delete=models.CASCADE, related_name='sync_state', verbose_name="Валюта")
+    covered_from = models.DateField(null=True, blank=True, verbose_name="Сверено с")
+    covered_to = models.DateField(null=True, blank=True, verbose_name="Сверено по")
+    last_synced_at = models.DateTimeField(null=True, blank=True, verbose_name="Последняя синхронизация")
+    last_rates_created = models.PositiveIntegerField(default=0, verbose_name="Создано курсов при последней синхронизации")
+    last_error = models.CharField(max_length=255, blank=True, default='', verbose_name="Последняя ошибка")
+
+    class Meta:
+        verbose_name = "Состояние синхронизации курсов"
+        verbose_name_plural = "Состояния синхронизации курсов"
+        ordering = ['currency__char_code']
+
+    def __str__(self):
+        return f"{self.currency.char_code}: {self.covered_from} - {self.covered_to}"
+
+
+class RatesRevision(models.Model):
+    """
+    Счётчик изменений курсов ЦБ по годам дат курсов. Растёт при каждой записи в ExchangeRate
+    (services.bump_rates_revision); по нему сохранённые результаты расчёта узнают, что курсы,
+    на которых они посчитаны, изменились.
+    """
+    year = models.IntegerField(unique=True, verbose_name="Год дат курсов")
+    revision = models.PositiveBigIntegerField(default=0, verbose_name="Номер изменения")
+
+    class Meta:
+        verbose_name = "Версия курсов за год"
+        verbose_name_plural = "Версии курсов по годам"
+        ordering = ['year']
+
+    def __str__(self):
+        return f"{self.year}: {self.revision}"
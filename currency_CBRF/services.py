@@ -1,12 +1,54 @@
 # currency_CBRF/services.py
 import requests
 import xml.etree.ElementTree as ET
+from bisect import bisect_right
+from collections import defaultdict
 from decimal import Decimal, InvalidOperation
-from datetime import datetime
+from datetime import datetime, date, timedelta
+import time
 from django.conf import settings
+from django.db.models import F, Sum
+from django.utils import timezone
+
+from NDFL.metrics import CBR_REQUEST_SECONDS
 
 # Импортируем модели для сохранения данных
-from .models import Currency, ExchangeRate # <--- ДОБАВЛЕНО
+from .models import Currency, ExchangeRate, RateSyncState, RatesRevision # <--- ДОБАВЛЕНО
+
+# Максимальный разрыв (в днях), который заполняется последним опубликованным курсом.
+# Покрывает выходные и новогодние каникулы; более длинные разрывы не заполняются.
+MAX_CARRY_FORWARD_DAYS = 14
+
+
+def bump_rates_revision(rate_dates):
+    """Отмечает изменение курсов на даты rate_dates: увеличивает RatesRevision их годов."""
+    years = {rate_date.year for rate_date in rate_dates}
+    if not years:
+        return
+    RatesRevision.objects.bulk_create([RatesRevision(year=year) for year in years], ignore_conflicts=True)
+    RatesRevision.objects.filter(year__in=years).update(revision=F('revision') + 1)
+
+
+def rates_revision(year):
+    """
+    Версия курсов, от которых зависит расчёт за год year: сумма RatesRevision по годам до year + 1
+    включительно (ближайший предыдущий курс может быть из прошлых лет, расчёты начала следующего
+    года — из января). Не убывает: любая запись курса на такие даты её увеличивает.
+    """
+    return RatesRevision.objects.filter(year__lte=year + 1).aggregate(total=Sum('revision'))['total'] or 0
+
+
+def _timed_cbr_get(endpoint, url, params, timeout):
+    """GET к API ЦБ с ошибкой для HTTP-статусов 4xx/5xx; длительность пишется в CBR_REQUEST_SECONDS."""
+    outcome = 'error'
+    started = time.perf_counter()
+    try:
+        response = requests.get(url, params=params, timeout=timeout)
+        response.raise_for_status()
+        outcome = 'ok'
+        return response
+    finally:
+        CBR_REQUEST_SECONDS.labels(endpoint=endpoint, outcome=outcome).observe(time.perf_counter() - started)
 
 
 def fetch_daily_rates(date_str=None):
@@ -29,73 +71,32 @@ def fetch_daily_rates(date_str=None):
         except ValueError:
             return None, None
             
-    raw_parsed_rates_from_xml = [] # Список для данных, как они пришли из XML
-    successfully_saved_rate_char_codes = [] # Для логирования, какие курсы сохранены
-
     try:
-        response = requests.get(url, params=params, timeout=timeout_daily)
-        response.raise_for_status() 
+        response = _timed_cbr_get('daily', url, params, timeout_daily)
         response.encoding = 'windows-1251' 
         xml_data = response.text
-        root = ET.fromstring(xml_data)
-        rates_date_str_from_xml = root.get('Date')
-
-        if not rates_date_str_from_xml:
-            return None, None
-        
-        try:
-            rates_date_obj_from_xml = datetime.strptime(rates_date_str_from_xml, '%d.%m.%Y').date()
-        except ValueError:
+        raw_parsed_rates_from_xml, rates_date_obj_from_xml = parse_daily_rates_xml(xml_data)
+        if rates_date_obj_from_xml is None:
             return None, None
 
-        for valute_node in root.findall('Valute'):
-            cbr_id = valute_node.get('ID')
-            num_code_node = valute_node.find('NumCode')
-            char_code_node = valute_node.find('CharCode')
-            nominal_node = valute_node.find('Nominal')
-            name_node = valute_node.find('Name')
-            value_node = valute_node.find('Value')
-
-            num_code_text = num_code_node.text.strip() if num_code_node is not None and num_code_node.text else None
-            char_code_text = char_code_node.text.strip() if char_code_node is not None and char_code_node.text else None
-            nominal_text = nominal_node.text.strip() if nominal_node is not None and nominal_node.text else None
-            name_text = name_node.text.strip() if name_node is not None and name_node.text else None
-            value_text = value_node.text.strip() if value_node is not None and value_node.text else None
-
-            if not all([cbr_id, num_code_text, char_code_text, nominal_text, name_text, value_text]):
-                continue
-
-            try:
-                value_decimal = Decimal(value_text.replace(',', '.'))
-                nominal_int = int(nominal_text)
-                
-                # Собираем данные, как они пришли из XML
-                rate_data_from_xml = {
-                    'cbr_id': cbr_id, 'num_code': num_code_text, 'char_code': char_code_text,
-                    'nominal': nominal_int, 'name': name_text, 'value': value_decimal,
-                    'date': rates_date_obj_from_xml # Важно: это дата, на которую ЦБ дал курсы
-                }
-                raw_parsed_rates_from_xml.append(rate_data_from_xml)
-
-                # Пытаемся сохранить в БД
-                currency_model_instance = Currency.objects.filter(char_code=char_code_text).first()
-                if currency_model_instance:
-                    # Проверяем, существует ли уже такой курс, чтобы не создавать дубликаты
-                    # Используем дату, которую вернул ЦБ (rates_date_obj_from_xml)
-                    if not ExchangeRate.objects.filter(currency=currency_model_instance, date=rates_date_obj_from_xml).exists():
-                        ExchangeRate.objects.create(
-                            currency=currency_model_instance,
-                            date=rates_date_obj_from_xml, # Сохраняем на дату от ЦБ
-                            value=value_decimal,
-                            nominal=nominal_int
-                            # unit_rate будет вычисляться через @property в модели
-                        )
-                        successfully_saved_rate_char_codes.append(char_code_text)
-
-            except (InvalidOperation, ValueError) as e_convert:
-                continue 
-        
-
+        # Пытаемся сохранить в БД
+        rates_created = False
+        for rate_data_from_xml in raw_parsed_rates_from_xml:
+            currency_model_instance = Currency.objects.filter(char_code=rate_data_from_xml['char_code']).first()
+            if currency_model_instance:
+                # Проверяем, существует ли уже такой курс, чтобы не создавать дубликаты
+                # Используем дату, которую вернул ЦБ (rates_date_obj_from_xml)
+                if not ExchangeRate.objects.filter(currency=currency_model_instance, date=rates_date_obj_from_xml).exists():
+                    ExchangeRate.objects.create(
+                        currency=currency_model_instance,
+                        date=rates_date_obj_from_xml, # Сохраняем на дату от ЦБ
+                        value=rate_data_from_xml['value'],
+                        nominal=rate_data_from_xml['nominal']
+                        # unit_rate будет вычисляться через @property в модели
+                    )
+                    rates_created = True
+        if rates_created:
+            bump_rates_revision([rates_date_obj_from_xml])
 
         # Возвращаем список всех успешно распарсенных данных из XML и дату, на которую ЦБ дал эти курсы
         return raw_parsed_rates_from_xml, rates_date_obj_from_xml
@@ -111,6 +112,55 @@ def fetch_daily_rates(date_str=None):
     except Exception as e_unexpected:
         return None, None
 
+
+def parse_daily_rates_xml(xml_data):
+    """
+    Разбирает ответ XML_daily.asp (str или bytes в windows-1251) без обращения к БД.
+    Возвращает кортеж (parsed_rates_list, rates_date_object) или (None, None), если в ответе нет даты.
+    Исключение ET.ParseError пробрасывается вызывающему коду.
+    """
+    root = ET.fromstring(xml_data)
+    rates_date_str_from_xml = root.get('Date')
+    if not rates_date_str_from_xml:
+        return None, None
+    try:
+        rates_date_obj_from_xml = datetime.strptime(rates_date_str_from_xml, '%d.%m.%Y').date()
+    except ValueError:
+        return None, None
+
+    raw_parsed_rates_from_xml = [] # Список для данных, как они пришли из XML
+    for valute_node in root.findall('Valute'):
+        cbr_id = valute_node.get('ID')
+        num_code_node = valute_node.find('NumCode')
+        char_code_node = valute_node.find('CharCode')
+        nominal_node = valute_node.find('Nominal')
+        name_node = valute_node.find('Name')
+        value_node = valute_node.find('Value')
+
+        num_code_text = num_code_node.text.strip() if num_code_node is not None and num_code_node.text else None
+        char_code_text = char_code_node.text.strip() if char_code_node is not None and char_code_node.text else None
+        nominal_text = nominal_node.text.strip() if nominal_node is not None and nominal_node.text else None
+        name_text = name_node.text.strip() if name_node is not None and name_node.text else None
+        value_text = value_node.text.strip() if value_node is not None and value_node.text else None
+
+        if not all([cbr_id, num_code_text, char_code_text, nominal_text, name_text, value_text]):
+            continue
+
+        try:
+            value_decimal = Decimal(value_text.replace(',', '.'))
+            nominal_int = int(nominal_text)
+        except (InvalidOperation, ValueError) as e_convert:
+            continue
+
+        # Собираем данные, как они пришли из XML
+        raw_parsed_rates_from_xml.append({
+            'cbr_id': cbr_id, 'num_code': num_code_text, 'char_code': char_code_text,
+            'nominal': nominal_int, 'name': name_text, 'value': value_decimal,
+            'date': rates_date_obj_from_xml # Важно: это дата, на которую ЦБ дал курсы
+        })
+    return raw_parsed_rates_from_xml, rates_date_obj_from_xml
+
+
 # fetch_period_rates остается без изменений, так как он не используется для автоматического сохранения в текущей логике.
 # Если для него тоже нужно автосохранение, его нужно будет доработать аналогично.
 def fetch_period_rates(cbr_id, date_req1_str, date_req2_str):
@@ -126,27 +176,10 @@ def fetch_period_rates(cbr_id, date_req1_str, date_req2_str):
         datetime.strptime(date_req1_str, '%d/%m/%Y'); datetime.strptime(date_req2_str, '%d/%m/%Y')
     except ValueError:
         return None
-    parsed_rates = []
     try:
-        response = requests.get(url, params=params, timeout=timeout_period)
-        response.raise_for_status(); response.encoding = 'windows-1251'; xml_data = response.text
-        root = ET.fromstring(xml_data)
-        if not root.findall('Record'):
-            return parsed_rates 
-        for record_node in root.findall('Record'):
-            date_str_rec = record_node.get('Date')
-            nominal_node = record_node.find('Nominal'); value_node = record_node.find('Value')
-            nominal_text = nominal_node.text.strip() if nominal_node is not None and nominal_node.text else None
-            value_text = value_node.text.strip() if value_node is not None and value_node.text else None
-            if not all([date_str_rec, nominal_text, value_text]):
-                continue
-            try:
-                value = Decimal(value_text.replace(',', '.')); nominal = int(nominal_text)
-                record_date = datetime.strptime(date_str_rec, '%d.%m.%Y').date()
-                parsed_rates.append({'cbr_id': cbr_id, 'nominal': nominal, 'value': value, 'date': record_date})
-            except (InvalidOperation, ValueError) as e_convert_dyn:
-                continue
-        return parsed_rates
+        response = _timed_cbr_get('dynamic', url, params, timeout_period)
+        response.encoding = 'windows-1251'; xml_data = response.text
+        return parse_period_rates_xml(xml_data, cbr_id)
     except requests.exceptions.Timeout:
         return None
     except requests.exceptions.HTTPError as e:
@@ -157,3 +190,254 @@ def fetch_period_rates(cbr_id, date_req1_str, date_req2_str):
         return None
     except Exception as e:
         return None
+
+
+def parse_period_rates_xml(xml_data, cbr_id):
+    """
+    Разбирает ответ XML_dynamic.asp без обращения к БД.
+    Возвращает список словарей {cbr_id, nominal, value, date}; ET.ParseError пробрасывается.
+    """
+    parsed_rates = []
+    root = ET.fromstring(xml_data)
+    for record_node in root.findall('Record'):
+        date_str_rec = record_node.get('Date')
+        nominal_node = record_node.find('Nominal'); value_node = record_node.find('Value')
+        nominal_text = nominal_node.text.strip() if nominal_node is not None and nominal_node.text else None
+        value_text = value_node.text.strip() if value_node is not None and value_node.text else None
+        if not all([date_str_rec, nominal_text, value_text]):
+            continue
+        try:
+            value = Decimal(value_text.replace(',', '.')); nominal = int(nominal_text)
+            record_date = datetime.strptime(date_str_rec, '%d.%m.%Y').date()
+            parsed_rates.append({'cbr_id': cbr_id, 'nominal': nominal, 'value': value, 'date': record_date})
+        except (InvalidOperation, ValueError) as e_convert_dyn:
+            continue
+    return parsed_rates
+
+
+def save_daily_rates_bulk(fetched_by_date, alias_char_codes=None):
+    """
+    Сохраняет результаты параллельной загрузки ежедневных курсов одной пачкой.
+    fetched_by_date: {запрошенная дата: (parsed_rates_list, rates_date_object)}.
+    Курсы сохраняются на дату, которую вернул ЦБ. Если она отличается от запрошенной
+    (выходные, праздники), для валют из alias_char_codes дополнительно создается
+    запись-алиас на запрошенную дату — так же, как это делает _get_exchange_rate_for_date.
+    Существующие курсы не перезаписываются. Возвращает число созданных записей.
+    """
+    currencies_by_code = {c.char_code: c for c in Currency.objects.all()}
+    rates_to_create = {}
+    for requested_date, (parsed_rates_list, rates_date_obj) in fetched_by_date.items():
+        if not parsed_rates_list or not rates_date_obj:
+            continue
+        for rate_data in parsed_rates_list:
+            currency = currencies_by_code.get(rate_data['char_code'])
+            if currency is None:
+                continue
+            target_dates = [rates_date_obj]
+            if requested_date and requested_date != rates_date_obj and \
+               (alias_char_codes is None or currency.char_code in alias_char_codes):
+                target_dates.append(requested_date)
+            for target_date in target_dates:
+                rates_to_create.setdefault(
+                    (currency.id, target_date),
+                    ExchangeRate(currency=currency, date=target_date, value=rate_data['value'], nominal=rate_data['nominal'])
+                )
+    if not rates_to_create:
+        return 0
+
+    all_dates = [key[1] for key in rates_to_create]
+    existing_keys = set(
+        ExchangeRate.objects.filter(date__gte=min(all_dates), date__lte=max(all_dates))
+        .values_list('currency_id', 'date')
+    )
+    new_rates = [rate for key, rate in rates_to_create.items() if key not in existing_keys]
+    ExchangeRate.objects.bulk_create(new_rates, ignore_conflicts=True)
+    bump_rates_revision(rate.date for rate in new_rates)
+    return len(new_rates)
+
+
+def warm_up_exchange_rates(rate_requests, concurrency=None):
+    """
+    Предзагрузка курсов перед обработкой отчетов.
+    rate_requests: итерируемое пар (char_code, date | datetime).
+    Определяет даты, для которых в БД нет точного курса хотя бы одной из нужных валют,
+    параллельно загружает их с ЦБ (AsyncCBRClient) и сохраняет пачкой.
+    После этого _get_exchange_rate_for_date находит курсы в БД без последовательных запросов к ЦБ.
+    Возвращает число созданных записей ExchangeRate.
+    """
+    if not getattr(settings, 'CBRF_RATES_WARM_UP', True):
+        return 0
+
+    today = date.today()
+    codes_by_date = {}
+    for char_code, date_value in rate_requests:
+        if not char_code or not isinstance(date_value, date):
+            continue
+        char_code = char_code.strip().upper()
+        if char_code == 'RUB':
+            continue
+        if isinstance(date_value, datetime):
+            date_value = date_value.date()
+        if date_value > today:
+            continue
+        codes_by_date.setdefault(date_value, set()).add(char_code)
+    if not codes_by_date:
+        return 0
+
+    all_codes = set().union(*codes_by_date.values())
+    known_codes = set(Currency.objects.filter(char_code__in=all_codes).values_list('char_code', flat=True))
+    if not known_codes:
+        return 0
+    existing_pairs = set(
+        ExchangeRate.objects.filter(
+            currency__char_code__in=known_codes,
+            date__gte=min(codes_by_date), date__lte=max(codes_by_date),
+        ).values_list('currency__char_code', 'date')
+    )
+    missing_dates = [
+        date_value for date_value, codes in codes_by_date.items()
+        if any((code, date_value) not in existing_pairs for code in codes & known_codes)
+    ]
+    if not missing_dates:
+        return 0
+
+    from .async_client import fetch_daily_rates_for_dates
+    fetched_by_date = fetch_daily_rates_for_dates(missing_dates, concurrency=concurrency)
+    return save_daily_rates_bulk(fetched_by_date, alias_char_codes=known_codes)
+
+
+def find_missing_rate_dates(existing_dates, date_from, date_to, covered_from=None, covered_to=None):
+    """
+    Календарные дни диапазона [date_from, date_to], для которых в existing_dates нет курса
+    и которые не входят в уже сверенный с ЦБ диапазон [covered_from, covered_to].
+    """
+    missing_dates = []
+    current_date = date_from
+    while current_date <= date_to:
+        is_covered = covered_from is not None and covered_to is not None and covered_from <= current_date <= covered_to
+        if current_date not in existing_dates and not is_covered:
+            missing_dates.append(current_date)
+        current_date += timedelta(days=1)
+    return missing_dates
+
+
+def fill_rates_forward(published_rates, missing_dates, max_carry_forward_days=MAX_CARRY_FORWARD_DAYS):
+    """
+    Для каждой даты из missing_dates подбирает последний опубликованный ЦБ курс на дату <= нее —
+    так же, как XML_daily.asp отвечает на запрос за выходной или праздник.
+    published_rates: список словарей {date, value, nominal} (результат XML_dynamic.asp).
+    Возвращает {date: rate_dict}; даты без курса в пределах max_carry_forward_days пропускаются.
+    """
+    sorted_rates = sorted(published_rates, key=lambda rate: rate['date'])
+    published_dates = [rate['date'] for rate in sorted_rates]
+    filled_rates = {}
+    for missing_date in missing_dates:
+        idx = bisect_right(published_dates, missing_date) - 1
+        if idx >= 0 and (missing_date - published_dates[idx]).days <= max_carry_forward_days:
+            filled_rates[missing_date] = sorted_rates[idx]
+    return filled_rates
+
+
+def _update_currency_directory(parsed_rates_list):
+    """Добавляет в справочник валюты из ответа XML_daily.asp, которых в нем еще нет. Возвращает число добавленных."""
+    known_cbr_ids = set(Currency.objects.values_list('cbr_id', flat=True))
+    new_currencies = [
+        Currency(cbr_id=rate_data['cbr_id'], char_code=rate_data['char_code'],
+                 num_code=rate_data['num_code'], name=rate_data['name'])
+        for rate_data in parsed_rates_list if rate_data['cbr_id'] not in known_cbr_ids
+    ]
+    Currency.objects.bulk_create(new_currencies, ignore_conflicts=True)
+    return len(new_currencies)
+
+
+def sync_exchange_rates(horizon_days=None, char_codes=None, concurrency=None):
+    """
+    Один цикл инкрементальной синхронизации курсов (manage.py sync_rates):
+    1. Загружает последние ежедневные курсы ЦБ и пополняет справочник валют.
+    2. По каждой валюте ищет дни без курса за последние horizon_days дней
+       (вне диапазона, уже сверенного при прошлых запусках).
+    3. Догружает пропуски одним запросом XML_dynamic.asp на валюту (параллельно, AsyncCBRClient)
+       и сохраняет пачкой; выходные и праздники заполняются последним опубликованным курсом.
+    4. Записывает состояние синхронизации по каждой валюте в RateSyncState.
+    Возвращает словарь со статистикой; если ЦБ недоступен — словарь с ключом 'error'.
+    """
+    horizon_days = horizon_days or getattr(settings, 'CBRF_SYNC_HORIZON_DAYS', 1100)
+
+    latest_rates, latest_date = fetch_daily_rates()
+    if not latest_rates or not latest_date:
+        return {'error': "Не удалось получить последние курсы ЦБ РФ."}
+    new_currencies_count = _update_currency_directory(latest_rates)
+    daily_created = save_daily_rates_bulk({latest_date: (latest_rates, latest_date)})
+
+    currencies = Currency.objects.all()
+    if char_codes:
+        currencies = currencies.filter(char_code__in=[code.strip().upper() for code in char_codes])
+    currencies = list(currencies)
+
+    horizon_from = latest_date - timedelta(days=horizon_days)
+    existing_dates_by_currency = defaultdict(set)
+    for currency_id, rate_date in ExchangeRate.objects.filter(
+        currency__in=currencies, date__gte=horizon_from, date__lte=latest_date
+    ).values_list('currency_id', 'date'):
+        existing_dates_by_currency[currency_id].add(rate_date)
+    states_by_currency = {state.currency_id: state for state in RateSyncState.objects.filter(currency__in=currencies)}
+
+    missing_by_currency = {}
+    period_request_by_currency = {}
+    for currency in currencies:
+        state = states_by_currency.get(currency.id)
+        missing_dates = find_missing_rate_dates(
+            existing_dates_by_currency[currency.id], horizon_from, latest_date,
+            state.covered_from if state else None, state.covered_to if state else None,
+        )
+        if missing_dates:
+            missing_by_currency[currency.id] = missing_dates
+            period_request_by_currency[currency.id] = (
+                currency.cbr_id, missing_dates[0] - timedelta(days=MAX_CARRY_FORWARD_DAYS), missing_dates[-1]
+            )
+
+    fetched_periods = {}
+    if period_request_by_currency:
+        from .async_client import fetch_period_rates_for_ranges
+        fetched_periods = fetch_period_rates_for_ranges(list(period_request_by_currency.values()), concurrency=concurrency)
+
+    synced_at = timezone.now()
+    rates_to_create = []
+    failed_char_codes = []
+    for currency in currencies:
+        state = states_by_currency.get(currency.id) or RateSyncState(currency=currency)
+        state.last_synced_at = synced_at
+        state.last_rates_created = 0
+        missing_dates = missing_by_currency.get(currency.id)
+        if missing_dates:
+            period_data = fetched_periods.get(period_request_by_currency[currency.id])
+            if period_data is None:
+                state.last_error = "Ошибка загрузки динамики курса с ЦБ РФ."
+                state.save()
+                failed_char_codes.append(currency.char_code)
+                continue
+            for rate_date, rate_data in fill_rates_forward(period_data, missing_dates).items():
+                rates_to_create.append(ExchangeRate(currency=currency, date=rate_date, value=rate_data['value'], nominal=rate_data['nominal']))
+                state.last_rates_created += 1
+
+        # Весь горизонт [horizon_from, latest_date] теперь сверен с ЦБ
+        if state.covered_from and state.covered_to and state.covered_to >= horizon_from - timedelta(days=1):
+            state.covered_from = min(state.covered_from, horizon_from)
+        else:
+            state.covered_from = horizon_from
+        state.covered_to = max(state.covered_to or latest_date, latest_date)
+        state.last_error = ''
+        state.save()
+
+    ExchangeRate.objects.bulk_create(rates_to_create, ignore_conflicts=True, batch_size=1000)
+    bump_rates_revision(rate.date for rate in rates_to_create)
+
+    return {
+        'rates_date': latest_date,
+        'new_currencies': new_currencies_count,
+        'daily_created': daily_created,
+        'currencies_checked': len(currencies),
+        'currencies_with_gaps': len(period_request_by_currency),
+        'backfilled': len(rates_to_create),
+        'failed_char_codes': failed_char_codes,
+    }
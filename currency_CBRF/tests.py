@@ -1,3 +1,201 @@
-from django.test import TestCase
+import asyncio
+import threading
+import time
+from datetime import date, timedelta
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from django.test import SimpleTestCase, TestCase
+
+from .async_client import AsyncCBRClient, fetch_daily_rates_for_dates
+from .models import Currency, ExchangeRate, RateSyncState, RatesRevision
+from .services import (
+    fetch_daily_rates, fill_rates_forward, find_missing_rate_dates, parse_daily_rates_xml, sync_exchange_rates,
+    warm_up_exchange_rates,
+)
+
+
+def _daily_xml(date_str, usd_value="90,1234"):
+    return (
+        '<?xml version="1.0" encoding="windows-1251"?>'
+        f'<ValCurs Date="{date_str}" name="Foreign Currency Market">'
+        '<Valute ID="R01235"><NumCode>840</NumCode><CharCode>USD</CharCode>'
+        f'<Nominal>1</Nominal><Name>Доллар США</Name><Value>{usd_value}</Value></Valute>'
+        '<Valute ID="R01375"><NumCode>156</NumCode><CharCode>CNY</CharCode>'
+        '<Nominal>10</Nominal><Name>Китайский юань</Name><Value>125,5000</Value></Valute>'
+        '</ValCurs>'
+    ).encode('windows-1251')
+
+
+class _FakeResponse:
+    def __init__(self, content):
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode('windows-1251')
+
+    def raise_for_status(self):
+        pass
+
+
+class CBRDailyXmlParsingTests(SimpleTestCase):
+    def test_parse_daily_rates_xml_decodes_windows_1251(self):
+        rates, rates_date = parse_daily_rates_xml(_daily_xml("02.02.2024").decode('windows-1251'))
+
+        self.assertEqual(rates_date, date(2024, 2, 2))
+        by_code = {r['char_code']: r for r in rates}
+        self.assertEqual(by_code['USD']['value'], Decimal("90.1234"))
+        self.assertEqual(by_code['USD']['name'], "Доллар США")
+        self.assertEqual(by_code['CNY']['nominal'], 10)
+
+
+class AsyncCBRClientTests(SimpleTestCase):
+    def test_fetch_daily_many_respects_concurrency_limit(self):
+        lock = threading.Lock()
+        state = {'active': 0, 'max_active': 0}
+
+        def fake_get(url, params=None, timeout=None):
+            with lock:
+                state['active'] += 1
+                state['max_active'] = max(state['max_active'], state['active'])
+            time.sleep(0.02)
+            with lock:
+                state['active'] -= 1
+            day, month, year = params['date_req'].split('/')
+            return _FakeResponse(_daily_xml(f"{day}.{month}.{year}"))
+
+        dates = [date(2024, 1, d) for d in range(9, 19)]
+        with mock.patch('currency_CBRF.async_client.requests.get', side_effect=fake_get):
+            results = fetch_daily_rates_for_dates(dates, concurrency=3)
+
+        self.assertEqual(set(results), set(dates))
+        self.assertTrue(all(results[d][1] == d for d in dates))
+        self.assertLessEqual(state['max_active'], 3)
+        self.assertGreater(state['max_active'], 1)
+
+    def test_fetch_daily_returns_none_on_broken_xml(self):
+        async def run():
+            async with AsyncCBRClient(concurrency=1) as client:
+                return await client.fetch_daily(date(2024, 1, 9))
+
+        with mock.patch('currency_CBRF.async_client.requests.get', return_value=_FakeResponse(b'<ValCurs')):
+            self.assertEqual(asyncio.run(run()), (None, None))
+
+
+class WarmUpExchangeRatesTests(TestCase):
+    def setUp(self):
+        self.usd = Currency.objects.create(name="Доллар США", char_code="USD", num_code="840", cbr_id="R01235")
+        ExchangeRate.objects.create(currency=self.usd, date=date(2024, 1, 9), value=Decimal("89.0"), nominal=1)
+
+    def test_warm_up_fetches_only_missing_dates_and_creates_aliases(self):
+        def fake_fetch(dates, concurrency=None):
+            # Суббота 13.01 -> ЦБ возвращает курсы на 12.01
+            return {d: parse_daily_rates_xml(_daily_xml("12.01.2024").decode('windows-1251')) for d in dates}
+
+        with mock.patch('currency_CBRF.async_client.fetch_daily_rates_for_dates', side_effect=fake_fetch) as fetch_mock:
+            created = warm_up_exchange_rates([
+                ('USD', date(2024, 1, 9)),
+                ('usd', date(2024, 1, 13)),
+                ('RUB', date(2024, 1, 10)),
+            ])
+
+        fetch_mock.assert_called_once()
+        self.assertEqual(fetch_mock.call_args[0][0], [date(2024, 1, 13)])
+        self.assertEqual(created, 2)
+        self.assertTrue(ExchangeRate.objects.filter(currency=self.usd, date=date(2024, 1, 12)).exists())
+        alias = ExchangeRate.objects.get(currency=self.usd, date=date(2024, 1, 13))
+        self.assertEqual(alias.value, Decimal("90.1234"))
+        self.assertFalse(Currency.objects.filter(char_code="CNY").exists())
+
+    def test_warm_up_skips_network_when_rates_present(self):
+        with mock.patch('currency_CBRF.async_client.fetch_daily_rates_for_dates') as fetch_mock:
+            self.assertEqual(warm_up_exchange_rates([('USD', date(2024, 1, 9))]), 0)
+        fetch_mock.assert_not_called()
+
+
+class FetchDailyRatesTests(TestCase):
+    def test_rates_revision_bumped_once_per_response(self):
+        for name, char_code, num_code, cbr_id in (("Доллар США", "USD", "840", "R01235"), ("Китайский юань", "CNY", "156", "R01375")):
+            Currency.objects.create(name=name, char_code=char_code, num_code=num_code, cbr_id=cbr_id)
+
+        with mock.patch('currency_CBRF.services.requests.get', return_value=_FakeResponse(_daily_xml("02.02.2024"))):
+            rates, rates_date = fetch_daily_rates("02/02/2024")
+
+        self.assertEqual((len(rates), rates_date), (2, date(2024, 2, 2)))
+        self.assertEqual(ExchangeRate.objects.filter(date=date(2024, 2, 2)).count(), 2)
+        self.assertEqual(RatesRevision.objects.get(year=2024).revision, 1)
+
+
+class RateGapDetectionTests(SimpleTestCase):
+    def test_find_missing_rate_dates_skips_existing_and_covered_days(self):
+        existing = {date(2024, 1, 2), date(2024, 1, 3)}
+        missing = find_missing_rate_dates(
+            existing, date(2024, 1, 1), date(2024, 1, 8),
+            covered_from=date(2024, 1, 5), covered_to=date(2024, 1, 6),
+        )
+        self.assertEqual(missing, [date(2024, 1, 1), date(2024, 1, 4), date(2024, 1, 7), date(2024, 1, 8)])
+
+    def test_fill_rates_forward_uses_last_published_rate(self):
+        published = [
+            {'date': date(2024, 1, 13), 'value': Decimal("89.6883"), 'nominal': 1},
+            {'date': date(2023, 12, 30), 'value': Decimal("89.6883"), 'nominal': 1},
+            {'date': date(2024, 1, 10), 'value': Decimal("90.0000"), 'nominal': 1},
+        ]
+        filled = fill_rates_forward(published, [date(2023, 12, 29), date(2024, 1, 1), date(2024, 1, 11), date(2024, 2, 20)])
+
+        self.assertNotIn(date(2023, 12, 29), filled)
+        self.assertEqual(filled[date(2024, 1, 1)]['date'], date(2023, 12, 30))
+        self.assertEqual(filled[date(2024, 1, 11)]['value'], Decimal("90.0000"))
+        # Разрыв больше MAX_CARRY_FORWARD_DAYS не заполняется
+        self.assertNotIn(date(2024, 2, 20), filled)
+
+
+class SyncExchangeRatesTests(TestCase):
+    def setUp(self):
+        self.usd = Currency.objects.create(name="Доллар США", char_code="USD", num_code="840", cbr_id="R01235")
+        self.latest_date = date(2024, 1, 12)
+        self.latest_rates = parse_daily_rates_xml(_daily_xml("12.01.2024").decode('windows-1251'))
+
+    def _fake_periods(self, period_requests, concurrency=None):
+        result = {}
+        for cbr_id, date_from, date_to in period_requests:
+            records = []
+            current = date_from
+            while current <= date_to:
+                if current.weekday() not in (0, 6):  # ЦБ не публикует курсы на воскресенье и понедельник
+                    records.append({'cbr_id': cbr_id, 'nominal': 1, 'value': Decimal("90"), 'date': current})
+                current += timedelta(days=1)
+            result[(cbr_id, date_from, date_to)] = records
+        return result
+
+    def test_sync_backfills_gaps_and_records_state(self):
+        with mock.patch('currency_CBRF.services.fetch_daily_rates', return_value=self.latest_rates), \
+             mock.patch('currency_CBRF.async_client.fetch_period_rates_for_ranges', side_effect=self._fake_periods) as periods_mock:
+            stats = sync_exchange_rates(horizon_days=10)
+
+        self.assertEqual(stats['rates_date'], self.latest_date)
+        self.assertEqual(stats['new_currencies'], 1)
+        requested = {request[0] for request in periods_mock.call_args[0][0]}
+        self.assertEqual(requested, {"R01235", "R01375"})
+        # Все календарные дни горизонта, включая воскресенье и понедельник, имеют курс
+        usd_dates = set(ExchangeRate.objects.filter(currency=self.usd).values_list('date', flat=True))
+        for offset in range(11):
+            self.assertIn(self.latest_date - timedelta(days=offset), usd_dates)
+
+        state = RateSyncState.objects.get(currency=self.usd)
+        self.assertEqual(state.covered_from, date(2024, 1, 2))
+        self.assertEqual(state.covered_to, self.latest_date)
+        self.assertEqual(state.last_error, '')
+
+        with mock.patch('currency_CBRF.services.fetch_daily_rates', return_value=self.latest_rates), \
+             mock.patch('currency_CBRF.async_client.fetch_period_rates_for_ranges') as periods_mock:
+            stats = sync_exchange_rates(horizon_days=10)
+        periods_mock.assert_not_called()
+        self.assertEqual(stats['backfilled'], 0)
+
+    def test_sync_reports_error_when_cbr_unavailable(self):
+        with mock.patch('currency_CBRF.services.fetch_daily_rates', return_value=(None, None)):
+            stats = sync_exchange_rates(horizon_days=10)
+        self.assertIn('error', stats)
+        self.assertFalse(RateSyncState.objects.exists())
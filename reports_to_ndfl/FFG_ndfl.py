@@ -3,7 +3,7 @@
 from django.contrib import messages
 import xml.etree.ElementTree as ET
 from datetime import datetime, date
-from collections import defaultdict, deque
+from collections import defaultdict, deque, namedtuple
 import re
 import json
 from decimal import Decimal, InvalidOperation, ROUND_HALF_UP, Context
@@ -14,14 +14,19 @@ from decimal import Decimal, InvalidOperation, ROUND_HALF_UP, Context
 # то импорты будут выглядеть так:
 from .models import UploadedXMLFile
 from currency_CBRF.models import Currency, ExchangeRate
-from currency_CBRF.services import fetch_daily_rates
+from currency_CBRF.services import bump_rates_revision, fetch_daily_rates, warm_up_exchange_rates
+from NDFL.metrics import RATE_LOOKUPS
+from .fifo_pool import fifo_worker_count, run_in_process_pool, split_families_into_buckets
+from .description_rules import parse_full_conversion_comment
+from .dividend_index import DividendIndex
+from .instrument_lineage import InstrumentLineage, is_relevance_pruning_enabled
+from .run_context import RunContext
 
 
 decimal_context = Context(prec=36, rounding=ROUND_HALF_UP)
 
 PARSING_ERROR_MARKER = "CA_PARSING_ERROR"
 NOT_A_RELEVANT_CONVERSION_MARKER = "CA_NOT_RELEVANT_CONVERSION"
-_processing_had_error = [False] # Общий флаг ошибки для всего процесса
 
 
 def _get_report_file_field(file_instance):
@@ -31,18 +36,22 @@ def _get_report_file_field(file_instance):
         return file_instance.report_file
     return None
 
-def _get_exchange_rate_for_date(request, currency_obj, target_date_obj, rate_purpose_message=""):
+def _get_exchange_rate_for_date(run_context, currency_obj, target_date_obj, rate_purpose_message=""):
     if not isinstance(target_date_obj, date):
         return None, False, None
 
     exact_rate_obj = ExchangeRate.objects.filter(currency=currency_obj, date=target_date_obj).first()
-    if exact_rate_obj: return exact_rate_obj, True, exact_rate_obj.unit_rate
+    if exact_rate_obj:
+        RATE_LOOKUPS.labels(result='exact').inc()
+        return exact_rate_obj, True, exact_rate_obj.unit_rate
 
     cbr_date_str_to_fetch = target_date_obj.strftime('%d/%m/%Y')
     parsed_rates_list_from_service, actual_rates_date_from_cbr = fetch_daily_rates(cbr_date_str_to_fetch)
     if actual_rates_date_from_cbr:
         rate_on_target_date_after_fetch = ExchangeRate.objects.filter(currency=currency_obj, date=target_date_obj).first()
-        if rate_on_target_date_after_fetch: return rate_on_target_date_after_fetch, True, rate_on_target_date_after_fetch.unit_rate
+        if rate_on_target_date_after_fetch:
+            RATE_LOOKUPS.labels(result='fetched').inc()
+            return rate_on_target_date_after_fetch, True, rate_on_target_date_after_fetch.unit_rate
         if actual_rates_date_from_cbr != target_date_obj:
             rate_data_for_alias_creation = None
             if parsed_rates_list_from_service:
@@ -51,44 +60,83 @@ def _get_exchange_rate_for_date(request, currency_obj, target_date_obj, rate_pur
                         rate_data_for_alias_creation = rate_info; break
             if rate_data_for_alias_creation:
                 try:
-                    aliased_rate, _ = ExchangeRate.objects.get_or_create(
+                    aliased_rate, alias_created = ExchangeRate.objects.get_or_create(
                         currency=currency_obj, date=target_date_obj,
                         defaults={'value': rate_data_for_alias_creation['value'], 'nominal': rate_data_for_alias_creation['nominal']}
                     )
+                    if alias_created:
+                        bump_rates_revision([target_date_obj])
                     # Убрано уведомление об алиасе курса
+                    RATE_LOOKUPS.labels(result='alias').inc()
                     return aliased_rate, True, aliased_rate.unit_rate
                 except KeyError as e_key: pass
                 except Exception as e_alias: pass
 
     final_fallback_rate = ExchangeRate.objects.filter(currency=currency_obj, date__lte=target_date_obj).order_by('-date').first()
     if final_fallback_rate:
-        if final_fallback_rate.date != target_date_obj: messages.info(request, f"Для {currency_obj.char_code} на {target_date_obj.strftime('%d.%m.%Y')} {rate_purpose_message} используется ближайший курс от {final_fallback_rate.date.strftime('%d.%m.%Y')}.")
+        if final_fallback_rate.date != target_date_obj:
+            run_context.diagnostics.add(
+                f"Для {currency_obj.char_code} на {target_date_obj.strftime('%d.%m.%Y')} {rate_purpose_message} используется ближайший курс от {final_fallback_rate.date.strftime('%d.%m.%Y')}.",
+                messages.INFO,
+                kind=('nearest_rate', currency_obj.char_code),
+                summary=f"Для {{count}} операций в {currency_obj.char_code} использован ближайший предыдущий курс ЦБ.",
+            )
+        RATE_LOOKUPS.labels(result='exact' if final_fallback_rate.date == target_date_obj else 'nearest').inc()
         return final_fallback_rate, final_fallback_rate.date == target_date_obj, final_fallback_rate.unit_rate
 
     message_to_user = f"Курс для {currency_obj.char_code} на {target_date_obj.strftime('%d.%m.%Y')} {rate_purpose_message} не найден."
-    if not actual_rates_date_from_cbr : message_to_user = f"Критическая ошибка при загрузке с ЦБ. {message_to_user}"; messages.error(request, message_to_user)
-    else: messages.warning(request, message_to_user)
+    if not actual_rates_date_from_cbr:
+        run_context.diagnostics.add(
+            f"Критическая ошибка при загрузке с ЦБ. {message_to_user}", messages.ERROR,
+            kind=('cbr_unavailable', currency_obj.char_code),
+            summary=f"Курсы ЦБ не загрузились: для {{count}} операций в {currency_obj.char_code} курс не найден.",
+        )
+    else:
+        run_context.diagnostics.add(
+            message_to_user, messages.WARNING,
+            kind=('missing_rate', currency_obj.char_code),
+            summary=f"Курс ЦБ не найден для {{count}} операций в {currency_obj.char_code}.",
+        )
+    RATE_LOOKUPS.labels(result='missing').inc()
     return None, False, None
 
+def _collect_rate_requests_from_root(root):
+    """Собирает пары (валюта, дата) из узлов отчета FFG для предзагрузки курсов ЦБ."""
+    rate_requests = set()
+    for node_element in root.iter('node'):
+        date_text = (node_element.findtext('date') or '').strip()
+        if not date_text:
+            continue
+        try:
+            node_date = datetime.strptime(date_text.split(' ')[0], '%Y-%m-%d').date()
+        except ValueError:
+            continue
+        for currency_tag in ('curr_c', 'currency', 'commission_currency'):
+            currency_code = (node_element.findtext(currency_tag) or '').strip().upper()
+            if currency_code:
+                rate_requests.add((currency_code, node_date))
+    return rate_requests
+
 def _parse_full_conversion_comment(comment_str):
-    if not comment_str: return None
-    pattern = re.compile(
-        r"Conversion of securities\s+"
-        r"(?P<old_ticker>[A-Z0-9\.\-\_]+)\s*\((?P<old_isin>[A-Z0-9]+)\)\s*->\s*"
-        r"(?P<new_ticker>[A-Z0-9\.\-\_]+)\s*\((?P<new_isin>[A-Z0-9]+)\)",
-        re.IGNORECASE
-    )
-    match = pattern.search(comment_str)
-    if match:
-        return {
-            'old_ticker': match.group('old_ticker').strip(), 'old_isin': match.group('old_isin').strip(),
-            'new_ticker': match.group('new_ticker').strip(), 'new_isin': match.group('new_isin').strip(),
-        }
-    return None
+    # Разбор запоминается в description_rules; копия — чтобы вызывающий код не менял общий результат
+    details = parse_full_conversion_comment(comment_str)
+    return dict(details) if details else None
 
-def _extract_ca_nodes_from_file(file_instance):
+def _extract_ca_nodes_from_root(root, file_instance):
     ca_nodes_in_file = []
     corp_action_tags = ['date', 'type', 'type_id', 'corporate_action_id', 'amount', 'asset_type', 'ticker', 'isin', 'currency', 'ex_date', 'comment']
+    corp_actions_element = root.find('.//corporate_actions')
+    if corp_actions_element:
+        detailed_corp_element = corp_actions_element.find('detailed')
+        if detailed_corp_element:
+            for node_element in detailed_corp_element.findall('node'):
+                ca_data_item = {tag: (node_element.findtext(tag, '').strip() if node_element.find(tag) is not None else None) for tag in corp_action_tags}
+                ca_data_item['file_source'] = f"{file_instance.original_filename} (за {file_instance.year})"
+                ca_nodes_in_file.append(ca_data_item)
+    return ca_nodes_in_file
+
+def _extract_ca_nodes_from_file(file_instance):
+    ca_nodes_in_file = []
     try:
         file_field = _get_report_file_field(file_instance)
         if not file_field:
@@ -100,20 +148,68 @@ def _extract_ca_nodes_from_file(file_instance):
             except UnicodeDecodeError: xml_string_loop = content_bytes.decode('windows-1251', errors='replace')
 
             if xml_string_loop:
-                root = ET.fromstring(xml_string_loop)
-                corp_actions_element = root.find('.//corporate_actions')
-                if corp_actions_element:
-                    detailed_corp_element = corp_actions_element.find('detailed')
-                    if detailed_corp_element:
-                        for node_element in detailed_corp_element.findall('node'):
-                            ca_data_item = {tag: (node_element.findtext(tag, '').strip() if node_element.find(tag) is not None else None) for tag in corp_action_tags}
-                            ca_data_item['file_source'] = f"{file_instance.original_filename} (за {file_instance.year})"
-                            ca_nodes_in_file.append(ca_data_item)
+                ca_nodes_in_file = _extract_ca_nodes_from_root(ET.fromstring(xml_string_loop), file_instance)
     except Exception as e:
         pass
     return ca_nodes_in_file
 
-def _parse_and_validate_ca_node_on_demand(request, raw_ca_node_data, ca_nodes_from_same_file, _processing_had_error):
+def _collect_target_year_sales_from_root(root, target_report_year):
+    """ISIN бумаг (instr_type=1), проданных в целевом году, по разделу trades/detailed отчёта."""
+    sold_isins = set()
+    trades_element_scan = root.find('.//trades')
+    if not trades_element_scan:
+        return sold_isins
+    detailed_element_scan = trades_element_scan.find('detailed')
+    if not detailed_element_scan:
+        return sold_isins
+    for node_element_scan in detailed_element_scan.findall('node'):
+        instr_type_el_sale = node_element_scan.find('instr_type')
+        if instr_type_el_sale is None or instr_type_el_sale.text != '1': continue
+        operation_el = node_element_scan.find('operation')
+        isin_el_sale = node_element_scan.find('isin')
+        isin_to_check_sale = isin_el_sale.text.strip() if isin_el_sale is not None and isin_el_sale.text and isin_el_sale.text.strip() != '-' else None
+        if not isin_to_check_sale:
+            isin_el_sale_nb = node_element_scan.find('issue_nb')
+            isin_to_check_sale = isin_el_sale_nb.text.strip() if isin_el_sale_nb is not None and isin_el_sale_nb.text and isin_el_sale_nb.text.strip() != '-' else None
+
+        if (operation_el is not None and operation_el.text and operation_el.text.strip().lower() == 'sell' and isin_to_check_sale):
+            # Проверяем дату продажи, чтобы она была в целевом году
+            date_str_sale_scan = node_element_scan.findtext('date')
+            if date_str_sale_scan:
+                try:
+                    if datetime.strptime(date_str_sale_scan, '%Y-%m-%d %H:%M:%S').year == target_report_year:
+                        sold_isins.add(isin_to_check_sale)
+                except ValueError:
+                    pass
+    return sold_isins
+
+def _build_isin_lineage(file_ca_nodes_cache):
+    """Семейства ISIN, связанных конвертациями, по уже извлеченным узлам корп. действий (без чтения файлов)."""
+    isin_lineage = InstrumentLineage()
+    for ca_nodes in file_ca_nodes_cache.values():
+        for raw_ca_item_data in ca_nodes:
+            if raw_ca_item_data.get('type_id') != 'conversion':
+                continue
+            conversion_details = _parse_full_conversion_comment(raw_ca_item_data.get('comment') or '')
+            if conversion_details:
+                isin_lineage.union(conversion_details['old_isin'], conversion_details['new_isin'], raw_ca_item_data.get('isin'))
+    return isin_lineage
+
+def _select_relevant_fifo_operations(operations, target_report_year, sold_isins_in_target_year, isin_lineage):
+    """
+    Оставляет операции только по ISIN из семейств продаж целевого года.
+    Возвращает (отобранные операции, множество ISIN этих семейств).
+    """
+    seed_isins = set(sold_isins_in_target_year)
+    for op in operations:
+        op_datetime_obj = op.get('datetime_obj')
+        if op.get('operation_type') == 'sell' and op_datetime_obj and op_datetime_obj.year == target_report_year:
+            seed_isins.add(op.get('isin'))
+
+    relevant_isins = isin_lineage.family_members(seed_isins)
+    return [op for op in operations if op.get('isin') in relevant_isins], relevant_isins
+
+def _parse_and_validate_ca_node_on_demand(request, raw_ca_node_data, ca_nodes_from_same_file, run_context):
     if not (raw_ca_node_data.get('type_id') == 'conversion' and \
             'Бумаги' in raw_ca_node_data.get('asset_type', '')):
         return NOT_A_RELEVANT_CONVERSION_MARKER
@@ -124,13 +220,13 @@ def _parse_and_validate_ca_node_on_demand(request, raw_ca_node_data, ca_nodes_fr
         try:
             ca_datetime_obj = datetime.strptime(ca_date_str, '%Y-%m-%d').date()
         except ValueError:
-            _processing_had_error[0] = True; return PARSING_ERROR_MARKER
-    if not ca_datetime_obj: _processing_had_error[0] = True; return PARSING_ERROR_MARKER
+            run_context.mark_error(); return PARSING_ERROR_MARKER
+    if not ca_datetime_obj: run_context.mark_error(); return PARSING_ERROR_MARKER
 
     amount_in_ca_node_str = raw_ca_node_data.get('amount', '0')
     try: quantity_in_node = Decimal(amount_in_ca_node_str)
     except InvalidOperation:
-        _processing_had_error[0] = True; return PARSING_ERROR_MARKER
+        run_context.mark_error(); return PARSING_ERROR_MARKER
 
     if quantity_in_node <= 0: return NOT_A_RELEVANT_CONVERSION_MARKER
 
@@ -164,8 +260,8 @@ def _parse_and_validate_ca_node_on_demand(request, raw_ca_node_data, ca_nodes_fr
         error_message = (f"Критическая ошибка (ON-DEMAND PARSE) для КД ID: {corp_action_id_from_node} в файле {raw_ca_node_data.get('file_source')}: "
                          f"Зачислено {quantity_in_node} шт. {isin_in_ca_node} (старый ISIN: {old_isin_from_comment}). "
                          f"Не найдено парное СПИСАНИЕ старых бумаг {old_isin_from_comment} в том же файле. Конвертация не будет применена.")
-        messages.error(request, error_message)
-        _processing_had_error[0] = True
+        run_context.diagnostics.add(error_message, messages.ERROR)
+        run_context.mark_error()
         return PARSING_ERROR_MARKER
 
     parsed_event_for_fifo = {
@@ -186,7 +282,7 @@ def _parse_and_validate_ca_node_on_demand(request, raw_ca_node_data, ca_nodes_fr
 def _apply_conversion_on_demand(request, target_isin, operation_date, buy_lots_deques,
                                 relevant_files_for_history, applied_corp_action_ids,
                                 memoized_parsed_ca_results, conversion_events_for_display_accumulator,
-                                file_ca_nodes_cache, _processing_had_error):
+                                file_ca_nodes_cache, run_context):
     conversion_applied_this_call = False
 
     for file_instance in relevant_files_for_history:
@@ -202,7 +298,7 @@ def _apply_conversion_on_demand(request, target_isin, operation_date, buy_lots_d
 
             parsed_ca_info = memoized_parsed_ca_results.get(ca_id)
             if parsed_ca_info is None:
-                parsed_ca_info = _parse_and_validate_ca_node_on_demand(request, raw_ca_item_data, current_file_raw_cas, _processing_had_error)
+                parsed_ca_info = _parse_and_validate_ca_node_on_demand(request, raw_ca_item_data, current_file_raw_cas, run_context)
                 memoized_parsed_ca_results[ca_id] = parsed_ca_info
 
             if parsed_ca_info in [PARSING_ERROR_MARKER, NOT_A_RELEVANT_CONVERSION_MARKER, None]: continue
@@ -275,7 +371,7 @@ def _apply_conversion_on_demand(request, target_isin, operation_date, buy_lots_d
                          conversion_events_for_display_accumulator.append(parsed_ca_info['display_data'])
                     conversion_applied_this_call = True
                 elif new_quantity_from_ca == 0 and total_qty_of_old_shares_removed > 0:
-                     messages.warning(request, f"При конвертации (ID: {ca_id}) было списано {total_qty_of_old_shares_removed} шт. {old_isin}, но не получено новых акций {new_isin}.")
+                     run_context.diagnostics.add(f"При конвертации (ID: {ca_id}) было списано {total_qty_of_old_shares_removed} шт. {old_isin}, но не получено новых акций {new_isin}.")
 
                 applied_corp_action_ids.add(ca_id)
                 # Если конвертация была для target_isin и она успешно применилась, можно вернуть True.
@@ -288,12 +384,14 @@ def _process_all_operations_for_fifo(request, operations_to_process,
                                      full_trade_history_map_for_fifo, # Используется для обновления ссылок на словари сделок
                                      relevant_files_for_history,
                                      conversion_events_for_display_accumulator,
-                                     _processing_had_error):
+                                     run_context,
+                                     file_ca_nodes_cache=None):
     buy_lots_deques = defaultdict(deque)
     pending_short_sales = defaultdict(deque) 
     applied_corp_action_ids = set()
     memoized_parsed_ca_results = {}
-    file_ca_nodes_cache = {}
+    if file_ca_nodes_cache is None:
+        file_ca_nodes_cache = {}
 
     for op in operations_to_process:
         op_type = op.get('op_type')
@@ -331,7 +429,7 @@ def _process_all_operations_for_fifo(request, operations_to_process,
                         buy_total_cost_shares_rub = (buy_price_per_share_orig_curr * buy_quantity_original * op['cbr_rate_decimal']).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
                     else:
                         if trade_dict_ref: trade_dict_ref['fifo_cost_rub_str'] = "Ошибка курса покупки (FIFO)"
-                        _processing_had_error[0] = True; continue
+                        run_context.mark_error(); continue
                 else: # RUB trade
                     buy_total_cost_shares_rub = (buy_price_per_share_orig_curr * buy_quantity_original).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
 
@@ -347,18 +445,17 @@ def _process_all_operations_for_fifo(request, operations_to_process,
                         buy_total_commission_rub = Decimal(0)  # Курс не найден, комиссия не учтена
                 else:
                     # Валюта комиссии отличается от валюты сделки - нужен отдельный курс
-                    commission_currency_model = Currency.objects.filter(char_code=commission_currency).first()
-                    if commission_currency_model:
-                        _, _, commission_rate = _get_exchange_rate_for_date(request, commission_currency_model, op_date, f"для комиссии покупки {op.get('trade_id', 'N/A')}")
+                    if run_context.currency(commission_currency):
+                        commission_rate = run_context.unit_rate(commission_currency, op_date, f"для комиссии покупки {op.get('trade_id', 'N/A')}")
                         if commission_rate is not None:
                             buy_total_commission_rub = (buy_commission_orig_curr * commission_rate).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
                         else:
-                            messages.warning(request, f"Курс {commission_currency} не найден для комиссии покупки {op.get('trade_id', 'N/A')}. Комиссия не учтена.")
-                            _processing_had_error[0] = True
+                            run_context.diagnostics.add(f"Курс {commission_currency} не найден для комиссии покупки {op.get('trade_id', 'N/A')}. Комиссия не учтена.")
+                            run_context.mark_error()
                             buy_total_commission_rub = Decimal(0)
                     else:
-                        messages.warning(request, f"Валюта {commission_currency} для комиссии покупки {op.get('trade_id', 'N/A')} не найдена. Комиссия не учтена.")
-                        _processing_had_error[0] = True
+                        run_context.diagnostics.add(f"Валюта {commission_currency} для комиссии покупки {op.get('trade_id', 'N/A')} не найдена. Комиссия не учтена.")
+                        run_context.mark_error()
                         buy_total_commission_rub = Decimal(0)
 
             # Полная стоимость одной акции этой покупки В РУБЛЯХ, включая ее комиссию
@@ -412,17 +509,16 @@ def _process_all_operations_for_fifo(request, operations_to_process,
                     else:
                         # Валюта комиссии отличается от валюты сделки - нужен отдельный курс
                         commission_for_closing_buy_rub = Decimal(0)
-                        close_comm_currency_model = Currency.objects.filter(char_code=commission_for_closing_buy_currency).first()
-                        if close_comm_currency_model:
-                            _, _, close_comm_rate = _get_exchange_rate_for_date(request, close_comm_currency_model, op_date, f"для комиссии закрытия шорта {op.get('trade_id', 'N/A')}")
+                        if run_context.currency(commission_for_closing_buy_currency):
+                            close_comm_rate = run_context.unit_rate(commission_for_closing_buy_currency, op_date, f"для комиссии закрытия шорта {op.get('trade_id', 'N/A')}")
                             if close_comm_rate is not None:
                                 commission_for_closing_buy_rub = (commission_for_closing_buy_orig * close_comm_rate).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
                             else:
-                                messages.warning(request, f"Курс {commission_for_closing_buy_currency} не найден для комиссии закрытия шорта {op.get('trade_id', 'N/A')} на {op_date.strftime('%d.%m.%Y')}.")
-                                _processing_had_error[0] = True
+                                run_context.diagnostics.add(f"Курс {commission_for_closing_buy_currency} не найден для комиссии закрытия шорта {op.get('trade_id', 'N/A')} на {op_date.strftime('%d.%m.%Y')}.")
+                                run_context.mark_error()
                         else:
-                            messages.warning(request, f"Валюта {commission_for_closing_buy_currency} для комиссии закрытия шорта {op.get('trade_id', 'N/A')} не найдена в системе.")
-                            _processing_had_error[0] = True
+                            run_context.diagnostics.add(f"Валюта {commission_for_closing_buy_currency} для комиссии закрытия шорта {op.get('trade_id', 'N/A')} не найдена в системе.")
+                            run_context.mark_error()
 
                     # Обновляем FIFO стоимость для короткой продажи (накопительно):
                     # Изначально там была только комиссия самой продажи (sell_commission_rub).
@@ -537,20 +633,19 @@ def _process_all_operations_for_fifo(request, operations_to_process,
                 if op['cbr_rate_decimal'] is not None:
                     commission_sell_rub = (commission_sell_orig_curr * op['cbr_rate_decimal']).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
                 else:
-                    messages.error(request, f"Нет курса для расчета комиссии продажи {op.get('trade_id','N/A')} ({op_isin}). Комиссия не учтена.")
-                    _processing_had_error[0] = True
+                    run_context.diagnostics.add(f"Нет курса для расчета комиссии продажи {op.get('trade_id','N/A')} ({op_isin}). Комиссия не учтена.", messages.ERROR)
+                    run_context.mark_error()
             else:
                 # Валюта комиссии отличается от валюты сделки - нужен отдельный курс
-                sell_commission_currency_model = Currency.objects.filter(char_code=sell_commission_currency).first()
-                if sell_commission_currency_model:
-                    _, _, sell_commission_rate = _get_exchange_rate_for_date(request, sell_commission_currency_model, op_date, f"для комиссии продажи {op.get('trade_id', 'N/A')}")
+                if run_context.currency(sell_commission_currency):
+                    sell_commission_rate = run_context.unit_rate(sell_commission_currency, op_date, f"для комиссии продажи {op.get('trade_id', 'N/A')}")
                     if sell_commission_rate is not None:
                         commission_sell_rub = (commission_sell_orig_curr * sell_commission_rate).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
                     else:
-                        messages.warning(request, f"Курс {sell_commission_currency} не найден для комиссии продажи {op.get('trade_id', 'N/A')}. Комиссия не учтена.")
-                        _processing_had_error[0] = True
+                        run_context.diagnostics.add(f"Курс {sell_commission_currency} не найден для комиссии продажи {op.get('trade_id', 'N/A')}. Комиссия не учтена.")
+                        run_context.mark_error()
                 else:
-                    messages.warning(request, f"Валюта {sell_commission_currency} для комиссии продажи {op.get('trade_id', 'N/A')} не найдена. Комиссия не учтена.")
+                    run_context.diagnostics.add(f"Валюта {sell_commission_currency} для комиссии продажи {op.get('trade_id', 'N/A')} не найдена. Комиссия не учтена.")
 
             # Начальные расходы для этой продажи = комиссия + стоимость опциона (если есть).
             # Стоимость акций будет добавляться по мере покрытия.
@@ -590,9 +685,8 @@ def _process_all_operations_for_fifo(request, operations_to_process,
                         option_purchase_date = option_purchase_date.date() if hasattr(option_purchase_date, 'date') else option_purchase_date
                     else:
                         option_purchase_date = op_date  # Fallback на дату продажи, если дата опциона недоступна
-                    opt_del_comm_currency_model = Currency.objects.filter(char_code=option_commission_currency).first()
-                    if opt_del_comm_currency_model:
-                        _, _, opt_del_comm_rate = _get_exchange_rate_for_date(request, opt_del_comm_currency_model, option_purchase_date, f"для комиссии опциона при поставке {option_data.get('trade_id', 'N/A')}")
+                    if run_context.currency(option_commission_currency):
+                        opt_del_comm_rate = run_context.unit_rate(option_commission_currency, option_purchase_date, f"для комиссии опциона при поставке {option_data.get('trade_id', 'N/A')}")
                         if opt_del_comm_rate is not None:
                             option_commission_rub = (option_commission * opt_del_comm_rate).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
 
@@ -639,7 +733,7 @@ def _process_all_operations_for_fifo(request, operations_to_process,
                         request, op_isin, op_date, buy_lots_deques, # op_isin это new_isin для конвертации
                         relevant_files_for_history,
                         applied_corp_action_ids, memoized_parsed_ca_results,
-                        conversion_events_for_display_accumulator, file_ca_nodes_cache, _processing_had_error
+                        conversion_events_for_display_accumulator, file_ca_nodes_cache, run_context
                     )
                     if was_conversion_applied:
                         current_buy_queue_after_conv = buy_lots_deques[op_isin]
@@ -759,7 +853,100 @@ def _process_all_operations_for_fifo(request, operations_to_process,
             # Если q_uncovered == 0, то он был полностью покрыт и уже удален из deque или его статус 'covered_by_future'
 
 
-def _str_to_decimal_safe(val_str, field_name_for_log="", context_id_for_log="", _processing_had_error=None):
+def _fifo_rate_requests(operations):
+    """Пары (валюта, дата) для комиссий в валюте, отличной от валюты сделки или опциона, — их курсы FIFO берёт отдельно."""
+    rate_requests = set()
+    for op in operations:
+        op_datetime_obj = op.get('datetime_obj')
+        commission_currency = op.get('commission_currency', op.get('currency'))
+        if op_datetime_obj and commission_currency and commission_currency != op.get('currency') \
+                and commission_currency not in ['RUB', 'РУБ', 'РУБ.']:
+            rate_requests.add((commission_currency, op_datetime_obj.date()))
+        trade_dict_ref = op.get('original_trade_dict_ref') or {}
+        option_data = trade_dict_ref.get('related_option_purchase') if trade_dict_ref.get('is_option_delivery') else None
+        if option_data:
+            option_currency = option_data.get('curr_c', '').strip().upper()
+            option_commission_currency = (option_data.get('commission_currency') or '').strip().upper() or option_currency
+            if option_commission_currency != option_currency and option_commission_currency not in ['RUB', 'РУБ', 'РУБ.']:
+                option_datetime_obj = option_data.get('datetime_obj') or op_datetime_obj
+                if option_datetime_obj:
+                    option_date = option_datetime_obj.date() if hasattr(option_datetime_obj, 'date') else option_datetime_obj
+                    rate_requests.add((option_commission_currency, option_date))
+    return rate_requests
+
+def _replay_fifo_bucket(operations_to_process, relevant_files_for_history, file_ca_nodes_cache, rates, currencies):
+    """
+    FIFO одной корзины семейств ISIN в рабочем процессе: предупреждения собираются в диагностику своего
+    контекста и сливаются в основном процессе, валюты и курсы комиссий берутся из переданных кэшей
+    расчёта (без обращений к БД).
+    """
+    run_context = RunContext()
+    run_context.rates.update(rates)
+    run_context.cache('currencies').update(currencies)
+    conversion_events = []
+    _process_all_operations_for_fifo(None, operations_to_process, None, relevant_files_for_history,
+                                     conversion_events, run_context, file_ca_nodes_cache)
+    updated_trade_dicts = [op.get('original_trade_dict_ref') for op in operations_to_process]
+    return updated_trade_dicts, conversion_events, run_context.had_error, run_context.diagnostics
+
+def _process_fifo_by_families(request, operations_to_process, full_trade_history_map_for_fifo,
+                              relevant_files_for_history, conversion_events_for_display_accumulator,
+                              run_context, file_ca_nodes_cache, isin_lineage):
+    """
+    FIFO по семействам ISIN (см. _build_isin_lineage): для больших историй корзины семейств
+    считаются в пуле процессов, иначе — обычный последовательный _process_all_operations_for_fifo.
+    Семейства не обмениваются лотами, поэтому результат совпадает с последовательным прогоном.
+    """
+    operations_by_family = defaultdict(list)
+    for op in operations_to_process:
+        op_isin = op.get('isin')
+        operations_by_family[isin_lineage.find(op_isin) if op_isin else None].append(op)
+
+    workers = fifo_worker_count(len(operations_to_process), len(operations_by_family))
+    if workers <= 1:
+        _process_all_operations_for_fifo(request, operations_to_process, full_trade_history_map_for_fifo,
+                                         relevant_files_for_history, conversion_events_for_display_accumulator,
+                                         run_context, file_ca_nodes_cache)
+        return
+
+    family_sizes = {family_key: len(ops) for family_key, ops in operations_by_family.items()}
+    buckets = split_families_into_buckets(family_sizes, workers * 2)
+    relevant_files_list = list(relevant_files_for_history)
+    bucket_operations = []
+    for bucket in buckets:
+        bucket_families = set(bucket)
+        # Порядок операций внутри корзины — как в общем отсортированном потоке
+        bucket_operations.append([
+            op for op in operations_to_process
+            if (isin_lineage.find(op['isin']) if op.get('isin') else None) in bucket_families
+        ])
+    # Валюты и курсы комиссий получаем здесь: рабочие процессы не обращаются к БД. Контекст запоминает
+    # только точные курсы, поэтому ближайшие и отсутствующие передаём отдельно
+    worker_rates = dict(run_context.rates)
+    for currency_code, rate_date in sorted(_fifo_rate_requests(operations_to_process)):
+        worker_rates[(currency_code, rate_date)] = run_context.unit_rate(currency_code, rate_date, "для комиссии")
+    tasks = [
+        (ops, relevant_files_list, file_ca_nodes_cache, worker_rates, run_context.cache('currencies'))
+        for ops in bucket_operations
+    ]
+    results = run_in_process_pool(_replay_fifo_bucket, tasks, workers)
+
+    for ops, (updated_trade_dicts, conversion_events, had_error, diagnostics) in zip(bucket_operations, results):
+        for op, updated_trade_dict in zip(ops, updated_trade_dicts):
+            trade_dict_ref = op.get('original_trade_dict_ref')
+            if trade_dict_ref is None or updated_trade_dict is None or updated_trade_dict is trade_dict_ref:
+                continue
+            # Переносим только изменённые поля: вложенные словари (related_option_purchase) сохраняют идентичность
+            for key, value in updated_trade_dict.items():
+                if key not in trade_dict_ref or trade_dict_ref[key] != value:
+                    trade_dict_ref[key] = value
+        conversion_events_for_display_accumulator.extend(conversion_events)
+        if had_error:
+            run_context.mark_error()
+        run_context.diagnostics.merge(diagnostics)
+
+
+def _str_to_decimal_safe(val_str, field_name_for_log="", context_id_for_log="", run_context=None):
     if val_str is None: return Decimal(0)
     if isinstance(val_str, str) and not val_str.strip(): return Decimal(0) 
     try:
@@ -768,8 +955,8 @@ def _str_to_decimal_safe(val_str, field_name_for_log="", context_id_for_log="",
             return val_str
         return Decimal(str(val_str)) 
     except InvalidOperation:
-        if _processing_had_error is not None: 
-            _processing_had_error[0] = True 
+        if run_context is not None:
+            run_context.mark_error()
         return Decimal(0) 
 
 def _parse_option_instr_name(option_name):
@@ -805,14 +992,132 @@ def _parse_option_instr_name(option_name):
         'strike': strike
     }
 
-def _calculate_additional_commissions(request, user, target_report_year, target_year_files, _processing_had_error):
+# Запись cash_in_outs: поля узла, JSON из details декодируется один раз при чтении
+CashInOut = namedtuple('CashInOut', [
+    'node_id', 'type', 'comment', 'amount', 'currency', 'ticker',
+    'datetime_str', 'pay_d_str', 'corporate_action_id', 'transaction_id',
+])
+
+
+def _read_cash_in_out(node):
+    corporate_action_id = None
+    details_json_str = node.findtext('details')
+    if details_json_str:
+        try:
+            details_data = json.loads(details_json_str)
+        except json.JSONDecodeError:
+            details_data = None
+        if isinstance(details_data, dict):
+            corporate_action_id = details_data.get('corporate_action_id')
+    if not corporate_action_id:
+        corporate_action_id = node.findtext('corporate_action_id', '').strip()
+    return CashInOut(
+        node_id=node.findtext('id'),
+        type=node.findtext('type', '').strip().lower(),
+        comment=node.findtext('comment', '').strip(),
+        amount=node.findtext('amount', '0'),
+        currency=node.findtext('currency'),
+        ticker=node.findtext('ticker', '').strip(),
+        datetime_str=node.findtext('datetime'),
+        pay_d_str=node.findtext('pay_d'),
+        corporate_action_id=corporate_action_id,
+        transaction_id=node.findtext('transaction_id', node.findtext('id', 'N/A')),
+    )
+
+
+def _dispatch_cash_in_outs(cash_in_outs_element, handlers):
+    """Один проход по cash_in_outs: каждая запись передаётся обработчику своего типа (handlers: тип -> функция)."""
+    for node in cash_in_outs_element.findall('node'):
+        record = _read_cash_in_out(node)
+        handler = handlers.get(record.type)
+        if handler is not None:
+            handler(record)
+
+
+def _cash_in_out_pay_date(record):
+    """Дата выплаты (pay_d, иначе datetime) или None."""
+    date_str = record.pay_d_str if record.pay_d_str is not None else (record.datetime_str or '')
+    if not date_str:
+        return None
+    return datetime.strptime(date_str.split(' ')[0], '%Y-%m-%d').date()
+
+
+def _add_dividend_from_cash_in_out(record, dividend_events, dividend_index, file_instance, target_report_year, run_context):
+    try:
+        amount_val = _str_to_decimal_safe(record.amount, 'dividend amount', record.node_id or 'N/A_CIO_DIV', run_context)
+        if amount_val <= 0:
+            return
+
+        try:
+            payment_date_obj = _cash_in_out_pay_date(record)
+        except ValueError:
+            return
+        if not payment_date_obj or payment_date_obj.year != target_report_year:
+            return
+
+        ticker_cio = record.ticker
+        currency_cio = (record.currency if record.currency is not None else 'RUB').strip().upper()
+
+        instr_name_cio = ticker_cio if ticker_cio else "Неизвестный инструмент"
+        match_comment_instr = re.search(r'Дивиденды по бумаге \((.*?)\s*\(([^)]+)\)\)', record.comment)
+        if match_comment_instr:
+            instr_name_cio = match_comment_instr.group(1).strip()
+            if not ticker_cio: ticker_cio = match_comment_instr.group(2).strip()
+
+        ca_id = record.corporate_action_id
+        div_event_key = f"{ca_id}_{payment_date_obj.isoformat()}" if ca_id else f"{instr_name_cio}_{ticker_cio}_{payment_date_obj.isoformat()}_{amount_val}" # Более уникальный ключ
+
+        if div_event_key not in dividend_events:
+            dividend_events[div_event_key] = {
+                'date': payment_date_obj, 'instrument_name': instr_name_cio, 'ticker': ticker_cio,
+                'amount': amount_val, 'tax_amount': Decimal(0),
+                'currency': currency_cio, 'cbr_rate_str': "-",
+                'amount_rub': Decimal(0),
+                'file_source': f"{file_instance.original_filename} (за {file_instance.year})",
+                'corporate_action_id': ca_id,
+                'dividend_key': div_event_key,
+            }
+            dividend_index.add(dividend_events[div_event_key])
+        else:
+            dividend_events[div_event_key]['amount'] += amount_val
+    except Exception:
+        pass
+
+
+def _add_dividend_tax_from_cash_in_out(record, dividend_index, target_report_year, run_context):
+    """Налог по корп. действию добавляется к дивиденду файла (все дивиденды файла уже в dividend_index)."""
+    try:
+        comment_lower = record.comment.lower()
+        if "налог за корпоративное действие" not in comment_lower and "tax for corporate action" not in comment_lower:
+            return
+        try:
+            tax_date_obj = _cash_in_out_pay_date(record)
+        except ValueError:
+            tax_date_obj = None
+        if not tax_date_obj or tax_date_obj.year != target_report_year:
+            return
+
+        tax_amount_val = _str_to_decimal_safe(record.amount, 'сумма налога', record.node_id or 'N/A_CIO_Tax', run_context)
+
+        # По CA_ID и дате (ключ дивиденда мог быть сгенерирован без CA_ID); налог без CA_ID — по тикеру и валюте
+        currency = (record.currency if record.currency is not None else 'RUB').strip().upper()
+        target_dividend_event = dividend_index.match_tax(record.corporate_action_id, record.ticker, currency, tax_date_obj)
+
+        if target_dividend_event:
+            target_dividend_event['tax_amount'] += abs(tax_amount_val)
+    except Exception:
+        pass
+
+
+def _calculate_additional_commissions(request, user, target_report_year, target_year_files, run_context,
+                                      dividend_agent_fees_by_file=None, dividend_index_by_file=None):
     dividend_commissions = defaultdict(lambda: {'amount_by_currency': defaultdict(Decimal), 'amount_rub': Decimal(0), 'details': []})
     other_commissions_details = defaultdict(lambda: {'currencies': defaultdict(Decimal), 'total_rub': Decimal(0), 'raw_events': []})
     total_other_commissions_rub = Decimal(0)
 
 
     if not target_year_files.exists():
-        messages.info(request, f"Нет файлов за {target_report_year} для расчета детализированных комиссий.")
+        run_context.diagnostics.add(f"Нет файлов за {target_report_year} для расчета детализированных комиссий.", messages.INFO)
         return dividend_commissions, other_commissions_details, total_other_commissions_rub
 
     for file_instance in target_year_files:
@@ -840,7 +1145,7 @@ def _calculate_additional_commissions(request, user, target_report_year, target_
                         for comm_node in detailed_comm.findall('node'):
                             sum_str = comm_node.findtext('sum', '0')
                             comm_id_for_log = comm_node.findtext('id', 'N/A_COMM') 
-                            sum_val = _str_to_decimal_safe(sum_str, 'commission sum', f"type: {comm_node.findtext('type', 'N/A_COMM_TYPE')}, ID: {comm_id_for_log}, file: {file_instance.original_filename}", _processing_had_error)
+                            sum_val = _str_to_decimal_safe(sum_str, 'commission sum', f"type: {comm_node.findtext('type', 'N/A_COMM_TYPE')}, ID: {comm_id_for_log}, file: {file_instance.original_filename}", run_context)
 
 
                             currency = comm_node.findtext('currency', '').strip().upper()
@@ -887,15 +1192,15 @@ def _calculate_additional_commissions(request, user, target_report_year, target_
                             if currency != 'RUB':
                                 currency_model_comm = Currency.objects.filter(char_code=currency).first()
                                 if currency_model_comm:
-                                    _, _, rate_val_comm = _get_exchange_rate_for_date(request, currency_model_comm, comm_date_obj, f"для комиссии '{category_key}'")
+                                    _, _, rate_val_comm = run_context.exchange_rate(currency_model_comm, comm_date_obj, f"для комиссии '{category_key}'")
                                     if rate_val_comm is not None:
                                         amount_rub_comm = (sum_val * rate_val_comm).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
                                     else:
-                                        messages.warning(request, f"Курс {currency} не найден для комиссии '{category_key}' на {comm_date_obj.strftime('%d.%m.%Y')}.")
-                                        _processing_had_error[0] = True
+                                        run_context.diagnostics.add(f"Курс {currency} не найден для комиссии '{category_key}' на {comm_date_obj.strftime('%d.%m.%Y')}.")
+                                        run_context.mark_error()
                                 else:
-                                    messages.warning(request, f"Валюта {currency} для комиссии '{category_key}' не найдена в системе.")
-                                    _processing_had_error[0] = True
+                                    run_context.diagnostics.add(f"Валюта {currency} для комиссии '{category_key}' не найдена в системе.")
+                                    run_context.mark_error()
                             
                             other_commissions_details[category_key]['currencies'][currency] += sum_val
                             other_commissions_details[category_key]['total_rub'] += amount_rub_comm
@@ -935,7 +1240,7 @@ def _calculate_additional_commissions(request, user, target_report_year, target_
                             if not (ca_date_obj and ca_date_obj.year == target_report_year):
                                 continue
                             if asset_type == "Деньги" and ca_type_id not in ['dividend', 'dividend_reverted']:
-                                amount_val_ca = _str_to_decimal_safe(ca_amount_str, 'corporate_action amount for commission', ca_id_for_log, _processing_had_error)
+                                amount_val_ca = _str_to_decimal_safe(ca_amount_str, 'corporate_action amount for commission', ca_id_for_log, run_context)
                                 
                                 if amount_val_ca < 0: 
                                     if ca_type_id == 'agent_fee' and "дивиденд" in ca_comment.lower():
@@ -962,15 +1267,15 @@ def _calculate_additional_commissions(request, user, target_report_year, target_
                                     if ca_currency != 'RUB':
                                         currency_model_ca = Currency.objects.filter(char_code=ca_currency).first()
                                         if currency_model_ca:
-                                            _, _, rate_val_ca = _get_exchange_rate_for_date(request, currency_model_ca, ca_date_obj, f"для списания по КД '{category_key_ca}'")
+                                            _, _, rate_val_ca = run_context.exchange_rate(currency_model_ca, ca_date_obj, f"для списания по КД '{category_key_ca}'")
                                             if rate_val_ca is not None:
                                                 amount_rub_ca = (actual_expense_amount_ca * rate_val_ca).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
                                             else:
-                                                messages.warning(request, f"Курс {ca_currency} не найден для списания по КД '{category_key_ca}' на {ca_date_obj.strftime('%d.%m.%Y')}.")
-                                                _processing_had_error[0] = True
+                                                run_context.diagnostics.add(f"Курс {ca_currency} не найден для списания по КД '{category_key_ca}' на {ca_date_obj.strftime('%d.%m.%Y')}.")
+                                                run_context.mark_error()
                                         else:
-                                            messages.warning(request, f"Валюта {ca_currency} для списания по КД '{category_key_ca}' не найдена в системе.")
-                                            _processing_had_error[0] = True
+                                            run_context.diagnostics.add(f"Валюта {ca_currency} для списания по КД '{category_key_ca}' не найдена в системе.")
+                                            run_context.mark_error()
 
                                     other_commissions_details[category_key_ca]['currencies'][ca_currency] += actual_expense_amount_ca
                                     other_commissions_details[category_key_ca]['total_rub'] += amount_rub_ca
@@ -983,92 +1288,106 @@ def _calculate_additional_commissions(request, user, target_report_year, target_
                                     })
                                     total_other_commissions_rub += amount_rub_ca
                 
-                cash_in_outs_element = root.find('.//cash_in_outs') 
-                
-                if cash_in_outs_element:
-                    for node_cio in cash_in_outs_element.findall('node'):
-                        cio_type = node_cio.findtext('type', '').strip().lower()
-                        cio_comment_original = node_cio.findtext('comment', '').strip() 
-                        cio_comment_lower = cio_comment_original.lower() 
-                        cio_id_for_log = node_cio.findtext('id', 'N/A_CIO_AGENT_FEE_DIV')
-
-                        if cio_type == 'agent_fee' and "дивиденд" in cio_comment_lower:
-                            cio_amount_str = node_cio.findtext('amount', '0')
-                            cio_currency = node_cio.findtext('currency', '').strip().upper()
-                            
-                            cio_datetime_str = node_cio.findtext('datetime', '')
-                            if not cio_datetime_str: 
-                                cio_datetime_str = node_cio.findtext('pay_d', '') 
+                # Записи agent_fee уже разобраны основным проходом по cash_in_outs; без него читаем их здесь
+                if dividend_agent_fees_by_file is not None:
+                    agent_fee_records = dividend_agent_fees_by_file.get(file_instance.id, [])
+                else:
+                    agent_fee_records = []
+                    cash_in_outs_element = root.find('.//cash_in_outs')
+                    if cash_in_outs_element:
+                        _dispatch_cash_in_outs(cash_in_outs_element, {'agent_fee': agent_fee_records.append})
 
-                            cio_date_obj = None
-                            if cio_datetime_str:
-                                try:
-                                    cio_date_obj = datetime.strptime(cio_datetime_str.split(' ')[0], '%Y-%m-%d').date()
-                                except ValueError:
-                                    continue
-                            
-                            if not cio_date_obj:
-                                continue
+                # Дивиденды файла — для привязки комиссии к дивиденду (dividend_key)
+                dividend_index = (dividend_index_by_file or {}).get(file_instance.id)
+
+                for record in agent_fee_records:
+                    cio_comment_original = record.comment
+                    cio_comment_lower = cio_comment_original.lower()
+                    cio_id_for_log = record.node_id or 'N/A_CIO_AGENT_FEE_DIV'
+
+                    if "дивиденд" in cio_comment_lower:
+                        cio_amount_str = record.amount
+                        cio_currency = (record.currency or '').strip().upper()
 
-                            if cio_date_obj.year != target_report_year:
+                        cio_datetime_str = record.datetime_str or ''
+                        if not cio_datetime_str:
+                            cio_datetime_str = record.pay_d_str or ''
+
+                        cio_date_obj = None
+                        if cio_datetime_str:
+                            try:
+                                cio_date_obj = datetime.strptime(cio_datetime_str.split(' ')[0], '%Y-%m-%d').date()
+                            except ValueError:
                                 continue
+                        
+                        if not cio_date_obj:
+                            continue
 
-                            amount_val_cio = _str_to_decimal_safe(cio_amount_str, 'agent_fee amount from cash_in_outs', cio_id_for_log, _processing_had_error)
+                        if cio_date_obj.year != target_report_year:
+                            continue
+
+                        amount_val_cio = _str_to_decimal_safe(cio_amount_str, 'agent_fee amount from cash_in_outs', cio_id_for_log, run_context)
+                        
+                        if amount_val_cio < Decimal(0): 
+                            actual_commission_amount = abs(amount_val_cio)
                             
-                            if amount_val_cio < Decimal(0): 
-                                actual_commission_amount = abs(amount_val_cio)
-                                
-                                if not cio_currency:
-                                    continue
-                                
-                                ticker_match = re.search(r'\(([^)]+?\.US|[A-Z]{2,6}\.(?:KZ|HK)|[A-Z0-9]{1,6})\)', cio_comment_original)
-                                ticker_key = ticker_match.group(1).strip().upper() if ticker_match else "Неизвестный тикер"
-                                
-                                category_key_div_comm = f"Агентская комиссия по дивидендам ({ticker_key})"
-
-                                amount_rub_cio = actual_commission_amount
-                                if cio_currency != 'RUB':
-                                    currency_model_cio = Currency.objects.filter(char_code=cio_currency).first()
-                                    if currency_model_cio:
-                                        _, _, rate_val_cio = _get_exchange_rate_for_date(request, currency_model_cio, cio_date_obj, f"агентской комиссии по дивидендам {ticker_key}")
-                                        if rate_val_cio is not None:
-                                            amount_rub_cio = (actual_commission_amount * rate_val_cio).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
-                                        else:
-                                            messages.warning(request, f"Курс {cio_currency} не найден для агентской комиссии по дивидендам ({ticker_key}) на {cio_date_obj.strftime('%d.%m.%Y')}.")
-                                            _processing_had_error[0] = True
+                            if not cio_currency:
+                                continue
+                            
+                            ticker_match = re.search(r'\(([^)]+?\.US|[A-Z]{2,6}\.(?:KZ|HK)|[A-Z0-9]{1,6})\)', cio_comment_original)
+                            ticker_key = ticker_match.group(1).strip().upper() if ticker_match else "Неизвестный тикер"
+                            
+                            category_key_div_comm = f"Агентская комиссия по дивидендам ({ticker_key})"
+
+                            amount_rub_cio = actual_commission_amount
+                            if cio_currency != 'RUB':
+                                currency_model_cio = Currency.objects.filter(char_code=cio_currency).first()
+                                if currency_model_cio:
+                                    _, _, rate_val_cio = run_context.exchange_rate(currency_model_cio, cio_date_obj, f"агентской комиссии по дивидендам {ticker_key}")
+                                    if rate_val_cio is not None:
+                                        amount_rub_cio = (actual_commission_amount * rate_val_cio).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
                                     else:
-                                        messages.warning(request, f"Валюта {cio_currency} для агентской комиссии по дивидендам ({ticker_key}) не найдена в системе.")
-                                        _processing_had_error[0] = True
-                                
-                                if 'amount_by_currency' not in dividend_commissions[category_key_div_comm]:
-                                    dividend_commissions[category_key_div_comm]['amount_by_currency'] = defaultdict(Decimal)
-                                
-                                dividend_commissions[category_key_div_comm]['amount_by_currency'][cio_currency] += actual_commission_amount
-                                dividend_commissions[category_key_div_comm]['amount_rub'] += amount_rub_cio
-                                dividend_commissions[category_key_div_comm]['details'].append({
-                                    'date': cio_date_obj.strftime('%d.%m.%Y'),
-                                    'amount': actual_commission_amount,
-                                    'currency': cio_currency,
-                                    'amount_rub': amount_rub_cio,
-                                    'comment': cio_comment_original,
-                                    'source_file': file_instance.original_filename,
-                                    'transaction_id': node_cio.findtext('transaction_id', node_cio.findtext('id', 'N/A')) 
-                                })
-                            elif amount_val_cio > Decimal(0):
-                                 pass
+                                        run_context.diagnostics.add(f"Курс {cio_currency} не найден для агентской комиссии по дивидендам ({ticker_key}) на {cio_date_obj.strftime('%d.%m.%Y')}.")
+                                        run_context.mark_error()
+                                else:
+                                    run_context.diagnostics.add(f"Валюта {cio_currency} для агентской комиссии по дивидендам ({ticker_key}) не найдена в системе.")
+                                    run_context.mark_error()
+                            
+                            matched_dividend = None
+                            if dividend_index is not None and ticker_match:
+                                matched_dividend = dividend_index.match_fee(ticker_key, cio_currency, cio_date_obj)
+
+                            if 'amount_by_currency' not in dividend_commissions[category_key_div_comm]:
+                                dividend_commissions[category_key_div_comm]['amount_by_currency'] = defaultdict(Decimal)
+                            
+                            dividend_commissions[category_key_div_comm]['amount_by_currency'][cio_currency] += actual_commission_amount
+                            dividend_commissions[category_key_div_comm]['amount_rub'] += amount_rub_cio
+                            dividend_commissions[category_key_div_comm]['details'].append({
+                                'date': cio_date_obj.strftime('%d.%m.%Y'),
+                                'amount': actual_commission_amount,
+                                'currency': cio_currency,
+                                'amount_rub': amount_rub_cio,
+                                'comment': cio_comment_original,
+                                'source_file': file_instance.original_filename,
+                                'transaction_id': record.transaction_id,
+                                'dividend_key': matched_dividend.get('dividend_key') if matched_dividend else None,
+                            })
+                        elif amount_val_cio > Decimal(0):
+                             pass
 
         except ET.ParseError as e_parse:
-            _processing_had_error[0] = True
-            messages.error(request, f"Ошибка парсинга XML в файле {file_instance.original_filename} при расчете детализированных комиссий.")
+            run_context.mark_error()
+            run_context.diagnostics.add(f"Ошибка парсинга XML в файле {file_instance.original_filename} при расчете детализированных комиссий.", messages.ERROR)
         except Exception as e:
-            _processing_had_error[0] = True
-            messages.error(request, f"Неожиданная ошибка при обработке файла {file_instance.original_filename} для детализированных комиссий.")
+            run_context.mark_error()
+            run_context.diagnostics.add(f"Неожиданная ошибка при обработке файла {file_instance.original_filename} для детализированных комиссий.", messages.ERROR)
 
     return dividend_commissions, other_commissions_details, total_other_commissions_rub
 
 
-def process_and_get_trade_data(request, user, target_report_year, files_queryset=None):
-    _processing_had_error_local_flag = [False] 
+def process_and_get_trade_data(request, user, target_report_year, files_queryset=None, run_context=None):
+    if run_context is None:
+        run_context = RunContext(request, user, target_report_year)
 
     full_instrument_trade_history_for_fifo = defaultdict(list)
     trade_and_holding_ops = []
@@ -1106,11 +1425,11 @@ def process_and_get_trade_data(request, user, target_report_year, files_queryset
     else:
         relevant_files_for_history = files_queryset.order_by('year', 'uploaded_at')
     if not relevant_files_for_history.exists():
-        messages.info(request, f"У вас нет загруженных файлов для анализа истории.") # Сообщение изменено
+        run_context.diagnostics.add(f"У вас нет загруженных файлов для анализа истории.", messages.INFO) # Сообщение изменено
         empty_profit_by_code = {'1530': Decimal(0), '1532': Decimal(0)}
         empty_profit_by_code_curr = {'1530': {}, '1532': {}}
         return (
-            {}, [], Decimal(0), Decimal(0), _processing_had_error_local_flag[0],
+            {}, [], Decimal(0), Decimal(0), run_context.had_error,
             defaultdict(lambda: {'amount_by_currency': defaultdict(Decimal),'amount_rub': Decimal(0), 'details': []}),
             defaultdict(lambda: {'currencies': defaultdict(Decimal), 'total_rub': Decimal(0), 'raw_events': []}),
             Decimal(0),
@@ -1145,10 +1464,18 @@ def process_and_get_trade_data(request, user, target_report_year, files_queryset
                         if date_start_el_temp is not None and date_start_el_temp.text:
                             earliest_report_start_datetime = datetime.strptime(date_start_el_temp.text.strip(), '%Y-%m-%d %H:%M:%S')
         except Exception as e_early_date:
-            _processing_had_error_local_flag[0] = True 
+            run_context.mark_error()
 
     processed_initial_holdings_file_ids = set() 
     dividend_events_in_current_file = {} 
+    # Записи cash_in_outs типа agent_fee по файлам целевого года: {id файла: [CashInOut]}
+    dividend_agent_fees_by_file = defaultdict(list)
+    # Индексы дивидендов этих файлов (общие для налогов и агентских комиссий): {id файла: DividendIndex}
+    dividend_index_by_file = {}
+    # Узлы корп. действий каждого файла и продажи целевого года собираем из уже разобранного XML,
+    # чтобы не перечитывать файлы при отборе инструментов и применении конвертаций
+    file_ca_nodes_cache = {}
+    instruments_with_sales_in_target_year = set()
 
     for file_instance in relevant_files_for_history:
         dividend_events_in_current_file.clear() 
@@ -1165,6 +1492,11 @@ def process_and_get_trade_data(request, user, target_report_year, files_queryset
                 if not xml_string_loop:
                     continue
                 root = ET.fromstring(xml_string_loop)
+                # Недостающие курсы ЦБ для операций файла загружаем заранее одним параллельным проходом
+                warm_up_exchange_rates(_collect_rate_requests_from_root(root))
+                file_ca_nodes_cache[file_instance.id] = _extract_ca_nodes_from_root(root, file_instance)
+                if is_target_year_file_for_dividends:
+                    instruments_with_sales_in_target_year.update(_collect_target_year_sales_from_root(root, target_report_year))
 
                 current_file_date_start_str = root.findtext('.//date_start', default='').strip()
                 current_file_start_dt = None
@@ -1191,9 +1523,9 @@ def process_and_get_trade_data(request, user, target_report_year, files_queryset
                                         isin = isin_el_fallback.text.strip() if isin_el_fallback is not None and isin_el_fallback.text and isin_el_fallback.text.strip() != '-' else None
 
                                     if not isin: instr_nm_log = pos_node.findtext('name', 'N/A').strip(); continue
-                                    quantity = _str_to_decimal_safe(pos_node.findtext('q', '0'), 'q НО', isin, _processing_had_error_local_flag)
+                                    quantity = _str_to_decimal_safe(pos_node.findtext('q', '0'), 'q НО', isin, run_context)
                                     if quantity <= 0: continue 
-                                    bal_price_per_share_curr = _str_to_decimal_safe(pos_node.findtext('bal_price_a', '0'), 'bal_price_a НО', isin, _processing_had_error_local_flag)
+                                    bal_price_per_share_curr = _str_to_decimal_safe(pos_node.findtext('bal_price_a', '0'), 'bal_price_a НО', isin, run_context)
                                     currency_code = pos_node.findtext('curr', 'RUB').strip().upper()
                                     
                                     total_cost_rub_init = (quantity * bal_price_per_share_curr) # В валюте позиции
@@ -1202,12 +1534,12 @@ def process_and_get_trade_data(request, user, target_report_year, files_queryset
                                     if currency_code != 'RUB':
                                         currency_model_init = Currency.objects.filter(char_code=currency_code).first()
                                         if currency_model_init and earliest_report_start_datetime: 
-                                            _ , _, rate_val_init = _get_exchange_rate_for_date(request, currency_model_init, earliest_report_start_datetime.date(), f"для НО {isin}")
+                                            _ , _, rate_val_init = run_context.exchange_rate(currency_model_init, earliest_report_start_datetime.date(), f"для НО {isin}")
                                             if rate_val_init is not None:
                                                 rate_decimal_init = rate_val_init
                                                 total_cost_rub_init = (total_cost_rub_init * rate_decimal_init).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP) # Теперь в RUB
-                                            else: _processing_had_error_local_flag[0] = True; messages.warning(request, f"Не найден курс для НО {isin} ({currency_code}) на {earliest_report_start_datetime.date().strftime('%d.%m.%Y') if earliest_report_start_datetime else 'N/A'}. Стоимость НО может быть неверной."); total_cost_rub_init = Decimal(0) # Обнуляем, если нет курса
-                                        else: _processing_had_error_local_flag[0] = True; messages.warning(request, f"Валюта {currency_code} для НО {isin} не найдена. Стоимость НО может быть неверной."); total_cost_rub_init = Decimal(0)
+                                            else: run_context.mark_error(); run_context.diagnostics.add(f"Не найден курс для НО {isin} ({currency_code}) на {earliest_report_start_datetime.date().strftime('%d.%m.%Y') if earliest_report_start_datetime else 'N/A'}. Стоимость НО может быть неверной."); total_cost_rub_init = Decimal(0) # Обнуляем, если нет курса
+                                        else: run_context.mark_error(); run_context.diagnostics.add(f"Валюта {currency_code} для НО {isin} не найдена. Стоимость НО может быть неверной."); total_cost_rub_init = Decimal(0)
                                     else: # RUB
                                         total_cost_rub_init = total_cost_rub_init.quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
 
@@ -1234,7 +1566,7 @@ def process_and_get_trade_data(request, user, target_report_year, files_queryset
                                         'file_source': op_details_dict_for_ref['file_source'] 
                                     })
                                 except (AttributeError, ValueError) as e_init: 
-                                     _processing_had_error_local_flag[0] = True
+                                     run_context.mark_error()
                         processed_initial_holdings_file_ids.add(file_instance.id) 
 
                 trades_element = root.find('.//trades')
@@ -1256,10 +1588,10 @@ def process_and_get_trade_data(request, user, target_report_year, files_queryset
 
                                     operation_raw = trade_data_dict.get('operation', '')
                                     operation = operation_raw.strip().lower()
-                                    trade_data_dict['p'] = _str_to_decimal_safe(trade_data_dict.get('p'), 'p', current_trade_id_for_log, _processing_had_error_local_flag)
-                                    trade_data_dict['q'] = _str_to_decimal_safe(trade_data_dict.get('q'), 'q', current_trade_id_for_log, _processing_had_error_local_flag)
-                                    trade_data_dict['summ'] = _str_to_decimal_safe(trade_data_dict.get('summ'), 'summ', current_trade_id_for_log, _processing_had_error_local_flag)
-                                    trade_data_dict['commission'] = _str_to_decimal_safe(trade_data_dict.get('commission'), 'commission', current_trade_id_for_log, _processing_had_error_local_flag)
+                                    trade_data_dict['p'] = _str_to_decimal_safe(trade_data_dict.get('p'), 'p', current_trade_id_for_log, run_context)
+                                    trade_data_dict['q'] = _str_to_decimal_safe(trade_data_dict.get('q'), 'q', current_trade_id_for_log, run_context)
+                                    trade_data_dict['summ'] = _str_to_decimal_safe(trade_data_dict.get('summ'), 'summ', current_trade_id_for_log, run_context)
+                                    trade_data_dict['commission'] = _str_to_decimal_safe(trade_data_dict.get('commission'), 'commission', current_trade_id_for_log, run_context)
 
                                     # Парсим дату
                                     op_datetime_obj_opt = None
@@ -1292,7 +1624,7 @@ def process_and_get_trade_data(request, user, target_report_year, files_queryset
                                     if currency_code_opt and currency_code_opt not in ['RUB', 'РУБ', 'РУБ.'] and op_datetime_obj_opt:
                                         currency_model_opt = Currency.objects.filter(char_code=currency_code_opt).first()
                                         if currency_model_opt:
-                                            _, _, rate_val_opt = _get_exchange_rate_for_date(request, currency_model_opt, op_datetime_obj_opt.date(), f"для опциона {current_trade_id_for_log}")
+                                            _, _, rate_val_opt = run_context.exchange_rate(currency_model_opt, op_datetime_obj_opt.date(), f"для опциона {current_trade_id_for_log}")
                                             if rate_val_opt is not None:
                                                 rate_decimal_opt = rate_val_opt
 
@@ -1352,7 +1684,7 @@ def process_and_get_trade_data(request, user, target_report_year, files_queryset
 
                                         # Получаем прибыль из поля profit
                                         profit_str = node_element.findtext('profit', '0')
-                                        repo_profit = _str_to_decimal_safe(profit_str, 'profit', current_trade_id_for_log, _processing_had_error_local_flag)
+                                        repo_profit = _str_to_decimal_safe(profit_str, 'profit', current_trade_id_for_log, run_context)
 
                                         if repo_profit > 0:
                                             # Парсим дату
@@ -1377,7 +1709,7 @@ def process_and_get_trade_data(request, user, target_report_year, files_queryset
                                                 if currency_code_repo and currency_code_repo not in ['RUB', 'РУБ', 'РУБ.']:
                                                     currency_model_repo = Currency.objects.filter(char_code=currency_code_repo).first()
                                                     if currency_model_repo:
-                                                        _, _, rate_val_repo = _get_exchange_rate_for_date(request, currency_model_repo, op_datetime_obj_repo.date(), f"для РЕПО {current_trade_id_for_log}")
+                                                        _, _, rate_val_repo = run_context.exchange_rate(currency_model_repo, op_datetime_obj_repo.date(), f"для РЕПО {current_trade_id_for_log}")
                                                         if rate_val_repo is not None:
                                                             rate_decimal_repo = rate_val_repo
 
@@ -1409,7 +1741,7 @@ def process_and_get_trade_data(request, user, target_report_year, files_queryset
                                     isin_el_issue_nb = node_element.find('issue_nb')
                                     current_isin = isin_el_issue_nb.text.strip() if isin_el_issue_nb is not None and isin_el_issue_nb.text and isin_el_issue_nb.text.strip() != '-' else None
                                 
-                                if not current_isin: _processing_had_error_local_flag[0] = True; continue
+                                if not current_isin: run_context.mark_error(); continue
                                 trade_data_dict['isin'] = current_isin 
 
                                 for tag in trade_detail_tags: 
@@ -1417,16 +1749,16 @@ def process_and_get_trade_data(request, user, target_report_year, files_queryset
                                     trade_data_dict[tag] = (data_el.text.strip() if data_el is not None and data_el.text is not None else None)
                                 if not trade_data_dict.get('isin') and current_isin : trade_data_dict['isin'] = current_isin
 
-                                trade_data_dict['p'] = _str_to_decimal_safe(trade_data_dict.get('p'), 'p', current_trade_id_for_log, _processing_had_error_local_flag)
-                                trade_data_dict['q'] = _str_to_decimal_safe(trade_data_dict.get('q'), 'q', current_trade_id_for_log, _processing_had_error_local_flag)
-                                trade_data_dict['summ'] = _str_to_decimal_safe(trade_data_dict.get('summ'), 'summ', current_trade_id_for_log, _processing_had_error_local_flag)
-                                trade_data_dict['commission'] = _str_to_decimal_safe(trade_data_dict.get('commission'), 'commission', current_trade_id_for_log, _processing_had_error_local_flag)
+                                trade_data_dict['p'] = _str_to_decimal_safe(trade_data_dict.get('p'), 'p', current_trade_id_for_log, run_context)
+                                trade_data_dict['q'] = _str_to_decimal_safe(trade_data_dict.get('q'), 'q', current_trade_id_for_log, run_context)
+                                trade_data_dict['summ'] = _str_to_decimal_safe(trade_data_dict.get('summ'), 'summ', current_trade_id_for_log, run_context)
+                                trade_data_dict['commission'] = _str_to_decimal_safe(trade_data_dict.get('commission'), 'commission', current_trade_id_for_log, run_context)
 
                                 op_datetime_obj = None
                                 if trade_data_dict.get('date'):
                                     try: op_datetime_obj = datetime.strptime(trade_data_dict['date'], '%Y-%m-%d %H:%M:%S')
-                                    except ValueError: _processing_had_error_local_flag[0] = True; messages.warning(request, f"Некорректная дата сделки {current_trade_id_for_log} ({current_isin})."); continue
-                                if not op_datetime_obj: _processing_had_error_local_flag[0] = True; messages.warning(request, f"Отсутствует дата для сделки {current_trade_id_for_log} ({current_isin})."); continue
+                                    except ValueError: run_context.mark_error(); run_context.diagnostics.add(f"Некорректная дата сделки {current_trade_id_for_log} ({current_isin})."); continue
+                                if not op_datetime_obj: run_context.mark_error(); run_context.diagnostics.add(f"Отсутствует дата для сделки {current_trade_id_for_log} ({current_isin})."); continue
 
                                 rate_decimal, rate_str = None, "-"; currency_code = trade_data_dict.get('curr_c', '').strip().upper()
                                 if currency_code: 
@@ -1434,16 +1766,16 @@ def process_and_get_trade_data(request, user, target_report_year, files_queryset
                                     else:
                                         currency_model = Currency.objects.filter(char_code=currency_code).first()
                                         if currency_model:
-                                            _ , fetched_exactly, rate_val_trade = _get_exchange_rate_for_date(request, currency_model, op_datetime_obj.date(), f"для сделки {current_trade_id_for_log}")
+                                            _ , fetched_exactly, rate_val_trade = run_context.exchange_rate(currency_model, op_datetime_obj.date(), f"для сделки {current_trade_id_for_log}")
                                             if rate_val_trade is not None:
                                                 rate_decimal = rate_val_trade; rate_str = f"{rate_decimal:.4f}"
                                                 if not fetched_exactly: rate_str += " (ближ.)" 
-                                            else: _processing_had_error_local_flag[0] = True; rate_str = "не найден"; messages.error(request, f"Курс {currency_code} не найден для сделки {current_trade_id_for_log} на {op_datetime_obj.date().strftime('%d.%m.%Y')}.")
-                                        else: _processing_had_error_local_flag[0] = True; rate_str = "валюта не найдена"; messages.error(request, f"Валюта {currency_code} не найдена для сделки {current_trade_id_for_log}.")
+                                            else: run_context.mark_error(); rate_str = "не найден"; run_context.diagnostics.add(f"Курс {currency_code} не найден для сделки {current_trade_id_for_log} на {op_datetime_obj.date().strftime('%d.%m.%Y')}.", messages.ERROR)
+                                        else: run_context.mark_error(); rate_str = "валюта не найдена"; run_context.diagnostics.add(f"Валюта {currency_code} не найдена для сделки {current_trade_id_for_log}.", messages.ERROR)
                                 trade_data_dict['transaction_cbr_rate_str'] = rate_str
                                 trade_data_dict['cbr_rate'] = rate_decimal if rate_decimal is not None else Decimal('0')
 
-                                if currency_code != 'RUB' and rate_decimal is None: _processing_had_error_local_flag[0] = True; continue
+                                if currency_code != 'RUB' and rate_decimal is None: run_context.mark_error(); continue
 
                                 # Проверяем, является ли эта сделка результатом исполнения опциона
                                 trade_nb = trade_data_dict.get('trade_nb', '')
@@ -1471,112 +1803,33 @@ def process_and_get_trade_data(request, user, target_report_year, files_queryset
                                 }
                                 trade_and_holding_ops.append(op_for_processing)
                             except Exception as e_node: 
-                                _processing_had_error_local_flag[0] = True
-                                messages.error(request, f"Ошибка данных для сделки ID: {current_trade_id_for_log} в файле {file_instance.original_filename}."); continue
+                                run_context.mark_error()
+                                run_context.diagnostics.add(f"Ошибка данных для сделки ID: {current_trade_id_for_log} в файле {file_instance.original_filename}.", messages.ERROR); continue
                 
                 if is_target_year_file_for_dividends:
                     cash_in_outs_element = root.find('.//cash_in_outs')
                     if cash_in_outs_element:
-                        for node_cio in cash_in_outs_element.findall('node'):
-                            try:
-                                cio_type = node_cio.findtext('type', '').strip().lower()
-                                cio_comment = node_cio.findtext('comment', '').strip()
-                                cio_id_for_log = node_cio.findtext('id', 'N/A_CIO_DIV') 
-                                
-                                details_json_str_cio = node_cio.findtext('details')
-                                ca_id_from_details_cio = None
-                                if details_json_str_cio:
-                                    try: details_data_cio = json.loads(details_json_str_cio); ca_id_from_details_cio = details_data_cio.get('corporate_action_id')
-                                    except json.JSONDecodeError: pass 
-                                if not ca_id_from_details_cio: 
-                                    ca_id_from_details_cio = node_cio.findtext('corporate_action_id', '').strip()
-
-                                if cio_type == 'dividend':
-                                    amount_val = _str_to_decimal_safe(node_cio.findtext('amount', '0'), 'dividend amount', cio_id_for_log, _processing_had_error_local_flag)
-                                    if amount_val <= 0: continue 
-
-                                    payment_date_str = node_cio.findtext('pay_d', node_cio.findtext('datetime', ''))
-                                    payment_date_obj = None
-                                    if payment_date_str:
-                                        try: 
-                                            dt_part = payment_date_str.split(' ')[0]; payment_date_obj = datetime.strptime(dt_part, '%Y-%m-%d').date()
-                                        except ValueError: continue
-                                    
-                                    if not payment_date_obj or payment_date_obj.year != target_report_year: continue
-
-                                    ticker_cio = node_cio.findtext('ticker', '').strip() 
-                                    currency_cio = node_cio.findtext('currency', 'RUB').strip().upper() 
-                                    
-                                    instr_name_cio = ticker_cio if ticker_cio else "Неизвестный инструмент" 
-                                    match_comment_instr = re.search(r'Дивиденды по бумаге \((.*?)\s*\(([^)]+)\)\)', cio_comment)
-                                    if match_comment_instr:
-                                        instr_name_cio = match_comment_instr.group(1).strip()
-                                        if not ticker_cio: ticker_cio = match_comment_instr.group(2).strip() 
-
-                                    div_event_key = f"{ca_id_from_details_cio}_{payment_date_obj.isoformat()}" if ca_id_from_details_cio else f"{instr_name_cio}_{ticker_cio}_{payment_date_obj.isoformat()}_{amount_val}" # Более уникальный ключ
-                                    
-                                    if div_event_key not in dividend_events_in_current_file:
-                                        dividend_events_in_current_file[div_event_key] = {
-                                            'date': payment_date_obj, 'instrument_name': instr_name_cio, 'ticker': ticker_cio,
-                                            'amount': amount_val, 'tax_amount': Decimal(0), 
-                                            'currency': currency_cio, 'cbr_rate_str': "-", 
-                                            'amount_rub': Decimal(0), 
-                                            'file_source': f"{file_instance.original_filename} (за {file_instance.year})",
-                                            'corporate_action_id': ca_id_from_details_cio 
-                                        }
-                                    else: 
-                                        dividend_events_in_current_file[div_event_key]['amount'] += amount_val
-                                    # Processed dividend event
-                            except Exception as e_div_pre_parse: 
-                                pass
-                        
-                        for node_cio in cash_in_outs_element.findall('node'):
-                            try:
-                                cio_type = node_cio.findtext('type', '').strip().lower()
-                                cio_comment = node_cio.findtext('comment', '').strip()
-                                cio_id_for_log_tax = node_cio.findtext('id', 'N/A_CIO_Tax') 
-                                
-                                details_json_str_cio = node_cio.findtext('details')
-                                ca_id_from_details_cio = None
-                                if details_json_str_cio:
-                                    try: details_data_cio = json.loads(details_json_str_cio); ca_id_from_details_cio = details_data_cio.get('corporate_action_id')
-                                    except json.JSONDecodeError: pass
-                                if not ca_id_from_details_cio:
-                                    ca_id_from_details_cio = node_cio.findtext('corporate_action_id', '').strip()
-
-                                if cio_type == 'tax' and ("налог за корпоративное действие" in cio_comment.lower() or "tax for corporate action" in cio_comment.lower()):
-                                    tax_date_str = node_cio.findtext('pay_d', node_cio.findtext('datetime', ''))
-                                    tax_date_obj = None
-                                    if tax_date_str:
-                                        try: dt_part = tax_date_str.split(' ')[0]; tax_date_obj = datetime.strptime(dt_part, '%Y-%m-%d').date()
-                                        except ValueError: pass 
-                                    
-                                    if not tax_date_obj or tax_date_obj.year != target_report_year: continue
-
-                                    tax_amount_val = _str_to_decimal_safe(node_cio.findtext('amount', '0'), 'сумма налога', cio_id_for_log_tax, _processing_had_error_local_flag)
-                                    
-                                    target_dividend_event = None
-                                    if ca_id_from_details_cio:
-                                        # Ищем по CA_ID и дате, т.к. ключ мог быть сгенерирован без CA_ID если его не было в 'dividend' событии
-                                        for key, div_event_entry in dividend_events_in_current_file.items():
-                                            if div_event_entry.get('corporate_action_id') == ca_id_from_details_cio:
-                                                # Проверка на разумную близость дат налога и дивиденда
-                                                if tax_date_obj and div_event_entry.get('date') and \
-                                                   tax_date_obj >= div_event_entry.get('date') and \
-                                                   (tax_date_obj - div_event_entry.get('date')).days < 90 : # Увеличил дельту
-                                                    target_dividend_event = div_event_entry; break
-                                    
-                                    if target_dividend_event:
-                                        target_dividend_event['tax_amount'] += abs(tax_amount_val) 
-                                        # Added tax to dividend event
-                                    else: pass
-                            except Exception as e_tax_parse: 
-                                pass
+                        # Налоги сопоставляются с дивидендами после того, как собраны все дивиденды файла
+                        dividend_taxes_in_current_file = []
+                        dividend_index = dividend_index_by_file[file_instance.id] = DividendIndex()
+                        _dispatch_cash_in_outs(cash_in_outs_element, {
+                            'dividend': lambda record: _add_dividend_from_cash_in_out(
+                                record, dividend_events_in_current_file, dividend_index, file_instance, target_report_year,
+                                run_context,
+                            ),
+                            'tax': dividend_taxes_in_current_file.append,
+                            # Агентские комиссии по дивидендам учитываются в _calculate_additional_commissions
+                            'agent_fee': dividend_agent_fees_by_file[file_instance.id].append,
+                        })
+                        for tax_record in dividend_taxes_in_current_file:
+                            _add_dividend_tax_from_cash_in_out(
+                                tax_record, dividend_index, target_report_year, run_context
+                            )
 
                     all_dividend_events_final_list.extend(dividend_events_in_current_file.values()) 
 
-        except ET.ParseError: _processing_had_error_local_flag[0] = True; messages.error(request, f"Ошибка парсинга XML в файле {file_instance.original_filename}.")
-        except Exception as e: _processing_had_error_local_flag[0] = True; messages.error(request, f"Неожиданная ошибка при обработке файла {file_instance.original_filename}.")
+        except ET.ParseError: run_context.mark_error(); run_context.diagnostics.add(f"Ошибка парсинга XML в файле {file_instance.original_filename}.", messages.ERROR)
+        except Exception as e: run_context.mark_error(); run_context.diagnostics.add(f"Неожиданная ошибка при обработке файла {file_instance.original_filename}.", messages.ERROR)
 
     for div_event in all_dividend_events_final_list:
         currency_code_final = div_event['currency']; payment_date_final = div_event['date']; ticker_final = div_event['ticker']
@@ -1585,7 +1838,7 @@ def process_and_get_trade_data(request, user, target_report_year, files_queryset
         if currency_code_final != 'RUB':
             currency_model_f = Currency.objects.filter(char_code=currency_code_final).first()
             if currency_model_f:
-                _, fetched_f, rate_val_fetched = _get_exchange_rate_for_date(request, currency_model_f, payment_date_final, f"дивиденд {ticker_final}")
+                _, fetched_f, rate_val_fetched = run_context.exchange_rate(currency_model_f, payment_date_final, f"дивиденд {ticker_final}")
                 if rate_val_fetched is not None:
                     rate_val_div = rate_val_fetched
                     cbr_rate_str_for_event = f"{rate_val_div:.4f}"
@@ -1702,11 +1955,21 @@ def process_and_get_trade_data(request, user, target_report_year, files_queryset
                     if opt_trade_id:
                         used_option_trade_ids.add(opt_trade_id)
 
-    _process_all_operations_for_fifo(request, trade_and_holding_ops, full_instrument_trade_history_for_fifo, relevant_files_for_history, conversion_events_for_display_accumulator, _processing_had_error_local_flag)
+    # FIFO прогоняем только по инструментам, связанным с продажами целевого года
+    isin_lineage = _build_isin_lineage(file_ca_nodes_cache)
+    relevant_fifo_isins = None
+    if is_relevance_pruning_enabled():
+        trade_and_holding_ops, relevant_fifo_isins = _select_relevant_fifo_operations(
+            trade_and_holding_ops, target_report_year, instruments_with_sales_in_target_year, isin_lineage)
+
+    with run_context.timed('fifo'):
+        _process_fifo_by_families(request, trade_and_holding_ops, full_instrument_trade_history_for_fifo, relevant_files_for_history, conversion_events_for_display_accumulator, run_context, file_ca_nodes_cache, isin_lineage)
 
 
     all_display_events = []
     for isin_key, trades_list_for_isin in full_instrument_trade_history_for_fifo.items():
+        if relevant_fifo_isins is not None and isin_key not in relevant_fifo_isins:
+            continue
         for trade_dict_updated_with_fifo in trades_list_for_isin:
             dt_obj = datetime.min
             if trade_dict_updated_with_fifo.get('date'):
@@ -1837,7 +2100,7 @@ def process_and_get_trade_data(request, user, target_report_year, files_queryset
                     if is_sell_operation: # Для продаж
                         fifo_cost_val = detail_item.get('fifo_cost_rub_decimal', Decimal(0)) 
                         if not isinstance(fifo_cost_val, Decimal): 
-                            fifo_cost_val = _str_to_decimal_safe(fifo_cost_val, 'fifo_cost_rub_decimal aggregation', detail_item.get('trade_id'), _processing_had_error_local_flag)
+                            fifo_cost_val = _str_to_decimal_safe(fifo_cost_val, 'fifo_cost_rub_decimal aggregation', detail_item.get('trade_id'), run_context)
                         total_fifo_cost_rub += fifo_cost_val
                     
                     trade_ids_list.append(str(detail_item.get('trade_id', ''))) 
@@ -1925,79 +2188,28 @@ def process_and_get_trade_data(request, user, target_report_year, files_queryset
         (3 if x.get('display_type') == 'trade' and x.get('event_details') and x['event_details'].get('operation','').lower() == 'sell' else 4))) 
     ))
 
-    instruments_with_sales_in_target_year = set()
-    # Сканируем продажи ТОЛЬКО в файлах целевого года для определения, чью историю показывать.
+    # Продажи целевого года (instruments_with_sales_in_target_year) собраны при разборе файлов выше
     if files_queryset is None:
         files_for_sales_scan_target_year_only = UploadedXMLFile.objects.filter(user=user, year=target_report_year)
     else:
         files_for_sales_scan_target_year_only = files_queryset.filter(year=target_report_year)
 
-    if files_for_sales_scan_target_year_only.exists():
-        for file_instance_scan in files_for_sales_scan_target_year_only:
-            try:
-                file_field = _get_report_file_field(file_instance_scan)
-                if not file_field:
-                    continue
-                with file_field.open('rb') as xml_file_content_stream:
-                    content_bytes = xml_file_content_stream.read(); xml_string_loop_scan = ""
-                    try: xml_string_loop_scan = content_bytes.decode('utf-8')
-                    except UnicodeDecodeError: xml_string_loop_scan = content_bytes.decode('windows-1251', errors='replace')
-                    if not xml_string_loop_scan: continue 
-                    root_scan = ET.fromstring(xml_string_loop_scan); trades_element_scan = root_scan.find('.//trades')
-                    if trades_element_scan:
-                        detailed_element_scan = trades_element_scan.find('detailed')
-                        if detailed_element_scan:
-                            for node_element_scan in detailed_element_scan.findall('node'):
-                                instr_type_el_sale = node_element_scan.find('instr_type')
-                                if instr_type_el_sale is None or instr_type_el_sale.text != '1': continue 
-                                operation_el = node_element_scan.find('operation'); 
-                                isin_el_sale = node_element_scan.find('isin')
-                                isin_to_check_sale = isin_el_sale.text.strip() if isin_el_sale is not None and isin_el_sale.text and isin_el_sale.text.strip() != '-' else None
-                                if not isin_to_check_sale : 
-                                    isin_el_sale_nb = node_element_scan.find('issue_nb')
-                                    isin_to_check_sale = isin_el_sale_nb.text.strip() if isin_el_sale_nb is not None and isin_el_sale_nb.text and isin_el_sale_nb.text.strip() != '-' else None
-                                
-                                if (operation_el is not None and operation_el.text and operation_el.text.strip().lower() == 'sell' and isin_to_check_sale):
-                                    # Проверяем дату продажи, чтобы она была в целевом году
-                                    date_str_sale_scan = node_element_scan.findtext('date')
-                                    if date_str_sale_scan:
-                                        try:
-                                            sale_datetime_scan = datetime.strptime(date_str_sale_scan, '%Y-%m-%d %H:%M:%S')
-                                            if sale_datetime_scan.year == target_report_year:
-                                                instruments_with_sales_in_target_year.add(isin_to_check_sale)
-                                        except ValueError:
-                                            pass
-
-
-            except Exception as e_sales_scan: _processing_had_error_local_flag[0] = True
-
     final_instrument_event_history = defaultdict(list)
-    conversion_map_old_to_new = {}; conversion_map_new_to_old = {}; processed_conversion_ids_for_map = set()
+    # Цепочки конвертаций для отображения строим по фактически примененным конвертациям
     temp_conversion_events_for_map = sorted(
         [evt_wrapper for evt_wrapper in all_display_events if evt_wrapper.get('display_type') == 'conversion_info'],
         key=lambda x: x.get('datetime_obj') or date.min 
     )
     for event_wrapper in temp_conversion_events_for_map: 
         event = event_wrapper.get('event_details')
-        if event and event.get('corp_action_id') not in processed_conversion_ids_for_map: 
+        if event:
             old_i = event.get('old_isin'); new_i = event.get('new_isin')
-            if old_i and new_i and old_i != new_i : # Добавил проверку old_i != new_i
-                 conversion_map_old_to_new[old_i] = new_i; conversion_map_new_to_old[new_i] = old_i; processed_conversion_ids_for_map.add(event['corp_action_id'])
+            if old_i and new_i and old_i != new_i:
+                isin_lineage.add_conversion(old_i, new_i, edge_id=event.get('corp_action_id'))
 
     relevant_isins_for_display = set() 
     for sold_isin in instruments_with_sales_in_target_year: 
-        relevant_isins_for_display.add(sold_isin); temp_isin_chain = sold_isin
-        # Назад по цепочке
-        while temp_isin_chain in conversion_map_new_to_old:
-            prev_isin = conversion_map_new_to_old[temp_isin_chain]
-            if prev_isin == temp_isin_chain or prev_isin in relevant_isins_for_display : break 
-            relevant_isins_for_display.add(prev_isin); temp_isin_chain = prev_isin
-        # Вперед по цепочке от исходно проданного ISIN
-        temp_isin_chain = sold_isin 
-        while temp_isin_chain in conversion_map_old_to_new:
-            next_isin = conversion_map_old_to_new[temp_isin_chain]
-            if next_isin == temp_isin_chain or next_isin in relevant_isins_for_display : break
-            relevant_isins_for_display.add(next_isin); temp_isin_chain = next_isin
+        relevant_isins_for_display.update(isin_lineage.conversion_chain(sold_isin))
             
     for event_data_wrapper in all_display_events:
         details = event_data_wrapper.get('event_details'); display_type = event_data_wrapper.get('display_type')
@@ -2007,37 +2219,14 @@ def process_and_get_trade_data(request, user, target_report_year, files_queryset
             elif display_type == 'conversion_info': current_event_isin = details.get('new_isin') 
         
         if not current_event_isin: 
-            log_id = "N/A"; 
-            if details: log_id = details.get('trade_id', details.get('corp_action_id', 'Details available but no ID'))
             continue
 
-        grouping_key_isin = current_event_isin
-        # Проходим по цепочке до самого "нового" ISIN для группировки
-        visited_for_grouping_key = {grouping_key_isin}
-        while grouping_key_isin in conversion_map_old_to_new:
-            next_in_chain = conversion_map_old_to_new[grouping_key_isin]
-            if next_in_chain == grouping_key_isin or next_in_chain in visited_for_grouping_key: break # Предотвращаем цикл
-            grouping_key_isin = next_in_chain
-            visited_for_grouping_key.add(grouping_key_isin)
+        # Группируем по самому "новому" ISIN цепочки
+        grouping_key_isin = isin_lineage.latest(current_event_isin)
         
         should_display_this_event = False
         # Проверяем релевантность всей цепочки, к которой принадлежит current_event_isin
-        temp_check_isin = current_event_isin
-        chain_to_check = {temp_check_isin}
-        # Назад
-        temp_prev = temp_check_isin
-        visited_prev = {temp_prev}
-        while temp_prev in conversion_map_new_to_old:
-            p = conversion_map_new_to_old[temp_prev]
-            if p == temp_prev or p in visited_prev: break
-            chain_to_check.add(p); temp_prev = p; visited_prev.add(p)
-        # Вперед
-        temp_next = temp_check_isin
-        visited_next = {temp_next}
-        while temp_next in conversion_map_old_to_new:
-            n = conversion_map_old_to_new[temp_next]
-            if n == temp_next or n in visited_next: break
-            chain_to_check.add(n); temp_next = n; visited_next.add(n)
+        chain_to_check = set(isin_lineage.conversion_chain(current_event_isin))
         
         if not relevant_isins_for_display.isdisjoint(chain_to_check): # Если есть пересечение
             should_display_this_event = True
@@ -2135,7 +2324,7 @@ def process_and_get_trade_data(request, user, target_report_year, files_queryset
                     commission_rub_buy = Decimal(0)
                     opt_comm_currency_model = Currency.objects.filter(char_code=opt_commission_currency).first()
                     if opt_comm_currency_model and dt_obj:
-                        _, _, opt_comm_rate = _get_exchange_rate_for_date(request, opt_comm_currency_model, dt_obj.date(), f"для комиссии покупки опциона {opt_trade.get('trade_id', 'N/A')}")
+                        _, _, opt_comm_rate = run_context.exchange_rate(opt_comm_currency_model, dt_obj.date(), f"для комиссии покупки опциона {opt_trade.get('trade_id', 'N/A')}")
                         if opt_comm_rate is not None:
                             commission_rub_buy = (commission * opt_comm_rate).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
 
@@ -2182,7 +2371,7 @@ def process_and_get_trade_data(request, user, target_report_year, files_queryset
                 commission_rub = Decimal(0)
                 opt_sell_comm_currency_model = Currency.objects.filter(char_code=opt_sell_commission_currency).first()
                 if opt_sell_comm_currency_model and dt_obj:
-                    _, _, opt_sell_comm_rate = _get_exchange_rate_for_date(request, opt_sell_comm_currency_model, dt_obj.date(), f"для комиссии продажи опциона {opt_trade.get('trade_id', 'N/A')}")
+                    _, _, opt_sell_comm_rate = run_context.exchange_rate(opt_sell_comm_currency_model, dt_obj.date(), f"для комиссии продажи опциона {opt_trade.get('trade_id', 'N/A')}")
                     if opt_sell_comm_rate is not None:
                         commission_rub = (commission * opt_sell_comm_rate).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
 
@@ -2254,13 +2443,13 @@ def process_and_get_trade_data(request, user, target_report_year, files_queryset
                                 elif currency_code != 'RUB': 
                                     cbr_rate_for_sale = Decimal(0)
 
-                            sale_amount_curr = _str_to_decimal_safe(sale_amount_curr, 'sale_amount_for_total_profit_calc', details.get('trade_id'), _processing_had_error_local_flag)
+                            sale_amount_curr = _str_to_decimal_safe(sale_amount_curr, 'sale_amount_for_total_profit_calc', details.get('trade_id'), run_context)
                             income_from_sale_gross_rub = decimal_context.multiply(sale_amount_curr, cbr_rate_for_sale)
                             
                             total_expenses_for_sale_rub = details.get('fifo_cost_rub_decimal', Decimal(0))
                             if total_expenses_for_sale_rub is None: total_expenses_for_sale_rub = Decimal(0) 
                             elif not isinstance(total_expenses_for_sale_rub, Decimal): 
-                                total_expenses_for_sale_rub = _str_to_decimal_safe(total_expenses_for_sale_rub, 'total_expenses_for_profit_calc', details.get('trade_id'), _processing_had_error_local_flag)
+                                total_expenses_for_sale_rub = _str_to_decimal_safe(total_expenses_for_sale_rub, 'total_expenses_for_profit_calc', details.get('trade_id'), run_context)
 
                             # Для open_short_sale, fifo_cost_rub_decimal = комиссия продажи. Это корректно для НДФЛ.
                             profit_for_this_sale_rub = income_from_sale_gross_rub - total_expenses_for_sale_rub
@@ -2293,9 +2482,9 @@ def process_and_get_trade_data(request, user, target_report_year, files_queryset
 
 
     if not final_instrument_event_history and not all_dividend_events_final_list and instruments_with_sales_in_target_year:
-         messages.warning(request, f"Найдены продажи в {target_report_year} для {list(instruments_with_sales_in_target_year)}, но не удалось собрать историю операций или дивидендов для них.")
+         run_context.diagnostics.add(f"Найдены продажи в {target_report_year} для {list(instruments_with_sales_in_target_year)}, но не удалось собрать историю операций или дивидендов для них.")
     elif not final_instrument_event_history and not all_dividend_events_final_list and not instruments_with_sales_in_target_year and files_for_sales_scan_target_year_only.exists():
-        messages.info(request, f"В отчетах за {target_report_year} год не найдено продаж по ценным бумагам и не найдено дивидендов для отображения.")
+        run_context.diagnostics.add(f"В отчетах за {target_report_year} год не найдено продаж по ценным бумагам и не найдено дивидендов для отображения.", messages.INFO)
     
     # Помечаем операции, связанные с продажами целевого года
     # Сначала собираем все ID покупок, использованных для продаж целевого года
@@ -2553,14 +2742,17 @@ def process_and_get_trade_data(request, user, target_report_year, files_queryset
                 option_data['link_colors'] = delivery_colors
 
     # Используем files_for_sales_scan_target_year_only для расчета комиссий за целевой год
-    dividend_commissions_details, other_commissions_details, total_other_commissions_rub_val = _calculate_additional_commissions(request, user, target_report_year, files_for_sales_scan_target_year_only, _processing_had_error_local_flag)
+    dividend_commissions_details, other_commissions_details, total_other_commissions_rub_val = _calculate_additional_commissions(
+        request, user, target_report_year, files_for_sales_scan_target_year_only, run_context,
+        dividend_agent_fees_by_file, dividend_index_by_file,
+    )
 
     # Accumulate other commissions by currency
     for category_data in other_commissions_details.values():
         for currency, amount in category_data.get('currencies', {}).items():
             other_commissions_by_currency[currency] += amount
 
-    if _processing_had_error_local_flag[0]: 
+    if run_context.had_error: 
         pass
     
     # Добавляем опционы в final_instrument_event_history как отдельные группы
@@ -2665,7 +2857,7 @@ def process_and_get_trade_data(request, user, target_report_year, files_queryset
         all_dividend_events_final_list,
         total_dividends_rub_for_year,
         total_sales_profit_rub_for_year + total_sales_profit_rub_1532_for_year,  # Общий профит для обратной совместимости
-        _processing_had_error_local_flag[0],
+        run_context.had_error,
         dividend_commissions_details,
         other_commissions_details,
         total_other_commissions_rub_val,
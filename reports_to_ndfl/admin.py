@@ -1,6 +1,6 @@
 # reports_to_ndfl/admin.py
 from django.contrib import admin
-from .models import UploadedXMLFile, BrokerReport
+from .models import UploadedXMLFile, BrokerReport, ProcessingRun, YearlyReportResult
 
 @admin.register(UploadedXMLFile)
 class UploadedXMLFileAdmin(admin.ModelAdmin):
@@ -18,3 +18,18 @@ class BrokerReportAdmin(admin.ModelAdmin):
     search_fields = ('original_filename', 'user__username', 'year')
     readonly_fields = ('uploaded_at',)
     date_hierarchy = 'uploaded_at'
+
+
+@admin.register(YearlyReportResult)
+class YearlyReportResultAdmin(admin.ModelAdmin):
+    list_display = ('broker_type', 'user', 'year', 'computed_at')
+    list_filter = ('broker_type', 'year', 'user')
+    exclude = ('result',)
+    readonly_fields = ('computed_at',)
+
+
+@admin.register(ProcessingRun)
+class ProcessingRunAdmin(admin.ModelAdmin):
+    list_display = ('broker_type', 'user', 'year', 'status', 'created_at', 'finished_at')
+    list_filter = ('status', 'broker_type', 'year')
+    readonly_fields = ('created_at', 'started_at', 'finished_at')
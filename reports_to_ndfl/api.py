@@ -0,0 +1,143 @@
+# reports_to_ndfl/api.py
+"""
+JSON API для пакетной обработки отчётов (аутентификация по JWT, см. api_urls).
+
+Загрузка отчётов, постановка расчёта за год в очередь (processing_runs), опрос статуса
+и получение сохранённого результата. Загрузка и расчёт идут тем же кодом, что и страница
+отчёта (uploads, yearly_results). Результат parser.process() отдаётся словарём с именованными
+полями; Decimal — строками, чтобы суммы не теряли точность.
+"""
+from django.http import Http404
+from django.urls import reverse
+from rest_framework import generics, serializers, status
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+from .models import BrokerReport, ProcessingRun, YearlyReportResult
+from .processing_runs import enqueue_run
+from .uploads import extract_uploads_metadata, save_uploaded_reports
+from .yearly_results import invalidate_year_results, load_year_run, result_payload
+
+REPORT_EXTENSIONS = {'ffg': '.xml', 'ib': '.csv'}
+
+
+class BrokerReportSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = BrokerReport
+        fields = ('id', 'broker_type', 'year', 'original_filename', 'account_number', 'uploaded_at')
+
+
+class ReportUploadSerializer(serializers.Serializer):
+    broker_type = serializers.ChoiceField(choices=BrokerReport.BROKER_TYPES)
+    report_file = serializers.ListField(child=serializers.FileField(), allow_empty=False)
+
+    def validate(self, attrs):
+        expected_ext = REPORT_EXTENSIONS[attrs['broker_type']]
+        invalid_files = [f.name for f in attrs['report_file'] if not f.name.lower().endswith(expected_ext)]
+        if invalid_files:
+            raise serializers.ValidationError({'report_file': (
+                f"Для выбранного брокера требуется формат {expected_ext.upper()}. "
+                f"Неподходящие файлы: {', '.join(invalid_files)}"
+            )})
+        return attrs
+
+
+class ProcessingRunSerializer(serializers.ModelSerializer):
+    result_url = serializers.SerializerMethodField()
+
+    class Meta:
+        model = ProcessingRun
+        fields = (
+            'id', 'broker_type', 'year', 'all_years', 'refresh', 'status', 'error',
+            'created_at', 'started_at', 'finished_at', 'result_url',
+        )
+        read_only_fields = ('status', 'error', 'created_at', 'started_at', 'finished_at')
+
+    def get_result_url(self, run):
+        if run.status != ProcessingRun.STATUS_DONE:
+            return None
+        url = reverse('api_year_result', kwargs={'broker_type': run.broker_type, 'year': run.year})
+        request = self.context.get('request')
+        return request.build_absolute_uri(url) if request else url
+
+    def validate(self, attrs):
+        user = self.context['request'].user
+        reports = BrokerReport.objects.filter(user=user, broker_type=attrs['broker_type'])
+        if not reports.filter(year=attrs['year']).exists():
+            raise serializers.ValidationError({'year': f"Нет отчётов за {attrs['year']} год для этого брокера."})
+        return attrs
+
+
+class ReportListCreateView(APIView):
+    """GET — загруженные отчёты; POST (multipart: broker_type, report_file[]) — загрузка отчётов."""
+
+    def get(self, request):
+        reports = BrokerReport.objects.filter(user=request.user).order_by('broker_type', 'year', 'uploaded_at')
+        broker_type = request.query_params.get('broker_type')
+        if broker_type:
+            reports = reports.filter(broker_type=broker_type)
+        return Response(BrokerReportSerializer(reports, many=True).data)
+
+    def post(self, request):
+        serializer = ReportUploadSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        broker_type = serializer.validated_data['broker_type']
+        upload_results = extract_uploads_metadata(serializer.validated_data['report_file'], broker_type)
+        created = save_uploaded_reports(request.user, broker_type, upload_results)
+        if created:
+            invalidate_year_results(request.user, broker_type)
+        files = [
+            {key: result[key] for key in ('original_filename', 'year', 'account_number', 'status', 'error')}
+            for result in upload_results
+        ]
+        return Response(
+            {'files': files, 'reports': BrokerReportSerializer(created, many=True).data},
+            status=status.HTTP_201_CREATED if created else status.HTTP_200_OK,
+        )
+
+
+class ProcessingRunListCreateView(generics.ListCreateAPIView):
+    """GET — расчёты пользователя; POST {broker_type, year[, all_years, refresh]} — поставить расчёт в очередь."""
+    serializer_class = ProcessingRunSerializer
+
+    def get_queryset(self):
+        return ProcessingRun.objects.filter(user=self.request.user)
+
+    def create(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        run = serializer.save(user=request.user)
+        enqueue_run(run)
+        run.refresh_from_db()
+        return Response(
+            self.get_serializer(run).data,
+            status=status.HTTP_202_ACCEPTED,
+            headers={'Location': reverse('api_run_detail', kwargs={'pk': run.pk})},
+        )
+
+
+class ProcessingRunDetailView(generics.RetrieveAPIView):
+    """Статус расчёта."""
+    serializer_class = ProcessingRunSerializer
+
+    def get_queryset(self):
+        return ProcessingRun.objects.filter(user=self.request.user)
+
+
+class YearResultView(APIView):
+    """Сохранённый результат расчёта за год: поля parser.process() и диагностика."""
+
+    def get(self, request, broker_type, year):
+        year_run = load_year_run(request.user, broker_type, year)
+        if year_run is None:
+            raise Http404("Нет сохранённого расчёта за этот год.")
+        computed_at = YearlyReportResult.objects.filter(
+            user=request.user, broker_type=broker_type, year=year,
+        ).values_list('computed_at', flat=True).first()
+        return Response({
+            'broker_type': broker_type,
+            'year': year,
+            'computed_at': serializers.DateTimeField().to_representation(computed_at) if computed_at else None,
+            'diagnostics': year_run.diagnostics,
+            'result': result_payload(year_run.result),
+        })
@@ -0,0 +1,13 @@
+from django.urls import path
+from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
+
+from . import api
+
+urlpatterns = [
+    path('token/', TokenObtainPairView.as_view(), name='api_token'),
+    path('token/refresh/', TokenRefreshView.as_view(), name='api_token_refresh'),
+    path('reports/', api.ReportListCreateView.as_view(), name='api_reports'),
+    path('runs/', api.ProcessingRunListCreateView.as_view(), name='api_runs'),
+    path('runs/<int:pk>/', api.ProcessingRunDetailView.as_view(), name='api_run_detail'),
+    path('results/<str:broker_type>/<int:year>/', api.YearResultView.as_view(), name='api_year_result'),
+]
@@ -1,6 +1,15 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class ReportsToNdflConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'reports_to_ndfl'
+
+    def ready(self):
+        # 'eager' — шрифты и шаблоны PDF загружаются при старте (gunicorn --preload: общие для рабочих
+        # процессов через copy-on-write); 'lazy' — при первом построении PDF, процессы стартуют быстрее
+        if getattr(settings, 'NDFL_PDF_WARMUP', 'lazy') == 'eager':
+            from .pdf_report import warm_up_pdf
+
+            warm_up_pdf()
@@ -0,0 +1,160 @@
+# reports_to_ndfl/description_rules.py
+"""
+Классификация текстовых описаний операций брокера по таблице предкомпилированных правил.
+
+Все регулярные выражения компилируются один раз при импорте. Ключевые слова правил
+(«дивиденд», «выдача прав», «слияние» …) собраны в одно выражение с именованными группами,
+поэтому все признаки описания находятся за один проход по строке, а не отдельной проверкой
+на каждое слово. В отчётах одни и те же описания повторяются десятки раз (дивиденд, налог
+и FEE по каждой выплате), поэтому результат разбора описания запоминается.
+"""
+import re
+from collections import namedtuple
+from functools import lru_cache
+
+# Сколько различных описаний помнить (на процесс)
+DESCRIPTION_CACHE_SIZE = 16384
+
+SYMBOL_ISIN_RE = re.compile(r'^([A-Z0-9.\-]+)\s*\(([A-Z0-9]{12})\)')
+FEE_TICKER_RE = re.compile(r'^([A-Z0-9.]+)\(')
+FEE_SUFFIX_RE = re.compile(r'\s*-\s*FEE\s*$', re.IGNORECASE)
+TAX_SUFFIX_RE = re.compile(r'\s*-\s*[A-Z]{2}\s*(налог|tax)\s*$', re.IGNORECASE)
+TRAILING_PARENS_RE = re.compile(r'(?:\s*\([^)]*\)\s*)+$')
+
+SECURITY_ID_RE = re.compile(r'^[A-Z0-9]{12}$')
+TICKER_ISIN_PAIR_RE = re.compile(r'([A-Z0-9\\.]+)\(([A-Z0-9]{12})\)')
+ALT_TICKER_ISIN_PAIR_RE = re.compile(r'\(([A-Z0-9\\.]+),\s*[^,]+,\s*([A-Z0-9]{12})\)')
+INSTRUMENT_NAME_SUFFIX_RE = re.compile(r'\s*\([^()]+\)\s*$')
+BASE_DESCRIPTION_RE = re.compile(r'^(.+?)\s*\([^()]+\)\s*$')
+
+FULL_CONVERSION_COMMENT_RE = re.compile(
+    r"Conversion of securities\s+"
+    r"(?P<old_ticker>[A-Z0-9\.\-\_]+)\s*\((?P<old_isin>[A-Z0-9]+)\)\s*->\s*"
+    r"(?P<new_ticker>[A-Z0-9\.\-\_]+)\s*\((?P<new_isin>[A-Z0-9]+)\)",
+    re.IGNORECASE
+)
+
+# Правила: (признак, ключевые слова в нижнем регистре, встречающиеся в описании)
+FEE_RULES = (
+    ('dividend', ('дивиденд', 'dividend')),
+)
+CORPORATE_ACTION_RULES = (
+    ('rights_issue', ('выдача прав', 'rights issue')),
+    ('subscription', ('подписка', 'subscription')),
+    ('merger', ('слияние', 'merger')),
+    ('spinoff', ('спин-офф', 'spin-off', 'spinoff')),
+)
+
+
+def compile_rules(rules):
+    """
+    Одно выражение для всей таблицы правил. Альтернатива стоит внутри опережающей проверки,
+    поэтому finditer пробует каждую позицию строки и находит все вхождения, включая перекрывающиеся.
+    """
+    alternatives = '|'.join(
+        f"(?P<{name}>{'|'.join(re.escape(keyword) for keyword in keywords)})"
+        for name, keywords in rules
+    )
+    return re.compile(f'(?=(?:{alternatives}))')
+
+
+def matched_rules(compiled_rules, text_lower):
+    """Множество признаков, ключевые слова которых есть в тексте (текст уже в нижнем регистре)."""
+    return frozenset(match.lastgroup for match in compiled_rules.finditer(text_lower))
+
+
+_FEE_RULES_RE = compile_rules(FEE_RULES)
+_CORPORATE_ACTION_RULES_RE = compile_rules(CORPORATE_ACTION_RULES)
+
+FeeDescription = namedtuple('FeeDescription', ['ticker', 'isin', 'dividend_key', 'is_dividend_related'])
+CorporateActionDescription = namedtuple(
+    'CorporateActionDescription',
+    ['pairs', 'base_description', 'is_rights_issue', 'is_subscription', 'is_merger', 'is_spinoff'],
+)
+
+
+@lru_cache(maxsize=DESCRIPTION_CACHE_SIZE)
+def extract_symbol_isin(description):
+    """'TICKER(ISIN) ...' -> (TICKER, ISIN); (None, None), если описание начинается не так."""
+    if not description:
+        return None, None
+    match = SYMBOL_ISIN_RE.match(description.strip())
+    if not match:
+        return None, None
+    return match.group(1), match.group(2)
+
+
+@lru_cache(maxsize=DESCRIPTION_CACHE_SIZE)
+def extract_fee_ticker(description):
+    if not description:
+        return None
+    match = FEE_TICKER_RE.match(description.strip())
+    return match.group(1) if match else None
+
+
+@lru_cache(maxsize=DESCRIPTION_CACHE_SIZE)
+def normalize_dividend_description(description):
+    """Описание без окончаний ' - FEE', ' - XX Налог/Tax' и завершающих скобок (см. IBParser)."""
+    if not description:
+        return None
+    desc = description.strip()
+    desc = FEE_SUFFIX_RE.sub('', desc)
+    desc = TAX_SUFFIX_RE.sub('', desc)
+    desc = TRAILING_PARENS_RE.sub('', desc)
+    return desc.strip() if desc else None
+
+
+@lru_cache(maxsize=DESCRIPTION_CACHE_SIZE)
+def classify_fee_description(description):
+    """
+    Разбор описания строки «Сборы/комиссии»: тикер и ISIN, ключ дивиденда и признак
+    связи с дивидендом по названию (окончание ' - FEE' или слово «дивиденд»/«dividend»).
+    """
+    ticker, isin = extract_symbol_isin(description)
+    text = description or ''
+    is_dividend_related = bool(FEE_SUFFIX_RE.search(text)) or 'dividend' in matched_rules(_FEE_RULES_RE, text.lower())
+    return FeeDescription(ticker, isin, normalize_dividend_description(description), is_dividend_related)
+
+
+@lru_cache(maxsize=DESCRIPTION_CACHE_SIZE)
+def classify_corporate_action(description):
+    """
+    Разбор описания корпоративного действия: пары (тикер, ISIN) без повторов в порядке появления,
+    базовое описание для связывания строк одного события и тип действия. Тип определяется
+    по описанию без последних скобок с названием инструмента, чтобы слова вроде SUBSCRIPTION
+    в названии не принимались за тип действия.
+    """
+    text = description or ''
+    pairs = []
+    seen_pairs = set()
+    for pair in TICKER_ISIN_PAIR_RE.findall(text) + ALT_TICKER_ISIN_PAIR_RE.findall(text):
+        if pair not in seen_pairs:
+            seen_pairs.add(pair)
+            pairs.append(pair)
+
+    base_match = BASE_DESCRIPTION_RE.match(text)
+    base_description = base_match.group(1).strip() if base_match else text.strip()
+
+    kinds = matched_rules(_CORPORATE_ACTION_RULES_RE, INSTRUMENT_NAME_SUFFIX_RE.sub('', text).lower())
+    return CorporateActionDescription(
+        tuple(pairs),
+        base_description,
+        'rights_issue' in kinds,
+        'subscription' in kinds,
+        'merger' in kinds,
+        'spinoff' in kinds,
+    )
+
+
+@lru_cache(maxsize=DESCRIPTION_CACHE_SIZE)
+def parse_full_conversion_comment(comment_str):
+    """Комментарий FFG 'Conversion of securities OLD (ISIN) -> NEW (ISIN)' -> словарь тикеров и ISIN."""
+    if not comment_str:
+        return None
+    match = FULL_CONVERSION_COMMENT_RE.search(comment_str)
+    if not match:
+        return None
+    return {
+        'old_ticker': match.group('old_ticker').strip(), 'old_isin': match.group('old_isin').strip(),
+        'new_ticker': match.group('new_ticker').strip(), 'new_isin': match.group('new_isin').strip(),
+    }
@@ -0,0 +1,83 @@
+# reports_to_ndfl/diagnostics.py
+"""
+Сгруппированная диагностика расчёта вместо отдельного сообщения на каждую строку отчёта.
+
+На большом счёте разбор выдаёт тысячи однотипных предупреждений («используется ближайший
+курс», «курс не найден для сделки …»). Сообщения django.contrib.messages сериализуются в
+сессию, поэтому такие расчёты раздували её и замедляли все следующие запросы. Diagnostics
+группирует предупреждения по виду, хранит число случаев и несколько примеров, а итог
+сохраняется вместе с результатом расчёта (YearlyReportResult.diagnostics).
+"""
+import re
+
+from django.conf import settings
+from django.contrib import messages
+
+# Числа, даты, идентификаторы сделок: части сообщения, которые отличаются от строки к строке
+_VARIABLE_PARTS_RE = re.compile(r'\d[\d.,:/\-]*')
+
+
+def message_kind(level, message):
+    """Вид сообщения без явного kind: уровень и текст, в котором числа и даты заменены на '#'."""
+    return level, _VARIABLE_PARTS_RE.sub('#', message)
+
+
+class Diagnostics:
+    """Предупреждения одного расчёта, сгруппированные по виду: число случаев и первые sample_size примеров."""
+
+    def __init__(self, sample_size=None):
+        if sample_size is None:
+            sample_size = getattr(settings, 'NDFL_DIAGNOSTICS_SAMPLE_SIZE', 5)
+        self.sample_size = sample_size
+        self._entries = {}
+
+    def add(self, message, level=messages.WARNING, kind=None, summary=None):
+        """
+        Учитывает одно сообщение. kind — ключ группы (по умолчанию message_kind), summary — текст
+        итога группы с подстановкой {count}; без него итогом служит первый пример.
+        """
+        key = kind if kind is not None else message_kind(level, message)
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = {'level': level, 'summary': summary, 'count': 0, 'samples': []}
+        entry['count'] += 1
+        entry['level'] = max(entry['level'], level)
+        if len(entry['samples']) < self.sample_size:
+            entry['samples'].append(message)
+
+    def merge(self, other):
+        """Добавляет группы другого сборщика (например, из рабочего процесса пула)."""
+        for key, other_entry in other._entries.items():
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = {
+                    'level': other_entry['level'], 'summary': other_entry['summary'], 'count': 0, 'samples': [],
+                }
+            entry['count'] += other_entry['count']
+            entry['level'] = max(entry['level'], other_entry['level'])
+            entry['samples'].extend(other_entry['samples'][:self.sample_size - len(entry['samples'])])
+
+    def __len__(self):
+        return len(self._entries)
+
+    def as_list(self):
+        """
+        Группы по убыванию важности и числа случаев — список словарей
+        {'level_tag', 'text', 'count', 'samples'} для шаблона и JSON.
+        """
+        items = []
+        for entry in sorted(self._entries.values(), key=lambda item: (-item['level'], -item['count'])):
+            count = entry['count']
+            if entry['summary']:
+                text = entry['summary'].format(count=count)
+            elif count == 1:
+                text = entry['samples'][0]
+            else:
+                text = f"{entry['samples'][0]} (и ещё похожих: {count - 1})"
+            items.append({
+                'level_tag': messages.DEFAULT_TAGS.get(entry['level'], ''),
+                'text': text,
+                'count': count,
+                'samples': list(entry['samples']),
+            })
+        return items
@@ -0,0 +1,121 @@
+# reports_to_ndfl/dividend_index.py
+"""
+Индексы дивидендов для сопоставления с налогами и комиссиями.
+
+Дивиденды группируются по ключу (corporate_action_id, тикер + валюта) и внутри группы
+упорядочиваются по дате, поэтому поиск дивиденда для строки налога или комиссии — это
+bisect по датам одной группы, а не перебор всех дивидендов файла.
+"""
+import bisect
+from collections import defaultdict
+from datetime import timedelta
+
+# Налог или агентская комиссия относятся к дивиденду, выплаченному не более чем за столько дней до них
+DIVIDEND_MATCH_WINDOW_DAYS = 90
+
+
+class DateBuckets:
+    """
+    Элементы, сгруппированные по ключу и упорядоченные внутри группы по дате (при равных — по порядку добавления).
+
+    Группа сортируется один раз при первом поиске после добавлений, поиск — bisect по датам.
+    Элементы без даты в поиске по датам не участвуют, но учитываются в first().
+    """
+
+    def __init__(self):
+        self._entries = defaultdict(list)  # (дата, порядковый номер добавления, элемент)
+        self._dates = {}                   # ключ -> отсортированные даты группы
+        self._first = {}
+        self._added = 0
+
+    def add(self, key, item_date, item):
+        self._first.setdefault(key, item)
+        if item_date is None:
+            return
+        self._entries[key].append((item_date, self._added, item))
+        self._added += 1
+        self._dates.pop(key, None)
+
+    def first(self, key):
+        """Первый добавленный элемент группы (с датой или без)."""
+        return self._first.get(key)
+
+    def _sorted(self, key):
+        dates = self._dates.get(key)
+        if dates is None:
+            entries = self._entries.get(key, [])
+            entries.sort(key=lambda entry: (entry[0], entry[1]))
+            dates = self._dates[key] = [entry[0] for entry in entries]
+        return dates, self._entries.get(key, [])
+
+    def in_range(self, key, start, end):
+        """[(дата, порядковый номер, элемент)] группы key с датой в [start, end], по возрастанию даты."""
+        dates, entries = self._sorted(key)
+        return entries[bisect.bisect_left(dates, start):bisect.bisect_right(dates, end)]
+
+    def first_added_in_range(self, key, start, end):
+        entries = self.in_range(key, start, end)
+        return min(entries, key=lambda entry: entry[1])[2] if entries else None
+
+    def latest_in_range(self, key, start, end):
+        entries = self.in_range(key, start, end)
+        return entries[-1][2] if entries else None
+
+    def nearest(self, key, target_date):
+        """
+        Элемент группы с ближайшей к target_date датой; при равном удалении — с более ранней датой,
+        при равной дате — добавленный первым. Без target_date или без дат в группе — first(key).
+        """
+        dates, entries = self._sorted(key)
+        if target_date is None or not dates:
+            return self.first(key)
+        position = bisect.bisect_left(dates, target_date)
+        best = position if position < len(dates) else None
+        if position > 0:
+            before = bisect.bisect_left(dates, dates[position - 1])
+            if best is None or target_date - dates[before] <= dates[best] - target_date:
+                best = before
+        return entries[best][2]
+
+
+class DividendIndex:
+    """Дивиденды отчёта по corporate_action_id и по (тикер, валюта)."""
+
+    def __init__(self):
+        self._by_corporate_action = DateBuckets()
+        self._by_ticker = DateBuckets()
+
+    def add(self, dividend_event):
+        dividend_date = dividend_event.get('date')
+        if not dividend_date:
+            return
+        corporate_action_id = dividend_event.get('corporate_action_id')
+        if corporate_action_id:
+            self._by_corporate_action.add(corporate_action_id, dividend_date, dividend_event)
+        ticker = (dividend_event.get('ticker') or '').upper()
+        if ticker:
+            self._by_ticker.add((ticker, dividend_event.get('currency')), dividend_date, dividend_event)
+
+    @staticmethod
+    def _window(event_date):
+        return event_date - timedelta(days=DIVIDEND_MATCH_WINDOW_DAYS - 1), event_date
+
+    def match_tax(self, corporate_action_id, ticker, currency, tax_date):
+        """
+        Дивиденд, к которому относится налог: с тем же corporate_action_id (налог без него — с тем же
+        тикером и валютой), выплаченный в день налога или раньше, но не более чем за 90 дней.
+        Из нескольких подходящих — добавленный первым.
+        """
+        start, end = self._window(tax_date)
+        if corporate_action_id:
+            return self._by_corporate_action.first_added_in_range(corporate_action_id, start, end)
+        if ticker:
+            return self._by_ticker.first_added_in_range((ticker.upper(), currency), start, end)
+        return None
+
+    def match_fee(self, ticker, currency, fee_date):
+        """Ближайший по дате дивиденд того же тикера и валюты, выплаченный не позже комиссии (в пределах 90 дней)."""
+        if not ticker:
+            return None
+        start, end = self._window(fee_date)
+        return self._by_ticker.latest_in_range((ticker.upper(), currency), start, end)
@@ -0,0 +1,90 @@
+# reports_to_ndfl/fifo_pool.py
+"""
+Параллельный FIFO по независимым семействам инструментов.
+
+Семейства (см. instrument_lineage) не обмениваются лотами, поэтому FIFO каждого можно
+считать в отдельном процессе. Семейства раскладываются по корзинам примерно равного
+размера, корзины считаются в пуле процессов и результаты сливаются в основном процессе.
+Пул включается только для больших историй; если пул не запустился или его рабочий процесс
+аварийно завершился, задачи выполняются в текущем процессе. Исключения самих задач пробрасываются.
+"""
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+
+def fifo_worker_count(operations_count, families_count):
+    """Число процессов для FIFO; 1 — считать в текущем процессе."""
+    if families_count < 2:
+        return 1
+    if operations_count < getattr(settings, 'NDFL_FIFO_PARALLEL_MIN_OPERATIONS', 5000):
+        return 1
+    workers = getattr(settings, 'NDFL_FIFO_WORKERS', None) or os.cpu_count() or 1
+    return max(1, min(int(workers), families_count))
+
+
+def split_families_into_buckets(family_sizes, buckets_count):
+    """
+    Раскладывает семейства {ключ: число операций} по buckets_count корзинам
+    (крупные — первыми, каждое в наименее загруженную). Возвращает список списков ключей.
+    """
+    buckets = [[] for _ in range(max(1, buckets_count))]
+    loads = [0] * len(buckets)
+    for family_key, size in sorted(family_sizes.items(), key=lambda item: -item[1]):
+        idx = loads.index(min(loads))
+        buckets[idx].append(family_key)
+        loads[idx] += size
+    return [bucket for bucket in buckets if bucket]
+
+
+def init_worker():
+    """Инициализатор рабочего процесса пула."""
+    import django
+
+    django.setup()
+
+
+def close_connections_before_fork():
+    """
+    Закрывает соединения с БД текущего процесса перед запуском пула, чтобы рабочие процессы
+    не унаследовали открытые сессии. Внутри транзакции соединение закрывать нельзя —
+    тогда возвращает False, и задачи нужно выполнить в текущем процессе.
+    """
+    if any(connection.in_atomic_block for connection in connections.all(initialized_only=True)):
+        return False
+    connections.close_all()
+    return True
+
+
+def run_in_process_pool(func, tasks, workers):
+    """
+    Выполняет func(*task) для каждой задачи, по возможности в пуле из workers процессов.
+    Возвращает результаты в порядке задач; исключение func пробрасывается вызывающему.
+    """
+    if workers > 1 and len(tasks) > 1 and close_connections_before_fork():
+        executor = None
+        try:
+            executor = ProcessPoolExecutor(max_workers=min(workers, len(tasks)), initializer=init_worker)
+            futures = [executor.submit(func, *task) for task in tasks]
+        except (OSError, NotImplementedError, BrokenProcessPool) as exc:
+            # Нет fork или семафоров (sem_open), процесс не запустился
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+            logger.warning("Пул процессов не запустился, задачи выполняются в текущем процессе: %r", exc)
+        else:
+            with executor:
+                try:
+                    return [future.result() for future in futures]
+                except BrokenProcessPool as exc:
+                    # Рабочий процесс убит (нехватка памяти, сигнал); задачи не меняют общего состояния
+                    logger.warning("Рабочий процесс пула завершился аварийно, задачи выполняются в текущем процессе: %r", exc)
+                except BaseException:
+                    executor.shutdown(cancel_futures=True)
+                    raise
+    return [func(*task) for task in tasks]
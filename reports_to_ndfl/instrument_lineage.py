@@ -0,0 +1,152 @@
+# reports_to_ndfl/instrument_lineage.py
+"""
+Родословная инструментов: какие тикеры, ISIN и групповые ключи (WARRANT_/OPTION_)
+относятся к одному инструменту и как они переходят друг в друга при конвертациях.
+
+Структура строится один раз за прогон обработки и используется для отбора инструментов
+перед FIFO, переноса лотов при конвертации и группировки истории для отображения.
+"""
+from collections import defaultdict
+
+from django.conf import settings
+
+
+def is_relevance_pruning_enabled():
+    return getattr(settings, 'NDFL_FIFO_RELEVANCE_PRUNING', True)
+
+
+def isin_node(isin):
+    """Ключ ISIN в графе связей (чтобы не совпасть с тикером)."""
+    isin = (isin or '').strip()
+    return f"ISIN:{isin}" if isin else None
+
+
+class InstrumentLineage:
+    """
+    Семейства инструментов (union-find) и цепочки конвертаций.
+
+    Семейство — связная компонента ключей (тикеры, isin_node(ISIN), WARRANT_/OPTION_-ключи),
+    объединённых сделками, справочником инструментов и корп. действиями; проверка
+    «один инструмент» выполняется за почти O(1). Цепочки конвертаций old -> new хранятся
+    отдельно: рёбра добавляются в порядке дат, при повторной конвертации того же ключа
+    действует последняя (как прежние conversion_map_old_to_new / conversion_map_new_to_old).
+    """
+
+    def __init__(self):
+        self._parent = {}
+        self._members = {}
+        self._symbols_by_isin = defaultdict(dict)
+        self._next = {}
+        self._prev = {}
+        self._edge_ids = set()
+
+    def add(self, key):
+        if key and key not in self._parent:
+            self._parent[key] = key
+            self._members[key] = [key]
+
+    def find(self, key):
+        self.add(key)
+        parent = self._parent
+        while parent[key] != key:
+            # Сжатие пути делением пополам
+            parent[key] = parent[parent[key]]
+            key = parent[key]
+        return key
+
+    def union(self, *keys):
+        keys = [key for key in keys if key]
+        if not keys:
+            return None
+        root = self.find(keys[0])
+        for key in keys[1:]:
+            other = self.find(key)
+            if other == root:
+                continue
+            # Меньшее семейство подвешиваем к большему
+            if len(self._members[root]) < len(self._members[other]):
+                root, other = other, root
+            self._parent[other] = root
+            self._members[root].extend(self._members.pop(other))
+        return root
+
+    def same_family(self, key_a, key_b):
+        if key_a not in self._parent or key_b not in self._parent:
+            return key_a == key_b
+        return self.find(key_a) == self.find(key_b)
+
+    def family(self, key):
+        """Все ключи семейства key (включая сам key)."""
+        if not key:
+            return set()
+        return set(self._members[self.find(key)])
+
+    def family_members(self, keys):
+        """Объединение семейств всех keys."""
+        members = set()
+        seen_roots = set()
+        for key in keys:
+            if not key:
+                continue
+            root = self.find(key)
+            if root not in seen_roots:
+                seen_roots.add(root)
+                members.update(self._members[root])
+        return members
+
+    def add_symbol_isin(self, symbol, isin):
+        """Связывает тикер с ISIN и запоминает его в индексе ISIN -> тикеры (в порядке добавления)."""
+        isin = (isin or '').strip()
+        if not symbol or not isin:
+            return
+        self.union(symbol, isin_node(isin))
+        self._symbols_by_isin[isin][symbol] = None
+
+    def symbols_for_isin(self, isin):
+        return list(self._symbols_by_isin.get((isin or '').strip(), ()))
+
+    def add_conversion(self, old_key, new_key, edge_id=None):
+        """Ребро конвертации old -> new. Добавлять в хронологическом порядке; edge_id защищает от повторов."""
+        self.union(old_key, new_key)
+        if edge_id is not None:
+            if edge_id in self._edge_ids:
+                return
+            self._edge_ids.add(edge_id)
+        if old_key and new_key and old_key != new_key:
+            self._next[old_key] = new_key
+            self._prev[new_key] = old_key
+
+    def has_next(self, key):
+        return key in self._next
+
+    def has_previous(self, key):
+        return key in self._prev
+
+    def _walk(self, key, links, visited=()):
+        chain = []
+        visited = {key, *visited}
+        while key in links:
+            key = links[key]
+            if key in visited:
+                break
+            chain.append(key)
+            visited.add(key)
+        return chain
+
+    def predecessors(self, key):
+        """Предыдущие ключи цепочки конвертаций, от ближайшего к самому старому."""
+        return self._walk(key, self._prev)
+
+    def successors(self, key):
+        """Следующие ключи цепочки конвертаций, от ближайшего к самому новому."""
+        return self._walk(key, self._next)
+
+    def latest(self, key):
+        """Самый новый ключ в цепочке конвертаций (ключ группировки истории)."""
+        successors = self.successors(key)
+        return successors[-1] if successors else key
+
+    def conversion_chain(self, key):
+        """Ключи цепочки конвертаций key в порядке от самого старого к самому новому."""
+        predecessors = self.predecessors(key)
+        return list(reversed(predecessors)) + [key] + self._walk(key, self._next, predecessors)
@@ -0,0 +1,60 @@
+# reports_to_ndfl/jinja2_env.py
+"""
+Окружение Jinja2 для шаблонов отчёта (reports_to_ndfl/jinja2/).
+
+Фильтры те же, что у шаблонов Django (date, floatformat, instrument_filters), а значения выводятся
+с локализацией Django (десятичная запятая для ru), как {{ значение }} в шаблоне Django.
+"""
+from decimal import Decimal
+from functools import lru_cache
+
+from django.template import defaultfilters
+from django.utils import numberformat
+from django.utils.formats import get_format, localize
+from django.utils.timezone import template_localtime
+from django.utils.translation import get_language
+from jinja2 import Environment, Undefined
+
+from .templatetags.instrument_filters import format_cbr_rate, format_currency_breakdown, instrument_type_plural
+
+
+@lru_cache(maxsize=None)
+def _number_format_args(lang):
+    """Разделители чисел для языка: formats.number_format ищет их заново для каждого числа."""
+    return (
+        get_format('DECIMAL_SEPARATOR', lang, use_l10n=True),
+        get_format('NUMBER_GROUPING', lang, use_l10n=True),
+        get_format('THOUSAND_SEPARATOR', lang, use_l10n=True),
+    )
+
+
+def localize_value(value):
+    """Как Django выводит {{ значение }}: aware-datetime в местном времени, числа и даты по локали."""
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (Decimal, float, int)) and not isinstance(value, bool):
+        # В таблице операций чисел больше, чем всех остальных значений
+        decimal_separator, grouping, thousand_separator = _number_format_args(get_language())
+        return numberformat.format(value, decimal_separator, None, grouping, thousand_separator, use_l10n=True)
+    return localize(template_localtime(value))
+
+
+def _date(value, arg=None):
+    """Фильтр date Django (значение сначала переводится в местное время, как делает Django)."""
+    return defaultfilters.date(template_localtime(value), arg)
+
+
+def environment(**options):
+    # В режиме DEBUG Django подставляет DebugUndefined, который выводит «{{ event.p }}» вместо
+    # пустой строки для отсутствующих ключей. Django-шаблоны выводят пустую строку всегда.
+    options['undefined'] = Undefined
+    options['finalize'] = localize_value
+    env = Environment(**options)
+    env.filters.update({
+        'instrument_type_plural': instrument_type_plural,
+        'format_currency_breakdown': format_currency_breakdown,
+        'format_cbr_rate': format_cbr_rate,
+        'date': _date,
+        'floatformat': defaultfilters.floatformat,
+    })
+    return env
@@ -0,0 +1,159 @@
+import random
+import re
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from reports_to_ndfl.description_rules import (
+    DESCRIPTION_CACHE_SIZE, classify_corporate_action, classify_fee_description, parse_full_conversion_comment,
+)
+
+_TICKERS = ['AAPL', 'MSFT', 'KO', 'MRK', 'GLTR', 'HSBK', 'D05', 'BRK.B', 'FMC', 'CMCSA', 'T', 'VZ', 'PFE', 'XOM']
+_FEE_TEMPLATES = [
+    '{ticker}({isin}) Наличный дивиденд USD {rate} на акцию - FEE',
+    '{ticker}({isin}) Наличный дивиденд USD {rate} на акцию (Обыкновенный дивиденд)',
+    '{ticker}({isin}) Выплата в качестве дивиденда - US Налог',
+    '{ticker} ({isin}) Cash Dividend USD {rate} per Share - FEE',
+    'Комиссия за рыночные данные {ticker} NYSE Network A',
+    'Плата за обслуживание счёта',
+]
+_CORPORATE_ACTION_TEMPLATES = [
+    '{ticker}({isin}) Сплит 4 к 1 ({ticker}, {ticker} INC, {isin})',
+    '{ticker}({isin}) Выдача прав 1 за 10 ({ticker}.RT, {ticker} RIGHTS, {new_isin})',
+    '{ticker}({isin}) Слияние поглощенная компания: {ticker}.OLD({new_isin}) 1 за 1 ({ticker}, {ticker} CORP, {isin})',
+    '{ticker}({isin}) Спин-офф 1 за 5 ({ticker}.S, {ticker} SPINCO, {new_isin})',
+    '{ticker}({isin}) Подписка ({ticker}.SUB, {ticker} SUBSCRIPTION RIGHTS, {new_isin})',
+]
+_CONVERSION_TEMPLATE = 'Conversion of securities {ticker}.OLD ({isin}) -> {ticker} ({new_isin})'
+
+
+def _isin(rng):
+    return 'US' + ''.join(rng.choice('0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ') for _ in range(10))
+
+
+def build_corpus(size, unique, seed=0):
+    """
+    Описания «как в отчётах»: unique различных строк (комиссии, корпоративные действия,
+    комментарии конвертаций FFG), повторённые до size штук в случайном порядке.
+    """
+    rng = random.Random(seed)
+    templates = (
+        [('fee', template) for template in _FEE_TEMPLATES]
+        + [('corporate_action', template) for template in _CORPORATE_ACTION_TEMPLATES]
+        + [('conversion', _CONVERSION_TEMPLATE)]
+    )
+    distinct = []
+    for _ in range(max(1, unique)):
+        kind, template = rng.choice(templates)
+        distinct.append((kind, template.format(
+            ticker=rng.choice(_TICKERS), isin=_isin(rng), new_isin=_isin(rng),
+            rate=f"{rng.randint(1, 400) / 100:.2f}",
+        )))
+    return [rng.choice(distinct) for _ in range(size)]
+
+
+def _legacy_fee(description):
+    """Разбор комиссии так, как IBParser делал его до description_rules (для сравнения)."""
+    ticker = isin = None
+    if description:
+        match = re.match(r'^([A-Z0-9.\-]+)\s*\(([A-Z0-9]{12})\)', description.strip())
+        if match:
+            ticker, isin = match.group(1), match.group(2)
+    desc_lower = (description or '').lower()
+    is_dividend_related = (
+        bool(re.search(r'\s*-\s*FEE\s*$', description or '', flags=re.IGNORECASE))
+        or 'дивиденд' in desc_lower
+        or 'dividend' in desc_lower
+    )
+    dividend_key = None
+    if description:
+        desc = description.strip()
+        desc = re.sub(r'\s*-\s*FEE\s*$', '', desc, flags=re.IGNORECASE)
+        desc = re.sub(r'\s*-\s*[A-Z]{2}\s*(налог|tax)\s*$', '', desc, flags=re.IGNORECASE)
+        desc = re.sub(r'(?:\s*\([^)]*\)\s*)+$', '', desc)
+        dividend_key = desc.strip() if desc else None
+    return ticker, isin, dividend_key, is_dividend_related
+
+
+def _legacy_corporate_action(description):
+    pairs_raw = re.findall(r'([A-Z0-9\\.]+)\(([A-Z0-9]{12})\)', description or '')
+    pairs_raw.extend(re.findall(r'\(([A-Z0-9\\.]+),\s*[^,]+,\s*([A-Z0-9]{12})\)', description or ''))
+    pairs = []
+    for pair in pairs_raw:
+        if pair not in pairs:
+            pairs.append(pair)
+    match = re.match(r'^(.+?)\s*\([^()]+\)\s*$', description or '')
+    base_description = match.group(1).strip() if match else (description or '').strip()
+    action_lower = re.sub(r'\s*\([^()]+\)\s*$', '', description or '').lower()
+    return (
+        tuple(pairs),
+        base_description,
+        'выдача прав' in action_lower or 'rights issue' in action_lower,
+        'подписка' in action_lower or 'subscription' in action_lower,
+        'слияние' in action_lower or 'merger' in action_lower,
+        'спин-офф' in action_lower or 'spin-off' in action_lower or 'spinoff' in action_lower,
+    )
+
+
+def _legacy_conversion(comment_str):
+    if not comment_str:
+        return None
+    pattern = re.compile(
+        r"Conversion of securities\s+"
+        r"(?P<old_ticker>[A-Z0-9\.\-\_]+)\s*\((?P<old_isin>[A-Z0-9]+)\)\s*->\s*"
+        r"(?P<new_ticker>[A-Z0-9\.\-\_]+)\s*\((?P<new_isin>[A-Z0-9]+)\)",
+        re.IGNORECASE
+    )
+    match = pattern.search(comment_str)
+    if not match:
+        return None
+    return {name: value.strip() for name, value in match.groupdict().items()}
+
+
+_LEGACY = {'fee': _legacy_fee, 'corporate_action': _legacy_corporate_action, 'conversion': _legacy_conversion}
+_RULES = {
+    'fee': lambda description: tuple(classify_fee_description(description)),
+    'corporate_action': lambda description: tuple(classify_corporate_action(description)),
+    'conversion': parse_full_conversion_comment,
+}
+
+
+class Command(BaseCommand):
+    help = (
+        'Сравнивает прежний разбор описаний операций (регулярные выражения на каждый вызов) с таблицей '
+        'предкомпилированных правил description_rules на синтетическом корпусе описаний IB/FFG.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, default=200000, help='Число описаний в корпусе.')
+        parser.add_argument('--unique', type=int, default=2000, help='Число различных описаний в корпусе.')
+        parser.add_argument('--seed', type=int, default=0, help='Зерно генератора корпуса.')
+
+    def handle(self, *args, **options):
+        if options['size'] <= 0 or options['unique'] <= 0:
+            raise CommandError("--size и --unique должны быть положительными.")
+        corpus = build_corpus(options['size'], options['unique'], options['seed'])
+
+        for kind, description in {item for item in corpus}:
+            if _LEGACY[kind](description) != _RULES[kind](description):
+                raise CommandError(f"Результаты разбора расходятся для описания: {description!r}")
+
+        legacy_seconds = self._measure(_LEGACY, corpus)
+        for func in (classify_fee_description, classify_corporate_action, parse_full_conversion_comment):
+            func.cache_clear()
+        rules_seconds = self._measure(_RULES, corpus)
+
+        self.stdout.write(
+            f"Описаний: {len(corpus)}, различных: {options['unique']} (кэш на {DESCRIPTION_CACHE_SIZE})"
+        )
+        self.stdout.write(f"Прежний разбор:     {legacy_seconds:.3f} с")
+        self.stdout.write(f"Таблица правил:     {rules_seconds:.3f} с")
+        if rules_seconds:
+            self.stdout.write(self.style.SUCCESS(f"Ускорение: {legacy_seconds / rules_seconds:.1f}x"))
+
+    @staticmethod
+    def _measure(handlers, corpus):
+        started = time.perf_counter()
+        for kind, description in corpus:
+            handlers[kind](description)
+        return time.perf_counter() - started
@@ -0,0 +1,104 @@
+import io
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand, CommandError
+
+from reports_to_ndfl.management.commands.benchmark_templates import build_history
+from reports_to_ndfl.pdf_report import PDF_BACKENDS, PDF_SECTIONS, write_pdf
+from reports_to_ndfl.pdf_sections import write_pdf_by_sections
+from reports_to_ndfl.pdf_writer import missing_outline_lines, report_outline
+
+
+def build_context(instruments, events_per_instrument, seed=0):
+    """Контекст PDF-отчёта (как pdf_report_context) с синтетической историей операций по кодам 1530 и 1532."""
+    history = build_history(instruments, events_per_instrument, seed)
+    keys = sorted(history)
+    option_keys = keys[:max(1, len(keys) // 10)]
+    totals = {'1530': Decimal('152340.25'), '1532': Decimal('-1820.40')}
+    return {
+        'target_report_year_for_title': 2023,
+        'broker_name': 'Interactive Brokers',
+        'account_number': 'U0000000',
+        'user_comment': '',
+        'instrument_history_1530': {key: history[key] for key in keys if key not in option_keys},
+        'instrument_history_1532': {f'OPTION_{key}': history[key] for key in option_keys},
+        'dividend_history': [],
+        'total_dividends_rub': Decimal(0),
+        'total_sales_profit_rub': sum(totals.values()),
+        'profit_by_income_code': totals,
+        'profit_by_income_code_currencies': {'1530': {'USD': Decimal('1650.10')}},
+        'income_by_income_code': {code: value * 3 for code, value in totals.items()},
+        'income_by_income_code_currencies': {},
+        'cost_by_income_code': {code: value * 2 for code, value in totals.items()},
+        'cost_by_income_code_currencies': {},
+        'total_dividends_tax_rub': Decimal(0),
+        'dividends_tax_by_currency': {},
+        'dividend_commissions_by_currency': {},
+        'dividends_by_currency': {},
+        'other_commissions_by_currency': {'USD': Decimal('-12.00')},
+        'dividend_commissions': {},
+        'other_commissions': {'Комиссии за рыночные данные': {
+            'currencies': {'USD': Decimal('-12.00')}, 'total_rub': Decimal('-1090.44'),
+            'raw_events': [{'description': 'Market data', 'amount': Decimal('-12.00'), 'currency': 'USD',
+                            'amount_rub': Decimal('-1090.44')}],
+        }},
+        'total_dividend_commissions_rub': Decimal(0),
+        'total_other_commissions_rub': Decimal('-1090.44'),
+        'dividend_fee_matching_report': None,
+        'generation_date': '01.01.2024 00:00',
+        'repo_events': [],
+        'total_repo_profit_rub': Decimal(0),
+        'repo_profit_by_currency': {},
+        'pdf_sections': PDF_SECTIONS,
+        'pdf_section_continued': False,
+    }
+
+
+class Command(BaseCommand):
+    help = (
+        'Строит один и тот же PDF-отчёт через xhtml2pdf и напрямую через ReportLab на синтетической истории '
+        'операций: проверяет, что в обоих PDF есть все разделы и итоги в том же порядке, и замеряет время.'
+    )
+
+    def add_arguments(self, parser):
+        # xhtml2pdf не умеет делить по страницам очень длинные таблицы: держим операций на инструмент немного
+        parser.add_argument('--instruments', type=int, default=60, help='Число инструментов.')
+        parser.add_argument('--events', type=int, default=40, help='Число операций на инструмент.')
+        parser.add_argument('--seed', type=int, default=0, help='Зерно генератора истории.')
+        parser.add_argument('--backend', choices=PDF_BACKENDS, action='append',
+                            help='Проверить только указанные способы (можно несколько раз).')
+        parser.add_argument('--by-sections', action='store_true',
+                            help='Строить разделы по отдельности и склеивать (NDFL_PDF_RENDER_BY_SECTIONS).')
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Число процессов для разделов (по умолчанию NDFL_PDF_RENDER_WORKERS).')
+
+    def handle(self, *args, **options):
+        if options['instruments'] <= 0 or options['events'] <= 0:
+            raise CommandError("--instruments и --events должны быть положительными.")
+        context = build_context(options['instruments'], options['events'], options['seed'])
+        outline = report_outline(context)
+
+        self.stdout.write(
+            f"Инструментов: {options['instruments']}, операций: {options['instruments'] * options['events']}, "
+            f"строк структуры: {len(outline)}"
+        )
+        seconds = {}
+        for backend in options['backend'] or PDF_BACKENDS:
+            output = io.BytesIO()
+            started = time.perf_counter()
+            if options['by_sections']:
+                built = write_pdf_by_sections(context, output, backend=backend, workers=options['workers'])
+            else:
+                built = write_pdf(context, output, backend=backend, by_sections=False)
+            if not built:
+                raise CommandError(f"{backend}: ошибка построения PDF")
+            seconds[backend] = time.perf_counter() - started
+            output.seek(0)
+            missing = missing_outline_lines(output, outline)
+            if missing:
+                raise CommandError(f"{backend}: в PDF нет разделов или итогов: {missing[:5]}")
+            self.stdout.write(f"{backend:10} {seconds[backend]:.3f} с, {len(output.getvalue()) // 1024} КБ")
+
+        if seconds.get('reportlab') and 'xhtml2pdf' in seconds:
+            self.stdout.write(self.style.SUCCESS(f"Ускорение: {seconds['xhtml2pdf'] / seconds['reportlab']:.1f}x"))
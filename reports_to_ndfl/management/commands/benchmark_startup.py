@@ -0,0 +1,114 @@
+import json
+import os
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+WARMUP_MODES = ('lazy', 'eager')
+
+# Выполняется в отдельном интерпретаторе: старт как у gunicorn --preload (django.setup и URLconf),
+# затем рабочие процессы через fork строят по небольшому PDF. Память — из /proc (Linux).
+_PROBE = r'''
+import io, json, os, sys, time
+
+def memory_kb(field_names, path):
+    total = 0
+    with open(path) as lines:
+        for line in lines:
+            name, _, value = line.partition(':')
+            if name in field_names:
+                total += int(value.split()[0])
+    return total
+
+started = time.perf_counter()
+import django
+django.setup()
+from importlib import import_module
+from django.conf import settings
+import_module(settings.ROOT_URLCONF)
+boot_seconds = time.perf_counter() - started
+result = {
+    'boot_seconds': boot_seconds,
+    'rss_kb': memory_kb({'VmRSS'}, '/proc/self/status'),
+    'pdf_loaded': 'xhtml2pdf' in sys.modules,
+    'workers': [],
+}
+
+for _ in range(int(sys.argv[1])):
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_end)
+        from reports_to_ndfl.management.commands.benchmark_pdf import build_context
+        from reports_to_ndfl.pdf_report import write_pdf
+        context = build_context(5, 20)
+        started = time.perf_counter()
+        write_pdf(context, io.BytesIO())
+        worker = {
+            'first_pdf_seconds': time.perf_counter() - started,
+            # Страницы, не разделённые с мастером (свои и скопированные при записи)
+            'private_kb': memory_kb({'Private_Clean', 'Private_Dirty'}, '/proc/self/smaps_rollup'),
+        }
+        os.write(write_end, json.dumps(worker).encode())
+        os._exit(0)
+    os.close(write_end)
+    with os.fdopen(read_end) as pipe:
+        result['workers'].append(json.loads(pipe.read()))
+    os.waitpid(pid, 0)
+
+print(json.dumps(result))
+'''
+
+
+class Command(BaseCommand):
+    help = (
+        'Сравнивает стратегии загрузки PDF (NDFL_PDF_WARMUP): время старта приложения, RSS мастер-процесса, '
+        'время первого PDF и неразделяемую память рабочего процесса после fork (как у gunicorn --preload).'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--mode', choices=WARMUP_MODES, action='append',
+                            help='Проверить только указанные режимы (можно несколько раз).')
+        parser.add_argument('--workers', type=int, default=2, help='Число рабочих процессов (fork).')
+        parser.add_argument('--runs', type=int, default=3, help='Запусков на режим (берётся медиана).')
+
+    def handle(self, *args, **options):
+        if not hasattr(os, 'fork') or not os.path.exists('/proc/self/smaps_rollup'):
+            raise CommandError("Замер рассчитан на Linux (fork и /proc/self/smaps_rollup).")
+        if options['workers'] <= 0 or options['runs'] <= 0:
+            raise CommandError("--workers и --runs должны быть положительными.")
+
+        self.stdout.write(
+            f"{'режим':6} {'старт, с':>9} {'RSS, МБ':>8} {'PDF загружен':>13} "
+            f"{'первый PDF, с':>14} {'своя память воркера, МБ':>24}"
+        )
+        for mode in options['mode'] or WARMUP_MODES:
+            runs = sorted(
+                (self._probe(mode, options['workers']) for _ in range(options['runs'])),
+                key=lambda run: run['boot_seconds'],
+            )
+            run = runs[len(runs) // 2]
+            workers = run['workers']
+            first_pdf = sum(worker['first_pdf_seconds'] for worker in workers) / len(workers)
+            private_mb = sum(worker['private_kb'] for worker in workers) / len(workers) / 1024
+            self.stdout.write(
+                f"{mode:6} {run['boot_seconds']:9.3f} {run['rss_kb'] / 1024:8.1f} "
+                f"{'да' if run['pdf_loaded'] else 'нет':>13} {first_pdf:14.3f} {private_mb:24.1f}"
+            )
+
+    @staticmethod
+    def _probe(mode, workers):
+        environment = {
+            **os.environ,
+            'DJANGO_SETTINGS_MODULE': os.environ.get('DJANGO_SETTINGS_MODULE', 'NDFL.settings'),
+            'NDFL_PDF_WARMUP': mode,
+        }
+        completed = subprocess.run(
+            [sys.executable, '-c', _PROBE, str(workers)],
+            cwd=settings.BASE_DIR, env=environment, capture_output=True, text=True,
+        )
+        if completed.returncode:
+            raise CommandError(f"{mode}: {completed.stderr.strip()[-2000:]}")
+        return json.loads(completed.stdout.strip().splitlines()[-1])
@@ -0,0 +1,108 @@
+import random
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand, CommandError
+
+from reports_to_ndfl.report_templates import (
+    INSTRUMENT_EVENTS_TEMPLATE, PDF_INSTRUMENT_EVENTS_TEMPLATE, render_report_fragment,
+)
+
+_TICKERS = ['AAPL', 'MSFT', 'KO', 'MRK', 'GLTR', 'HSBK', 'D05', 'BRK.B', 'FMC', 'CMCSA', 'T', 'VZ', 'PFE', 'XOM']
+_LINK_COLORS = ['#e6194b', '#3cb44b', '#4363d8', '#f58231', '#911eb4']
+
+
+def _trade(rng, ticker, moment, relevant, split=None):
+    quantity = Decimal(rng.randint(1, 500))
+    price = Decimal(rng.randint(100, 50000)) / 100
+    details = {
+        'date': moment.strftime('%d.%m.%Y %H:%M:%S'), 'trade_id': str(rng.randint(10 ** 8, 10 ** 9)),
+        'operation': rng.choice(['buy', 'sell']), 'ticker': ticker, 'isin': f'US{rng.randint(10 ** 9, 10 ** 10 - 1)}',
+        'p': price, 'q': quantity, 'summ': price * quantity, 'commission': Decimal(rng.randint(0, 500)) / 100,
+        'curr_c': 'USD', 'cbr_rate': Decimal(rng.randint(5000, 10000)) / 100,
+        'fifo_cost_rub_str': f'{rng.randint(0, 10 ** 6) / 100:.2f}',
+        'is_relevant_for_target_year': relevant, 'is_in_pdf_range': relevant or rng.random() < 0.5,
+        'is_aggregated': rng.random() < 0.05, 'is_option_delivery': rng.random() < 0.05,
+        'link_colors': rng.sample(_LINK_COLORS, rng.randint(0, 2)),
+    }
+    if split:
+        details.update({
+            'is_split_part': True, 'split_part_index': split[0], 'split_total_parts': split[1],
+            'split_part_note': f'часть {split[0] + 1} из {split[1]}',
+        })
+    return {'display_type': 'trade', 'datetime_obj': moment, 'event_details': details}
+
+
+def build_history(instruments, events_per_instrument, seed=0):
+    """
+    История операций «как у parser.process()»: instruments инструментов по events_per_instrument
+    строк — сделки (в том числе разбитые на части), конвертации, приобретения, начальные остатки и опционы.
+    """
+    rng = random.Random(seed)
+    history = {}
+    for index in range(instruments):
+        ticker = f'{rng.choice(_TICKERS)}{index}'
+        moment = datetime(2020, 1, 1)
+        events = []
+        while len(events) < events_per_instrument:
+            moment += timedelta(days=rng.randint(1, 10), seconds=rng.randint(0, 86399))
+            relevant = moment.year >= 2023
+            kind = rng.random()
+            if kind < 0.8:
+                events.append(_trade(rng, ticker, moment, relevant))
+            elif kind < 0.85:
+                events.extend(_trade(rng, ticker, moment, relevant, split=(part, 2)) for part in range(2))
+            elif kind < 0.9:
+                events.append({'display_type': 'conversion_info', 'datetime_obj': moment, 'event_details': {
+                    'old_ticker': ticker, 'new_ticker': f'{ticker}.N', 'old_quantity_removed': Decimal(10),
+                    'new_quantity_received': Decimal(20), 'is_relevant_for_target_year': relevant,
+                    'is_in_pdf_range': True,
+                }})
+            elif kind < 0.95:
+                events.append({'display_type': 'acquisition_info', 'datetime_obj': moment, 'event_details': {
+                    'acquisition_type': rng.choice(['subscription', 'rights_issue', 'spinoff', None]),
+                    'ticker': f'{ticker}.RT', 'quantity': Decimal(rng.randint(1, 50)), 'source_ticker': ticker,
+                    'cost': Decimal(rng.randint(0, 2)), 'currency': 'USD', 'cost_rub': Decimal('91.5'),
+                    'is_relevant_for_target_year': relevant, 'is_in_pdf_range': True,
+                }})
+            elif kind < 0.97:
+                events.append({'display_type': 'initial_holding', 'datetime_obj': moment, 'event_details': {
+                    'ticker': ticker, 'p': Decimal('10.5'), 'q': Decimal(100), 'curr_c': 'USD',
+                    'total_cost_rub_str': '75000.00', 'is_relevant_for_target_year': relevant, 'is_in_pdf_range': True,
+                }})
+            else:
+                option = _trade(rng, f'{ticker} 20DEC24 100 C', moment, relevant)
+                option['display_type'] = 'option'
+                events.append(option)
+        history[ticker] = events[:events_per_instrument]
+    return history
+
+
+class Command(BaseCommand):
+    help = (
+        'Замеряет рендеринг таблиц операций инструментов (страница отчёта и PDF, шаблоны Jinja2) '
+        'на синтетической истории операций.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--instruments', type=int, default=200, help='Число инструментов.')
+        parser.add_argument('--events', type=int, default=100, help='Число операций на инструмент.')
+        parser.add_argument('--seed', type=int, default=0, help='Зерно генератора истории.')
+
+    def handle(self, *args, **options):
+        if options['instruments'] <= 0 or options['events'] <= 0:
+            raise CommandError("--instruments и --events должны быть положительными.")
+        history = build_history(options['instruments'], options['events'], options['seed'])
+
+        self.stdout.write(
+            f"Инструментов: {options['instruments']}, операций: {options['instruments'] * options['events']}"
+        )
+        for template_name in (INSTRUMENT_EVENTS_TEMPLATE, PDF_INSTRUMENT_EVENTS_TEMPLATE):
+            started = time.perf_counter()
+            html_length = sum(
+                len(render_report_fragment(template_name, {'event_list': events, 'income_code': '1530'}))
+                for events in history.values()
+            )
+            seconds = time.perf_counter() - started
+            self.stdout.write(f"{template_name}: {seconds:.3f} с, HTML: {html_length // 1024} КБ")
@@ -0,0 +1,155 @@
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from reports_to_ndfl.fifo_pool import close_connections_before_fork, init_worker
+from reports_to_ndfl.models import BrokerReport
+from reports_to_ndfl.yearly_results import compute_year_runs, report_years, result_payload, store_year_results
+
+OUTPUT_FORMATS = ('json', 'pdf')
+
+
+def _write_result(user, broker_type, year, year_run, output_dir, output_format):
+    user_dir = os.path.join(output_dir, user.username)
+    os.makedirs(user_dir, exist_ok=True)
+    if output_format == 'pdf':
+        from reports_to_ndfl.pdf_report import pdf_filename, pdf_report_context, write_pdf
+
+        context = pdf_report_context(user, broker_type, year, year_run.result)
+        path = os.path.join(user_dir, pdf_filename(context))
+        with open(path, 'wb') as output:
+            if not write_pdf(context, output):
+                raise RuntimeError("ошибка построения PDF")
+        return path
+
+    path = os.path.join(user_dir, f'{broker_type}_{year}.json')
+    payload = {
+        'user': user.username, 'broker_type': broker_type, 'year': year,
+        'diagnostics': year_run.diagnostics, 'result': result_payload(year_run.result),
+    }
+    with open(path, 'w', encoding='utf-8') as output:
+        json.dump(payload, output, ensure_ascii=False, separators=(',', ':'))
+    return path
+
+
+def compute_user(user_id, broker_types, years, output_dir, output_format, store):
+    """
+    Расчёт всех (или указанных) лет по брокерам пользователя без HTTP-запроса. Выполняется и в рабочих
+    процессах пула, поэтому принимает и возвращает только простые значения:
+    список (пользователь, брокер, год, ошибка или '', путь к файлу, секунды).
+    """
+    user = User.objects.get(pk=user_id)
+    rows = []
+    for broker_type in broker_types:
+        available = report_years(user, broker_type)
+        selected = [year for year in available if not years or year in years]
+        if not selected:
+            continue
+        started = time.perf_counter()
+        try:
+            runs_by_year = compute_year_runs(None, user, broker_type, selected)
+        except Exception as e:
+            seconds = time.perf_counter() - started
+            rows.extend((user.username, broker_type, year, f"ошибка расчета: {e}", '', seconds) for year in selected)
+            continue
+        if store:
+            # Для лет с ошибкой разбора store_year_results удаляет прежний сохранённый результат
+            store_year_results(user, broker_type, runs_by_year)
+        seconds = (time.perf_counter() - started) / len(runs_by_year)
+        for year, year_run in sorted(runs_by_year.items()):
+            error = "ошибка разбора отчетов" if year_run.result[4] else ''
+            try:
+                path = _write_result(user, broker_type, year, year_run, output_dir, output_format)
+            except Exception as e:
+                error, path = f"не удалось записать результат: {e}", ''
+            rows.append((user.username, broker_type, year, error, path, seconds))
+    return rows
+
+
+class Command(BaseCommand):
+    help = (
+        'Расчёт 3-НДФЛ без веб-интерфейса: считает результаты по загруженным отчётам пользователей '
+        '(например, всех после исправления курсов ЦБ), сохраняет их для страницы отчёта и API и пишет '
+        'в файлы <output-dir>/<пользователь>/ в формате JSON или PDF.'
+    )
+
+    def add_arguments(self, parser):
+        users = parser.add_mutually_exclusive_group(required=True)
+        users.add_argument('--user', action='append', help='Имя пользователя (можно несколько раз).')
+        users.add_argument('--all-users', action='store_true', help='Все пользователи с загруженными отчётами.')
+        parser.add_argument('--broker', choices=[code for code, _ in BrokerReport.BROKER_TYPES], action='append',
+                            help='Брокер (можно несколько раз; по умолчанию все).')
+        parser.add_argument('--year', type=int, action='append', help='Год (можно несколько раз; по умолчанию все).')
+        parser.add_argument('--format', choices=OUTPUT_FORMATS, default='json', help='Формат файлов результата.')
+        parser.add_argument('--output-dir', default='ndfl_results', help='Каталог для файлов результата.')
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Число процессов для --all-users (по умолчанию по числу ядер).')
+        parser.add_argument('--no-store', action='store_true',
+                            help='Не обновлять сохранённые результаты (YearlyReportResult), только писать файлы.')
+
+    def handle(self, *args, **options):
+        if options['all_users']:
+            user_ids = list(BrokerReport.objects.values_list('user_id', flat=True).distinct().order_by('user_id'))
+        else:
+            users = {user.username: user.pk for user in User.objects.filter(username__in=options['user'])}
+            unknown = sorted(set(options['user']) - set(users))
+            if unknown:
+                raise CommandError(f"Пользователи не найдены: {', '.join(unknown)}")
+            user_ids = [users[username] for username in options['user']]
+
+        broker_types = options['broker'] or [code for code, _ in BrokerReport.BROKER_TYPES]
+        years = set(options['year'] or [])
+        output_dir = os.path.abspath(options['output_dir'])
+        workers = options['workers'] or os.cpu_count() or 1
+        tasks = [
+            (user_id, broker_types, years, output_dir, options['format'], not options['no_store'])
+            for user_id in user_ids
+        ]
+        usernames = dict(User.objects.filter(pk__in=user_ids).values_list('pk', 'username'))
+        started = time.perf_counter()
+        rows = self._run_tasks(tasks, usernames, workers)
+
+        failed = 0
+        for username, broker_type, year, error, path, seconds in rows:
+            if error:
+                failed += 1
+                self.stderr.write(f"{username} {broker_type} {year}: {error}")
+            else:
+                self.stdout.write(f"{username} {broker_type} {year}: {seconds:.2f} с -> {path}")
+        self.stdout.write(
+            f"Пользователей: {len(user_ids)}, расчётов: {len(rows)}, с ошибкой: {failed}, "
+            f"всего {time.perf_counter() - started:.1f} с"
+        )
+        if failed:
+            raise CommandError(f"Расчётов с ошибкой: {failed}")
+
+    @staticmethod
+    def _run_tasks(tasks, usernames, workers):
+        """
+        Выполняет compute_user по задачам (в пуле процессов, если workers > 1). compute_user пишет файлы
+        и сохраняет результаты, поэтому упавшая задача (в том числе при падении процесса пула) не
+        пересчитывается повторно, а попадает в вывод строкой с ошибкой.
+        """
+        def failed(task, error):
+            return [(usernames.get(task[0], str(task[0])), ','.join(task[1]), '-', f"расчёт не выполнен: {error!r}", '', 0.0)]
+
+        results = []
+        if workers > 1 and len(tasks) > 1 and close_connections_before_fork():
+            with ProcessPoolExecutor(max_workers=min(workers, len(tasks)), initializer=init_worker) as executor:
+                futures = [(task, executor.submit(compute_user, *task)) for task in tasks]
+                for task, future in futures:
+                    try:
+                        results.append(future.result())
+                    except Exception as e:
+                        results.append(failed(task, e))
+        else:
+            for task in tasks:
+                try:
+                    results.append(compute_user(*task))
+                except Exception as e:
+                    results.append(failed(task, e))
+        return [row for user_rows in results for row in user_rows]
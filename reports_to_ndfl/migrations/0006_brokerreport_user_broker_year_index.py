@@ -0,0 +1,17 @@
+# Generated by Django 4.2.30 on 2026-10-19 00:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reports_to_ndfl', '0005_brokerreport'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='brokerreport',
+            index=models.Index(fields=['user', 'broker_type', 'year', 'uploaded_at'], name='brokerrep_usr_brk_yr_upl_idx'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.2.30 on 2026-10-19 00:27
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('reports_to_ndfl', '0006_brokerreport_user_broker_year_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='YearlyReportResult',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('broker_type', models.CharField(choices=[('ffg', 'Freedom Finance Global'), ('ib', 'Interactive Brokers')], max_length=10, verbose_name='Тип брокера')),
+                ('year', models.IntegerField(verbose_name='Год отчета')),
+                ('result', models.BinaryField(verbose_name='Результат обработки')),
+                ('computed_at', models.DateTimeField(auto_now=True, verbose_name='Дата расчета')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+            ],
+            options={
+                'verbose_name': 'Результат обработки за год',
+                'verbose_name_plural': 'Результаты обработки за год',
+                'unique_together': {('user', 'broker_type', 'year')},
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-19 00:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reports_to_ndfl', '0007_yearlyreportresult'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='yearlyreportresult',
+            name='diagnostics',
+            field=models.JSONField(blank=True, default=list, verbose_name='Диагностика расчета'),
+        ),
+    ]
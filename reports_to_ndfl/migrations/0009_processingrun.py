@@ -0,0 +1,37 @@
+# Generated by Django 4.2.30 on 2026-10-19 01:16
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('reports_to_ndfl', '0008_yearlyreportresult_diagnostics'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProcessingRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('broker_type', models.CharField(choices=[('ffg', 'Freedom Finance Global'), ('ib', 'Interactive Brokers')], max_length=10, verbose_name='Тип брокера')),
+                ('year', models.IntegerField(verbose_name='Год отчета')),
+                ('all_years', models.BooleanField(default=False, verbose_name='Пересчитать все годы')),
+                ('refresh', models.BooleanField(default=False, verbose_name='Не брать сохранённый результат')),
+                ('status', models.CharField(choices=[('queued', 'В очереди'), ('running', 'Выполняется'), ('done', 'Готово'), ('failed', 'Ошибка')], default='queued', max_length=10, verbose_name='Статус')),
+                ('error', models.TextField(blank=True, verbose_name='Ошибка')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата постановки в очередь')),
+                ('started_at', models.DateTimeField(blank=True, null=True, verbose_name='Начало расчета')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='Окончание расчета')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+            ],
+            options={
+                'verbose_name': 'Расчет через API',
+                'verbose_name_plural': 'Расчеты через API',
+                'ordering': ['-created_at'],
+            },
+        ),
+    ]
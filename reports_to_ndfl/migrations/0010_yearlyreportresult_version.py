@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-19 01:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reports_to_ndfl', '0009_processingrun'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='yearlyreportresult',
+            name='version',
+            field=models.CharField(blank=True, default='', help_text='Версия кода расчёта и курсов ЦБ, на которых посчитан результат (yearly_results.result_version)', max_length=64, verbose_name='Версия расчета'),
+        ),
+    ]
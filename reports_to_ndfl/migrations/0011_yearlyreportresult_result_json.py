@@ -0,0 +1,29 @@
+# Generated by Django 4.2.30 on 2026-10-19 12:10
+
+from django.db import migrations, models
+
+
+def delete_stored_results(apps, schema_editor):
+    # Результаты в pickle не переносятся: это кэш, год пересчитается при следующем открытии
+    YearlyReportResult = apps.get_model('reports_to_ndfl', 'YearlyReportResult')
+    YearlyReportResult.objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reports_to_ndfl', '0010_yearlyreportresult_version'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_stored_results, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='yearlyreportresult',
+            name='result',
+        ),
+        migrations.AddField(
+            model_name='yearlyreportresult',
+            name='result',
+            field=models.JSONField(default=list, verbose_name='Результат обработки'),
+        ),
+    ]
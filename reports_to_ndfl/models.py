@@ -65,6 +65,10 @@ class BrokerReport(models.Model):
         verbose_name_plural = "Брокерские отчеты"
         unique_together = ('user', 'broker_type', 'original_filename', 'year')
         ordering = ['-uploaded_at']
+        indexes = [
+            # Отчеты пользователя по брокеру: filter(user, broker_type[, year]).order_by('year', 'uploaded_at')
+            models.Index(fields=['user', 'broker_type', 'year', 'uploaded_at'], name='brokerrep_usr_brk_yr_upl_idx'),
+        ]
 
     def __str__(self):
         broker_display = self.get_broker_type_display()
@@ -74,3 +78,68 @@ class BrokerReport(models.Model):
     @property
     def file_extension(self):
         return 'xml' if self.broker_type == 'ffg' else 'csv'
+
+
+class YearlyReportResult(models.Model):
+    """Сохранённый результат обработки отчётов брокера за год (кортеж parser.process())."""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, verbose_name="Пользователь")
+    broker_type = models.CharField(
+        max_length=10,
+        choices=BrokerReport.BROKER_TYPES,
+        verbose_name="Тип брокера"
+    )
+    year = models.IntegerField(verbose_name="Год отчета")
+    # Кортеж parser.process() в JSON с тегами типов (yearly_results._to_stored)
+    result = models.JSONField(default=list, verbose_name="Результат обработки")
+    diagnostics = models.JSONField(default=list, blank=True, verbose_name="Диагностика расчета")
+    version = models.CharField(
+        max_length=64, blank=True, default='',
+        help_text="Версия кода расчёта и курсов ЦБ, на которых посчитан результат (yearly_results.result_version)",
+        verbose_name="Версия расчета",
+    )
+    computed_at = models.DateTimeField(auto_now=True, verbose_name="Дата расчета")
+
+    class Meta:
+        verbose_name = "Результат обработки за год"
+        verbose_name_plural = "Результаты обработки за год"
+        unique_together = ('user', 'broker_type', 'year')
+
+    def __str__(self):
+        return f"{self.get_broker_type_display()} - {self.year} ({self.computed_at:%d.%m.%Y %H:%M})"
+
+
+class ProcessingRun(models.Model):
+    """Расчёт, поставленный в очередь через API: отчёты брокера за год считаются в фоне (processing_runs)."""
+    STATUS_QUEUED = 'queued'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUSES = [
+        (STATUS_QUEUED, 'В очереди'),
+        (STATUS_RUNNING, 'Выполняется'),
+        (STATUS_DONE, 'Готово'),
+        (STATUS_FAILED, 'Ошибка'),
+    ]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, verbose_name="Пользователь")
+    broker_type = models.CharField(
+        max_length=10,
+        choices=BrokerReport.BROKER_TYPES,
+        verbose_name="Тип брокера"
+    )
+    year = models.IntegerField(verbose_name="Год отчета")
+    all_years = models.BooleanField(default=False, verbose_name="Пересчитать все годы")
+    refresh = models.BooleanField(default=False, verbose_name="Не брать сохранённый результат")
+    status = models.CharField(max_length=10, choices=STATUSES, default=STATUS_QUEUED, verbose_name="Статус")
+    error = models.TextField(blank=True, verbose_name="Ошибка")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата постановки в очередь")
+    started_at = models.DateTimeField(null=True, blank=True, verbose_name="Начало расчета")
+    finished_at = models.DateTimeField(null=True, blank=True, verbose_name="Окончание расчета")
+
+    class Meta:
+        verbose_name = "Расчет через API"
+        verbose_name_plural = "Расчеты через API"
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"{self.get_broker_type_display()} - {self.year}: {self.get_status_display()}"
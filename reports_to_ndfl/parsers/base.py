@@ -1,11 +1,41 @@
+import functools
+import time
 from abc import ABC, abstractmethod
 
+from NDFL.metrics import PARSER_RUN_SECONDS, PARSER_RUNS
+
+from ..run_context import RunContext
+
+
+def measured_run(broker, mode='year'):
+    """
+    Декоратор process() / process_all_years(): длительность и исход расчёта в метриках (NDFL.metrics).
+    Исход — ok, parsing_error (флаг ошибки в результате хотя бы за один год) или exception.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            outcome = 'exception'
+            started = time.perf_counter()
+            try:
+                result = method(self, *args, **kwargs)
+                results = result.values() if isinstance(result, dict) else [result]
+                outcome = 'parsing_error' if any(item[4] for item in results) else 'ok'
+                return result
+            finally:
+                PARSER_RUN_SECONDS.labels(broker=broker, mode=mode).observe(time.perf_counter() - started)
+                PARSER_RUNS.labels(broker=broker, mode=mode, outcome=outcome).inc()
+        return wrapper
+    return decorator
+
 
 class BaseBrokerParser(ABC):
-    def __init__(self, request, user, target_year):
+    def __init__(self, request, user, target_year, run_context=None):
         self.request = request
         self.user = user
         self.target_year = target_year
+        # Ошибки, курсы и кэши этого расчёта (см. run_context) — у каждого парсера свои
+        self.context = run_context or RunContext(request, user, target_year)
 
     @abstractmethod
     def process(self):
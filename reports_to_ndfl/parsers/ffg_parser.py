@@ -1,18 +1,21 @@
 from decimal import Decimal
 
-from .base import BaseBrokerParser
+from .base import BaseBrokerParser, measured_run
 from ..FFG_ndfl import process_and_get_trade_data
 from ..models import BrokerReport
 
 
 class FFGParser(BaseBrokerParser):
+    @measured_run('ffg')
     def process(self):
         files_queryset = BrokerReport.objects.filter(user=self.user, broker_type='ffg')
+        # Сообщения разбора собираются в диагностику расчёта (self.context), а не в сессию
         result = process_and_get_trade_data(
             self.request,
             self.user,
             self.target_year,
             files_queryset=files_queryset,
+            run_context=self.context,
         )
         # Нормализуем результат под общий контракт парсеров (как у IBParser):
         # (instrument_event_history, dividend_events, total_dividends_rub,
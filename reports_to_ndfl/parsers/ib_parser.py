@@ -1,54 +1,132 @@
 import csv
-import re
 from collections import defaultdict, deque
 from datetime import datetime, date
 from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
 
-from currency_CBRF.models import Currency
-from ..FFG_ndfl import _get_exchange_rate_for_date
-from .base import BaseBrokerParser
+from currency_CBRF.services import warm_up_exchange_rates
+from ..description_rules import (
+    SECURITY_ID_RE, classify_corporate_action, classify_fee_description, extract_fee_ticker, extract_symbol_isin,
+    normalize_dividend_description,
+)
+from ..fifo_pool import fifo_worker_count, run_in_process_pool, split_families_into_buckets
+from ..fifo_vectorized import is_vectorized_fifo_enabled, iter_lot_takes, long_only_lot_ranges, scale_quantities
+from ..instrument_lineage import InstrumentLineage, is_relevance_pruning_enabled, isin_node
+from .base import BaseBrokerParser, measured_run
 
 
 class IBParser(BaseBrokerParser):
+    @measured_run('ib')
     def process(self):
         reports = list(self._get_reports())
         if not reports:
             from django.contrib import messages
-            messages.info(self.request, "У вас нет загруженных IB отчетов для анализа истории.")
-            empty_commissions = defaultdict(lambda: {'amount_by_currency': defaultdict(Decimal), 'amount_rub': Decimal(0), 'details': []})
-            empty_other = defaultdict(lambda: {'currencies': defaultdict(Decimal), 'total_rub': Decimal(0), 'raw_events': []})
-            empty_profit_by_code = {'1530': Decimal(0), '1532': Decimal(0)}
-            empty_profit_by_code_currencies = {'1530': {}, '1532': {}}
-            empty_income_by_code = {'1530': Decimal(0), '1532': Decimal(0)}
-            empty_income_by_code_currencies = {'1530': {}, '1532': {}}
-            empty_cost_by_code = {'1530': Decimal(0), '1532': Decimal(0)}
-            empty_cost_by_code_currencies = {'1530': {}, '1532': {}}
-            return (
-                {},
-                [],
-                Decimal(0),
-                Decimal(0),
-                False,
-                empty_commissions,
-                empty_other,
-                Decimal(0),
-                empty_profit_by_code,
-                empty_profit_by_code_currencies,
-                {},
-                {},
-                empty_income_by_code,
-                empty_income_by_code_currencies,
-                empty_cost_by_code,
-                empty_cost_by_code_currencies,
-                Decimal(0),
-                {},
-                {},
-                # РЕПО-данные (пустые для IB)
-                [],
-                Decimal(0),
-                {},
+            self.context.diagnostics.add("У вас нет загруженных IB отчетов для анализа истории.", messages.INFO)
+            return self._empty_result()
+
+        sections = self._load_sections(reports)
+
+        dividend_commissions, other_commissions = self._new_commission_accumulators()
+
+        symbol_to_isin, symbol_to_name, symbol_to_multiplier = self._parse_instrument_info(sections)
+        trades = self._parse_trades(sections, other_commissions, symbol_to_isin, symbol_to_name, symbol_to_multiplier)
+        dividends = self._parse_dividends(sections)
+        conversions, acquisitions = self._parse_corporate_actions(sections, symbol_to_name)
+        self._parse_interest(sections, other_commissions)
+        dividend_accrual_payments = self._parse_dividend_accrual_payments(sections)
+        self._parse_fees(sections, other_commissions, dividend_commissions, dividend_accrual_payments)
+
+        with self.context.timed('fifo'):
+            fifo_history = self._build_fifo_history(trades, conversions, acquisitions, symbol_to_isin, symbol_to_name)
+        return self._assemble_result(fifo_history, dividends, dividend_commissions, other_commissions)
+
+    @measured_run('ib', mode='all_years')
+    def process_all_years(self, years):
+        """
+        Результаты process() сразу за несколько лет: {год: кортеж как у process()}.
+
+        Отчёты читаются, курсы загружаются и FIFO прогоняется один раз (прогон от года не зависит),
+        а по годам считаются только итоги FIFO и годовые секции (дивиденды, комиссии, проценты).
+        Годовая часть пишет в свой контекст (self.year_contexts[год]): предупреждения и флаг ошибки
+        одного года не попадают в результаты других; общая часть, как и в process(), — во все годы.
+        """
+        reports = list(self._get_reports())
+        if not reports:
+            return {}
+
+        sections = self._load_sections(reports)
+
+        symbol_to_isin, symbol_to_name, symbol_to_multiplier = self._parse_instrument_info(sections)
+        # FX-комиссии из сделок собираются ниже отдельно для каждого года
+        _, scratch_commissions = self._new_commission_accumulators()
+        trades = self._parse_trades(sections, scratch_commissions, symbol_to_isin, symbol_to_name, symbol_to_multiplier)
+        conversions, acquisitions = self._parse_corporate_actions(sections, symbol_to_name)
+        with self.context.timed('fifo'):
+            instrument_events, symbols_with_sales_by_year, used_buy_ids_by_year, lineage = self._replay_fifo_history(
+                trades, conversions, acquisitions, symbol_to_isin, symbol_to_name
             )
 
+        results = {}
+        self.year_contexts = {}
+        shared_context, original_target_year = self.context, self.target_year
+        try:
+            for year in years:
+                self.target_year = year
+                self.context = self.year_contexts[year] = shared_context.for_year(year)
+                dividend_commissions, other_commissions = self._new_commission_accumulators()
+                self._parse_forex_commissions(sections, other_commissions)
+                dividends = self._parse_dividends(sections)
+                self._parse_interest(sections, other_commissions)
+                dividend_accrual_payments = self._parse_dividend_accrual_payments(sections)
+                self._parse_fees(sections, other_commissions, dividend_commissions, dividend_accrual_payments)
+
+                fifo_history = self._summarize_fifo_history(
+                    self._copy_fifo_events(instrument_events),
+                    set(symbols_with_sales_by_year.get(year, ())),
+                    set(used_buy_ids_by_year.get(year, ())),
+                    lineage,
+                    symbol_to_isin,
+                )
+                results[year] = self._assemble_result(fifo_history, dividends, dividend_commissions, other_commissions)
+        finally:
+            self.target_year = original_target_year
+            self.context = shared_context
+        return results
+
+    def _empty_result(self):
+        empty_commissions, empty_other = self._new_commission_accumulators()
+        empty_profit_by_code = {'1530': Decimal(0), '1532': Decimal(0)}
+        empty_profit_by_code_currencies = {'1530': {}, '1532': {}}
+        empty_income_by_code = {'1530': Decimal(0), '1532': Decimal(0)}
+        empty_income_by_code_currencies = {'1530': {}, '1532': {}}
+        empty_cost_by_code = {'1530': Decimal(0), '1532': Decimal(0)}
+        empty_cost_by_code_currencies = {'1530': {}, '1532': {}}
+        return (
+            {},
+            [],
+            Decimal(0),
+            Decimal(0),
+            False,
+            empty_commissions,
+            empty_other,
+            Decimal(0),
+            empty_profit_by_code,
+            empty_profit_by_code_currencies,
+            {},
+            {},
+            empty_income_by_code,
+            empty_income_by_code_currencies,
+            empty_cost_by_code,
+            empty_cost_by_code_currencies,
+            Decimal(0),
+            {},
+            {},
+            # РЕПО-данные (пустые для IB)
+            [],
+            Decimal(0),
+            {},
+        )
+
+    def _load_sections(self, reports):
         sections = {}
         for report in reports:
             report_sections = self._parse_csv_sections(report.report_file.path)
@@ -56,23 +134,21 @@ class IBParser(BaseBrokerParser):
                 sections.setdefault(key, [])
                 sections[key].extend(blocks)
 
+        # Недостающие курсы ЦБ загружаем заранее одним параллельным проходом
+        warm_up_exchange_rates(self._collect_rate_requests(sections))
+        return sections
+
+    @staticmethod
+    def _new_commission_accumulators():
+        """(dividend_commissions, other_commissions) — пустые накопители комиссий прогона."""
         dividend_commissions = defaultdict(lambda: {'amount_by_currency': defaultdict(Decimal), 'amount_rub': Decimal(0), 'details': []})
         other_commissions = defaultdict(lambda: {'currencies': defaultdict(Decimal), 'total_rub': Decimal(0), 'raw_events': []})
-        total_other_commissions_rub = Decimal(0)
-
-        symbol_to_isin, symbol_to_name, symbol_to_multiplier = self._parse_instrument_info(sections)
-        trades = self._parse_trades(sections, other_commissions, symbol_to_isin, symbol_to_name, symbol_to_multiplier)
-        dividends = self._parse_dividends(sections)
-        conversions, acquisitions = self._parse_corporate_actions(sections, symbol_to_name)
-        self._parse_interest(sections, other_commissions)
-        dividend_accrual_payments = self._parse_dividend_accrual_payments(sections)
-        self._parse_fees(sections, other_commissions, dividend_commissions, dividend_accrual_payments)
+        return dividend_commissions, other_commissions
 
+    def _assemble_result(self, fifo_history, dividends, dividend_commissions, other_commissions):
         (instrument_event_history, total_sales_profit, profit_by_income_code, profit_by_income_code_currencies,
          income_by_income_code, income_by_income_code_currencies,
-         cost_by_income_code, cost_by_income_code_currencies) = self._build_fifo_history(
-            trades, conversions, acquisitions, symbol_to_isin, symbol_to_name
-        )
+         cost_by_income_code, cost_by_income_code_currencies) = fifo_history
 
         total_other_commissions_rub = sum((data.get('total_rub', Decimal(0)) for data in other_commissions.values()), Decimal(0))
         total_dividends_rub = sum((d.get('amount_rub', Decimal(0)) for d in dividends), Decimal(0))
@@ -118,7 +194,7 @@ class IBParser(BaseBrokerParser):
             dividends,
             total_dividends_rub,
             total_sales_profit,
-            False,
+            self.context.had_error,
             dividend_commissions,
             other_commissions,
             total_other_commissions_rub,
@@ -213,16 +289,35 @@ class IBParser(BaseBrokerParser):
                 continue
         return None
 
+    def _collect_rate_requests(self, sections):
+        """Собирает пары (валюта, дата) из всех секций отчета для предзагрузки курсов ЦБ."""
+        rate_requests = set()
+        for blocks in sections.values():
+            for block in blocks:
+                header_map = self._header_map(block.get('header'))
+                if 'Валюта' not in header_map and 'Currency' not in header_map:
+                    continue
+                for row in block.get('data', []):
+                    currency = self._get_value(row, header_map, ['Валюта', 'Currency']).strip().upper()
+                    dt_obj = self._parse_datetime(self._get_value(row, header_map, ['Дата/Время', 'Date/Time', 'Дата', 'Date']))
+                    if currency and dt_obj:
+                        rate_requests.add((currency, dt_obj.date()))
+        return rate_requests
+
     def _get_cbr_rate(self, currency_code, dt_obj):
         if not currency_code or currency_code.upper() == 'RUB':
             return Decimal('1')
-        if not isinstance(dt_obj, (datetime, date)):
+        rate_key = self._cbr_rate_key(currency_code, dt_obj)
+        if rate_key is None:
             return None
-        curr = Currency.objects.filter(char_code=currency_code.upper()).first()
-        if not curr:
+        return self.context.unit_rate(*rate_key, f"для {currency_code}")
+
+    @staticmethod
+    def _cbr_rate_key(currency_code, dt_obj):
+        """Ключ курса ЦБ (код валюты, дата) для RunContext.unit_rate; None для рублей и операций без даты."""
+        if not currency_code or currency_code.upper() == 'RUB' or not isinstance(dt_obj, (datetime, date)):
             return None
-        _, _, rate_val = _get_exchange_rate_for_date(self.request, curr, dt_obj.date(), f"для {currency_code}")
-        return rate_val
+        return currency_code.upper(), dt_obj.date() if isinstance(dt_obj, datetime) else dt_obj
 
     def _parse_instrument_info(self, sections):
         """Парсит секцию 'Информация о финансовом инструменте' и возвращает словари symbol -> ISIN, symbol -> название, symbol -> множитель."""
@@ -504,26 +599,19 @@ class IBParser(BaseBrokerParser):
                 if not (is_target_year or is_prev_december):
                     continue
 
-                # Извлекаем тикер из описания для проверки
-                ticker, isin = self._extract_symbol_isin(description)
+                # Тикер, ISIN, ключ дивиденда и признаки описания — за один разбор (см. description_rules)
+                fee_description = classify_fee_description(description)
+                ticker, isin = fee_description.ticker, fee_description.isin
 
                 # Проверяем, связана ли комиссия с дивидендами:
                 # 1. По названию (содержит "дивиденд", "dividend", или "- FEE" в конце)
                 # 2. Или если платёж есть в секции "Изменения в начислениях дивидендов"
-                desc_lower = (description or '').lower()
-                is_dividend_related_by_name = (
-                    bool(re.search(r'\s*-\s*FEE\s*$', description or '', flags=re.IGNORECASE))
-                    or 'дивиденд' in desc_lower
-                    or 'dividend' in desc_lower
-                )
-                # Проверяем наличие платежа в "Изменениях в начислениях дивидендов"
                 is_in_dividend_accruals = ticker and (ticker, abs(amount)) in dividend_accrual_payments
-                is_dividend_related = is_dividend_related_by_name or is_in_dividend_accruals
+                is_dividend_related = fee_description.is_dividend_related or is_in_dividend_accruals
 
                 if is_dividend_related:
-                    # ticker и isin уже извлечены выше
                     category = ticker or "Комиссии по дивидендам"
-                    dividend_key = self._normalize_dividend_description(description)
+                    dividend_key = fee_description.dividend_key
                     dividend_match_key = self._make_dividend_match_key(dt_obj.date(), currency, dividend_key)
                     self._add_dividend_commission(
                         dividend_commissions,
@@ -567,12 +655,7 @@ class IBParser(BaseBrokerParser):
                 self._add_other_commission(other_commissions, category, amount, currency, dt_obj, description)
 
     def _extract_symbol_isin(self, description):
-        if not description:
-            return None, None
-        match = re.match(r'^([A-Z0-9.\-]+)\s*\(([A-Z0-9]{12})\)', description.strip())
-        if not match:
-            return None, None
-        return match.group(1), match.group(2)
+        return extract_symbol_isin(description)
 
     def _make_dividend_match_key(self, dt_value, currency, normalized_description):
         if not dt_value or not normalized_description:
@@ -619,38 +702,23 @@ class IBParser(BaseBrokerParser):
                 value = self._parse_decimal(self._get_value(row, header_map, ['Стоимость', 'Value']))
                 row_security_id = self._get_value(row, header_map, ['Идентификатор ценной бумаги', 'Security ID'])
                 row_security_id = row_security_id.strip() if isinstance(row_security_id, str) else ''
-                if row_security_id and not re.match(r'^[A-Z0-9]{12}$', row_security_id):
+                if row_security_id and not SECURITY_ID_RE.match(row_security_id):
                     row_security_id = ''
 
                 dt_obj = self._parse_datetime(date_raw)
                 if not dt_obj or quantity == 0:
                     continue
 
-                # Ищем паттерны: TICKER(ISIN) и (TICKER, описание, ISIN)
-                pairs_raw = re.findall(r'([A-Z0-9\\.]+)\(([A-Z0-9]{12})\)', description or '')
-                alt_pairs = re.findall(r'\(([A-Z0-9\\.]+),\s*[^,]+,\s*([A-Z0-9]{12})\)', description or '')
-                pairs_raw.extend(alt_pairs)
-                # Убираем дубли (в IB Description часто повторяются одинаковые пары)
-                pairs = []
-                seen_pairs = set()
-                for tck, isn in pairs_raw:
-                    key = (tck, isn)
-                    if key in seen_pairs:
-                        continue
-                    seen_pairs.add(key)
-                    pairs.append((tck, isn))
+                # Пары TICKER(ISIN) / (TICKER, описание, ISIN) без повторов и тип действия
+                # (по описанию без последних скобок с названием инструмента) — см. description_rules
+                action = classify_corporate_action(description)
+                pairs = list(action.pairs)
                 if len(pairs) < 1:
                     continue
-
-                # Определяем тип события по описанию
-                # Убираем последние скобки с названием инструмента, чтобы не путать
-                # слова типа "SUBSCRIPTION" в названии с типом действия "Подписка"
-                action_part = re.sub(r'\s*\([^()]+\)\s*$', '', description or '')
-                action_lower = action_part.lower()
-                is_rights_issue = 'выдача прав' in action_lower or 'rights issue' in action_lower
-                is_subscription = 'подписка' in action_lower or 'subscription' in action_lower
-                is_merger = 'слияние' in action_lower or 'merger' in action_lower
-                is_spinoff = 'спин-офф' in action_lower or 'spin-off' in action_lower or 'spinoff' in action_lower
+                is_rights_issue = action.is_rights_issue
+                is_subscription = action.is_subscription
+                is_merger = action.is_merger
+                is_spinoff = action.is_spinoff
 
                 # Определяем "тикер строки" (какой инструмент именно списан/получен в этой записи).
                 # В реальном IB CSV он есть в колонке "Символ". Если колонки нет (например, в тестах),
@@ -719,20 +787,14 @@ class IBParser(BaseBrokerParser):
                     'is_merger': is_merger,
                     'is_spinoff': is_spinoff,
                     'pairs': pairs,
+                    'base_description': action.base_description,
                 })
 
-        # Группируем события по дате и нормализованному описанию для связывания пар
-        # Ключ: (дата, базовое описание без конкретного тикера результата)
-        def normalize_description(desc):
-            """Извлекаем базовое описание для связывания событий."""
-            # Убираем последние скобки с результатом
-            match = re.match(r'^(.+?)\s*\([^()]+\)\s*$', desc or '')
-            return match.group(1).strip() if match else (desc or '').strip()
-
+        # Группируем события по дате и базовому описанию (без последних скобок с результатом)
+        # для связывания пар. Ключ: (дата, базовое описание без конкретного тикера результата)
         events_by_base = defaultdict(list)
         for ev in all_events:
-            base_desc = normalize_description(ev['description'])
-            key = (ev['date'], base_desc)
+            key = (ev['date'], ev['base_description'])
             events_by_base[key].append(ev)
 
         # Собираем конвертации и приобретения
@@ -960,6 +1022,17 @@ class IBParser(BaseBrokerParser):
 
         return False
 
+    def _parse_forex_commissions(self, sections, other_commissions):
+        """FX-комиссии из секции сделок (как при _parse_trades) без разбора самих сделок."""
+        for block in sections.get('Сделки') or []:
+            header_map = self._header_map(block.get('header', []))
+            for row in block.get('data', []):
+                discriminator = self._get_value(row, header_map, ['DataDiscriminator'])
+                if discriminator and discriminator != 'Order':
+                    continue
+                if self._get_value(row, header_map, ['Класс актива', 'Asset Class']) in ('Forex',):
+                    self._record_commission_from_trade(row, header_map, other_commissions)
+
     def _record_commission_from_trade(self, row, header_map, other_commissions):
         currency = self._get_value(row, header_map, ['Валюта', 'Currency']).upper()
         datetime_raw = self._get_value(row, header_map, ['Дата/Время', 'Date/Time'])
@@ -998,12 +1071,7 @@ class IBParser(BaseBrokerParser):
         - "HSBK(US46627J3023) Наличный дивиденд USD 2.258938 на акцию - FEE" -> "HSBK"
         - "GLTR.OLD(US37949E2046) Наличный дивиденд USD 3.910916 на акцию - FEE" -> "GLTR.OLD"
         """
-        if not description:
-            return None
-        match = re.match(r'^([A-Z0-9.]+)\(', description.strip())
-        if match:
-            return match.group(1)
-        return None
+        return extract_fee_ticker(description)
 
     def _normalize_dividend_description(self, description):
         """Нормализует описание дивидендного события для связывания (дивиденд/налог/FEE).
@@ -1021,16 +1089,7 @@ class IBParser(BaseBrokerParser):
         - "FMC(US3024913036) Выплата в качестве дивиденда - US Налог"
           -> "FMC(US3024913036) Выплата в качестве дивиденда"
         """
-        if not description:
-            return None
-        desc = description.strip()
-        # Убираем " - FEE"
-        desc = re.sub(r'\s*-\s*FEE\s*$', '', desc, flags=re.IGNORECASE)
-        # Убираем " - XX Налог" / " - XX Tax" в конце
-        desc = re.sub(r'\s*-\s*[A-Z]{2}\s*(налог|tax)\s*$', '', desc, flags=re.IGNORECASE)
-        # Убираем завершающие скобки (тип выплаты): "(...)" в конце (в т.ч. несколько подряд)
-        desc = re.sub(r'(?:\s*\([^)]*\)\s*)+$', '', desc)
-        return desc.strip() if desc else None
+        return normalize_dividend_description(description)
 
     def _add_dividend_commission(
         self,
@@ -1070,14 +1129,6 @@ class IBParser(BaseBrokerParser):
         })
 
     def _build_fifo_history(self, trades, conversions, acquisitions=None, symbol_to_isin=None, symbol_to_name=None):
-        buy_lots = defaultdict(deque)
-        short_sales = defaultdict(deque)
-        instrument_events = defaultdict(list)
-        trade_details_by_id = {}
-        symbols_with_sales_in_target_year = set()
-        used_buy_ids_for_target_year = set()
-        total_sales_profit_rub = Decimal(0)
-
         if acquisitions is None:
             acquisitions = []
         if symbol_to_isin is None:
@@ -1085,6 +1136,24 @@ class IBParser(BaseBrokerParser):
         if symbol_to_name is None:
             symbol_to_name = {}
 
+        # FIFO прогоняем только по инструментам, связанным со сделками целевого года
+        instrument_events, symbols_with_sales_by_year, used_buy_ids_by_year, lineage = self._replay_fifo_history(
+            trades, conversions, acquisitions, symbol_to_isin, symbol_to_name,
+            prune=is_relevance_pruning_enabled() and bool(self.target_year),
+        )
+        return self._summarize_fifo_history(
+            instrument_events,
+            set(symbols_with_sales_by_year.get(self.target_year, ())),
+            set(used_buy_ids_by_year.get(self.target_year, ())),
+            lineage,
+            symbol_to_isin,
+        )
+
+    def _replay_fifo_history(self, trades, conversions, acquisitions, symbol_to_isin, symbol_to_name, prune=False):
+        """Общая для всех лет часть истории: родословная инструментов и FIFO-прогон.
+
+        Возвращает (instrument_events, symbols_with_sales_by_year, used_buy_ids_by_year, lineage).
+        """
         # Дополняем symbol_to_isin из конвертаций.
         # Это важно когда тикер сменился (LFC → LFCHY) и старый тикер
         # отсутствует в секции "Информация о финансовом инструменте" текущего отчёта.
@@ -1105,381 +1174,145 @@ class IBParser(BaseBrokerParser):
             if ticker and isin and ticker not in symbol_to_isin:
                 symbol_to_isin[ticker] = isin
 
-        # Объединяем все события (сделки, конвертации, acquisitions) и сортируем по дате
-        conversions_by_date = sorted(conversions, key=lambda x: x.get('datetime_obj') or datetime.min)
-        acquisitions_by_date = sorted(acquisitions, key=lambda x: x.get('datetime_obj') or datetime.min)
-        conversion_idx = 0
-        acquisition_idx = 0
+        lineage = self._build_instrument_lineage(trades, conversions, acquisitions, symbol_to_isin)
 
-        for trade in trades:
-            # Обрабатываем конвертации и acquisitions в хронологическом порядке до текущей сделки
-            trade_dt = trade.get('datetime_obj') or datetime.max
-            while True:
-                next_conv = conversions_by_date[conversion_idx] if conversion_idx < len(conversions_by_date) else None
-                next_acq = acquisitions_by_date[acquisition_idx] if acquisition_idx < len(acquisitions_by_date) else None
+        if prune:
+            trades, conversions, acquisitions = self._select_fifo_relevant_inputs(
+                trades, conversions, acquisitions, lineage
+            )
 
-                next_conv_dt = (next_conv.get('datetime_obj') if next_conv else None) or datetime.min
-                next_acq_dt = (next_acq.get('datetime_obj') if next_acq else None) or datetime.min
+        instrument_events, symbols_with_sales_by_year, used_buy_ids_by_year = self._replay_fifo_families(
+            trades, conversions, acquisitions, symbol_to_isin, symbol_to_name, lineage
+        )
+        return instrument_events, symbols_with_sales_by_year, used_buy_ids_by_year, lineage
+
+    @staticmethod
+    def _copy_fifo_events(instrument_events):
+        """Копия событий прогона, в которой итоги отдельного года можно помечать независимо."""
+        return {
+            symbol: [dict(event, event_details=dict(event.get('event_details') or {})) for event in events]
+            for symbol, events in instrument_events.items()
+        }
 
-                has_conv = next_conv is not None and next_conv_dt <= trade_dt
-                has_acq = next_acq is not None and next_acq_dt <= trade_dt
+    def _summarize_fifo_history(self, instrument_events, symbols_with_sales_in_target_year, used_buy_ids_for_target_year,
+                                lineage, symbol_to_isin):
+        """Итоги FIFO за self.target_year: релевантность событий, связи покупка-продажа, прибыль и история."""
+        total_sales_profit_rub = Decimal(0)
 
-                if not has_conv and not has_acq:
-                    break
+        for symbol, events in instrument_events.items():
+            for event in events:
+                if event.get('display_type') != 'trade':
+                    continue
+                details = event.get('event_details') or {}
+                if details.get('operation') == 'sell':
+                    dt_obj = event.get('datetime_obj')
+                    effective_year = details.get('short_close_year') or (dt_obj.year if dt_obj else None)
+                    details['is_relevant_for_target_year'] = bool(effective_year == self.target_year)
+                    if effective_year == self.target_year:
+                        used_buy_ids_for_target_year.update(details.get('used_buy_ids', []))
 
-                if has_conv and (not has_acq or next_conv_dt <= next_acq_dt):
-                    self._apply_conversion(next_conv, buy_lots, instrument_events, symbol_to_isin, symbol_to_name)
-                    conversion_idx += 1
-                else:
-                    self._apply_acquisition(next_acq, buy_lots, instrument_events, symbol_to_isin, symbol_to_name)
-                    acquisition_idx += 1
+        for symbol, events in instrument_events.items():
+            for event in events:
+                if event.get('display_type') != 'trade':
+                    continue
+                details = event.get('event_details') or {}
+                if details.get('operation') == 'buy':
+                    trade_id = details.get('trade_id')
+                    dt_obj = event.get('datetime_obj')
+                    if details.get('is_expired') and dt_obj and dt_obj.year == self.target_year:
+                        details['is_relevant_for_target_year'] = True
+                    else:
+                        details['is_relevant_for_target_year'] = trade_id in used_buy_ids_for_target_year
 
-            dt_obj = trade.get('datetime_obj')
-            symbol = trade.get('group_symbol') or trade.get('symbol') or 'UNKNOWN'
-            quantity = trade.get('quantity', Decimal(0))
-            price = trade.get('price', Decimal(0))
-            commission = trade.get('commission', Decimal(0))
-            cbr_rate = trade.get('cbr_rate', Decimal(0))
-            multiplier = trade.get('multiplier', Decimal(1))
-            proceeds = trade.get('proceeds', price * quantity * multiplier)
+        for symbol, events in instrument_events.items():
+            if symbol in symbols_with_sales_in_target_year:
+                for event in events:
+                    if event.get('display_type') == 'conversion_info':
+                        details = event.get('event_details') or {}
+                        details['is_relevant_for_target_year'] = True
 
-            if trade['operation'] == 'buy':
-                # Покрываем открытые шорты (если есть)
-                remaining = quantity
-                # Для опционов: сумма = цена * количество * множитель (100)
-                cost_shares_rub = (proceeds * cbr_rate).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
-                cost_comm_rub = (commission * cbr_rate).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
-                cost_per_share_rub = Decimal(0)
-                if quantity:
-                    cost_per_share_rub = (cost_shares_rub + cost_comm_rub) / quantity
+        # Цветовые связи покупка-продажа (как в FFG)
+        available_colors = ['#4FC3F7', '#FF9800', '#66BB6A', '#AB47BC', '#EF5350', '#FFEB3B', '#26C6DA', '#FF7043']
+        color_index = 0
+        pair_to_color = {}
+        trade_id_to_colors = {}
 
-                while remaining > 0 and short_sales[symbol]:
-                    short_entry = short_sales[symbol][0]
-                    cover_qty = min(remaining, short_entry['qty_remaining'])
-                    remaining -= cover_qty
-                    short_entry['qty_remaining'] -= cover_qty
+        for symbol, events in instrument_events.items():
+            for event in events:
+                if event.get('display_type') != 'trade':
+                    continue
+                details = event.get('event_details') or {}
+                if details.get('operation') == 'sell' and details.get('is_relevant_for_target_year'):
+                    sell_id = details.get('trade_id')
+                    used_buy_ids = details.get('used_buy_ids', [])
+                    unique_buy_ids = []
+                    seen = set()
+                    for buy_id in used_buy_ids:
+                        if buy_id not in seen:
+                            seen.add(buy_id)
+                            unique_buy_ids.append(buy_id)
+                    for buy_id in unique_buy_ids:
+                        if buy_id in used_buy_ids_for_target_year:
+                            pair_key = (buy_id, sell_id)
+                            if pair_key not in pair_to_color:
+                                pair_to_color[pair_key] = available_colors[color_index % len(available_colors)]
+                                color_index += 1
 
-                    sell_details = short_entry.get('sell_details')
-                    if sell_details:
-                        sell_details['fifo_cost_rub_decimal'] += (cover_qty * cost_per_share_rub)
-                        # Накапливаем затраты в валюте для шортов
-                        fifo_cost_by_curr_short = sell_details.setdefault('fifo_cost_by_currency', defaultdict(Decimal))
-                        buy_currency = trade.get('currency', 'USD')
-                        buy_cost_per_share_currency = (proceeds + commission) / quantity if quantity else Decimal(0)
-                        fifo_cost_by_curr_short[buy_currency] += (cover_qty * buy_cost_per_share_currency)
-                        used_buy_ids = sell_details.setdefault('used_buy_ids', [])
-                        if trade.get('trade_id') not in used_buy_ids:
-                            used_buy_ids.append(trade.get('trade_id'))
-                        if short_entry.get('sell_year') == self.target_year:
-                            used_buy_ids_for_target_year.add(trade.get('trade_id'))
+        for symbol, events in instrument_events.items():
+            for event in events:
+                if event.get('display_type') != 'trade':
+                    continue
+                details = event.get('event_details') or {}
+                trade_id = details.get('trade_id')
+                if not trade_id:
+                    continue
+                colors = []
+                for (buy_id, sell_id), color in pair_to_color.items():
+                    if trade_id in (buy_id, sell_id) and color not in colors:
+                        colors.append(color)
+                details['link_colors'] = colors
 
-                    if short_entry['qty_remaining'] <= 0:
-                        if sell_details:
-                            # Конвертируем defaultdict в dict для fifo_cost_by_currency
-                            if 'fifo_cost_by_currency' in sell_details and isinstance(sell_details['fifo_cost_by_currency'], defaultdict):
-                                sell_details['fifo_cost_by_currency'] = dict(sell_details['fifo_cost_by_currency'])
-                            sell_details['fifo_cost_rub_str'] = f"{sell_details['fifo_cost_rub_decimal']:.2f} (шорт, покр.)"
-                            # Для шортов финансовый результат считаем по году закрытия позиции.
-                            # Если шорт был открыт в прошлом году, но закрыт в целевом — сделка должна попасть в отчёт.
-                            if dt_obj:
-                                sell_details['short_close_datetime_obj'] = dt_obj
-                                sell_details['short_close_year'] = dt_obj.year
-                                if dt_obj.year == self.target_year:
-                                    symbols_with_sales_in_target_year.add(symbol)
-                        short_sales[symbol].popleft()
-                    elif sell_details:
-                        sell_details['fifo_cost_rub_str'] = f"Частично открытый шорт (тек. расх.: {sell_details['fifo_cost_rub_decimal']:.2f} RUB)"
+        # Пересчет total_sales_profit_rub после учета шортов/покрытий
+        # Разделение по кодам дохода: 1530 (акции), 1532 (ПФИ/опционы)
+        profit_by_income_code = {'1530': Decimal(0), '1532': Decimal(0)}
+        # Добавляем структуру для хранения профита по валютам для каждого кода дохода
+        profit_by_income_code_currencies = {
+            '1530': defaultdict(Decimal),  # {currency: profit_amount}
+            '1532': defaultdict(Decimal)
+        }
+        # Добавляем структуры для хранения дохода и затрат
+        income_by_income_code = {'1530': Decimal(0), '1532': Decimal(0)}
+        income_by_income_code_currencies = {
+            '1530': defaultdict(Decimal),
+            '1532': defaultdict(Decimal)
+        }
+        cost_by_income_code = {'1530': Decimal(0), '1532': Decimal(0)}
+        cost_by_income_code_currencies = {
+            '1530': defaultdict(Decimal),
+            '1532': defaultdict(Decimal)
+        }
+        for symbol, events in instrument_events.items():
+            for event in events:
+                if event.get('display_type') != 'trade':
+                    continue
+                details = event.get('event_details') or {}
+                if details.get('operation') == 'sell':
+                    dt_obj = event.get('datetime_obj')
+                    effective_year = details.get('short_close_year') or (dt_obj.year if dt_obj else None)
+                    if effective_year == self.target_year:
+                        # Используем summ, которая уже учитывает множитель для опционов
+                        income_rub = (details.get('summ', Decimal(0)) * details.get('cbr_rate', Decimal(0))).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+                        fifo_cost_val = details.get('fifo_cost_rub_decimal', Decimal(0)) or Decimal(0)
+                        profit = income_rub - fifo_cost_val
+                        total_sales_profit_rub += profit
+                        # Добавляем в соответствующий код дохода
+                        income_code = details.get('income_code', '1530')
+                        profit_by_income_code[income_code] = profit_by_income_code.get(income_code, Decimal(0)) + profit
 
-                quantity_for_lots = remaining
-
-                if quantity_for_lots > 0:
-                    # Расчет стоимости в оригинальной валюте
-                    cost_per_share_currency = (proceeds + commission) / quantity if quantity else Decimal(0)
-                    buy_lots[symbol].append({
-                        'q_remaining': quantity_for_lots,
-                        'cost_per_share_rub': cost_per_share_rub,
-                        'cost_per_share_currency': cost_per_share_currency,
-                        'currency': trade.get('currency'),
-                        'lot_id': trade.get('trade_id'),
-                    })
-                fifo_cost_rub = None
-                fifo_cost_str = None
-                fifo_cost_by_currency = {}
-                used_buy_ids = []
-            else:
-                # Для истёкших опционов: если нет лота покупки, создаём виртуальный на основе Базиса
-                is_expired = trade.get('is_expired', False)
-                basis = trade.get('basis', Decimal(0))
-                if is_expired and not buy_lots[symbol] and basis > 0:
-                    # Создаём виртуальную покупку на основе Базиса
-                    # Базис в IB указан в валюте сделки, переводим в рубли
-                    basis_rub = (basis * cbr_rate).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP) if cbr_rate else Decimal(0)
-                    cost_per_share_rub = (basis_rub / quantity) if quantity else Decimal(0)
-                    cost_per_share_currency = (basis / quantity) if quantity else Decimal(0)
-                    virtual_lot_id = f"VIRTUAL_BUY_{trade.get('trade_id')}"
-                    buy_lots[symbol].append({
-                        'q_remaining': quantity,
-                        'cost_per_share_rub': cost_per_share_rub,
-                        'cost_per_share_currency': cost_per_share_currency,
-                        'currency': trade.get('currency'),
-                        'lot_id': virtual_lot_id,
-                    })
-                    # Добавляем событие виртуальной покупки для отображения
-                    instrument_events[symbol].append({
-                        'display_type': 'trade',
-                        'datetime_obj': dt_obj,  # Дата та же (покупка была ранее, но отображаем здесь)
-                        'event_details': {
-                            'date': dt_obj.strftime('%d.%m.%Y %H:%M:%S') if dt_obj else '-',
-                            'trade_id': virtual_lot_id,
-                            'operation': 'buy',
-                            'symbol': trade.get('symbol'),
-                            'instr_nm': trade.get('instr_nm') or symbol,
-                            'isin': trade.get('isin', ''),
-                            'instr_kind': trade.get('instr_kind'),
-                            'income_code': trade.get('income_code', '1530'),
-                            'p': Decimal(0),  # Цена неизвестна
-                            'curr_c': trade.get('currency'),
-                            'cbr_rate': cbr_rate,
-                            'q': quantity,
-                            'multiplier': multiplier,
-                            'summ': basis,  # Базис = стоимость покупки
-                            'commission': Decimal(0),
-                            'fifo_cost_rub_decimal': None,
-                            'fifo_cost_rub_str': None,
-                            'is_relevant_for_target_year': True,  # Покупка релевантна для истёкшего опциона
-                            'used_buy_ids': [],
-                            'link_colors': [],
-                            'is_virtual_buy': True,  # Флаг виртуальной покупки
-                            'virtual_buy_comment': 'Покупка опциона (из отчёта за предыдущий период)',
-                        },
-                    })
-                    if virtual_lot_id:
-                        trade_details_by_id[virtual_lot_id] = instrument_events[symbol][-1]['event_details']
-
-                remaining = quantity
-                fifo_cost_rub = Decimal(0)
-                fifo_cost_by_currency = defaultdict(Decimal)
-                used_buy_ids = []
-                commission_rub = (commission * cbr_rate).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP) if cbr_rate else Decimal(0)
-                while remaining > 0 and buy_lots[symbol]:
-                    lot = buy_lots[symbol][0]
-                    take = min(remaining, lot['q_remaining'])
-                    fifo_cost_rub += (take * lot['cost_per_share_rub'])
-                    # Накапливаем затраты в оригинальной валюте покупки
-                    lot_currency = lot.get('currency', 'USD')
-                    lot_cost_in_currency = lot.get('cost_per_share_currency', Decimal(0))
-                    fifo_cost_by_currency[lot_currency] += (take * lot_cost_in_currency)
-                    lot['q_remaining'] -= take
-                    remaining -= take
-                    # Получаем ID оригинальных покупок (из конвертации или напрямую)
-                    if lot.get('source_lot_ids'):
-                        # Лот создан конвертацией - берём ID оригинальных покупок
-                        for sid in lot['source_lot_ids']:
-                            if sid not in used_buy_ids:
-                                used_buy_ids.append(sid)
-                    else:
-                        # Обычный лот - берём его собственный lot_id
-                        lot_id = lot.get('lot_id')
-                        if lot_id and lot_id not in used_buy_ids:
-                            used_buy_ids.append(lot_id)
-                    if lot['q_remaining'] <= 0:
-                        buy_lots[symbol].popleft()
-
-                # Добавляем комиссию продажи для всех продаж (не только шортов)
-                fifo_cost_rub += commission_rub
-                # Добавляем комиссию продажи в валюте продажи
-                sale_currency = trade.get('currency', 'USD')
-                fifo_cost_by_currency[sale_currency] += commission
-
-                if remaining > 0:
-                    short_sales[symbol].append({
-                        'sell_id': trade.get('trade_id'),
-                        'qty_remaining': remaining,
-                        'sell_year': dt_obj.year if dt_obj else None,
-                        'sell_details': None,
-                    })
-                    if fifo_cost_rub == commission_rub:
-                        fifo_cost_str = f"Открытый шорт (расх.: {commission_rub:.2f} RUB)"
-                    else:
-                        fifo_cost_str = f"Частично открытый шорт (тек. расх.: {fifo_cost_rub:.2f} RUB)"
-                else:
-                    fifo_cost_str = f"{fifo_cost_rub:.2f}"
-
-                if dt_obj and dt_obj.year == self.target_year:
-                    symbols_with_sales_in_target_year.add(symbol)
-
-            # Если есть погашение опциона (Ep) в целевом году — инструмент должен попасть в историю/PDF,
-            # даже если операция формально 'buy' (закрытие шорта) и нет обычной продажи в этом году.
-            if dt_obj and dt_obj.year == self.target_year and trade.get('is_expired', False):
-                symbols_with_sales_in_target_year.add(symbol)
-
-            event_details = {
-                'date': dt_obj.strftime('%d.%m.%Y %H:%M:%S') if dt_obj else '-',
-                'trade_id': trade.get('trade_id'),
-                'operation': trade.get('operation'),
-                'symbol': trade.get('symbol'),
-                'instr_nm': trade.get('instr_nm') or symbol,
-                'isin': trade.get('isin', ''),
-                'instr_kind': trade.get('instr_kind'),
-                'income_code': trade.get('income_code', '1530'),
-                'p': price,
-                'curr_c': trade.get('currency'),
-                'cbr_rate': cbr_rate,
-                'q': quantity,
-                'multiplier': multiplier,
-                'summ': proceeds,  # Для опционов уже включает множитель 100
-                'commission': commission,
-                'fifo_cost_rub_decimal': fifo_cost_rub,
-                'fifo_cost_rub_str': fifo_cost_str,
-                'fifo_cost_by_currency': dict(fifo_cost_by_currency) if fifo_cost_by_currency else {},
-                'is_relevant_for_target_year': bool(dt_obj and dt_obj.year == self.target_year and (trade.get('operation') == 'sell' or trade.get('is_expired'))),
-                'used_buy_ids': used_buy_ids,
-                'link_colors': [],
-                'is_expired': trade.get('is_expired', False),  # Флаг истёкшего опциона
-            }
-            instrument_events[symbol].append({
-                'display_type': 'trade',
-                'datetime_obj': dt_obj,
-                'event_details': event_details,
-            })
-            if event_details.get('trade_id'):
-                trade_details_by_id[event_details['trade_id']] = event_details
-                if trade.get('operation') == 'sell' and short_sales[symbol]:
-                    last_short = short_sales[symbol][-1]
-                    if last_short.get('sell_id') == event_details['trade_id']:
-                        last_short['sell_details'] = event_details
-
-        # Обрабатываем оставшиеся конвертации/acquisitions после всех сделок (тоже по времени)
-        while conversion_idx < len(conversions_by_date) or acquisition_idx < len(acquisitions_by_date):
-            next_conv = conversions_by_date[conversion_idx] if conversion_idx < len(conversions_by_date) else None
-            next_acq = acquisitions_by_date[acquisition_idx] if acquisition_idx < len(acquisitions_by_date) else None
-
-            next_conv_dt = (next_conv.get('datetime_obj') if next_conv else None) or datetime.max
-            next_acq_dt = (next_acq.get('datetime_obj') if next_acq else None) or datetime.max
-
-            if next_conv and (not next_acq or next_conv_dt <= next_acq_dt):
-                self._apply_conversion(next_conv, buy_lots, instrument_events, symbol_to_isin, symbol_to_name)
-                conversion_idx += 1
-            elif next_acq:
-                self._apply_acquisition(next_acq, buy_lots, instrument_events, symbol_to_isin, symbol_to_name)
-                acquisition_idx += 1
-            else:
-                break
-
-        for symbol, events in instrument_events.items():
-            for event in events:
-                if event.get('display_type') != 'trade':
-                    continue
-                details = event.get('event_details') or {}
-                if details.get('operation') == 'sell':
-                    dt_obj = event.get('datetime_obj')
-                    effective_year = details.get('short_close_year') or (dt_obj.year if dt_obj else None)
-                    details['is_relevant_for_target_year'] = bool(effective_year == self.target_year)
-                    if effective_year == self.target_year:
-                        used_buy_ids_for_target_year.update(details.get('used_buy_ids', []))
-
-        for symbol, events in instrument_events.items():
-            for event in events:
-                if event.get('display_type') != 'trade':
-                    continue
-                details = event.get('event_details') or {}
-                if details.get('operation') == 'buy':
-                    trade_id = details.get('trade_id')
-                    dt_obj = event.get('datetime_obj')
-                    if details.get('is_expired') and dt_obj and dt_obj.year == self.target_year:
-                        details['is_relevant_for_target_year'] = True
-                    else:
-                        details['is_relevant_for_target_year'] = trade_id in used_buy_ids_for_target_year
-
-        for symbol, events in instrument_events.items():
-            if symbol in symbols_with_sales_in_target_year:
-                for event in events:
-                    if event.get('display_type') == 'conversion_info':
-                        details = event.get('event_details') or {}
-                        details['is_relevant_for_target_year'] = True
-
-        # Цветовые связи покупка-продажа (как в FFG)
-        available_colors = ['#4FC3F7', '#FF9800', '#66BB6A', '#AB47BC', '#EF5350', '#FFEB3B', '#26C6DA', '#FF7043']
-        color_index = 0
-        pair_to_color = {}
-        trade_id_to_colors = {}
-
-        for symbol, events in instrument_events.items():
-            for event in events:
-                if event.get('display_type') != 'trade':
-                    continue
-                details = event.get('event_details') or {}
-                if details.get('operation') == 'sell' and details.get('is_relevant_for_target_year'):
-                    sell_id = details.get('trade_id')
-                    used_buy_ids = details.get('used_buy_ids', [])
-                    unique_buy_ids = []
-                    seen = set()
-                    for buy_id in used_buy_ids:
-                        if buy_id not in seen:
-                            seen.add(buy_id)
-                            unique_buy_ids.append(buy_id)
-                    for buy_id in unique_buy_ids:
-                        if buy_id in used_buy_ids_for_target_year:
-                            pair_key = (buy_id, sell_id)
-                            if pair_key not in pair_to_color:
-                                pair_to_color[pair_key] = available_colors[color_index % len(available_colors)]
-                                color_index += 1
-
-        for symbol, events in instrument_events.items():
-            for event in events:
-                if event.get('display_type') != 'trade':
-                    continue
-                details = event.get('event_details') or {}
-                trade_id = details.get('trade_id')
-                if not trade_id:
-                    continue
-                colors = []
-                for (buy_id, sell_id), color in pair_to_color.items():
-                    if trade_id in (buy_id, sell_id) and color not in colors:
-                        colors.append(color)
-                details['link_colors'] = colors
-
-        # Пересчет total_sales_profit_rub после учета шортов/покрытий
-        # Разделение по кодам дохода: 1530 (акции), 1532 (ПФИ/опционы)
-        profit_by_income_code = {'1530': Decimal(0), '1532': Decimal(0)}
-        # Добавляем структуру для хранения профита по валютам для каждого кода дохода
-        profit_by_income_code_currencies = {
-            '1530': defaultdict(Decimal),  # {currency: profit_amount}
-            '1532': defaultdict(Decimal)
-        }
-        # Добавляем структуры для хранения дохода и затрат
-        income_by_income_code = {'1530': Decimal(0), '1532': Decimal(0)}
-        income_by_income_code_currencies = {
-            '1530': defaultdict(Decimal),
-            '1532': defaultdict(Decimal)
-        }
-        cost_by_income_code = {'1530': Decimal(0), '1532': Decimal(0)}
-        cost_by_income_code_currencies = {
-            '1530': defaultdict(Decimal),
-            '1532': defaultdict(Decimal)
-        }
-        for symbol, events in instrument_events.items():
-            for event in events:
-                if event.get('display_type') != 'trade':
-                    continue
-                details = event.get('event_details') or {}
-                if details.get('operation') == 'sell':
-                    dt_obj = event.get('datetime_obj')
-                    effective_year = details.get('short_close_year') or (dt_obj.year if dt_obj else None)
-                    if effective_year == self.target_year:
-                        # Используем summ, которая уже учитывает множитель для опционов
-                        income_rub = (details.get('summ', Decimal(0)) * details.get('cbr_rate', Decimal(0))).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
-                        fifo_cost_val = details.get('fifo_cost_rub_decimal', Decimal(0)) or Decimal(0)
-                        profit = income_rub - fifo_cost_val
-                        total_sales_profit_rub += profit
-                        # Добавляем в соответствующий код дохода
-                        income_code = details.get('income_code', '1530')
-                        profit_by_income_code[income_code] = profit_by_income_code.get(income_code, Decimal(0)) + profit
-
-                        # Считаем профит и затраты в валютах напрямую из fifo_cost_by_currency
-                        currency = details.get('curr_c', 'USD')
-                        summ = details.get('summ', Decimal(0))
-                        fifo_cost_by_curr = details.get('fifo_cost_by_currency', {})
+                        # Считаем профит и затраты в валютах напрямую из fifo_cost_by_currency
+                        currency = details.get('curr_c', 'USD')
+                        summ = details.get('summ', Decimal(0))
+                        fifo_cost_by_curr = details.get('fifo_cost_by_currency', {})
 
                         # Суммируем затраты по всем валютам из FIFO
                         for curr, cost_in_curr in fifo_cost_by_curr.items():
@@ -1495,11 +1328,7 @@ class IBParser(BaseBrokerParser):
                         for curr, cost_in_curr in fifo_cost_by_curr.items():
                             profit_by_income_code_currencies[income_code][curr] -= cost_in_curr
 
-        # Собираем карту конвертаций: старый_символ -> новый_символ и новый_символ -> старый_символ
-        conversion_map_old_to_new = {}
-        conversion_map_new_to_old = {}
-        processed_conversion_ids = set()
-
+        # Собираем цепочки конвертаций: старый_символ -> новый_символ
         # Собираем все конвертации из всех инструментов
         all_conversion_events = []
         for symbol, events in instrument_events.items():
@@ -1510,66 +1339,31 @@ class IBParser(BaseBrokerParser):
         # Сортируем конвертации по дате
         all_conversion_events.sort(key=lambda x: x.get('datetime_obj') or datetime.min)
 
-        # Строим карту конвертаций
         for event in all_conversion_events:
             details = event.get('event_details', {})
-            conv_id = id(event)  # Используем id события как уникальный идентификатор
-            if conv_id not in processed_conversion_ids:
-                old_symbol = details.get('old_symbol') or details.get('old_ticker')
-                new_symbol = details.get('new_symbol') or details.get('new_ticker')
-                if old_symbol and new_symbol and old_symbol != new_symbol:
-                    conversion_map_old_to_new[old_symbol] = new_symbol
-                    conversion_map_new_to_old[new_symbol] = old_symbol
-                    processed_conversion_ids.add(conv_id)
+            old_symbol = details.get('old_symbol') or details.get('old_ticker')
+            new_symbol = details.get('new_symbol') or details.get('new_ticker')
+            if old_symbol and new_symbol and old_symbol != new_symbol:
+                lineage.add_conversion(old_symbol, new_symbol, edge_id=id(event))
 
         # Определяем релевантные символы для отображения (по аналогии с FFG)
         # Начинаем с символов, у которых были продажи в целевом году
         relevant_symbols_for_display = set()
         for sold_symbol in symbols_with_sales_in_target_year:
-            relevant_symbols_for_display.add(sold_symbol)
-
-            # Идем назад по цепочке конвертаций
-            # Для варрантов (WARRANT_XXX) также проверяем символ без префикса
-            temp_symbol = sold_symbol
-            if temp_symbol.startswith('WARRANT_') and temp_symbol not in conversion_map_new_to_old:
-                base_symbol = temp_symbol[8:]  # Убираем 'WARRANT_'
-                if base_symbol in conversion_map_new_to_old:
-                    temp_symbol = base_symbol
-                    relevant_symbols_for_display.add(temp_symbol)
-            visited = {temp_symbol, sold_symbol}
-            while temp_symbol in conversion_map_new_to_old:
-                prev_symbol = conversion_map_new_to_old[temp_symbol]
-                if prev_symbol == temp_symbol or prev_symbol in visited:
-                    break
-                relevant_symbols_for_display.add(prev_symbol)
-                temp_symbol = prev_symbol
-                visited.add(prev_symbol)
-
-            # Идем вперед по цепочке конвертаций
-            temp_symbol = sold_symbol
-            visited = {temp_symbol}
-            while temp_symbol in conversion_map_old_to_new:
-                next_symbol = conversion_map_old_to_new[temp_symbol]
-                if next_symbol == temp_symbol or next_symbol in visited:
-                    break
-                relevant_symbols_for_display.add(next_symbol)
-                temp_symbol = next_symbol
-                visited.add(next_symbol)
+            relevant_symbols_for_display.update(lineage.conversion_chain(sold_symbol))
+
+            # Для варрантов (WARRANT_XXX) также идем назад от символа без префикса
+            if sold_symbol.startswith('WARRANT_') and not lineage.has_previous(sold_symbol):
+                base_symbol = sold_symbol[8:]  # Убираем 'WARRANT_'
+                if lineage.has_previous(base_symbol):
+                    relevant_symbols_for_display.add(base_symbol)
+                    relevant_symbols_for_display.update(lineage.predecessors(base_symbol))
 
         # Добавляем символы с тем же ISIN (для случаев смены тикера без корп. действия)
         # Пример: LFC -> LFCHY (тот же ISIN US16939P1066)
-        isin_to_symbols = defaultdict(set)
-        for sym, isin in symbol_to_isin.items():
-            if isin:
-                isin_to_symbols[isin].add(sym)
-
         symbols_to_add = set()
         for rel_symbol in relevant_symbols_for_display:
-            rel_isin = symbol_to_isin.get(rel_symbol)
-            if rel_isin and rel_isin in isin_to_symbols:
-                for same_isin_symbol in isin_to_symbols[rel_isin]:
-                    if same_isin_symbol not in relevant_symbols_for_display:
-                        symbols_to_add.add(same_isin_symbol)
+            symbols_to_add.update(lineage.symbols_for_isin(symbol_to_isin.get(rel_symbol)))
         relevant_symbols_for_display.update(symbols_to_add)
 
         # Группируем события по "финальному" символу в цепочке конвертаций
@@ -1581,26 +1375,7 @@ class IBParser(BaseBrokerParser):
 
         for symbol, events in instrument_events.items():
             # Проверяем, является ли этот символ релевантным
-            chain_symbols = {symbol}
-            temp_prev = symbol
-            visited_prev = {temp_prev}
-            while temp_prev in conversion_map_new_to_old:
-                prev = conversion_map_new_to_old[temp_prev]
-                if prev == temp_prev or prev in visited_prev:
-                    break
-                chain_symbols.add(prev)
-                temp_prev = prev
-                visited_prev.add(prev)
-
-            temp_next = symbol
-            visited_next = {temp_next}
-            while temp_next in conversion_map_old_to_new:
-                next_sym = conversion_map_old_to_new[temp_next]
-                if next_sym == temp_next or next_sym in visited_next:
-                    break
-                chain_symbols.add(next_sym)
-                temp_next = next_sym
-                visited_next.add(next_sym)
+            chain_symbols = set(lineage.conversion_chain(symbol))
 
             # Если символ не релевантен, пропускаем все его события
             if relevant_symbols_for_display.isdisjoint(chain_symbols):
@@ -1655,148 +1430,631 @@ class IBParser(BaseBrokerParser):
                     event_details['is_relevant_for_target_year'] = True
                     is_relevant = True
 
-                # Фильтруем нерелевантные события старше 3 лет
-                if not is_relevant and dt_obj and dt_obj.year < cutoff_year:
-                    continue
+                # Фильтруем нерелевантные события старше 3 лет
+                if not is_relevant and dt_obj and dt_obj.year < cutoff_year:
+                    continue
+
+                # Определяем ключ группировки - самый новый символ в цепочке
+                if display_type == 'conversion_info':
+                    event_symbol = event_details.get('new_symbol') or symbol
+                else:
+                    event_symbol = symbol
+
+                grouping_key = lineage.latest(event_symbol)
+
+                # Если не нашли по цепочке конвертаций, ищем по ISIN
+                # Пример: LFC имеет тот же ISIN что и LFCHY, но нет конвертации LFC->LFCHY
+                if grouping_key == event_symbol:
+                    for same_isin_sym in lineage.symbols_for_isin(symbol_to_isin.get(event_symbol)):
+                        if same_isin_sym != event_symbol and lineage.has_next(same_isin_sym):
+                            # Берём конец цепочки этого символа
+                            grouping_key = lineage.latest(same_isin_sym)
+                            break
+
+                # Для acquisition_info: если тикер есть в symbols_with_sales_in_target_year,
+                # используем его как ключ группировки (чтобы подписка была рядом с продажей)
+                if display_type == 'acquisition_info':
+                    acq_ticker = event_details.get('ticker', '')
+                    if acq_ticker in symbols_with_sales_in_target_year:
+                        grouping_key = acq_ticker
+                    # Также проверяем варрантный префикс для тикера
+                    elif f"WARRANT_{acq_ticker}" in symbols_with_sales_in_target_year:
+                        grouping_key = f"WARRANT_{acq_ticker}"
+
+                # Проверяем, есть ли группа с префиксом WARRANT_ для этого символа
+                # (варранты группируются с префиксом WARRANT_)
+                warrant_key = f"WARRANT_{grouping_key}"
+                if warrant_key in symbols_with_sales_in_target_year:
+                    grouping_key = warrant_key
+
+                if display_type == 'acquisition_info':
+                    print(f"[DEBUG] Adding acquisition to filtered_history: symbol={symbol}, grouping_key={grouping_key}, ticker={event_details.get('ticker')}, is_relevant={event_details.get('is_relevant_for_target_year')}")
+
+                filtered_history[grouping_key].append(event)
+
+        # Сортируем события в каждой группе: по времени, затем по цене (FIFO), затем по trade_id
+        for symbol in filtered_history:
+            filtered_history[symbol].sort(key=lambda x: (
+                x.get('datetime_obj') or datetime.min,
+                x.get('event_details', {}).get('price') or Decimal(0),
+                x.get('event_details', {}).get('trade_id') or ''
+            ))
+
+        # Определяем диапазон дат для PDF (от первой релевантной покупки до последней релевантной продажи)
+        for symbol, events in filtered_history.items():
+            min_relevant_date = None
+            max_relevant_date = None
+
+            # Находим границы диапазона релевантных событий
+            for event in events:
+                event_details = event.get('event_details', {})
+                dt_obj = event.get('datetime_obj')
+                if event_details.get('is_relevant_for_target_year') and dt_obj:
+                    if min_relevant_date is None or dt_obj < min_relevant_date:
+                        min_relevant_date = dt_obj
+                    if max_relevant_date is None or dt_obj > max_relevant_date:
+                        max_relevant_date = dt_obj
+
+            # Устанавливаем флаг is_in_pdf_range для каждого события
+            for event in events:
+                event_details = event.get('event_details', {})
+                dt_obj = event.get('datetime_obj')
+                if min_relevant_date and max_relevant_date and dt_obj:
+                    event_details['is_in_pdf_range'] = min_relevant_date <= dt_obj <= max_relevant_date
+                else:
+                    event_details['is_in_pdf_range'] = event_details.get('is_relevant_for_target_year', False)
+
+        # Преобразуем defaultdict обратно в обычный dict
+        filtered_history = dict(filtered_history)
+
+        # Преобразуем profit_by_income_code_currencies в обычный dict
+        profit_by_income_code_currencies_dict = {
+            '1530': dict(profit_by_income_code_currencies['1530']),
+            '1532': dict(profit_by_income_code_currencies['1532'])
+        }
+
+        # Преобразуем income и cost currencies в обычные dict
+        income_by_income_code_currencies_dict = {
+            '1530': dict(income_by_income_code_currencies['1530']),
+            '1532': dict(income_by_income_code_currencies['1532'])
+        }
+        cost_by_income_code_currencies_dict = {
+            '1530': dict(cost_by_income_code_currencies['1530']),
+            '1532': dict(cost_by_income_code_currencies['1532'])
+        }
+
+        return (filtered_history, total_sales_profit_rub, profit_by_income_code, profit_by_income_code_currencies_dict,
+                income_by_income_code, income_by_income_code_currencies_dict,
+                cost_by_income_code, cost_by_income_code_currencies_dict)
+
+    @staticmethod
+    def _asset_group_symbol(ticker, asset_class):
+        # Ключ группировки с учётом класса актива (как group_symbol у сделок)
+        if asset_class in ('Варранты', 'Warrants'):
+            return f"WARRANT_{ticker}"
+        if asset_class in ('Опционы на акции и индексы', 'Stock Options'):
+            return f"OPTION_{ticker}"
+        return ticker
+
+    def _conversion_group_symbols(self, conv):
+        """Возвращает (old_symbol, new_symbol) конвертации с учётом классов активов."""
+        return (
+            self._asset_group_symbol(conv['old_ticker'], conv.get('asset_class_from', '')),
+            self._asset_group_symbol(conv['new_ticker'], conv.get('asset_class_to', '')),
+        )
+
+    @staticmethod
+    def _acquisition_group_symbol(acq):
+        # Для варрантов добавляем префикс (как у сделок с варрантами)
+        ticker = acq.get('ticker', '')
+        if acq.get('asset_class', '') in ('Варранты', 'Warrants'):
+            return f"WARRANT_{ticker}"
+        return ticker
+
+    @staticmethod
+    def _iter_fifo_timeline(trades, conversions, acquisitions):
+        """Сделки, конвертации и acquisitions в порядке обработки FIFO: ('trade' | 'conversion' | 'acquisition', событие)."""
+        conversions_by_date = sorted(conversions, key=lambda x: x.get('datetime_obj') or datetime.min)
+        acquisitions_by_date = sorted(acquisitions, key=lambda x: x.get('datetime_obj') or datetime.min)
+        conversion_idx = 0
+        acquisition_idx = 0
+
+        for trade in trades:
+            # Конвертации и acquisitions в хронологическом порядке до текущей сделки
+            trade_dt = trade.get('datetime_obj') or datetime.max
+            while True:
+                next_conv = conversions_by_date[conversion_idx] if conversion_idx < len(conversions_by_date) else None
+                next_acq = acquisitions_by_date[acquisition_idx] if acquisition_idx < len(acquisitions_by_date) else None
+
+                next_conv_dt = (next_conv.get('datetime_obj') if next_conv else None) or datetime.min
+                next_acq_dt = (next_acq.get('datetime_obj') if next_acq else None) or datetime.min
+
+                has_conv = next_conv is not None and next_conv_dt <= trade_dt
+                has_acq = next_acq is not None and next_acq_dt <= trade_dt
+
+                if not has_conv and not has_acq:
+                    break
+
+                if has_conv and (not has_acq or next_conv_dt <= next_acq_dt):
+                    yield 'conversion', next_conv
+                    conversion_idx += 1
+                else:
+                    yield 'acquisition', next_acq
+                    acquisition_idx += 1
+
+            yield 'trade', trade
+
+        # Оставшиеся конвертации/acquisitions после всех сделок (тоже по времени)
+        while conversion_idx < len(conversions_by_date) or acquisition_idx < len(acquisitions_by_date):
+            next_conv = conversions_by_date[conversion_idx] if conversion_idx < len(conversions_by_date) else None
+            next_acq = acquisitions_by_date[acquisition_idx] if acquisition_idx < len(acquisitions_by_date) else None
+
+            next_conv_dt = (next_conv.get('datetime_obj') if next_conv else None) or datetime.max
+            next_acq_dt = (next_acq.get('datetime_obj') if next_acq else None) or datetime.max
+
+            if next_conv and (not next_acq or next_conv_dt <= next_acq_dt):
+                yield 'conversion', next_conv
+                conversion_idx += 1
+            elif next_acq:
+                yield 'acquisition', next_acq
+                acquisition_idx += 1
+            else:
+                break
+
+    def _timeline_event_symbol(self, kind, item):
+        """Ключ instrument_events, в который шаг хронологии добавляет событие."""
+        if kind == 'conversion':
+            return self._conversion_group_symbols(item)[1]
+        if kind == 'acquisition':
+            return self._acquisition_group_symbol(item)
+        return item.get('group_symbol') or item.get('symbol') or 'UNKNOWN'
+
+    def _replay_fifo(self, trades, conversions, acquisitions, symbol_to_isin, symbol_to_name, lineage):
+        """FIFO-прогон сделок с конвертациями и acquisitions.
+
+        Прогон не зависит от целевого года: продажи и использованные покупки собираются по годам.
+        Возвращает (instrument_events, symbols_with_sales_by_year, used_buy_ids_by_year).
+        """
+        buy_lots = defaultdict(deque)
+        short_sales = defaultdict(deque)
+        instrument_events = defaultdict(list)
+        trade_details_by_id = {}
+        symbols_with_sales_by_year = defaultdict(set)
+        used_buy_ids_by_year = defaultdict(set)
+        vectorized_symbols, vectorized_sales = set(), {}
+        if is_vectorized_fifo_enabled():
+            vectorized_symbols, vectorized_sales = self._vectorized_fifo_sales(trades, conversions, acquisitions, lineage)
+
+        for kind, trade in self._iter_fifo_timeline(trades, conversions, acquisitions):
+            if kind == 'conversion':
+                self._apply_conversion(trade, buy_lots, instrument_events, symbol_to_isin, symbol_to_name, lineage)
+                continue
+            if kind == 'acquisition':
+                self._apply_acquisition(trade, buy_lots, instrument_events, symbol_to_isin, symbol_to_name, lineage)
+                continue
+
+            dt_obj = trade.get('datetime_obj')
+            symbol = trade.get('group_symbol') or trade.get('symbol') or 'UNKNOWN'
+            quantity = trade.get('quantity', Decimal(0))
+            price = trade.get('price', Decimal(0))
+            commission = trade.get('commission', Decimal(0))
+            cbr_rate = trade.get('cbr_rate', Decimal(0))
+            multiplier = trade.get('multiplier', Decimal(1))
+            proceeds = trade.get('proceeds', price * quantity * multiplier)
+
+            if trade['operation'] == 'buy':
+                # Покрываем открытые шорты (если есть)
+                remaining = quantity
+                cost_per_share_rub, cost_per_share_currency = self._buy_cost_per_share(quantity, proceeds, commission, cbr_rate)
+
+                while remaining > 0 and short_sales[symbol]:
+                    short_entry = short_sales[symbol][0]
+                    cover_qty = min(remaining, short_entry['qty_remaining'])
+                    remaining -= cover_qty
+                    short_entry['qty_remaining'] -= cover_qty
+
+                    sell_details = short_entry.get('sell_details')
+                    if sell_details:
+                        sell_details['fifo_cost_rub_decimal'] += (cover_qty * cost_per_share_rub)
+                        # Накапливаем затраты в валюте для шортов
+                        fifo_cost_by_curr_short = sell_details.setdefault('fifo_cost_by_currency', defaultdict(Decimal))
+                        buy_currency = trade.get('currency', 'USD')
+                        fifo_cost_by_curr_short[buy_currency] += (cover_qty * cost_per_share_currency)
+                        used_buy_ids = sell_details.setdefault('used_buy_ids', [])
+                        if trade.get('trade_id') not in used_buy_ids:
+                            used_buy_ids.append(trade.get('trade_id'))
+                        if short_entry.get('sell_year'):
+                            used_buy_ids_by_year[short_entry['sell_year']].add(trade.get('trade_id'))
+
+                    if short_entry['qty_remaining'] <= 0:
+                        if sell_details:
+                            # Конвертируем defaultdict в dict для fifo_cost_by_currency
+                            if 'fifo_cost_by_currency' in sell_details and isinstance(sell_details['fifo_cost_by_currency'], defaultdict):
+                                sell_details['fifo_cost_by_currency'] = dict(sell_details['fifo_cost_by_currency'])
+                            sell_details['fifo_cost_rub_str'] = f"{sell_details['fifo_cost_rub_decimal']:.2f} (шорт, покр.)"
+                            # Для шортов финансовый результат считаем по году закрытия позиции.
+                            # Если шорт был открыт в прошлом году, но закрыт в целевом — сделка должна попасть в отчёт.
+                            if dt_obj:
+                                sell_details['short_close_datetime_obj'] = dt_obj
+                                sell_details['short_close_year'] = dt_obj.year
+                                symbols_with_sales_by_year[dt_obj.year].add(symbol)
+                        short_sales[symbol].popleft()
+                    elif sell_details:
+                        sell_details['fifo_cost_rub_str'] = f"Частично открытый шорт (тек. расх.: {sell_details['fifo_cost_rub_decimal']:.2f} RUB)"
+
+                quantity_for_lots = remaining
 
-                # Определяем ключ группировки - самый новый символ в цепочке
-                if display_type == 'conversion_info':
-                    event_symbol = event_details.get('new_symbol') or symbol
-                else:
-                    event_symbol = symbol
+                # Продажи простых инструментов уже посчитаны векторно, лоты им не нужны
+                if quantity_for_lots > 0 and symbol not in vectorized_symbols:
+                    buy_lots[symbol].append({
+                        'q_remaining': quantity_for_lots,
+                        'cost_per_share_rub': cost_per_share_rub,
+                        'cost_per_share_currency': cost_per_share_currency,
+                        'currency': trade.get('currency'),
+                        'lot_id': trade.get('trade_id'),
+                    })
+                fifo_cost_rub = None
+                fifo_cost_str = None
+                fifo_cost_by_currency = {}
+                used_buy_ids = []
+            else:
+                # Для истёкших опционов: если нет лота покупки, создаём виртуальный на основе Базиса
+                is_expired = trade.get('is_expired', False)
+                basis = trade.get('basis', Decimal(0))
+                if is_expired and not buy_lots[symbol] and basis > 0:
+                    # Создаём виртуальную покупку на основе Базиса
+                    # Базис в IB указан в валюте сделки, переводим в рубли
+                    basis_rub = (basis * cbr_rate).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP) if cbr_rate else Decimal(0)
+                    cost_per_share_rub = (basis_rub / quantity) if quantity else Decimal(0)
+                    cost_per_share_currency = (basis / quantity) if quantity else Decimal(0)
+                    virtual_lot_id = f"VIRTUAL_BUY_{trade.get('trade_id')}"
+                    buy_lots[symbol].append({
+                        'q_remaining': quantity,
+                        'cost_per_share_rub': cost_per_share_rub,
+                        'cost_per_share_currency': cost_per_share_currency,
+                        'currency': trade.get('currency'),
+                        'lot_id': virtual_lot_id,
+                    })
+                    # Добавляем событие виртуальной покупки для отображения
+                    instrument_events[symbol].append({
+                        'display_type': 'trade',
+                        'datetime_obj': dt_obj,  # Дата та же (покупка была ранее, но отображаем здесь)
+                        'event_details': {
+                            'date': dt_obj.strftime('%d.%m.%Y %H:%M:%S') if dt_obj else '-',
+                            'trade_id': virtual_lot_id,
+                            'operation': 'buy',
+                            'symbol': trade.get('symbol'),
+                            'instr_nm': trade.get('instr_nm') or symbol,
+                            'isin': trade.get('isin', ''),
+                            'instr_kind': trade.get('instr_kind'),
+                            'income_code': trade.get('income_code', '1530'),
+                            'p': Decimal(0),  # Цена неизвестна
+                            'curr_c': trade.get('currency'),
+                            'cbr_rate': cbr_rate,
+                            'q': quantity,
+                            'multiplier': multiplier,
+                            'summ': basis,  # Базис = стоимость покупки
+                            'commission': Decimal(0),
+                            'fifo_cost_rub_decimal': None,
+                            'fifo_cost_rub_str': None,
+                            'is_relevant_for_target_year': True,  # Покупка релевантна для истёкшего опциона
+                            'used_buy_ids': [],
+                            'link_colors': [],
+                            'is_virtual_buy': True,  # Флаг виртуальной покупки
+                            'virtual_buy_comment': 'Покупка опциона (из отчёта за предыдущий период)',
+                        },
+                    })
+                    if virtual_lot_id:
+                        trade_details_by_id[virtual_lot_id] = instrument_events[symbol][-1]['event_details']
 
-                grouping_key = event_symbol
-                visited = {grouping_key}
-                while grouping_key in conversion_map_old_to_new:
-                    next_symbol = conversion_map_old_to_new[grouping_key]
-                    if next_symbol == grouping_key or next_symbol in visited:
-                        break
-                    grouping_key = next_symbol
-                    visited.add(next_symbol)
+                remaining = quantity
+                fifo_cost_rub = Decimal(0)
+                fifo_cost_by_currency = defaultdict(Decimal)
+                used_buy_ids = []
+                commission_rub = (commission * cbr_rate).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP) if cbr_rate else Decimal(0)
+                if id(trade) in vectorized_sales:
+                    fifo_cost_rub, fifo_cost_by_currency, used_buy_ids = vectorized_sales[id(trade)]
+                    remaining = Decimal(0)
+                while remaining > 0 and buy_lots[symbol]:
+                    lot = buy_lots[symbol][0]
+                    take = min(remaining, lot['q_remaining'])
+                    fifo_cost_rub += (take * lot['cost_per_share_rub'])
+                    # Накапливаем затраты в оригинальной валюте покупки
+                    lot_currency = lot.get('currency', 'USD')
+                    lot_cost_in_currency = lot.get('cost_per_share_currency', Decimal(0))
+                    fifo_cost_by_currency[lot_currency] += (take * lot_cost_in_currency)
+                    lot['q_remaining'] -= take
+                    remaining -= take
+                    # Получаем ID оригинальных покупок (из конвертации или напрямую)
+                    if lot.get('source_lot_ids'):
+                        # Лот создан конвертацией - берём ID оригинальных покупок
+                        for sid in lot['source_lot_ids']:
+                            if sid not in used_buy_ids:
+                                used_buy_ids.append(sid)
+                    else:
+                        # Обычный лот - берём его собственный lot_id
+                        lot_id = lot.get('lot_id')
+                        if lot_id and lot_id not in used_buy_ids:
+                            used_buy_ids.append(lot_id)
+                    if lot['q_remaining'] <= 0:
+                        buy_lots[symbol].popleft()
 
-                # Если не нашли через conversion_map, ищем по ISIN
-                # Пример: LFC имеет тот же ISIN что и LFCHY, но нет конвертации LFC->LFCHY
-                if grouping_key == event_symbol:
-                    event_isin = symbol_to_isin.get(event_symbol)
-                    if event_isin:
-                        # Ищем символ с тем же ISIN, который есть в conversion_map
-                        for same_isin_sym in isin_to_symbols.get(event_isin, []):
-                            if same_isin_sym != event_symbol and same_isin_sym in conversion_map_old_to_new:
-                                # Идём по цепочке от этого символа
-                                temp_key = same_isin_sym
-                                temp_visited = {temp_key}
-                                while temp_key in conversion_map_old_to_new:
-                                    next_sym = conversion_map_old_to_new[temp_key]
-                                    if next_sym == temp_key or next_sym in temp_visited:
-                                        break
-                                    temp_key = next_sym
-                                    temp_visited.add(next_sym)
-                                grouping_key = temp_key
-                                break
+                # Добавляем комиссию продажи для всех продаж (не только шортов)
+                fifo_cost_rub += commission_rub
+                # Добавляем комиссию продажи в валюте продажи
+                sale_currency = trade.get('currency', 'USD')
+                fifo_cost_by_currency[sale_currency] += commission
 
-                # Для acquisition_info: если тикер есть в symbols_with_sales_in_target_year,
-                # используем его как ключ группировки (чтобы подписка была рядом с продажей)
-                if display_type == 'acquisition_info':
-                    acq_ticker = event_details.get('ticker', '')
-                    if acq_ticker in symbols_with_sales_in_target_year:
-                        grouping_key = acq_ticker
-                    # Также проверяем варрантный префикс для тикера
-                    elif f"WARRANT_{acq_ticker}" in symbols_with_sales_in_target_year:
-                        grouping_key = f"WARRANT_{acq_ticker}"
+                if remaining > 0:
+                    short_sales[symbol].append({
+                        'sell_id': trade.get('trade_id'),
+                        'qty_remaining': remaining,
+                        'sell_year': dt_obj.year if dt_obj else None,
+                        'sell_details': None,
+                    })
+                    if fifo_cost_rub == commission_rub:
+                        fifo_cost_str = f"Открытый шорт (расх.: {commission_rub:.2f} RUB)"
+                    else:
+                        fifo_cost_str = f"Частично открытый шорт (тек. расх.: {fifo_cost_rub:.2f} RUB)"
+                else:
+                    fifo_cost_str = f"{fifo_cost_rub:.2f}"
 
-                # Проверяем, есть ли группа с префиксом WARRANT_ для этого символа
-                # (варранты группируются с префиксом WARRANT_)
-                warrant_key = f"WARRANT_{grouping_key}"
-                if warrant_key in symbols_with_sales_in_target_year:
-                    grouping_key = warrant_key
+                if dt_obj:
+                    symbols_with_sales_by_year[dt_obj.year].add(symbol)
 
-                if display_type == 'acquisition_info':
-                    print(f"[DEBUG] Adding acquisition to filtered_history: symbol={symbol}, grouping_key={grouping_key}, ticker={event_details.get('ticker')}, is_relevant={event_details.get('is_relevant_for_target_year')}")
+            # Если есть погашение опциона (Ep) в целевом году — инструмент должен попасть в историю/PDF,
+            # даже если операция формально 'buy' (закрытие шорта) и нет обычной продажи в этом году.
+            if dt_obj and trade.get('is_expired', False):
+                symbols_with_sales_by_year[dt_obj.year].add(symbol)
 
-                filtered_history[grouping_key].append(event)
+            event_details = {
+                'date': dt_obj.strftime('%d.%m.%Y %H:%M:%S') if dt_obj else '-',
+                'trade_id': trade.get('trade_id'),
+                'operation': trade.get('operation'),
+                'symbol': trade.get('symbol'),
+                'instr_nm': trade.get('instr_nm') or symbol,
+                'isin': trade.get('isin', ''),
+                'instr_kind': trade.get('instr_kind'),
+                'income_code': trade.get('income_code', '1530'),
+                'p': price,
+                'curr_c': trade.get('currency'),
+                'cbr_rate': cbr_rate,
+                'q': quantity,
+                'multiplier': multiplier,
+                'summ': proceeds,  # Для опционов уже включает множитель 100
+                'commission': commission,
+                'fifo_cost_rub_decimal': fifo_cost_rub,
+                'fifo_cost_rub_str': fifo_cost_str,
+                'fifo_cost_by_currency': dict(fifo_cost_by_currency) if fifo_cost_by_currency else {},
+                'is_relevant_for_target_year': bool(dt_obj and dt_obj.year == self.target_year and (trade.get('operation') == 'sell' or trade.get('is_expired'))),
+                'used_buy_ids': used_buy_ids,
+                'link_colors': [],
+                'is_expired': trade.get('is_expired', False),  # Флаг истёкшего опциона
+            }
+            instrument_events[symbol].append({
+                'display_type': 'trade',
+                'datetime_obj': dt_obj,
+                'event_details': event_details,
+            })
+            if event_details.get('trade_id'):
+                trade_details_by_id[event_details['trade_id']] = event_details
+                if trade.get('operation') == 'sell' and short_sales[symbol]:
+                    last_short = short_sales[symbol][-1]
+                    if last_short.get('sell_id') == event_details['trade_id']:
+                        last_short['sell_details'] = event_details
 
-        # Сортируем события в каждой группе: по времени, затем по цене (FIFO), затем по trade_id
-        for symbol in filtered_history:
-            filtered_history[symbol].sort(key=lambda x: (
-                x.get('datetime_obj') or datetime.min,
-                x.get('event_details', {}).get('price') or Decimal(0),
-                x.get('event_details', {}).get('trade_id') or ''
-            ))
+        return instrument_events, symbols_with_sales_by_year, used_buy_ids_by_year
 
-        # Определяем диапазон дат для PDF (от первой релевантной покупки до последней релевантной продажи)
-        for symbol, events in filtered_history.items():
-            min_relevant_date = None
-            max_relevant_date = None
+    @staticmethod
+    def _buy_cost_per_share(quantity, proceeds, commission, cbr_rate):
+        """Стоимость 1 шт. лота покупки вместе с комиссией: (в рублях, в валюте сделки)."""
+        if not quantity:
+            return Decimal(0), Decimal(0)
+        # Для опционов: сумма = цена * количество * множитель (100)
+        cost_shares_rub = (proceeds * cbr_rate).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+        cost_comm_rub = (commission * cbr_rate).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+        return (cost_shares_rub + cost_comm_rub) / quantity, (proceeds + commission) / quantity
 
-            # Находим границы диапазона релевантных событий
-            for event in events:
-                event_details = event.get('event_details', {})
-                dt_obj = event.get('datetime_obj')
-                if event_details.get('is_relevant_for_target_year') and dt_obj:
-                    if min_relevant_date is None or dt_obj < min_relevant_date:
-                        min_relevant_date = dt_obj
-                    if max_relevant_date is None or dt_obj > max_relevant_date:
-                        max_relevant_date = dt_obj
+    def _vectorized_fifo_sales(self, trades, conversions, acquisitions, lineage):
+        """Векторный FIFO для простых инструментов (только длинные позиции, без корп. действий и опционов).
 
-            # Устанавливаем флаг is_in_pdf_range для каждого события
-            for event in events:
-                event_details = event.get('event_details', {})
-                dt_obj = event.get('datetime_obj')
-                if min_relevant_date and max_relevant_date and dt_obj:
-                    event_details['is_in_pdf_range'] = min_relevant_date <= dt_obj <= max_relevant_date
-                else:
-                    event_details['is_in_pdf_range'] = event_details.get('is_relevant_for_target_year', False)
+        Возвращает (множество таких инструментов, {id(продажи): (расход RUB без комиссии продажи,
+        расход по валютам, used_buy_ids)}); остальные инструменты считаются обычным циклом.
+        """
+        # Инструменты, лоты которых могут переноситься конвертациями или пополняться acquisitions
+        touched_symbols = set()
+        for conv in conversions:
+            touched_symbols.update(self._conversion_group_symbols(conv))
+            for sym in lineage.symbols_for_isin(conv.get('old_isin', '')):
+                touched_symbols.update((sym, f"WARRANT_{sym}", f"OPTION_{sym}"))
+        for acq in acquisitions:
+            touched_symbols.add(self._acquisition_group_symbol(acq))
 
-        # Преобразуем defaultdict обратно в обычный dict
-        filtered_history = dict(filtered_history)
+        trades_by_symbol = defaultdict(list)
+        for trade in trades:
+            trades_by_symbol[trade.get('group_symbol') or trade.get('symbol') or 'UNKNOWN'].append(trade)
+
+        vectorized_symbols = set()
+        vectorized_sales = {}
+        for symbol, symbol_trades in trades_by_symbol.items():
+            if symbol in touched_symbols or any(
+                trade.get('operation') not in ('buy', 'sell') or trade.get('is_expired', False)
+                or trade.get('multiplier', Decimal(1)) != 1
+                for trade in symbol_trades
+            ):
+                continue
+            buys = [trade for trade in symbol_trades if trade['operation'] == 'buy']
+            sells = [trade for trade in symbol_trades if trade['operation'] == 'sell']
+            if not sells:
+                continue
+            scaled = scale_quantities([trade.get('quantity', Decimal(0)) for trade in buys + sells])
+            if scaled is None:
+                continue
+            quantities, scale = scaled
+            buys_count = 0
+            buys_before_sell = []
+            for trade in symbol_trades:
+                if trade['operation'] == 'buy':
+                    buys_count += 1
+                else:
+                    buys_before_sell.append(buys_count)
+            sell_qty = quantities[len(buys):]
+            lot_ranges = long_only_lot_ranges(quantities[:len(buys)], sell_qty, buys_before_sell)
+            if lot_ranges is None:
+                continue
 
-        # Преобразуем profit_by_income_code_currencies в обычный dict
-        profit_by_income_code_currencies_dict = {
-            '1530': dict(profit_by_income_code_currencies['1530']),
-            '1532': dict(profit_by_income_code_currencies['1532'])
-        }
+            lot_costs = []
+            for buy in buys:
+                quantity = buy.get('quantity', Decimal(0))
+                proceeds = buy.get('proceeds', buy.get('price', Decimal(0)) * quantity * buy.get('multiplier', Decimal(1)))
+                lot_costs.append(self._buy_cost_per_share(quantity, proceeds, buy.get('commission', Decimal(0)), buy.get('cbr_rate', Decimal(0))))
 
-        # Преобразуем income и cost currencies в обычные dict
-        income_by_income_code_currencies_dict = {
-            '1530': dict(income_by_income_code_currencies['1530']),
-            '1532': dict(income_by_income_code_currencies['1532'])
-        }
-        cost_by_income_code_currencies_dict = {
-            '1530': dict(cost_by_income_code_currencies['1530']),
-            '1532': dict(cost_by_income_code_currencies['1532'])
-        }
+            # Точная сверка в Decimal: те же слагаемые и в том же порядке, что и в цикле FIFO
+            for sale_index, sale in enumerate(sells):
+                fifo_cost_rub = Decimal(0)
+                fifo_cost_by_currency = defaultdict(Decimal)
+                used_buy_ids = []
+                for lot_index, take in iter_lot_takes(lot_ranges, sell_qty, sale_index, scale):
+                    cost_per_share_rub, cost_per_share_currency = lot_costs[lot_index]
+                    fifo_cost_rub += (take * cost_per_share_rub)
+                    fifo_cost_by_currency[buys[lot_index].get('currency')] += (take * cost_per_share_currency)
+                    lot_id = buys[lot_index].get('trade_id')
+                    if lot_id and lot_id not in used_buy_ids:
+                        used_buy_ids.append(lot_id)
+                vectorized_sales[id(sale)] = (fifo_cost_rub, fifo_cost_by_currency, used_buy_ids)
+            vectorized_symbols.add(symbol)
+        return vectorized_symbols, vectorized_sales
+
+    def _replay_fifo_families(self, trades, conversions, acquisitions, symbol_to_isin, symbol_to_name, lineage):
+        """FIFO-прогон: для больших историй — по корзинам семейств инструментов в пуле процессов.
+
+        Результат совпадает с одним последовательным _replay_fifo: семейства не обмениваются лотами,
+        а порядок ключей instrument_events восстанавливается по общей хронологии.
+        """
+        family_of = {}
+        family_sizes = defaultdict(int)
+        for kind, item in self._iter_fifo_timeline(trades, conversions, acquisitions):
+            family_key = lineage.find(self._timeline_event_symbol(kind, item))
+            family_of[id(item)] = family_key
+            family_sizes[family_key] += 1
+
+        workers = fifo_worker_count(len(trades), len(family_sizes))
+        if workers <= 1:
+            return self._replay_fifo(trades, conversions, acquisitions, symbol_to_isin, symbol_to_name, lineage)
+
+        # Курсы для acquisitions получаем здесь: рабочие процессы не обращаются к БД. Контекст запоминает
+        # только точные курсы, поэтому ближайшие и отсутствующие передаём отдельно
+        worker_rates = dict(self.context.rates)
+        for acq in acquisitions:
+            rate_key = self._cbr_rate_key(acq.get('currency', 'USD'), acq.get('datetime_obj'))
+            if rate_key is not None:
+                worker_rates[rate_key] = self._get_cbr_rate(*rate_key)
+
+        buckets = split_families_into_buckets(family_sizes, workers * 2)
+        tasks = []
+        for bucket in buckets:
+            bucket_families = set(bucket)
+            bucket_symbols = lineage.family_members(bucket)
+            tasks.append((
+                self.target_year,
+                worker_rates,
+                [trade for trade in trades if family_of[id(trade)] in bucket_families],
+                [conv for conv in conversions if family_of[id(conv)] in bucket_families],
+                [acq for acq in acquisitions if family_of[id(acq)] in bucket_families],
+                {sym: isin for sym, isin in symbol_to_isin.items() if sym in bucket_symbols},
+                symbol_to_name,
+            ))
+        results = run_in_process_pool(_replay_ib_fifo_bucket, tasks, workers)
+
+        events_by_symbol = {}
+        symbols_with_sales_by_year = defaultdict(set)
+        used_buy_ids_by_year = defaultdict(set)
+        for bucket_events, bucket_sales, bucket_used_ids, bucket_symbol_to_isin, diagnostics in results:
+            events_by_symbol.update(bucket_events)
+            for year, symbols in bucket_sales.items():
+                symbols_with_sales_by_year[year].update(symbols)
+            for year, buy_ids in bucket_used_ids.items():
+                used_buy_ids_by_year[year].update(buy_ids)
+            # ISIN, добавленные при обработке acquisitions (WARRANT_-ключи)
+            for sym, isin in bucket_symbol_to_isin.items():
+                if sym not in symbol_to_isin:
+                    symbol_to_isin[sym] = isin
+                    lineage.add_symbol_isin(sym, isin)
+            self.context.diagnostics.merge(diagnostics)
+
+        # Порядок ключей — как при последовательном прогоне (по первому событию в общей хронологии)
+        instrument_events = defaultdict(list)
+        for kind, item in self._iter_fifo_timeline(trades, conversions, acquisitions):
+            symbol = self._timeline_event_symbol(kind, item)
+            if symbol not in instrument_events and symbol in events_by_symbol:
+                instrument_events[symbol] = events_by_symbol[symbol]
+        for symbol, events in events_by_symbol.items():
+            instrument_events.setdefault(symbol, events)
+        return instrument_events, symbols_with_sales_by_year, used_buy_ids_by_year
+
+    @staticmethod
+    def _base_symbol(symbol):
+        for prefix in ('WARRANT_', 'OPTION_'):
+            if symbol.startswith(prefix):
+                return symbol[len(prefix):]
+        return symbol
+
+    def _build_instrument_lineage(self, trades, conversions, acquisitions, symbol_to_isin):
+        """Семейства инструментов прогона: тикер, ISIN, конвертации и префиксы WARRANT_/OPTION_."""
+        lineage = InstrumentLineage()
+        for symbol, isin in symbol_to_isin.items():
+            lineage.add_symbol_isin(symbol, isin)
+        for trade in trades:
+            symbol = trade.get('group_symbol') or trade.get('symbol') or 'UNKNOWN'
+            lineage.union(symbol, self._base_symbol(symbol), trade.get('symbol'), isin_node(trade.get('isin')))
+        for conv in conversions:
+            old_symbol, new_symbol = self._conversion_group_symbols(conv)
+            lineage.union(
+                old_symbol, new_symbol, self._base_symbol(old_symbol), self._base_symbol(new_symbol),
+                isin_node(conv.get('old_isin')), isin_node(conv.get('new_isin')),
+            )
+        for acq in acquisitions:
+            lineage.union(self._acquisition_group_symbol(acq), acq.get('ticker', ''), isin_node(acq.get('isin')))
+        return lineage
 
-        return (filtered_history, total_sales_profit_rub, profit_by_income_code, profit_by_income_code_currencies_dict,
-                income_by_income_code, income_by_income_code_currencies_dict,
-                cost_by_income_code, cost_by_income_code_currencies_dict)
+    def _select_fifo_relevant_inputs(self, trades, conversions, acquisitions, lineage):
+        """Отбирает сделки и корп. действия семейств, в которых есть сделки целевого года.
 
-    def _apply_conversion(self, conv, buy_lots, instrument_events, symbol_to_isin=None, symbol_to_name=None):
+        Сделка целевого года (продажа, закрытие шорта, погашение опциона) может зависеть только
+        от инструментов своего семейства, а остальные в историю целевого года не попадают.
+        """
+        seed_symbols = set()
+        for trade in trades:
+            dt_obj = trade.get('datetime_obj')
+            if dt_obj and dt_obj.year == self.target_year:
+                seed_symbols.add(trade.get('group_symbol') or trade.get('symbol') or 'UNKNOWN')
+
+        relevant_symbols = lineage.family_members(seed_symbols)
+        relevant_trades = [
+            trade for trade in trades
+            if (trade.get('group_symbol') or trade.get('symbol') or 'UNKNOWN') in relevant_symbols
+        ]
+        relevant_conversions = [conv for conv in conversions if self._conversion_group_symbols(conv)[0] in relevant_symbols]
+        relevant_acquisitions = [acq for acq in acquisitions if self._acquisition_group_symbol(acq) in relevant_symbols]
+        return relevant_trades, relevant_conversions, relevant_acquisitions
+
+    def _apply_conversion(self, conv, buy_lots, instrument_events, symbol_to_isin=None, symbol_to_name=None, lineage=None):
         if symbol_to_isin is None:
             symbol_to_isin = {}
         if symbol_to_name is None:
             symbol_to_name = {}
+        if lineage is None:
+            lineage = InstrumentLineage()
+            for symbol, isin in symbol_to_isin.items():
+                lineage.add_symbol_isin(symbol, isin)
 
         old_ticker = conv['old_ticker']
         new_ticker = conv['new_ticker']
         old_qty_removed = conv['old_qty_removed']
         new_qty_received = conv['new_qty_received']
-
-        # Определяем group_symbol с учётом класса актива
-        asset_class_to = conv.get('asset_class_to', '')
-        if asset_class_to in ('Варранты', 'Warrants'):
-            new_symbol = f"WARRANT_{new_ticker}"
-        elif asset_class_to in ('Опционы на акции и индексы', 'Stock Options'):
-            new_symbol = f"OPTION_{new_ticker}"
-        else:
-            new_symbol = new_ticker
-
         asset_class_from = conv.get('asset_class_from', '')
-        if asset_class_from in ('Варранты', 'Warrants'):
-            old_symbol = f"WARRANT_{old_ticker}"
-        elif asset_class_from in ('Опционы на акции и индексы', 'Stock Options'):
-            old_symbol = f"OPTION_{old_ticker}"
-        else:
-            old_symbol = old_ticker
+        asset_class_to = conv.get('asset_class_to', '')
+        old_symbol, new_symbol = self._conversion_group_symbols(conv)
 
         # Рассчитываем соотношение конвертации (ratio)
         # Например: 1500 old -> 150 new, ratio = 150/1500 = 0.1 (10:1 reverse split)
@@ -1816,9 +2074,7 @@ class IBParser(BaseBrokerParser):
             old_isin = conv.get('old_isin', '')
             if old_isin:
                 # Ищем символ с тем же ISIN
-                for sym, isin in symbol_to_isin.items():
-                    if isin != old_isin:
-                        continue
+                for sym in lineage.symbols_for_isin(old_isin):
                     if sym == old_ticker:
                         continue
 
@@ -1918,7 +2174,7 @@ class IBParser(BaseBrokerParser):
             },
         })
 
-    def _apply_acquisition(self, acq, buy_lots, instrument_events, symbol_to_isin=None, symbol_to_name=None):
+    def _apply_acquisition(self, acq, buy_lots, instrument_events, symbol_to_isin=None, symbol_to_name=None, lineage=None):
         """Обрабатывает acquisition - получение инструмента через корп. действие.
 
         Создаёт лот для полученного инструмента и добавляет событие в историю.
@@ -1940,16 +2196,15 @@ class IBParser(BaseBrokerParser):
         dt_obj = acq.get('datetime_obj')
         acq_type = acq.get('type', 'unknown')
         source_ticker = acq.get('source_ticker', '')
-        asset_class = acq.get('asset_class', '')
 
         # Определяем group_symbol (для варрантов добавляем префикс)
-        group_symbol = ticker
-        if asset_class in ('Варранты', 'Warrants'):
-            group_symbol = f"WARRANT_{ticker}"
+        group_symbol = self._acquisition_group_symbol(acq)
 
         # Дублируем ISIN на group_symbol, чтобы внутренние связи/фильтры работали и для префиксных инструментов
         if isin and group_symbol and group_symbol != ticker and group_symbol not in symbol_to_isin:
             symbol_to_isin[group_symbol] = isin
+            if lineage is not None:
+                lineage.add_symbol_isin(group_symbol, isin)
 
         # Рассчитываем стоимость в рублях и валюте
         cbr_rate = self._get_cbr_rate(currency, dt_obj) or Decimal(0)
@@ -1990,3 +2245,16 @@ class IBParser(BaseBrokerParser):
                 'lot_id': lot_id,
             },
         })
+
+
+def _replay_ib_fifo_bucket(target_year, cbr_rate_cache, trades, conversions, acquisitions, symbol_to_isin, symbol_to_name):
+    """FIFO одной корзины семейств в рабочем процессе (без обращений к БД и request)."""
+    parser = IBParser(request=None, user=None, target_year=target_year)
+    parser.context.rates.update(cbr_rate_cache)
+    lineage = InstrumentLineage()
+    for sym, isin in symbol_to_isin.items():
+        lineage.add_symbol_isin(sym, isin)
+    instrument_events, sales_symbols, used_buy_ids = parser._replay_fifo(
+        trades, conversions, acquisitions, symbol_to_isin, symbol_to_name, lineage
+    )
+    return dict(instrument_events), sales_symbols, used_buy_ids, symbol_to_isin, parser.context.diagnostics
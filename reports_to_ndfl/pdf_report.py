@@ -0,0 +1,259 @@
+# reports_to_ndfl/pdf_report.py
+"""
+Данные и построение PDF-отчёта за год.
+
+Данные для отчёта (pdf_report_context) общие для двух способов вывода, которые выбираются
+настройкой NDFL_PDF_BACKEND:
+- 'xhtml2pdf' — HTML из шаблона pdf_report.html, свёрстанный xhtml2pdf;
+- 'reportlab' — документ собирается напрямую из flowables ReportLab (см. pdf_writer), без
+  разбора HTML/CSS; на больших отчётах заметно быстрее и расходует меньше памяти.
+
+При NDFL_PDF_RENDER_BY_SECTIONS разделы отчёта строятся отдельно и склеиваются (pdf_sections).
+
+xhtml2pdf и ReportLab импортируются при первом построении PDF, а не при импорте views: большинство
+запросов PDF не строят, и процессы стартуют быстрее. При NDFL_PDF_WARMUP='eager' всё нужное для
+PDF загружается заранее в AppConfig.ready (warm_up_pdf) — для gunicorn --preload, где рабочие
+процессы получают загруженные модули и шрифты от мастера через fork (copy-on-write).
+"""
+import io
+import os
+import threading
+from collections import defaultdict
+from datetime import datetime
+from decimal import Decimal
+
+from django.conf import settings
+from django.contrib.staticfiles import finders
+from django.template.loader import get_template, render_to_string
+
+from .models import BrokerReport
+from .report_templates import PDF_INSTRUMENT_EVENTS_TEMPLATE, REPORT_TEMPLATES_ENGINE
+
+PDF_BACKENDS = ('xhtml2pdf', 'reportlab')
+
+# Разделы PDF-отчёта в порядке вывода: сводка (итоги и комментарий), операции по кодам 1530 и 1532,
+# дивиденды, РЕПО и прочие расходы и доходы. В контексте (pdf_sections) — какие из них выводить.
+PDF_SECTIONS = ('summary', '1530', '1532', 'dividends', 'repo', 'commissions')
+
+BROKER_DISPLAY_NAMES = {
+    'ffg': 'Freedom Finance Global',
+    'ib': 'Interactive Brokers',
+}
+
+# Регистрируем шрифты DejaVu для поддержки кириллицы в PDF.
+# Реестр шрифтов ReportLab и таблица шрифтов xhtml2pdf общие для процесса, поэтому
+# регистрация выполняется один раз под блокировкой (потоковые воркеры рендерят PDF параллельно).
+_fonts_lock = threading.Lock()
+_fonts_registered = False
+def register_fonts():
+    global _fonts_registered
+    if _fonts_registered:
+        return
+    with _fonts_lock:
+        if _fonts_registered:
+            return
+        from reportlab.pdfbase import pdfmetrics
+        from reportlab.pdfbase.ttfonts import TTFont
+        from xhtml2pdf import default
+
+        font_path = os.path.join(settings.BASE_DIR, 'reports_to_ndfl', 'static', 'fonts')
+        pdfmetrics.registerFont(TTFont('DejaVuSans', os.path.join(font_path, 'DejaVuSans.ttf')))
+        pdfmetrics.registerFont(TTFont('DejaVuSans-Bold', os.path.join(font_path, 'DejaVuSans-Bold.ttf')))
+        pdfmetrics.registerFont(TTFont('DejaVuSans-Oblique', os.path.join(font_path, 'DejaVuSans-Oblique.ttf')))
+        pdfmetrics.registerFont(TTFont('DejaVuSans-BoldOblique', os.path.join(font_path, 'DejaVuSans-BoldOblique.ttf')))
+        pdfmetrics.registerFontFamily(
+            'DejaVuSans',
+            normal='DejaVuSans',
+            bold='DejaVuSans-Bold',
+            italic='DejaVuSans-Oblique',
+            boldItalic='DejaVuSans-BoldOblique',
+        )
+        default.DEFAULT_FONT.update({
+            'dejavusans': 'DejaVuSans',
+            'dejavu sans': 'DejaVuSans',
+            'dejavusans-bold': 'DejaVuSans-Bold',
+            'dejavu sans bold': 'DejaVuSans-Bold',
+        })
+        _fonts_registered = True
+
+
+def _pisa_link_callback(uri, _rel):
+    if uri.startswith(('http://', 'https://', 'file://')):
+        return uri
+    result = finders.find(uri)
+    if result:
+        if isinstance(result, (list, tuple)):
+            result = result[0]
+        return result
+    return uri
+
+
+def pdf_backend():
+    """Способ построения PDF из NDFL_PDF_BACKEND ('xhtml2pdf' или 'reportlab')."""
+    backend = getattr(settings, 'NDFL_PDF_BACKEND', 'xhtml2pdf')
+    return backend if backend in PDF_BACKENDS else 'xhtml2pdf'
+
+
+def pdf_report_context(user, broker_type, target_year, processing_result, user_comment=''):
+    """Контекст PDF-отчёта из результата parser.process() (без информации о пользователе)."""
+    instrument_event_history, dividend_events, total_dividends_rub, \
+    total_sales_profit, parsing_error, \
+    dividend_commissions_data, other_commissions_data, total_other_commissions_rub_val, \
+    profit_by_income_code, profit_by_income_code_currencies, \
+    dividends_by_currency, other_commissions_by_currency, \
+    income_by_income_code, income_by_income_code_currencies, \
+    cost_by_income_code, cost_by_income_code_currencies, \
+    total_dividends_tax_rub, dividends_tax_by_currency, \
+    dividend_commissions_by_currency, \
+    repo_events, total_repo_profit_rub, repo_profit_by_currency = processing_result
+
+    # Преобразуем defaultdict в обычные dict
+    if isinstance(dividend_commissions_data, defaultdict):
+        temp_div_comm = {}
+        for category_key, data_dict_item in dividend_commissions_data.items():
+            temp_div_comm[category_key] = {
+                'amount_by_currency': dict(data_dict_item['amount_by_currency']),
+                'amount_rub': data_dict_item['amount_rub'],
+                'details': data_dict_item['details']
+            }
+        dividend_commissions_data = temp_div_comm
+
+    if isinstance(other_commissions_data, defaultdict):
+        converted_other_commissions = {}
+        for category, data_dict in other_commissions_data.items():
+            converted_other_commissions[category] = {
+                'currencies': dict(data_dict['currencies']),
+                'total_rub': data_dict['total_rub'],
+                'raw_events': data_dict['raw_events']
+            }
+        other_commissions_data = converted_other_commissions
+
+    # Разделяем историю операций по кодам дохода: 1530 (акции) и 1532 (опционы/ПФИ)
+    instrument_history_1530 = {}  # Ценные бумаги
+    instrument_history_1532 = {}  # ПФИ / опционы
+
+    for key in sorted(instrument_event_history.keys()):
+        events = instrument_event_history[key]
+        is_pfi = key.startswith('OPTION_') or key.startswith('WARRANT_')
+        if is_pfi:
+            instrument_history_1532[key] = events
+        else:
+            instrument_history_1530[key] = events
+
+    # Название брокера для отображения в PDF
+    broker_display_name = BROKER_DISPLAY_NAMES.get(broker_type, BROKER_DISPLAY_NAMES['ib'])
+
+    # Номер счёта из отчёта за целевой год
+    account_number = None
+    report_with_account = BrokerReport.objects.filter(
+        user=user, broker_type=broker_type, year=target_year
+    ).exclude(account_number='').first()
+    if report_with_account:
+        account_number = report_with_account.account_number
+
+    # Сумма комиссий, связанных с дивидендами
+    total_dividend_commissions_rub = sum(
+        (data.get('amount_rub', Decimal(0)) for data in dividend_commissions_data.values()),
+        Decimal(0)
+    )
+
+    return {
+        'target_report_year_for_title': target_year,
+        'broker_name': broker_display_name,
+        'account_number': account_number,
+        'user_comment': user_comment,
+        'instrument_history_1530': instrument_history_1530,
+        'instrument_history_1532': instrument_history_1532,
+        'dividend_history': dividend_events,
+        'total_dividends_rub': total_dividends_rub,
+        'total_sales_profit_rub': total_sales_profit,
+        'profit_by_income_code': profit_by_income_code,
+        'profit_by_income_code_currencies': profit_by_income_code_currencies,
+        'income_by_income_code': income_by_income_code,
+        'income_by_income_code_currencies': income_by_income_code_currencies,
+        'cost_by_income_code': cost_by_income_code,
+        'cost_by_income_code_currencies': cost_by_income_code_currencies,
+        'total_dividends_tax_rub': total_dividends_tax_rub,
+        'dividends_tax_by_currency': dividends_tax_by_currency,
+        'dividend_commissions_by_currency': dividend_commissions_by_currency,
+        'dividends_by_currency': dividends_by_currency,
+        'other_commissions_by_currency': other_commissions_by_currency,
+        'dividend_commissions': dividend_commissions_data,
+        'other_commissions': other_commissions_data,
+        'total_dividend_commissions_rub': total_dividend_commissions_rub,
+        'total_other_commissions_rub': total_other_commissions_rub_val,
+        'dividend_fee_matching_report': None,
+        'generation_date': datetime.now().strftime('%d.%m.%Y %H:%M'),
+        # РЕПО-данные
+        'repo_events': repo_events,
+        'total_repo_profit_rub': total_repo_profit_rub,
+        'repo_profit_by_currency': repo_profit_by_currency,
+        # Выводимые разделы (при построении по разделам у каждой части свои)
+        'pdf_sections': PDF_SECTIONS,
+        'pdf_section_continued': False,
+    }
+
+
+def pdf_filename(context):
+    """Имя файла: Расчет_КодБрокера_НомерСчета_Год.pdf"""
+    broker_code_map = {
+        'Freedom Finance Global': 'FFG',
+        'Interactive Brokers': 'IB',
+    }
+    broker_display_name = context['broker_name']
+    account_number = context['account_number']
+    broker_code = broker_code_map.get(broker_display_name, broker_display_name.replace(' ', '') if broker_display_name else 'Broker')
+    account_safe = account_number.replace(' ', '_') if account_number else ''
+    filename_parts = ['Расчет', broker_code]
+    if account_safe:
+        filename_parts.append(account_safe)
+    filename_parts.append(str(context['target_report_year_for_title']))
+    return '_'.join(filename_parts) + '.pdf'
+
+
+def write_pdf(context, output, backend=None, by_sections=None):
+    """
+    Пишет PDF-отчёт в файловый объект output выбранным способом (по умолчанию pdf_backend()).
+    by_sections (по умолчанию NDFL_PDF_RENDER_BY_SECTIONS) — строить разделы отдельно и склеивать
+    их с оглавлением и номерами страниц (см. pdf_sections).
+    Возвращает False, если xhtml2pdf сообщил об ошибке вёрстки или не удалось построить часть
+    при построении по разделам.
+    """
+    if by_sections is None:
+        by_sections = getattr(settings, 'NDFL_PDF_RENDER_BY_SECTIONS', False)
+    if by_sections:
+        from .pdf_sections import write_pdf_by_sections
+
+        return write_pdf_by_sections(context, output, backend=backend)
+
+    register_fonts()
+    if (backend or pdf_backend()) == 'reportlab':
+        from .pdf_writer import build_pdf_report
+
+        build_pdf_report(context, output)
+        return True
+
+    from xhtml2pdf import pisa
+
+    html_string = render_to_string('reports_to_ndfl/pdf_report.html', context)
+    pdf = pisa.pisaDocument(
+        io.BytesIO(html_string.encode('utf-8')),
+        output,
+        encoding='utf-8',
+        link_callback=_pisa_link_callback,
+    )
+    return not pdf.err
+
+
+def warm_up_pdf():
+    """
+    Загружает заранее всё, что нужно для первого PDF: xhtml2pdf и ReportLab, шрифты DejaVu
+    и скомпилированные шаблоны отчёта (NDFL_PDF_WARMUP='eager', см. apps.ReportsToNdflConfig).
+    """
+    from xhtml2pdf import pisa  # noqa: F401
+
+    from . import pdf_sections, pdf_writer  # noqa: F401
+
+    register_fonts()
+    get_template('reports_to_ndfl/pdf_report.html')
+    get_template(PDF_INSTRUMENT_EVENTS_TEMPLATE, using=REPORT_TEMPLATES_ENGINE)
@@ -0,0 +1,139 @@
+# reports_to_ndfl/pdf_sections.py
+"""
+Построение PDF-отчёта по разделам (NDFL_PDF_RENDER_BY_SECTIONS).
+
+Сводка, операции по кодам 1530 и 1532, дивиденды, РЕПО и прочие расходы строятся как
+отдельные PDF (длинные разделы операций — несколькими частями по NDFL_PDF_SECTION_MAX_EVENTS
+операций), при NDFL_PDF_RENDER_WORKERS > 1 — в пуле процессов. Части склеиваются pypdf
+в один документ: сводка, оглавление с номерами страниц, остальные разделы; у разделов есть
+закладки, на каждой странице — «Страница X из N».
+"""
+import io
+
+from django.conf import settings
+from pypdf import PdfReader, PdfWriter
+
+from .fifo_pool import run_in_process_pool
+from .pdf_report import pdf_backend, register_fonts, write_pdf
+
+
+def section_parts(context, max_events=None):
+    """
+    Части отчёта в порядке вывода: список (раздел, заголовок, контекст части).
+    Заголовок (для оглавления и закладок) есть только у первой части раздела, у продолжений — None.
+    Разделы без данных пропускаются.
+    """
+    if max_events is None:
+        max_events = getattr(settings, 'NDFL_PDF_SECTION_MAX_EVENTS', 2000)
+    year = context['target_report_year_for_title']
+    # Истории операций нужны сводке (итоги по кодам) и своим частям: остальным частям (и рабочим процессам)
+    # их не передаём
+    without_history = {**context, 'instrument_history_1530': {}, 'instrument_history_1532': {}}
+    parts = []
+
+    def add_part(section, title, continued=False, base=without_history, **overrides):
+        parts.append((section, None if continued else title, {
+            **base, 'pdf_sections': (section,), 'pdf_section_continued': continued, **overrides,
+        }))
+
+    add_part('summary', f"Итоги расчета за {year} год", base=context)
+    instrument_sections = (
+        ('1530', f"Код дохода 1530. История операций с ценными бумагами за {year} год"),
+        ('1532', f"Код дохода 1532. История операций по производным фин. инструментам за {year} год"),
+    )
+    for code, title in instrument_sections:
+        history_key = f'instrument_history_{code}'
+        chunks, chunk, chunk_events = [], {}, 0
+        for grouping_key, event_list in (context.get(history_key) or {}).items():
+            # Инструмент целиком остаётся в одной части, даже если операций у него больше max_events
+            if chunk and chunk_events + len(event_list) > max_events:
+                chunks.append(chunk)
+                chunk, chunk_events = {}, 0
+            chunk[grouping_key] = event_list
+            chunk_events += len(event_list)
+        if chunk:
+            chunks.append(chunk)
+        for index, chunk in enumerate(chunks):
+            add_part(code, title, continued=index > 0, **{history_key: chunk})
+
+    if context.get('dividend_history'):
+        add_part('dividends', f"Код дохода 1010. История дивидендов за {year} год")
+    if context.get('repo_events'):
+        add_part('repo', f"Код дохода 1011. РЕПО-доходы за {year} год")
+    if context.get('other_commissions'):
+        add_part('commissions', f"Прочие расходы и доходы за {year} год")
+    return parts
+
+
+def _render_part(part_context, backend):
+    """PDF одной части (bytes) или None, если xhtml2pdf сообщил об ошибке вёрстки."""
+    output = io.BytesIO()
+    if not write_pdf(part_context, output, backend=backend, by_sections=False):
+        return None
+    return output.getvalue()
+
+
+def _contents_pages(entries):
+    """Страницы оглавления: entries — (заголовок, номер первой страницы раздела без учёта оглавления)."""
+    from .pdf_writer import build_contents_page
+
+    # Номера страниц зависят от длины самого оглавления: строим, пока число его страниц не сойдётся
+    contents_length = 1
+    while True:
+        output = io.BytesIO()
+        build_contents_page([(title, page + contents_length) for title, page in entries], output)
+        reader = PdfReader(output)
+        if len(reader.pages) == contents_length:
+            return reader
+        contents_length = len(reader.pages)
+
+
+def write_pdf_by_sections(context, output, backend=None, workers=None):
+    """
+    Пишет PDF-отчёт в output, строя разделы по отдельности (см. описание модуля).
+    Возвращает False, если не удалось построить какую-либо часть.
+    """
+    from .pdf_writer import build_page_numbers
+
+    # Оглавление и номера страниц строятся здесь, даже если части строились в других процессах
+    register_fonts()
+    backend = backend or pdf_backend()
+    if workers is None:
+        workers = getattr(settings, 'NDFL_PDF_RENDER_WORKERS', 1) or 1
+    parts = section_parts(context)
+    rendered = run_in_process_pool(_render_part, [(part_context, backend) for _, _, part_context in parts], workers)
+    if any(data is None for data in rendered):
+        return False
+    readers = [PdfReader(io.BytesIO(data)) for data in rendered]
+
+    # Сводка — первыми страницами, за ней оглавление, затем остальные разделы
+    summary_length = len(readers[0].pages)
+    sections = []
+    first_page = summary_length + 1
+    for (_, title, _), reader in zip(parts[1:], readers[1:]):
+        if title:
+            sections.append((title, first_page))
+        first_page += len(reader.pages)
+    contents_reader = _contents_pages(sections) if sections else None
+    contents_length = len(contents_reader.pages) if contents_reader else 0
+
+    writer = PdfWriter()
+    for reader in readers[:1] + ([contents_reader] if contents_reader else []) + readers[1:]:
+        for page in reader.pages:
+            writer.add_page(page)
+
+    numbers = io.BytesIO()
+    build_page_numbers([(float(page.mediabox.width), float(page.mediabox.height)) for page in writer.pages], numbers)
+    for page, number_page in zip(writer.pages, PdfReader(numbers).pages):
+        page.merge_page(number_page)
+        # merge_page оставляет содержимое страницы несжатым — без этого файл вырастает в разы
+        page.compress_content_streams()
+
+    writer.add_outline_item(parts[0][1], 0)
+    if contents_reader:
+        writer.add_outline_item("Содержание", summary_length)
+    for title, page in sections:
+        writer.add_outline_item(title, page - 1 + contents_length)
+    writer.add_metadata({'/Title': f"Расчет для декларации 3-НДФЛ за {context['target_report_year_for_title']} год"})
+    writer.write(output)
+    return True
@@ -0,0 +1,668 @@
+# reports_to_ndfl/pdf_writer.py
+"""
+PDF-отчёт из flowables ReportLab (platypus) — тот же документ, что pdf_report.html, но без HTML.
+
+xhtml2pdf разбирает HTML и CSS и раскладывает каждую таблицу целиком, поэтому на отчётах
+с десятками тысяч сделок построение PDF занимает минуты и много памяти. Здесь таблицы
+операций собираются сразу в LongTable: ячейки — обычные строки (Paragraph только там, где
+нужен перенос или разметка), таблица сама делится по страницам с повтором заголовка.
+
+Документ описывается последовательностью блоков (_document_blocks): из неё строится и PDF,
+и report_outline — заголовки разделов и итоговые суммы, по которым проверяется, что оба
+способа вывода (xhtml2pdf и ReportLab) дают документ одинаковой структуры с одинаковыми итогами.
+"""
+import re
+from xml.sax.saxutils import escape
+
+from django.conf import settings
+from django.template.defaultfilters import date as date_filter, floatformat
+from django.utils.timezone import template_localtime
+from reportlab.lib import colors
+from reportlab.lib.enums import TA_RIGHT
+from reportlab.lib.pagesizes import A4, landscape
+from reportlab.lib.styles import ParagraphStyle
+from reportlab.lib.units import cm
+from reportlab.pdfbase.pdfmetrics import stringWidth
+from reportlab.pdfgen import canvas
+from reportlab.platypus import Flowable, LongTable, Paragraph, SimpleDocTemplate, Spacer, Table, TableStyle
+
+from .jinja2_env import localize_value
+from .templatetags.instrument_filters import format_cbr_rate, format_currency_breakdown, instrument_type_plural
+
+FONT = 'DejaVuSans'
+FONT_BOLD = 'DejaVuSans-Bold'
+FONT_ITALIC = 'DejaVuSans-Oblique'
+
+_STYLES = {
+    'header': ParagraphStyle('header', fontName=FONT, fontSize=7, leading=9, alignment=TA_RIGHT,
+                             textColor=colors.HexColor('#777777'), spaceAfter=10),
+    'h1': ParagraphStyle('h1', fontName=FONT, fontSize=14, leading=18, textColor=colors.HexColor('#333333'),
+                         spaceAfter=6),
+    'broker': ParagraphStyle('broker', fontName=FONT, fontSize=14, leading=18, textColor=colors.HexColor('#333333'),
+                             spaceAfter=12),
+    'h2': ParagraphStyle('h2', fontName=FONT, fontSize=11, leading=14, textColor=colors.HexColor('#333333'),
+                         spaceBefore=10, spaceAfter=6, keepWithNext=True),
+    'h3': ParagraphStyle('h3', fontName=FONT, fontSize=10, leading=13, textColor=colors.HexColor('#555555'),
+                         spaceBefore=8, spaceAfter=4, keepWithNext=True),
+    'p': ParagraphStyle('p', fontName=FONT, fontSize=9, leading=12, spaceAfter=6),
+    'summary_title': ParagraphStyle('summary_title', fontName=FONT_BOLD, fontSize=9, leading=12),
+    'summary_line': ParagraphStyle('summary_line', fontName=FONT, fontSize=7, leading=10),
+    'cell': ParagraphStyle('cell', fontName=FONT, fontSize=7, leading=9),
+    'comment': ParagraphStyle('comment', fontName=FONT, fontSize=9, leading=12),
+}
+
+_BASE_TABLE_STYLE = [
+    ('FONTNAME', (0, 0), (-1, -1), FONT),
+    ('FONTSIZE', (0, 0), (-1, -1), 7),
+    ('LEADING', (0, 0), (-1, -1), 9),
+    ('FONTNAME', (0, 0), (-1, 0), FONT_BOLD),
+    ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#dbeafe')),
+    ('TEXTCOLOR', (0, 0), (-1, 0), colors.HexColor('#495057')),
+    ('GRID', (0, 0), (-1, -1), 0.5, colors.HexColor('#dddddd')),
+    ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+    ('LEFTPADDING', (0, 0), (-1, -1), 3),
+    ('RIGHTPADDING', (0, 0), (-1, -1), 3),
+    ('TOPPADDING', (0, 0), (-1, -1), 2),
+    ('BOTTOMPADDING', (0, 0), (-1, -1), 2),
+]
+
+# Таблицы: заголовки столбцов, доли ширины страницы, номера столбцов с числами (выравнивание вправо)
+EVENT_COLUMNS = ['Дата', 'Операция', 'Инструмент', 'Цена', 'Кол-во', 'Сумма', 'Комиссия', 'Курс ЦБ', 'Итого затрат, Руб']
+EVENT_WIDTHS = [0.09, 0.07, 0.19, 0.08, 0.11, 0.13, 0.08, 0.08, 0.17]
+DIVIDEND_COLUMNS = ['Дата выплаты', 'Инструмент', 'Сумма дивиденда', 'Удержанный налог', 'Валюта', 'Курс ЦБ']
+DIVIDEND_WIDTHS = [0.12, 0.40, 0.14, 0.14, 0.08, 0.12]
+REPO_COLUMNS = ['Дата закрытия', 'Инструмент', 'Доход', 'Валюта', 'Курс ЦБ', 'Доход (RUB)']
+REPO_WIDTHS = [0.12, 0.40, 0.14, 0.08, 0.12, 0.14]
+COMMISSION_WIDTHS = [0.18, 0.10, 0.08, 0.42, 0.22]
+
+_NON_RELEVANT_COLOR = colors.HexColor('#888888')
+_SPLIT_NOTE_COLOR = colors.HexColor('#8899aa')
+# Высота строки таблицы с текстом в одну строку: LEADING + TOPPADDING + BOTTOMPADDING из _BASE_TABLE_STYLE
+_PLAIN_ROW_HEIGHT = 9 + 2 + 2
+
+
+def _value(value, default='-'):
+    """{{ value|default:"-" }}: пустое значение заменяется на default, число выводится по локали."""
+    return str(localize_value(value)) if value else default
+
+
+def _text(value):
+    return '' if value is None else str(localize_value(value))
+
+
+def _amount(value):
+    """{{ value|floatformat:2|default:"0.00" }}"""
+    return floatformat(value, 2) or '0.00'
+
+
+def _total(value):
+    """{{ value|default:0|floatformat:2 }}"""
+    return floatformat(value or 0, 2)
+
+
+def _with_breakdown(text, currencies):
+    return f"{text} {format_currency_breakdown(currencies)}" if currencies else text
+
+
+def _date(value, fmt='d.m.Y'):
+    return date_filter(template_localtime(value), fmt)
+
+
+def instrument_heading(grouping_key, event_list):
+    """Строки заголовка блока инструмента (как <h3> в pdf_report.html)."""
+    first_wrapper = event_list[0] if event_list else {}
+    first = first_wrapper.get('event_details') or {}
+    display_type = first_wrapper.get('display_type')
+    kind = first.get('instr_kind')
+
+    def plural(fallback):
+        return instrument_type_plural(kind) if kind else fallback
+
+    if display_type == 'conversion_info':
+        return [
+            f"{plural('Акции')} {_text(first.get('old_ticker'))} - "
+            f"{_text(first.get('old_instr_nm') or first.get('old_ticker'))} ({_text(first.get('old_isin'))})",
+            f"{plural('Акции')} {_text(first.get('new_ticker'))} - "
+            f"{_text(first.get('new_instr_nm') or first.get('new_ticker'))} ({_text(first.get('new_isin'))})",
+        ]
+    if display_type == 'acquisition_info':
+        prefix = f"{instrument_type_plural(kind)} " if kind else ''
+        isin = f" ({first['isin']})" if first.get('isin') else ''
+        return [f"{prefix}{_text(first.get('ticker'))} - {_text(first.get('instr_nm') or first.get('ticker'))}{isin}"]
+    # default_if_none в шаблоне срабатывает только на None; отсутствующий ключ шаблон выводит пустой строкой
+    if display_type == 'option':
+        name = first.get('instr_nm', '')
+        return [f"{plural('Опционы')} {'N/A' if name is None else name}"]
+    if display_type in ('trade', 'initial_holding'):
+        ticker = first.get('ticker') or first.get('symbol')
+        if ticker:
+            name = f"{ticker} - {first['instr_nm']}" if first.get('instr_nm') else str(ticker)
+        else:
+            name = first.get('instr_nm', '')
+            name = grouping_key if name is None else str(name)
+        isin = first.get('isin')
+        if isin and isin != grouping_key:
+            name = f"{name} ({isin})"
+        return [f"{plural('Инструменты')} {name}"]
+    return [str(grouping_key)]
+
+
+def summary_boxes(context):
+    """Итоговые блоки в начале отчёта: список строк на блок (первая строка — заголовок)."""
+    boxes = []
+    for code in ('1530', '1532'):
+        if context.get(f'instrument_history_{code}'):
+            boxes.append([
+                f"Код дохода {code}",
+                _with_breakdown(
+                    f"Доход: {_amount(context['income_by_income_code'].get(code))} RUB",
+                    context['income_by_income_code_currencies'].get(code),
+                ),
+                _with_breakdown(
+                    f"Затраты: {_amount(context['cost_by_income_code'].get(code))} RUB",
+                    context['cost_by_income_code_currencies'].get(code),
+                ),
+                _with_breakdown(
+                    f"Финансовый результат: {_amount(context['profit_by_income_code'].get(code))} RUB",
+                    context['profit_by_income_code_currencies'].get(code),
+                ),
+            ])
+    if context.get('dividend_history'):
+        boxes.append([
+            "Код дохода 1010",
+            _with_breakdown(
+                f"Общая сумма дивидендов до налогов: {_amount(context['total_dividends_rub'])} RUB",
+                context['dividends_by_currency'],
+            ),
+            _with_breakdown(
+                f"Уплаченный налог: {_amount(context['total_dividends_tax_rub'])} RUB",
+                context['dividends_tax_by_currency'],
+            ),
+        ])
+    if context.get('repo_events'):
+        boxes.append([
+            "Код дохода 1011",
+            _with_breakdown(
+                f"РЕПО-доходы: {_amount(context['total_repo_profit_rub'])} RUB", context['repo_profit_by_currency'],
+            ),
+        ])
+    if context.get('other_commissions'):
+        boxes.append([_with_breakdown(
+            f"Прочие расходы и доходы: {_total(context['total_other_commissions_rub'])} RUB",
+            context['other_commissions_by_currency'],
+        )])
+    if context.get('dividend_commissions'):
+        boxes.append([_with_breakdown(
+            f"Прочие расходы и доходы связанные с дивидендами: {_total(context['total_dividend_commissions_rub'])} RUB",
+            context['dividend_commissions_by_currency'],
+        )])
+    return boxes
+
+
+def _document_blocks(context):
+    """
+    Документ как последовательность блоков (вид, данные) в порядке pdf_report.html.
+    Выводятся только разделы из context['pdf_sections']; при pdf_section_continued у разделов
+    операций 1530/1532 нет заголовков (продолжение раздела, см. pdf_sections.section_parts).
+    """
+    year = context['target_report_year_for_title']
+    account = f", счет {context['account_number']}" if context.get('account_number') else ''
+    included = context['pdf_sections']
+
+    if 'summary' in included:
+        yield 'header', f"Дата формирования: {context['generation_date']}"
+        yield 'h1', f"Расчет для декларации 3-НДФЛ за {year} год на основании отчета брокера"
+        yield 'broker', f"Брокер: {context['broker_name']}{account}"
+        for box in summary_boxes(context):
+            yield 'summary', box
+
+        if context.get('user_comment'):
+            yield 'h2', "Комментарий"
+            yield 'comment', context['user_comment']
+
+    sections = (
+        ('1530', f"История операций с ценными бумагами за {year} год"),
+        ('1532', f"История операций по производным фин. инструментам за {year} год"),
+    )
+    for code, title in sections:
+        history = context.get(f'instrument_history_{code}')
+        if not history or code not in included:
+            continue
+        if not context.get('pdf_section_continued'):
+            yield 'h2', f"Код дохода {code}"
+            yield 'h2', title
+        for grouping_key, event_list in history.items():
+            yield 'h3', instrument_heading(grouping_key, event_list)
+            yield 'events', event_list
+
+    if context.get('dividend_history') and 'dividends' in included:
+        yield 'h2', "Код дохода 1010"
+        yield 'h2', f"История дивидендов за {year} год"
+        yield 'p', _with_breakdown(
+            f"Общая сумма дивидендов до налогов: {_amount(context['total_dividends_rub'])} RUB",
+            context['dividends_by_currency'],
+        )
+        yield 'dividends', context['dividend_history']
+        if context.get('dividend_commissions'):
+            yield 'h3', ["Детализация комиссий связанных с дивидендами"]
+            yield 'p', f"Общая сумма: {_total(context['total_dividend_commissions_rub'])} RUB"
+            yield 'dividend_commissions', context['dividend_commissions']
+
+    if context.get('repo_events') and 'repo' in included:
+        yield 'h2', "Код дохода 1011"
+        yield 'h2', f"РЕПО-доходы за {year} год"
+        yield 'p', _with_breakdown(
+            f"Общая сумма РЕПО-доходов: {_amount(context['total_repo_profit_rub'])} RUB",
+            context['repo_profit_by_currency'],
+        )
+        yield 'repo', context['repo_events']
+
+    if context.get('other_commissions') and 'commissions' in included:
+        yield 'h2', f"Прочие расходы и доходы за {year} год"
+        yield 'p', _with_breakdown(
+            f"Общая сумма: {_total(context['total_other_commissions_rub'])} RUB",
+            context['other_commissions_by_currency'],
+        )
+        yield 'other_commissions', context['other_commissions']
+
+
+def report_outline(context):
+    """Заголовки разделов, инструментов и строки итогов документа по порядку."""
+    outline = []
+    for kind, data in _document_blocks(context):
+        if kind in ('h1', 'broker', 'h2', 'p'):
+            outline.append(data)
+        elif kind in ('h3', 'summary'):
+            outline.extend(data)
+    return outline
+
+
+_WHITESPACE_RE = re.compile(r'\s+')
+
+
+def missing_outline_lines(pdf_file, outline):
+    """
+    Строки outline, которых нет в тексте PDF в том же порядке (пустой список — структура и итоги совпадают).
+    Пробелы и переносы строк при сравнении не учитываются.
+    """
+    from pypdf import PdfReader
+
+    text = _WHITESPACE_RE.sub('', ''.join(page.extract_text() or '' for page in PdfReader(pdf_file).pages))
+    missing = []
+    position = 0
+    for line in outline:
+        found = text.find(_WHITESPACE_RE.sub('', line), position)
+        if found < 0:
+            missing.append(line)
+        else:
+            position = found
+    return missing
+
+
+def _operation_label(event):
+    operation = str(event.get('operation')).lower()
+    if event.get('is_expired'):
+        return 'Погашение'
+    if operation == 'buy' and event.get('income_code') == '1532' and event.get('p') == 0 and event.get('summ') == 0:
+        return 'Погашение'
+    if operation == 'buy':
+        return 'Покупка'
+    if operation == 'sell':
+        return 'Продажа'
+    return _value(event.get('operation'))
+
+
+class LinkedQuantity(Flowable):
+    """
+    Количество с цветными метками связей FIFO и пометкой части разбитой сделки. Рисуется прямо
+    на холсте: таких ячеек в таблице операций почти половина, а Paragraph для каждой разбирает
+    разметку и переносит строки.
+    """
+
+    def __init__(self, link_colors, quantity, note=None, text_color=colors.black):
+        super().__init__()
+        self.link_colors = [_to_color(color) for color in link_colors or ()]
+        self.quantity = quantity
+        self.note = note
+        self.text_color = text_color
+        self._marker_width = stringWidth('■', FONT, 7)
+        self._content_width = (
+            self._marker_width * len(self.link_colors) + stringWidth(f' {quantity}', FONT, 7)
+            + (stringWidth(f' {note}', FONT, 5) if note else 0)
+        )
+
+    def wrap(self, available_width, available_height):
+        return self._content_width, 9
+
+    def draw(self):
+        canvas = self.canv
+        x = 0
+        canvas.setFont(FONT, 7)
+        for color in self.link_colors:
+            canvas.setFillColor(color)
+            canvas.drawString(x, 2, '■')
+            x += self._marker_width
+        canvas.setFillColor(self.text_color)
+        text = f' {self.quantity}'
+        canvas.drawString(x, 2, text)
+        if self.note:
+            x += stringWidth(text, FONT, 7)
+            canvas.setFont(FONT, 5)
+            canvas.setFillColor(_SPLIT_NOTE_COLOR)
+            canvas.drawString(x, 2, f' {self.note}')
+
+
+def _to_color(value):
+    try:
+        return colors.toColor(value)
+    except ValueError:
+        return colors.black
+
+
+def _quantity_cell(event, text_color=colors.black):
+    """Количество; цветные метки связей FIFO и пометка части разбитой сделки — через LinkedQuantity."""
+    quantity = _value(event.get('q'))
+    link_colors = event.get('link_colors')
+    split_note = event.get('split_part_note') if event.get('is_split_part') else None
+    if not link_colors and not split_note:
+        return quantity
+    return LinkedQuantity(link_colors, quantity, split_note, text_color)
+
+
+def _event_rows(event_list):
+    """Строки таблицы операций инструмента и команды стиля для них (как _pdf_instrument_events.html)."""
+    rows = [list(EVENT_COLUMNS)]
+    style = [('ALIGN', (3, 1), (-1, -1), 'RIGHT')]
+    for wrapper in event_list:
+        event = wrapper.get('event_details') or {}
+        display_type = wrapper.get('display_type')
+        if display_type != 'option' and not event.get('is_in_pdf_range'):
+            continue
+        row = len(rows)
+        relevant = bool(event.get('is_relevant_for_target_year'))
+        text_color = colors.black if relevant else _NON_RELEVANT_COLOR
+
+        if display_type == 'trade':
+            if event.get('is_split_part') and (event.get('split_part_index') or 0) > 0:
+                # Продолжение разбитой сделки: дата, операция, инструмент и цена указаны в первой части
+                leading_cells = ['', '', '', '']
+            else:
+                leading_cells = [
+                    _value(event.get('date')),
+                    _operation_label(event),
+                    _text(event.get('ticker') or event.get('symbol') or event.get('isin') or ''),
+                    _value(event.get('p')),
+                ]
+            rows.append(leading_cells + [
+                _quantity_cell(event, text_color),
+                f"{_value(event.get('summ'))} {_value(event.get('curr_c'), '')}",
+                _value(event.get('commission')),
+                format_cbr_rate(event.get('cbr_rate')),
+                _value(event.get('fifo_cost_rub_str')),
+            ])
+            style.append(('FONTNAME', (8, row), (8, row), FONT_BOLD))
+            if event.get('is_option_delivery'):
+                style.append(('LINEBEFORE', (0, row), (0, row), 3, colors.HexColor('#f59e0b')))
+            if event.get('is_split_part'):
+                style.append(('BACKGROUND', (0, row), (-1, row), colors.HexColor('#fafbfc')))
+        elif display_type in ('conversion_info', 'acquisition_info'):
+            if display_type == 'conversion_info':
+                markup = (
+                    f"<b>Конвертация:</b> {escape(_value(event.get('old_quantity_removed'), '?'))} "
+                    f"{escape(_text(event.get('old_ticker')))} → "
+                    f"{escape(_value(event.get('new_quantity_received'), '?'))} {escape(_text(event.get('new_ticker')))}"
+                )
+                style.append(('BACKGROUND', (0, row), (-1, row), colors.HexColor('#e6f7ff')))
+            else:
+                acquisition_label = {
+                    'subscription': 'Подписка', 'rights_issue': 'Выдача прав', 'spinoff': 'Спин-офф',
+                }.get(event.get('acquisition_type'), 'Приобретение')
+                markup = (
+                    f"<b>{acquisition_label}:</b> {escape(_value(event.get('quantity'), '?'))} "
+                    f"{escape(_text(event.get('ticker')))}"
+                )
+                if event.get('source_ticker'):
+                    markup += f" (из {escape(str(event['source_ticker']))})"
+                if event.get('cost') and event.get('cost') != 0:
+                    markup += (
+                        f" — оплачено {escape(_text(event.get('cost')))} {escape(_text(event.get('currency')))} "
+                        f"({escape(_text(event.get('cost_rub')))} RUB)"
+                    )
+            rows.append([_date(wrapper.get('datetime_obj')), Paragraph(markup, _STYLES['cell'])] + [''] * 7)
+            style.append(('SPAN', (1, row), (-1, row)))
+            style.append(('ALIGN', (1, row), (-1, row), 'LEFT'))
+        elif display_type == 'initial_holding':
+            rows.append([
+                _date(wrapper.get('datetime_obj')),
+                'Зачисл.',
+                _text(event.get('ticker') or event.get('symbol') or event.get('isin') or ''),
+                _value(event.get('p')),
+                _quantity_cell(event, text_color),
+                f"{_value(event.get('total_cost_rub_str'))} RUB",
+                '-',
+                '-',
+                '',
+            ])
+        elif display_type == 'option':
+            rows.append([
+                _value(event.get('date')),
+                'Опцион',
+                _text(event.get('ticker') or event.get('symbol') or '-'),
+                _value(event.get('p')),
+                _quantity_cell(event),
+                f"{_value(event.get('summ'))} {_value(event.get('curr_c'), '')}",
+                _value(event.get('commission')),
+                format_cbr_rate(event.get('cbr_rate')),
+                'В поставке',
+            ])
+            style.append(('FONTNAME', (1, row), (1, row), FONT_BOLD))
+            style.append(('FONTNAME', (8, row), (8, row), FONT_ITALIC))
+            style.append(('LINEBEFORE', (0, row), (0, row), 3, colors.HexColor('#f59e0b')))
+            continue
+        else:
+            continue
+
+        if not relevant:
+            style.append(('TEXTCOLOR', (0, row), (-1, row), _NON_RELEVANT_COLOR))
+    return rows, style
+
+
+def _dividend_rows(dividend_history):
+    rows = [list(DIVIDEND_COLUMNS)]
+    for div_event in dividend_history:
+        rows.append([
+            _date(div_event.get('date')),
+            Paragraph(escape(f"{_value(div_event.get('ticker'), 'N/A')} ({_value(div_event.get('instrument_name'), '')})"),
+                      _STYLES['cell']),
+            floatformat(div_event.get('amount'), 2),
+            floatformat(div_event.get('tax_amount'), 2),
+            _value(div_event.get('currency'), 'N/A'),
+            _value(div_event.get('cbr_rate_str')),
+        ])
+    return rows, [('ALIGN', (2, 1), (3, -1), 'RIGHT'), ('ALIGN', (5, 1), (5, -1), 'RIGHT')]
+
+
+def _repo_rows(repo_events):
+    rows = [list(REPO_COLUMNS)]
+    for repo_event in repo_events:
+        rows.append([
+            _date(repo_event.get('date')),
+            Paragraph(escape(_value(repo_event.get('instrument_name'), 'N/A')), _STYLES['cell']),
+            floatformat(repo_event.get('profit_currency'), 2),
+            _value(repo_event.get('currency'), 'USD'),
+            floatformat(repo_event.get('cbr_rate'), 4),
+            floatformat(repo_event.get('profit_rub'), 2),
+        ])
+    return rows, [('ALIGN', (2, 1), (2, -1), 'RIGHT'), ('ALIGN', (4, 1), (5, -1), 'RIGHT')]
+
+
+def _commission_rows(first_column, categories, currencies_key, total_key, events_key, describe):
+    """Таблица комиссий по категориям: суммы в валютах, итог в рублях, описания и детализация."""
+    rows = [[first_column, 'Суммы в валютах', 'Сумма (RUB)', 'Описание', 'Детализация']]
+    for category, data in categories.items():
+        currencies = data.get(currencies_key) or {}
+        events = data.get(events_key) or []
+        rows.append([
+            Paragraph(escape(str(category)), _STYLES['cell']),
+            Paragraph(escape(', '.join(
+                f"{floatformat(amount, 2)} {code}" for code, amount in currencies.items()
+            )) or ('N/A' if events_key == 'details' else 'Нет данных'), _STYLES['cell']),
+            floatformat(data.get(total_key), 2),
+            Paragraph(escape('; '.join(describe(event) for event in events)) or '-', _STYLES['cell']),
+            Paragraph('<br/>'.join(
+                escape(f"{floatformat(event.get('amount'), 2)} {_text(event.get('currency'))} "
+                       f"({floatformat(event.get('amount_rub'), 2)} RUB)")
+                for event in events
+            ) or '-', _STYLES['cell']),
+        ])
+    return rows, [('ALIGN', (2, 1), (2, -1), 'RIGHT'), ('FONTNAME', (2, 1), (2, -1), FONT_BOLD)]
+
+
+def _describe_dividend_commission(detail):
+    return f"{_text(detail.get('date'))}: {_value(detail.get('comment'))}"
+
+
+def _describe_other_commission(event):
+    return f"{_date(event.get('date'))}: {event.get('description') or event.get('source') or '-'}"
+
+
+def chunk_style(extra_style, first_row, last_row):
+    """
+    Команды стиля для части таблицы со строками данных first_row..last_row (номера в полной таблице).
+    Команды одной строки переносятся с новым номером строки, команды на весь столбец — как есть.
+    """
+    style = []
+    for command in extra_style:
+        (start_col, start_row), (end_col, end_row) = command[1], command[2]
+        if start_row > 0 and start_row == end_row:
+            if not first_row <= start_row <= last_row:
+                continue
+            row = start_row - first_row + 1
+            command = (command[0], (start_col, row), (end_col, row)) + tuple(command[3:])
+        style.append(command)
+    return style
+
+
+def chunked_table(rows, widths, extra_style, available_width, chunk_rows=None):
+    """
+    Таблица с заголовком rows[0]. При каждом переносе на новую страницу ReportLab заново обрабатывает
+    все оставшиеся строки таблицы, и время растёт квадратично от её длины, поэтому длинная таблица
+    выводится подряд идущими частями по chunk_rows строк (NDFL_PDF_TABLE_CHUNK_ROWS), каждая со своим заголовком.
+    """
+    if chunk_rows is None:
+        chunk_rows = getattr(settings, 'NDFL_PDF_TABLE_CHUNK_ROWS', 100)
+    col_widths = [available_width * share for share in widths]
+    header, data = rows[0], rows[1:]
+    tables = []
+    for offset in range(0, max(len(data), 1), chunk_rows):
+        chunk = [header] + data[offset:offset + chunk_rows]
+        # Высоту строк из одних строк (без Paragraph) знаем заранее — измеряются только строки с разметкой
+        row_heights = [
+            None if any(isinstance(cell, Paragraph) for cell in row) else _PLAIN_ROW_HEIGHT
+            for row in chunk
+        ]
+        table = LongTable(chunk, colWidths=col_widths, rowHeights=row_heights, repeatRows=1)
+        table.setStyle(TableStyle(_BASE_TABLE_STYLE + chunk_style(extra_style, offset + 1, offset + len(chunk) - 1)))
+        tables.append(table)
+    return tables
+
+
+def _summary_box(lines, available_width):
+    paragraphs = [Paragraph(escape(lines[0]), _STYLES['summary_title'])]
+    paragraphs += [Paragraph(escape(line), _STYLES['summary_line']) for line in lines[1:]]
+    box = Table([[paragraphs]], colWidths=[available_width])
+    box.setStyle(TableStyle([
+        ('BACKGROUND', (0, 0), (-1, -1), colors.HexColor('#f4f7f6')),
+        ('BOX', (0, 0), (-1, -1), 0.5, colors.HexColor('#dddddd')),
+        ('LEFTPADDING', (0, 0), (-1, -1), 8),
+        ('RIGHTPADDING', (0, 0), (-1, -1), 8),
+        ('TOPPADDING', (0, 0), (-1, -1), 4),
+        ('BOTTOMPADDING', (0, 0), (-1, -1), 4),
+    ]))
+    return [box, Spacer(1, 8)]
+
+
+def report_flowables(context, available_width):
+    """Flowables документа по блокам _document_blocks."""
+    story = []
+    for kind, data in _document_blocks(context):
+        if kind in ('header', 'h1', 'broker', 'h2', 'p'):
+            story.append(Paragraph(escape(data), _STYLES[kind]))
+        elif kind == 'h3':
+            story.append(Paragraph('<br/>'.join(escape(line) for line in data), _STYLES['h3']))
+        elif kind == 'summary':
+            story.extend(_summary_box(data, available_width))
+        elif kind == 'comment':
+            story.append(Paragraph(escape(data).replace('\n', '<br/>'), _STYLES['comment']))
+        elif kind == 'events':
+            rows, style = _event_rows(data)
+            story.extend(chunked_table(rows, EVENT_WIDTHS, style, available_width))
+        elif kind == 'dividends':
+            rows, style = _dividend_rows(data)
+            story.extend(chunked_table(rows, DIVIDEND_WIDTHS, style, available_width))
+        elif kind == 'repo':
+            rows, style = _repo_rows(data)
+            story.extend(chunked_table(rows, REPO_WIDTHS, style, available_width))
+        elif kind == 'dividend_commissions':
+            rows, style = _commission_rows(
+                'Тикер', data, 'amount_by_currency', 'amount_rub', 'details', _describe_dividend_commission,
+            )
+            story.extend(chunked_table(rows, COMMISSION_WIDTHS, style, available_width))
+        elif kind == 'other_commissions':
+            rows, style = _commission_rows(
+                'Категория', data, 'currencies', 'total_rub', 'raw_events', _describe_other_commission,
+            )
+            story.extend(chunked_table(rows, COMMISSION_WIDTHS, style, available_width))
+    return story
+
+
+def build_pdf_report(context, output):
+    """
+    Пишет PDF-отчёт в output (путь или файловый объект). Шрифты DejaVu должны быть
+    зарегистрированы (pdf_report.register_fonts).
+    """
+    document = SimpleDocTemplate(
+        output,
+        pagesize=landscape(A4),
+        leftMargin=1 * cm, rightMargin=1 * cm, topMargin=1 * cm, bottomMargin=1 * cm,
+        title=f"Расчет для декларации 3-НДФЛ за {context['target_report_year_for_title']} год",
+    )
+    document.build(report_flowables(context, document.width))
+
+
+def build_contents_page(entries, output):
+    """
+    Оглавление отчёта, построенного по разделам: entries — пары (заголовок раздела, номер первой страницы).
+    Страницы — того же формата, что и отчёт.
+    """
+    document = SimpleDocTemplate(
+        output,
+        pagesize=landscape(A4),
+        leftMargin=1 * cm, rightMargin=1 * cm, topMargin=1 * cm, bottomMargin=1 * cm,
+    )
+    rows = [[Paragraph(escape(title), _STYLES['p']), str(page)] for title, page in entries]
+    table = Table(rows, colWidths=[document.width * 0.9, document.width * 0.1])
+    table.setStyle(TableStyle([
+        ('FONTNAME', (0, 0), (-1, -1), FONT),
+        ('FONTSIZE', (0, 0), (-1, -1), 9),
+        ('ALIGN', (1, 0), (1, -1), 'RIGHT'),
+        ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+        ('LINEBELOW', (0, 0), (-1, -1), 0.5, colors.HexColor('#dddddd')),
+    ]))
+    document.build([Paragraph("Содержание", _STYLES['h1']), Spacer(1, 6), table])
+
+
+def build_page_numbers(page_sizes, output):
+    """
+    Страницы с одной подписью «Страница X из N» в правом нижнем углу — накладываются на страницы
+    собранного отчёта. page_sizes — (ширина, высота) каждой страницы.
+    """
+    total = len(page_sizes)
+    pages = canvas.Canvas(output)
+    for number, (width, height) in enumerate(page_sizes, start=1):
+        pages.setPageSize((width, height))
+        pages.setFont(FONT, 7)
+        pages.setFillColor(colors.HexColor('#777777'))
+        pages.drawRightString(width - 1 * cm, 0.5 * cm, f"Страница {number} из {total}")
+        pages.showPage()
+    pages.save()
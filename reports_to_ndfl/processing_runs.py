@@ -0,0 +1,73 @@
+# reports_to_ndfl/processing_runs.py
+"""
+Фоновые расчёты, поставленные в очередь через API (ProcessingRun).
+
+Расчёт идёт тем же путём, что и со страницы отчёта (yearly_results.year_run_for /
+process_all_years), и сохраняет результат в YearlyReportResult, откуда его отдаёт API.
+Очередь — пул потоков в памяти процесса (NDFL_API_PROCESSING_WORKERS; 0 — считать сразу
+в запросе): расчёты, не завершённые к перезапуску процесса, остаются в статусе queued/running,
+их нужно поставить заново.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.utils import timezone
+
+from .models import ProcessingRun
+from .yearly_results import process_all_years, year_run_for
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor(workers):
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ndfl-api-run')
+        return _executor
+
+
+def _error_text(diagnostics):
+    errors = [item['text'] for item in diagnostics if item['level_tag'] == 'error']
+    return '; '.join(errors) or "Ошибка разбора отчётов"
+
+
+def execute_run(run_id):
+    """Выполняет расчёт ProcessingRun и записывает его статус."""
+    run = ProcessingRun.objects.select_related('user').get(pk=run_id)
+    ProcessingRun.objects.filter(pk=run_id).update(status=ProcessingRun.STATUS_RUNNING, started_at=timezone.now())
+    status, error = ProcessingRun.STATUS_DONE, ''
+    try:
+        year_run = None
+        if run.all_years:
+            year_run = process_all_years(None, run.user, run.broker_type).get(run.year)
+        if year_run is None:
+            year_run = year_run_for(None, run.user, run.broker_type, run.year, refresh=run.refresh)
+        if year_run.result[4]:
+            # Расчёт с ошибкой разбора не сохраняется (store_year_results)
+            status, error = ProcessingRun.STATUS_FAILED, _error_text(year_run.diagnostics)
+    except Exception as e:
+        status, error = ProcessingRun.STATUS_FAILED, f"Непредвиденная ошибка расчета: {e}"
+    ProcessingRun.objects.filter(pk=run_id).update(status=status, error=error, finished_at=timezone.now())
+
+
+def _execute_in_worker(run_id):
+    # Поток пула держит свои соединения с БД: закрываем их после каждого расчёта
+    close_old_connections()
+    try:
+        execute_run(run_id)
+    finally:
+        connection.close()
+
+
+def enqueue_run(run):
+    """Ставит расчёт в очередь (после фиксации транзакции, в которой он создан)."""
+    workers = getattr(settings, 'NDFL_API_PROCESSING_WORKERS', 2)
+    if workers <= 0:
+        execute_run(run.pk)
+        return
+    executor = _get_executor(workers)
+    transaction.on_commit(lambda: executor.submit(_execute_in_worker, run.pk))
@@ -0,0 +1,22 @@
+# reports_to_ndfl/report_templates.py
+"""
+Шаблоны тяжёлых таблиц отчёта.
+
+Таблица операций инструмента выводится строкой на каждую сделку, и на большом счёте
+шаблонизатор Django тратит основное время на разбор переменных и вызовы фильтров в каждой
+ячейке. Поэтому эти шаблоны есть только в reports_to_ndfl/jinja2/: Jinja2 компилирует их
+в Python-код. Страница отчёта, фрагменты истории инструмента и PDF рендерят их через
+render_report_fragment (в шаблонах Django — тегом instrument_events).
+"""
+from django.template.loader import render_to_string
+
+INSTRUMENT_EVENTS_TEMPLATE = 'reports_to_ndfl/_instrument_events.html'
+PDF_INSTRUMENT_EVENTS_TEMPLATE = 'reports_to_ndfl/_pdf_instrument_events.html'
+
+# Имя движка Jinja2 в settings.TEMPLATES
+REPORT_TEMPLATES_ENGINE = 'jinja2'
+
+
+def render_report_fragment(template_name, context, request=None):
+    """Рендерит фрагмент отчёта (шаблон из reports_to_ndfl/jinja2/)."""
+    return render_to_string(template_name, context, request=request, using=REPORT_TEMPLATES_ENGINE)
@@ -0,0 +1,117 @@
+# reports_to_ndfl/run_context.py
+"""
+Состояние одного расчёта отчёта.
+
+Флаг ошибки, диагностика, курсы ЦБ и кэши хранятся не в переменных модуля, а в объекте
+RunContext, который создаётся на каждый расчёт (один пользователь, один год) и передаётся
+по цепочке FFG/IB. Расчёты разных пользователей в потоках одного
+процесса (потоковые воркеры gunicorn, фоновые задачи в пуле потоков) не видят состояния
+друг друга.
+"""
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.contrib import messages
+
+from currency_CBRF.models import Currency
+from NDFL.metrics import RATE_CACHE_LOOKUPS
+from .diagnostics import Diagnostics
+
+
+class RunContext:
+    """
+    Ошибки, диагностика, курсы ЦБ, кэши и замеры времени одного расчёта.
+
+    Предупреждения расчёта собираются в diagnostics (см. diagnostics.Diagnostics), а не
+    в сообщения сессии.
+    """
+
+    def __init__(self, request=None, user=None, target_year=None):
+        self.request = request
+        self.user = user
+        self.target_year = target_year
+        self.had_error = False
+        self.diagnostics = Diagnostics()
+        # Точные курсы ЦБ: (код валюты, дата) -> курс за единицу валюты. В рабочих процессах пула
+        # сюда же кладутся переданные заранее ближайшие и отсутствующие (None) курсы
+        self.rates = {}
+        # Точные курсы ЦБ: (id валюты, дата) -> (ExchangeRate, True, курс за единицу)
+        self._exact_rates = {}
+        self._caches = defaultdict(dict)
+        self.timings = defaultdict(float)
+
+    def mark_error(self, message=None):
+        """Отмечает ошибку разбора; message (если есть) попадает в диагностику."""
+        self.had_error = True
+        if message:
+            self.diagnostics.add(message, messages.ERROR)
+
+    def for_year(self, target_year):
+        """
+        Контекст одного года общего расчёта за несколько лет: курсы и кэши общие с этим контекстом,
+        а диагностика и флаг ошибки свои — начинаются с накопленных в общей части расчёта.
+        """
+        context = RunContext(self.request, self.user, target_year)
+        context.had_error = self.had_error
+        context.diagnostics.merge(self.diagnostics)
+        context.rates = self.rates
+        context._exact_rates = self._exact_rates
+        context._caches = self._caches
+        context.timings = self.timings
+        return context
+
+    def cache(self, name):
+        """Именованный словарь-кэш, живущий столько же, сколько расчёт."""
+        return self._caches[name]
+
+    @contextmanager
+    def timed(self, stage):
+        """Суммирует время выполнения блока в timings[stage] (секунды)."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[stage] += time.perf_counter() - started
+
+    def exchange_rate(self, currency_obj, target_date_obj, rate_purpose_message=""):
+        """
+        То же, что FFG_ndfl._get_exchange_rate_for_date, но точные курсы запоминаются на время расчёта.
+        Ближайшие (не точные) курсы не запоминаются: для них каждый вызов сообщает пользователю,
+        для какой цели взят курс другой даты.
+        """
+        from .FFG_ndfl import _get_exchange_rate_for_date  # FFG_ndfl сам импортирует RunContext
+
+        key = (currency_obj.pk, target_date_obj)
+        cached = self._exact_rates.get(key)
+        if cached is not None:
+            RATE_CACHE_LOOKUPS.labels(result='hit').inc()
+            return cached
+        RATE_CACHE_LOOKUPS.labels(result='miss').inc()
+        result = _get_exchange_rate_for_date(self, currency_obj, target_date_obj, rate_purpose_message)
+        if result[1]:
+            self._exact_rates[key] = result
+        return result
+
+    def currency(self, currency_code):
+        """Currency по коду или None; запоминается на время расчёта."""
+        currencies = self.cache('currencies')
+        if currency_code not in currencies:
+            currencies[currency_code] = Currency.objects.filter(char_code=currency_code).first()
+        return currencies[currency_code]
+
+    def unit_rate(self, currency_code, target_date_obj, rate_purpose_message=""):
+        """
+        Курс ЦБ за единицу валюты по коду; None, если валюты или курса нет. Как и в exchange_rate,
+        запоминаются только точные курсы: ближайший или отсутствующий курс каждый раз попадает в диагностику.
+        """
+        key = (currency_code, target_date_obj)
+        if key in self.rates:
+            return self.rates[key]
+        currency_obj = self.currency(currency_code)
+        if not currency_obj:
+            return None
+        _, exact, rate_val = self.exchange_rate(currency_obj, target_date_obj, rate_purpose_message)
+        if exact:
+            self.rates[key] = rate_val
+        return rate_val
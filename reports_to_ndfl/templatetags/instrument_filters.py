@@ -2,6 +2,7 @@
 Custom template filters для отображения информации об инструментах
 """
 from django import template
+from django.utils.safestring import mark_safe
 from decimal import Decimal
 
 register = template.Library()
@@ -108,3 +109,20 @@ def format_cbr_rate(value):
             return f"{value:.4f}"
     except:
         return str(value) if value else "-"
+
+
+@register.simple_tag
+def instrument_events(event_list, income_code='', template_name=None):
+    """
+    Таблица операций одного инструмента. Рендерится отдельным шаблоном Jinja2
+    (см. report_templates).
+
+    Пример:
+        {% instrument_events event_list '1530' %}
+    """
+    from ..report_templates import INSTRUMENT_EVENTS_TEMPLATE, render_report_fragment
+
+    return mark_safe(render_report_fragment(
+        template_name or INSTRUMENT_EVENTS_TEMPLATE,
+        {'event_list': event_list, 'income_code': income_code},
+    ))
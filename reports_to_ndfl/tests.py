@@ -1,8 +1,64 @@
-from datetime import datetime
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import xml.etree.ElementTree as ET
+from io import BytesIO, StringIO
+from types import SimpleNamespace
+from datetime import date, datetime, timedelta
 from collections import defaultdict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from decimal import Decimal
-
-from django.test import SimpleTestCase
+from unittest import mock
+
+from django.apps import apps
+from django.conf import settings
+from django.contrib import messages
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY
+from pypdf import PdfReader
+from rest_framework.test import APIClient
+from reportlab.lib import colors
+
+from currency_CBRF.models import Currency, ExchangeRate
+from currency_CBRF.services import bump_rates_revision
+from reports_to_ndfl.description_rules import (
+    CORPORATE_ACTION_RULES, classify_corporate_action, classify_fee_description, compile_rules, matched_rules,
+)
+from reports_to_ndfl.diagnostics import Diagnostics
+from reports_to_ndfl.dividend_index import DividendIndex
+from reports_to_ndfl.fifo_pool import run_in_process_pool, split_families_into_buckets
+from reports_to_ndfl.FFG_ndfl import (
+    _add_dividend_from_cash_in_out, _add_dividend_tax_from_cash_in_out, _dispatch_cash_in_outs,
+    _fifo_rate_requests, _process_all_operations_for_fifo, _replay_fifo_bucket, _str_to_decimal_safe,
+)
+from reports_to_ndfl.fifo_vectorized import scale_quantities
+from reports_to_ndfl.instrument_lineage import InstrumentLineage
+from reports_to_ndfl.models import BrokerReport, ProcessingRun, YearlyReportResult
+from reports_to_ndfl.management.commands.benchmark_pdf import build_context
+from reports_to_ndfl.management.commands.compute_ndfl import compute_user
+from reports_to_ndfl.management.commands.benchmark_templates import build_history
+from reports_to_ndfl.pdf_report import PDF_BACKENDS, pdf_report_context, write_pdf
+from reports_to_ndfl.pdf_sections import section_parts
+from reports_to_ndfl.pdf_writer import chunk_style, chunked_table, missing_outline_lines, report_outline
+from reports_to_ndfl.report_templates import INSTRUMENT_EVENTS_TEMPLATE, PDF_INSTRUMENT_EVENTS_TEMPLATE, render_report_fragment
+from reports_to_ndfl.run_context import RunContext
+from reports_to_ndfl.uploads import (
+    extract_uploads_metadata, save_uploaded_reports, sniff_ffg_report_metadata, sniff_ib_report_metadata,
+)
+from reports_to_ndfl.yearly_results import (
+    _from_stored, _to_stored, load_year_result, load_year_run, process_all_years, store_year_results,
+)
 
 from reports_to_ndfl.parsers.ib_parser import IBParser
 from reports_to_ndfl.views import _attach_dividend_fees
@@ -499,6 +555,39 @@ class IBParserDividendMatchingTests(SimpleTestCase):
         self.assertTrue(report2["ok"])
         self.assertEqual(dividend_events[0].get("fee_rub"), Decimal("-120"))
 
+    def test_dividend_fee_fallback_prefers_earlier_dividend_on_tie_and_first_for_undated_fee(self):
+        dividend_events = [
+            {"date": datetime(2025, 3, 11).date(), "ticker": "KO", "currency": "USD"},
+            {"date": datetime(2025, 3, 1).date(), "ticker": "KO", "currency": "USD"},
+            {"date": datetime(2025, 3, 1).date(), "ticker": "KO", "currency": "USD"},
+        ]
+        dividend_commissions_data = {
+            "Комиссия по дивидендам (KO)": {
+                "details": [
+                    {
+                        "date_obj": datetime(2025, 3, 6).date(),
+                        "currency": "USD",
+                        "amount_rub": Decimal("-10"),
+                        "comment": "KO(US1912161007) Cash Dividend - FEE",
+                    },
+                    {
+                        "currency": "USD",
+                        "amount_rub": Decimal("-5"),
+                        "comment": "KO(US1912161007) Cash Dividend - FEE",
+                    },
+                ],
+            }
+        }
+
+        report = _attach_dividend_fees(dividend_events, dividend_commissions_data)
+
+        self.assertTrue(report["ok"])
+        # Равное удаление в 5 дней: берётся более ранний дивиденд, из двух одинаковых дат — первый
+        self.assertEqual(dividend_events[1].get("fee_rub"), Decimal("-10"))
+        self.assertNotIn("fee_rub", dividend_events[2])
+        # Комиссия без даты относится к первому дивиденду тикера
+        self.assertEqual(dividend_events[0].get("fee_rub"), Decimal("-5"))
+
     def test_parse_fees_includes_adr_fee_near_target_year_dividend(self):
         parser = IBParser(request=None, user=None, target_year=2024)
         parser._get_cbr_rate = lambda _currency, _dt_obj: Decimal("1")
@@ -905,3 +994,938 @@ class IBParserWarrantCorporateActionsTests(SimpleTestCase):
         fifo_cost = sell_details.get("fifo_cost_rub_decimal")
         self.assertIsNotNone(fifo_cost)
         self.assertEqual(fifo_cost.quantize(Decimal("0.01")), Decimal("75.00"))
+
+
+class DescriptionRulesTests(SimpleTestCase):
+    def test_corporate_action_type_ignores_instrument_name_and_keeps_unique_pairs(self):
+        action = classify_corporate_action(
+            "ABC(US0000000001) Выдача прав 1 за 10 (ABC.RT, ABC SUBSCRIPTION RIGHTS, US0000000002)"
+        )
+        self.assertEqual(action.pairs, (("ABC", "US0000000001"), ("ABC.RT", "US0000000002")))
+        self.assertTrue(action.is_rights_issue)
+        self.assertFalse(action.is_subscription)
+        self.assertEqual(action.base_description, "ABC(US0000000001) Выдача прав 1 за 10")
+
+    def test_rule_table_finds_every_kind_in_one_pass(self):
+        rules = compile_rules(CORPORATE_ACTION_RULES)
+        self.assertEqual(matched_rules(rules, "merger и spin-off, затем подписка"), {"merger", "spinoff", "subscription"})
+        self.assertEqual(matched_rules(rules, "сплит 4 к 1"), frozenset())
+
+    def test_fee_description_classification(self):
+        fee = classify_fee_description("KO(US1912161007) Наличный дивиденд USD 0.51 на акцию - FEE")
+        self.assertEqual((fee.ticker, fee.isin), ("KO", "US1912161007"))
+        self.assertEqual(fee.dividend_key, "KO(US1912161007) Наличный дивиденд USD 0.51 на акцию")
+        self.assertTrue(fee.is_dividend_related)
+        self.assertFalse(classify_fee_description("Плата за рыночные данные").is_dividend_related)
+
+    def test_benchmark_command_checks_results_match_previous_parsing(self):
+        out = StringIO()
+        call_command("benchmark_descriptions", size=500, unique=100, stdout=out)
+        self.assertIn("Ускорение", out.getvalue())
+
+
+class ReportTemplatesTests(SimpleTestCase):
+    def test_instrument_tables_render_every_event(self):
+        history = build_history(instruments=5, events_per_instrument=60, seed=3)
+        for events in history.values():
+            html = render_report_fragment(INSTRUMENT_EVENTS_TEMPLATE, {"event_list": events, "income_code": "1530"})
+            pdf_html = render_report_fragment(PDF_INSTRUMENT_EVENTS_TEMPLATE, {"event_list": events, "income_code": "1530"})
+            # Строка заголовка и по строке на операцию; в PDF — только операции периода отчёта
+            self.assertEqual(html.count("<tr"), len(events) + 1)
+            in_pdf_range = sum(1 for event in events if event["event_details"].get("is_in_pdf_range"))
+            self.assertGreaterEqual(pdf_html.count("<tr"), in_pdf_range + 1)
+            self.assertLess(pdf_html.count("<tr"), html.count("<tr"))
+        # Числа выводятся по локали, как в шаблонах Django
+        self.assertIn("12,5", render_report_fragment(INSTRUMENT_EVENTS_TEMPLATE, {"event_list": [
+            {"display_type": "trade", "datetime_obj": datetime(2023, 1, 2), "event_details": {"p": Decimal("12.5")}},
+        ]}))
+
+    def test_long_pdf_table_is_split_into_chunks_with_row_styles(self):
+        rows = [["Заголовок"]] + [[str(index)] for index in range(250)]
+        style = [("ALIGN", (0, 1), (-1, -1), "RIGHT"), ("TEXTCOLOR", (0, 120), (-1, 120), colors.red)]
+        tables = chunked_table(rows, [1.0], style, 500, chunk_rows=100)
+
+        self.assertEqual([len(table._cellvalues) for table in tables], [101, 101, 51])
+        self.assertEqual(tables[1]._cellvalues[20], ["119"])
+        self.assertEqual(
+            chunk_style(style, 101, 200),
+            [("ALIGN", (0, 1), (-1, -1), "RIGHT"), ("TEXTCOLOR", (0, 20), (-1, 20), colors.red)],
+        )
+
+    @override_settings(NDFL_PDF_SECTION_MAX_EVENTS=50)
+    def test_pdf_built_by_sections_has_contents_bookmarks_and_page_numbers(self):
+        context = build_context(6, 20)
+        parts = section_parts(context)
+        self.assertEqual([section for section, _, _ in parts], ["summary", "1530", "1530", "1530", "1532", "commissions"])
+        self.assertEqual([title is None for _, title, _ in parts], [False, False, True, True, False, False])
+
+        output = BytesIO()
+        self.assertTrue(write_pdf(context, output, backend="reportlab", by_sections=True))
+        output.seek(0)
+        self.assertEqual(missing_outline_lines(output, report_outline(context)), [])
+
+        reader = PdfReader(output)
+        total = len(reader.pages)
+        bookmarks = {item.title: reader.get_destination_page_number(item) for item in reader.outline}
+        self.assertEqual(bookmarks["Итоги расчета за 2023 год"], 0)
+        self.assertEqual(bookmarks["Содержание"], 1)
+        contents = reader.pages[1].extract_text()
+        for title, page_index in bookmarks.items():
+            if page_index > 1:
+                self.assertIn(f"{title}\n{page_index + 1}", contents)
+                self.assertIn(title.split(". ")[0], reader.pages[page_index].extract_text())
+        for number, page in enumerate(reader.pages, start=1):
+            self.assertIn(f"Страница {number} из {total}", page.extract_text())
+
+
+class PdfWarmupTests(SimpleTestCase):
+    def test_views_import_does_not_load_pdf_stack(self):
+        probe = (
+            "import sys, django; django.setup(); import reports_to_ndfl.views; "
+            "print(sorted(name for name in ('xhtml2pdf', 'reportlab', 'pypdf') if name in sys.modules))"
+        )
+        completed = subprocess.run(
+            [sys.executable, "-c", probe], cwd=settings.BASE_DIR, capture_output=True, text=True,
+            env={**os.environ, "DJANGO_SETTINGS_MODULE": "NDFL.settings", "NDFL_PDF_WARMUP": "lazy"},
+        )
+        self.assertEqual(completed.returncode, 0, completed.stderr)
+        self.assertEqual(completed.stdout.strip(), "[]")
+
+    def test_eager_mode_warms_up_pdf_in_app_ready(self):
+        config = apps.get_app_config("reports_to_ndfl")
+        with mock.patch("reports_to_ndfl.pdf_report.warm_up_pdf") as warm_up:
+            config.ready()
+            warm_up.assert_not_called()
+            with override_settings(NDFL_PDF_WARMUP="eager"):
+                config.ready()
+            warm_up.assert_called_once_with()
+
+
+class InstrumentLineageTests(SimpleTestCase):
+    def test_families_join_tickers_isins_and_conversions(self):
+        lineage = InstrumentLineage()
+        lineage.add_symbol_isin("LFC", "US16939P1066")
+        lineage.add_symbol_isin("LFCHY", "US16939P1066")
+        lineage.add_conversion("RAC", "RACAU")
+        lineage.add_conversion("RACAU", "WARRANT_RACAU")
+
+        self.assertTrue(lineage.same_family("LFC", "LFCHY"))
+        self.assertFalse(lineage.same_family("LFC", "RAC"))
+        self.assertEqual(lineage.family("RAC"), {"RAC", "RACAU", "WARRANT_RACAU"})
+        self.assertEqual(lineage.symbols_for_isin("US16939P1066"), ["LFC", "LFCHY"])
+
+    def test_conversion_chain_is_ordered_and_latest_edge_wins(self):
+        lineage = InstrumentLineage()
+        lineage.add_conversion("A", "B", edge_id=1)
+        lineage.add_conversion("B", "C", edge_id=2)
+        lineage.add_conversion("B", "X", edge_id=2)  # Повтор того же события игнорируется
+        lineage.add_conversion("C", "A", edge_id=3)  # Цикл не зацикливает обход
+
+        self.assertEqual(lineage.conversion_chain("B"), ["C", "A", "B"])
+        self.assertEqual(lineage.latest("A"), "C")
+        self.assertEqual(lineage.predecessors("C"), ["B", "A"])
+
+
+class FifoRelevancePruningTests(SimpleTestCase):
+    def _history_inputs(self):
+        trades = [
+            _trade(trade_id="BUY_OLD", operation="buy", symbol="OLD", dt_obj=datetime(2019, 3, 1, 10, 0, 0), quantity="10", price="1"),
+            _trade(trade_id="SELL_NEW", operation="sell", symbol="NEW", dt_obj=datetime(2024, 3, 1, 10, 0, 0), quantity="10", price="3"),
+            # Давно закрытая позиция без связи с продажами целевого года
+            _trade(trade_id="BUY_DEAD", operation="buy", symbol="DEAD", dt_obj=datetime(2018, 1, 10, 10, 0, 0), quantity="5", price="2"),
+            _trade(trade_id="SELL_DEAD", operation="sell", symbol="DEAD", dt_obj=datetime(2021, 1, 10, 10, 0, 0), quantity="5", price="4"),
+            # Тот же ISIN, что у NEW, под другим тикером
+            _trade(trade_id="BUY_ALIAS", operation="buy", symbol="NEWY", dt_obj=datetime(2022, 1, 10, 10, 0, 0), quantity="1", price="2"),
+        ]
+        conversions = [{
+            "datetime_obj": datetime(2021, 6, 1, 10, 0, 0),
+            "old_ticker": "OLD", "new_ticker": "NEW",
+            "old_qty_removed": Decimal("10"), "new_qty_received": Decimal("10"),
+            "old_isin": "US0000000011", "new_isin": "US0000000012", "comment": "OLD -> NEW",
+        }]
+        return trades, conversions, {"NEWY": "US0000000012"}
+
+    def test_selects_closure_of_target_year_trades(self):
+        parser = IBParser(request=None, user=None, target_year=2024)
+        trades, conversions, symbol_to_isin = self._history_inputs()
+
+        lineage = parser._build_instrument_lineage(trades, conversions, [], symbol_to_isin)
+        relevant_trades, relevant_conversions, _ = parser._select_fifo_relevant_inputs(trades, conversions, [], lineage)
+
+        self.assertEqual({t["trade_id"] for t in relevant_trades}, {"BUY_OLD", "SELL_NEW", "BUY_ALIAS"})
+        self.assertEqual(relevant_conversions, conversions)
+
+    def test_pruned_history_matches_full_replay(self):
+        results = []
+        for pruning in (True, False):
+            parser = IBParser(request=None, user=None, target_year=2024)
+            trades, conversions, symbol_to_isin = self._history_inputs()
+            with override_settings(NDFL_FIFO_RELEVANCE_PRUNING=pruning):
+                results.append(parser._build_fifo_history(trades, conversions, [], symbol_to_isin))
+
+        pruned, full = results
+        self.assertEqual(pruned[1:], full[1:])
+        self.assertEqual(set(pruned[0]), set(full[0]))
+        for symbol, events in full[0].items():
+            self.assertEqual(
+                [(e["display_type"], e["event_details"].get("trade_id"), e["event_details"].get("fifo_cost_rub_decimal")) for e in pruned[0][symbol]],
+                [(e["display_type"], e["event_details"].get("trade_id"), e["event_details"].get("fifo_cost_rub_decimal")) for e in events],
+            )
+
+
+class FFGCashInOutsDispatchTests(SimpleTestCase):
+    CASH_IN_OUTS = """<cash_in_outs>
+        <node><id>1</id><type>dividend</type><pay_d>2024-05-10</pay_d><amount>10.00</amount><currency>USD</currency>
+            <comment>Дивиденды по бумаге (Apple Inc. (AAPL.US))</comment>
+            <details>{"corporate_action_id": "CA-1"}</details></node>
+        <node><id>2</id><type>tax</type><pay_d>2024-05-11</pay_d><amount>-1.50</amount><currency>USD</currency>
+            <comment>Налог за корпоративное действие</comment>
+            <details>{"corporate_action_id": "CA-1"}</details></node>
+        <node><id>3</id><type>agent_fee</type><datetime>2024-05-12 10:00:00</datetime><amount>-0.20</amount>
+            <currency>USD</currency><comment>Агентская комиссия за дивиденды (AAPL.US)</comment></node>
+        <node><id>4</id><type>dividend</type><pay_d>2023-12-10</pay_d><amount>5.00</amount><currency>USD</currency>
+            <comment>Дивиденды по бумаге (Old Corp (OLD.US))</comment></node>
+    </cash_in_outs>"""
+
+    class _File:
+        original_filename = "report_2024.xml"
+        year = 2024
+
+    def test_single_pass_dispatches_dividends_taxes_and_fees(self):
+        element = ET.fromstring(self.CASH_IN_OUTS)
+        dividend_events, dividend_index, taxes, fees, run_context = {}, DividendIndex(), [], [], RunContext()
+        loads_calls = []
+
+        def counting_loads(value, *args, **kwargs):
+            loads_calls.append(value)
+            return json.JSONDecoder().decode(value)
+
+        with mock.patch('reports_to_ndfl.FFG_ndfl.json.loads', side_effect=counting_loads):
+            _dispatch_cash_in_outs(element, {
+                'dividend': lambda record: _add_dividend_from_cash_in_out(
+                    record, dividend_events, dividend_index, self._File, 2024, run_context
+                ),
+                'tax': taxes.append,
+                'agent_fee': fees.append,
+            })
+        for record in taxes:
+            _add_dividend_tax_from_cash_in_out(record, dividend_index, 2024, run_context)
+
+        # details каждого узла декодируется один раз
+        self.assertEqual(len(loads_calls), 2)
+        self.assertEqual(list(dividend_events), ["CA-1_2024-05-10"])
+        event = dividend_events["CA-1_2024-05-10"]
+        self.assertEqual((event["instrument_name"], event["ticker"]), ("Apple Inc.", "AAPL.US"))
+        self.assertEqual((event["amount"], event["tax_amount"]), (Decimal("10.00"), Decimal("1.50")))
+        self.assertEqual([(fee.node_id, fee.transaction_id, fee.amount) for fee in fees], [("3", "3", "-0.20")])
+        self.assertFalse(run_context.had_error)
+        self.assertIs(dividend_index.match_fee("AAPL.US", "USD", date(2024, 5, 12)), event)
+
+    def test_tax_matches_first_dividend_of_corporate_action_within_window(self):
+        index = DividendIndex()
+        events = [
+            {"date": date(2024, 1, 10), "corporate_action_id": "CA-1", "ticker": "X.US", "currency": "USD"},
+            {"date": date(2024, 3, 1), "corporate_action_id": "CA-1", "ticker": "X.US", "currency": "USD"},
+            {"date": date(2024, 2, 1), "corporate_action_id": "CA-1", "ticker": "X.US", "currency": "USD"},
+            {"date": date(2024, 2, 5), "corporate_action_id": "", "ticker": "Y.US", "currency": "USD"},
+        ]
+        for event in events:
+            index.add(event)
+
+        # Как и прежний перебор: первый добавленный дивиденд с датой в [налог - 89 дней, налог]
+        self.assertIs(index.match_tax("CA-1", "", "USD", date(2024, 3, 5)), events[0])
+        self.assertIs(index.match_tax("CA-1", "", "USD", date(2024, 4, 15)), events[1])
+        self.assertIsNone(index.match_tax("CA-1", "", "USD", date(2024, 1, 9)))
+        self.assertIsNone(index.match_tax("CA-2", "X.US", "USD", date(2024, 3, 5)))
+        # Налог без CA_ID — по тикеру и валюте
+        self.assertIs(index.match_tax("", "y.us", "USD", date(2024, 2, 20)), events[3])
+        self.assertIsNone(index.match_tax("", "Y.US", "EUR", date(2024, 2, 20)))
+
+
+class FFGOnDemandConversionTests(SimpleTestCase):
+    def test_sale_covered_by_on_demand_conversion(self):
+        comment = "Conversion of securities OLD (RU000OLD0001) -> NEW (RU000NEW0001)"
+        ca_nodes = [
+            {"corporate_action_id": "CA1", "type_id": "conversion", "asset_type": "Бумаги", "date": "2023-02-01",
+             "isin": "RU000NEW0001", "amount": "20", "comment": comment, "file_source": "ffg.xml (за 2023)"},
+            {"corporate_action_id": "CA1", "type_id": "conversion", "asset_type": "Бумаги", "date": "2023-02-01",
+             "isin": "RU000OLD0001", "amount": "-10", "comment": comment, "file_source": "ffg.xml (за 2023)"},
+        ]
+        buy, sell = {"trade_id": "B1"}, {"trade_id": "S1"}
+        operations = [
+            {"op_type": "trade", "datetime_obj": datetime(2023, 1, 10, 10), "isin": "RU000OLD0001",
+             "trade_id": "B1", "operation_type": "buy", "quantity": Decimal("10"), "price_per_share": Decimal("100"),
+             "commission": Decimal("0"), "currency": "RUB", "commission_currency": "RUB",
+             "cbr_rate_decimal": Decimal(1), "original_trade_dict_ref": buy},
+            {"op_type": "trade", "datetime_obj": datetime(2023, 3, 1, 10), "isin": "RU000NEW0001",
+             "trade_id": "S1", "operation_type": "sell", "quantity": Decimal("20"), "price_per_share": Decimal("60"),
+             "commission": Decimal("0"), "currency": "RUB", "commission_currency": "RUB",
+             "cbr_rate_decimal": Decimal(1), "original_trade_dict_ref": sell},
+        ]
+        conversions = []
+        run_context = RunContext()
+
+        _process_all_operations_for_fifo(
+            None, operations, {}, [SimpleNamespace(id=1)], conversions, run_context, {1: ca_nodes},
+        )
+
+        self.assertFalse(run_context.had_error)
+        self.assertEqual(sell["fifo_cost_rub_decimal"], Decimal("1000.00"))
+        self.assertEqual(sell["used_buy_ids"], ["B1"])
+        self.assertEqual([event["corp_action_id"] for event in conversions], ["CA1"])
+
+
+class RunContextTests(SimpleTestCase):
+    def test_concurrent_runs_do_not_share_error_state(self):
+        contexts = [RunContext() for _ in range(8)]
+
+        def run(index):
+            # Нечётные «расчёты» встречают некорректное число, чётные — нет
+            _str_to_decimal_safe("1.5" if index % 2 == 0 else "не число", "q", str(index), contexts[index])
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            list(executor.map(run, range(len(contexts))))
+
+        self.assertEqual([context.had_error for context in contexts], [index % 2 == 1 for index in range(8)])
+
+    def test_parsers_get_their_own_context(self):
+        first = IBParser(None, None, 2024)
+        second = IBParser(None, None, 2024)
+        first.context.rates[("USD", date(2024, 1, 9))] = Decimal("90")
+        first.context.mark_error("ошибка")
+
+        self.assertEqual(first._get_cbr_rate("usd", datetime(2024, 1, 9, 12, 0)), Decimal("90"))
+        self.assertEqual(second.context.rates, {})
+        self.assertFalse(second.context.had_error)
+        self.assertEqual([item["text"] for item in first.context.diagnostics.as_list()], ["ошибка"])
+
+
+class DiagnosticsTests(TestCase):
+    def test_messages_are_grouped_by_kind_with_capped_samples(self):
+        diagnostics = Diagnostics(sample_size=2)
+        for trade_id in range(1, 5):
+            diagnostics.add(f"Курс USD не найден для сделки {trade_id} на 0{trade_id}.02.2024.")
+        diagnostics.add("Ошибка парсинга XML в файле a.xml.", messages.ERROR)
+
+        items = diagnostics.as_list()
+        self.assertEqual([(item["level_tag"], item["count"]) for item in items], [("error", 1), ("warning", 4)])
+        self.assertEqual(items[1]["samples"], [
+            "Курс USD не найден для сделки 1 на 01.02.2024.",
+            "Курс USD не найден для сделки 2 на 02.02.2024.",
+        ])
+        self.assertIn("и ещё похожих: 3", items[1]["text"])
+
+    def test_unit_rate_caches_only_exact_rates(self):
+        usd = Currency.objects.create(name="Доллар США", char_code="USD", num_code="840", cbr_id="R01235")
+        ExchangeRate.objects.create(currency=usd, date=date(2024, 1, 9), value=Decimal("89.0"), nominal=1)
+        run_context = RunContext()
+
+        with mock.patch("reports_to_ndfl.FFG_ndfl.fetch_daily_rates", return_value=([], date(2024, 1, 9))):
+            self.assertEqual(run_context.unit_rate("USD", date(2024, 1, 9)), Decimal("89.0"))
+            for _ in range(2):
+                self.assertEqual(run_context.unit_rate("USD", date(2024, 1, 10), "для сделки"), Decimal("89.0"))
+        with self.assertNumQueries(0):
+            self.assertEqual(run_context.unit_rate("USD", date(2024, 1, 9)), Decimal("89.0"))
+
+        self.assertEqual(run_context.rates, {("USD", date(2024, 1, 9)): Decimal("89.0")})
+        self.assertEqual([item["count"] for item in run_context.diagnostics.as_list()], [2])
+
+    def test_nearest_rate_notices_are_summarized_per_currency(self):
+        usd = Currency.objects.create(name="Доллар США", char_code="USD", num_code="840", cbr_id="R01235")
+        ExchangeRate.objects.create(currency=usd, date=date(2024, 1, 9), value=Decimal("89.0"), nominal=1)
+        run_context = RunContext()
+
+        with mock.patch("reports_to_ndfl.FFG_ndfl.fetch_daily_rates", return_value=([], date(2024, 1, 9))):
+            for day in (10, 11, 12):
+                _, exact, rate = run_context.exchange_rate(usd, date(2024, 1, day), "для сделки")
+                self.assertEqual((exact, rate), (False, Decimal("89.0")))
+
+        self.assertEqual(run_context.diagnostics.as_list(), [{
+            "level_tag": "info",
+            "text": "Для 3 операций в USD использован ближайший предыдущий курс ЦБ.",
+            "count": 3,
+            "samples": [
+                f"Для USD на {day}.01.2024 для сделки используется ближайший курс от 09.01.2024." for day in (10, 11, 12)
+            ],
+        }])
+
+
+def _square_or_fail(value):
+    """Задача для тестов пула процессов (должна импортироваться в рабочем процессе)."""
+    if value < 0:
+        raise ValueError(f"negative: {value}")
+    return value * value
+
+
+class ParallelFifoTests(SimpleTestCase):
+    def test_process_pool_propagates_task_errors(self):
+        self.assertEqual(run_in_process_pool(_square_or_fail, [(2,), (3,)], 2), [4, 9])
+        with mock.patch("reports_to_ndfl.fifo_pool.ProcessPoolExecutor", wraps=ProcessPoolExecutor) as pool, \
+                self.assertRaisesMessage(ValueError, "negative: -1"):
+            run_in_process_pool(_square_or_fail, [(2,), (-1,)], 2)
+        pool.assert_called_once()
+
+    def test_process_pool_start_failure_runs_tasks_here(self):
+        with mock.patch("reports_to_ndfl.fifo_pool.ProcessPoolExecutor", side_effect=NotImplementedError("sem_open")), \
+                self.assertLogs("reports_to_ndfl.fifo_pool", "WARNING") as logs:
+            self.assertEqual(run_in_process_pool(_square_or_fail, [(2,), (3,)], 2), [4, 9])
+        self.assertIn("sem_open", logs.output[0])
+
+    def test_split_families_into_buckets_balances_load(self):
+        buckets = split_families_into_buckets({"A": 10, "B": 6, "C": 5, "D": 1}, 2)
+        self.assertEqual(sorted(map(sorted, buckets)), [["A", "D"], ["B", "C"]])
+        self.assertEqual(split_families_into_buckets({"A": 1}, 4), [["A"]])
+
+    def test_process_pool_history_matches_sequential(self):
+        results = []
+        for workers in (1, 2):
+            parser = IBParser(request=None, user=None, target_year=2024)
+            trades, conversions, symbol_to_isin = FifoRelevancePruningTests._history_inputs(None)
+            with override_settings(NDFL_FIFO_RELEVANCE_PRUNING=False, NDFL_FIFO_WORKERS=workers,
+                                   NDFL_FIFO_PARALLEL_MIN_OPERATIONS=0):
+                results.append(parser._build_fifo_history(trades, conversions, [], symbol_to_isin))
+
+        sequential, parallel = results
+        self.assertEqual(parallel[1:], sequential[1:])
+        self.assertEqual(list(parallel[0]), list(sequential[0]))
+        for symbol, events in sequential[0].items():
+            self.assertEqual(
+                [(e["display_type"], e["event_details"].get("trade_id"), e["event_details"].get("fifo_cost_rub_decimal")) for e in parallel[0][symbol]],
+                [(e["display_type"], e["event_details"].get("trade_id"), e["event_details"].get("fifo_cost_rub_decimal")) for e in events],
+            )
+
+
+    def test_ffg_worker_uses_prefetched_commission_rates(self):
+        buy, sell = {"trade_id": "B1"}, {"trade_id": "S1"}
+        operations = [
+            {"op_type": "trade", "datetime_obj": datetime(2024, 1, 10, 10), "isin": "US0000000001",
+             "trade_id": "B1", "operation_type": "buy", "quantity": Decimal("10"), "price_per_share": Decimal("100"),
+             "commission": Decimal("1"), "currency": "USD", "commission_currency": "EUR",
+             "cbr_rate_decimal": Decimal("80"), "original_trade_dict_ref": buy},
+            {"op_type": "trade", "datetime_obj": datetime(2024, 2, 1, 10), "isin": "US0000000001",
+             "trade_id": "S1", "operation_type": "sell", "quantity": Decimal("10"), "price_per_share": Decimal("110"),
+             "commission": Decimal("0"), "currency": "USD", "commission_currency": "USD",
+             "cbr_rate_decimal": Decimal("85"), "original_trade_dict_ref": sell},
+        ]
+        self.assertEqual(_fifo_rate_requests(operations), {("EUR", date(2024, 1, 10))})
+
+        # SimpleTestCase запрещает запросы к БД: рабочий процесс берёт валюты и курсы только из кэшей
+        updated_trade_dicts, _, had_error, _ = _replay_fifo_bucket(
+            operations, [], {}, {("EUR", date(2024, 1, 10)): Decimal("90")}, {"EUR": Currency(char_code="EUR")},
+        )
+        self.assertFalse(had_error)
+        self.assertEqual(updated_trade_dicts[1]["fifo_cost_rub_decimal"], Decimal("80090.00"))
+
+
+class VectorizedFifoTests(SimpleTestCase):
+    def _history_inputs(self):
+        rng = random.Random(34)
+        trades = []
+        moment = datetime(2022, 1, 3, 10, 0, 0)
+        for symbol in ("AAA", "BBB", "SHRT"):
+            position = Decimal(0)
+            for idx in range(40):
+                moment += timedelta(hours=rng.randint(1, 48))
+                quantity = Decimal(rng.randint(1, 400)) / Decimal(rng.choice([1, 4, 10]))
+                # SHRT уходит в шорт и считается обычным циклом
+                operation = "buy" if position < quantity or rng.random() < 0.5 else "sell"
+                if symbol == "SHRT" and idx == 0:
+                    operation = "sell"
+                position += quantity if operation == "buy" else -quantity
+                trades.append(_trade(
+                    trade_id=f"{symbol}_{idx}", operation=operation, symbol=symbol, dt_obj=moment,
+                    quantity=str(quantity), price=str(Decimal(rng.randint(100, 9000)) / 100),
+                    cbr_rate=str(Decimal(rng.randint(6000, 10000)) / 100), commission=str(Decimal(rng.randint(0, 300)) / 100),
+                    currency="USD" if symbol == "SHRT" else rng.choice(["USD", "EUR"]),
+                ))
+        trades.sort(key=lambda t: t["datetime_obj"])
+        return trades
+
+    def test_scale_quantities_rejects_inexact_values(self):
+        quantities, scale = scale_quantities([Decimal("1.25"), Decimal("10"), Decimal("0.5")])
+        self.assertEqual(scale, 2)
+        self.assertEqual(list(quantities), [125, 1000, 50])
+        self.assertIsNone(scale_quantities([Decimal("1"), Decimal("0")]))
+        self.assertIsNone(scale_quantities([Decimal("1E-12")]))
+
+    def test_vectorized_sales_match_loop(self):
+        parser = IBParser(request=None, user=None, target_year=2022)
+        vectorized_symbols, _ = parser._vectorized_fifo_sales(self._history_inputs(), [], [], InstrumentLineage())
+        self.assertEqual(vectorized_symbols, {"AAA", "BBB"})
+
+        results = []
+        for vectorized in (False, True):
+            parser = IBParser(request=None, user=None, target_year=2022)
+            with override_settings(NDFL_FIFO_VECTORIZED=vectorized):
+                results.append(parser._build_fifo_history(self._history_inputs(), [], [], {}))
+
+        loop, fast = results
+        self.assertEqual(fast[1:], loop[1:])
+        self.assertEqual(list(fast[0]), list(loop[0]))
+        for symbol, events in loop[0].items():
+            fields = ("trade_id", "fifo_cost_rub_decimal", "fifo_cost_rub_str", "fifo_cost_by_currency", "used_buy_ids")
+            self.assertEqual(
+                [tuple(e["event_details"].get(field) for field in fields) for e in fast[0][symbol]],
+                [tuple(e["event_details"].get(field) for field in fields) for e in events],
+            )
+
+
+class HotQueryPlanTests(TestCase):
+    """Горячие запросы к курсам и отчетам должны идти по индексу, без полного просмотра таблицы и сортировки."""
+
+    def setUp(self):
+        self.currency = Currency.objects.create(name="Доллар США", char_code="USD", num_code="840", cbr_id="R01235")
+        self.user = User.objects.create(username="plan_user")
+        if connection.vendor == 'postgresql':
+            # На маленьких тестовых таблицах планировщик Postgres всегда выбирает Seq Scan
+            with connection.cursor() as cursor:
+                cursor.execute("SET LOCAL enable_seqscan = off")
+
+    def assertUsesIndexWithoutSort(self, queryset):
+        plan = queryset.explain()
+        if connection.vendor == 'postgresql':
+            self.assertNotIn("Seq Scan", plan)
+            self.assertNotIn("Sort", plan)
+        elif connection.vendor == 'sqlite':
+            full_scans = [line for line in plan.splitlines() if " SCAN " in f" {line} " and "USING" not in line]
+            self.assertEqual(full_scans, [], plan)
+            self.assertNotIn("TEMP B-TREE", plan)
+        self.assertIn("index", plan.lower())
+
+    def test_nearest_earlier_rate_lookup_uses_index(self):
+        # Обратный просмотр индекса уникальности (currency, date), без отдельного индекса по -date
+        self.assertUsesIndexWithoutSort(
+            ExchangeRate.objects.filter(currency=self.currency, date__lte=date(2024, 1, 13)).order_by('-date')[:1]
+        )
+
+    def test_broker_reports_history_uses_index(self):
+        self.assertUsesIndexWithoutSort(
+            BrokerReport.objects.filter(user=self.user, broker_type='ib').order_by('year', 'uploaded_at')
+        )
+        self.assertUsesIndexWithoutSort(
+            BrokerReport.objects.filter(user=self.user, broker_type='ffg', year=2024).order_by('uploaded_at')
+        )
+
+
+class UploadMetadataSniffingTests(SimpleTestCase):
+    def test_ffg_metadata_is_read_from_stream_head(self):
+        head = (
+            '<?xml version="1.0" encoding="utf-8"?>'
+            '<broker_report date_start="2023-01-01 00:00:00" date_end="2023-12-31 23:59:59">'
+            '<plainAccountInfoData><client_code>C-123456</client_code></plainAccountInfoData>'
+            '<trades><detailed>'
+        )
+        body = '<node><trade_id>1</trade_id><comment>Покупка</comment></node>' * 20000
+        upload = SimpleUploadedFile("report.xml", (head + body + '</detailed></trades></broker_report>').encode('utf-8'))
+        chunk_sizes = []
+        original_chunks = upload.chunks
+
+        def counting_chunks(chunk_size=None):
+            for chunk in original_chunks(chunk_size):
+                chunk_sizes.append(len(chunk))
+                yield chunk
+
+        upload.chunks = counting_chunks
+        self.assertEqual(sniff_ffg_report_metadata(upload), (2023, "C-123456"))
+        # Прочитана только первая порция, а не весь файл
+        self.assertEqual(len(chunk_sizes), 1)
+        self.assertEqual(upload.tell(), 0)
+
+    def test_ffg_metadata_falls_back_to_windows_1251_and_date_end_tag(self):
+        xml = (
+            '<broker_report><date_end>2022-12-31</date_end><comment>Отчет брокера</comment>'
+            '<plainAccountInfoData><client_code>777</client_code></plainAccountInfoData></broker_report>'
+        )
+        upload = SimpleUploadedFile("report.xml", xml.encode('windows-1251'))
+        self.assertEqual(sniff_ffg_report_metadata(upload), (2022, "777"))
+
+    def test_ib_metadata_uses_header_sections(self):
+        csv_text = (
+            '\ufeffStatement,Header,Field Name,Field Value\r\n'
+            'Statement,Data,Period,"January 1, 2024 - December 31, 2024"\r\n'
+            'Информация о счёте,Data,Счёт,U1234567\r\n'
+            'Сделки,Header,Символ,Количество\r\n'
+        )
+        upload = SimpleUploadedFile("activity.csv", csv_text.encode('utf-8'))
+        self.assertEqual(sniff_ib_report_metadata(upload, "activity.csv"), (2024, "U1234567"))
+        self.assertEqual(sniff_ib_report_metadata(upload, "U1234567_2023.csv"), (2023, "U1234567"))
+
+
+class ParallelUploadTests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+        self.user = User.objects.create(username="upload_user")
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def _ffg_upload(self, name, year, account="C-1"):
+        xml = (
+            f'<broker_report date_end="{year}-12-31 23:59:59">'
+            f'<plainAccountInfoData><client_code>{account}</client_code></plainAccountInfoData></broker_report>'
+        )
+        return SimpleUploadedFile(name, xml.encode('utf-8'))
+
+    def test_multi_file_upload_reports_per_file_results(self):
+        BrokerReport.objects.create(
+            user=self.user, broker_type='ffg', year=2021, original_filename="old.xml", report_file="broker_reports/old.xml"
+        )
+        files = [
+            self._ffg_upload("old.xml", 2021),
+            self._ffg_upload("y2022.xml", 2022),
+            SimpleUploadedFile("broken.xml", b"<broker_report><trades>"),
+            self._ffg_upload("y2023.xml", 2023, account="C-2"),
+            self._ffg_upload("y2023.xml", 2023, account="C-2"),
+        ]
+
+        results = extract_uploads_metadata(files, 'ffg', max_workers=3)
+        created = save_uploaded_reports(self.user, 'ffg', results, max_workers=3)
+
+        self.assertEqual([r['status'] for r in results], ['duplicate', 'created', 'error', 'created', 'duplicate'])
+        self.assertEqual(len(created), 2)
+        report_2023 = BrokerReport.objects.get(user=self.user, year=2023)
+        self.assertEqual(report_2023.account_number, "C-2")
+        self.assertEqual(report_2023.original_filename, "y2023.xml")
+        with report_2023.report_file.open('rb') as stored:
+            self.assertIn(b'date_end="2023-12-31', stored.read())
+        self.assertEqual(BrokerReport.objects.filter(user=self.user).count(), 3)
+
+    def test_concurrent_duplicate_drops_only_conflicting_file(self):
+        files = [self._ffg_upload("y2022.xml", 2022), self._ffg_upload("y2023.xml", 2023)]
+        results = extract_uploads_metadata(files, 'ffg', max_workers=2)
+        storage = BrokerReport._meta.get_field('report_file').storage
+        real_save = storage.save
+
+        def save_during_concurrent_upload(name, content, *args, **kwargs):
+            if name.endswith("y2023.xml"):
+                # Другой запрос успел сохранить y2023.xml после проверки дубликатов
+                BrokerReport.objects.create(
+                    user=self.user, broker_type='ffg', year=2023, original_filename="y2023.xml",
+                    report_file="broker_reports/other.xml",
+                )
+            return real_save(name, content, *args, **kwargs)
+
+        with mock.patch.object(storage, 'save', side_effect=save_during_concurrent_upload):
+            created = save_uploaded_reports(self.user, 'ffg', results, max_workers=1)
+
+        self.assertEqual([r['status'] for r in results], ['created', 'duplicate'])
+        self.assertEqual([report.original_filename for report in created], ["y2022.xml"])
+        self.assertTrue(created[0].report_file.storage.exists(created[0].report_file.name))
+        self.assertEqual(BrokerReport.objects.filter(user=self.user).count(), 2)
+        self.assertEqual(len(os.listdir(os.path.join(self.media_root, "broker_reports"))), 1)
+
+
+class AllYearsProcessingTests(TestCase):
+    CSV_ROWS = [
+        "Сделки,Header,DataDiscriminator,Класс актива,Валюта,Символ,Дата/Время,Количество,Цена транзакции,Выручка,Комиссия/плата,Базис,Код",
+        'Сделки,Data,Order,Акции,RUB,AAA,"2022-02-01, 10:00:00",10,100,-1000,-1,0,O',
+        'Сделки,Data,Order,Акции,RUB,AAA,"2022-06-01, 10:00:00",-4,120,480,-1,0,C',
+        'Сделки,Data,Order,Акции,RUB,AAA,"2023-03-01, 10:00:00",-6,90,540,-1,0,C',
+        'Сделки,Data,Order,Акции,RUB,BBB,"2023-04-01, 10:00:00",5,10,-50,0,0,O',
+        'Сделки,Data,Order,Акции,RUB,BBB,"2023-05-01, 10:00:00",-5,12,60,0,0,C',
+    ]
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root, NDFL_FIFO_RELEVANCE_PRUNING=True)
+        self.settings_override.enable()
+        self.user = User.objects.create(username="all_years_user")
+        content = ("\n".join(self.CSV_ROWS) + "\n").encode('utf-8')
+        for year in (2022, 2023):
+            report = BrokerReport(user=self.user, broker_type='ib', year=year, original_filename=f"ib_{year}.csv")
+            report.report_file.save(f"ib_{year}.csv", SimpleUploadedFile(f"ib_{year}.csv", content if year == 2023 else b""), save=True)
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    @staticmethod
+    def _summary(result):
+        history = {
+            symbol: [(e["display_type"], e["event_details"].get("trade_id"), e["event_details"].get("fifo_cost_rub_decimal"),
+                      e["event_details"].get("is_relevant_for_target_year")) for e in events]
+            for symbol, events in result[0].items()
+        }
+        return history, result[1:5], result[7:19]
+
+    def test_all_years_match_single_year_processing(self):
+        results = process_all_years(None, self.user, 'ib')
+
+        self.assertEqual(sorted(results), [2022, 2023])
+        for year in (2022, 2023):
+            single = IBParser(request=None, user=self.user, target_year=year).process()
+            self.assertEqual(self._summary(results[year].result), self._summary(single))
+        self.assertEqual(results[2022].result[3], Decimal("78.60"))
+        self.assertEqual(set(results[2023].result[0]), {"AAA", "BBB"})
+
+    def test_year_notices_stay_in_their_year(self):
+        usd = Currency.objects.create(name="Доллар США", char_code="USD", num_code="840", cbr_id="R01235")
+        ExchangeRate.objects.create(currency=usd, date=date(2022, 3, 1), value=Decimal("90.0"), nominal=1)
+        content = (
+            "Дивиденды,Header,Валюта,Дата,Описание,Сумма\n"
+            "Дивиденды,Data,USD,2022-03-02,AAA(US0000000001) Наличный дивиденд USD 1 на акцию (Обыкновенный дивиденд),10\n"
+        ).encode('utf-8')
+        report = BrokerReport(user=self.user, broker_type='ib', year=2022, original_filename="ib_2022_dividends.csv")
+        report.report_file.save("ib_2022_dividends.csv", SimpleUploadedFile("ib_2022_dividends.csv", content), save=True)
+
+        with override_settings(CBRF_RATES_WARM_UP=False), \
+                mock.patch("reports_to_ndfl.FFG_ndfl.fetch_daily_rates", return_value=([], date(2022, 3, 1))):
+            results = process_all_years(None, self.user, 'ib')
+
+        self.assertEqual(sorted(results), [2022, 2023])
+        self.assertEqual([item["samples"] for item in results[2022].diagnostics],
+                         [["Для USD на 02.03.2022 для USD используется ближайший курс от 01.03.2022."]])
+        self.assertEqual(results[2023].diagnostics, [])
+        self.assertEqual(load_year_run(self.user, 'ib', 2023).diagnostics, [])
+
+    def test_stored_year_result_is_loaded(self):
+        results = process_all_years(None, self.user, 'ib')
+
+        self.assertEqual(YearlyReportResult.objects.filter(user=self.user, broker_type='ib').count(), 2)
+        stored = load_year_result(self.user, 'ib', 2023)
+        self.assertEqual(self._summary(stored), self._summary(results[2023].result))
+        self.assertEqual(load_year_run(self.user, 'ib', 2023).diagnostics, results[2023].diagnostics)
+        self.assertIsNone(load_year_result(self.user, 'ffg', 2023))
+
+    def test_stored_result_keeps_value_types(self):
+        process_all_years(None, self.user, 'ib')
+        stored = YearlyReportResult.objects.get(user=self.user, broker_type='ib', year=2022).result
+        self.assertEqual(stored["$tuple"][3], {"$decimal": "78.60"})
+
+        value = (
+            {"a": defaultdict(Decimal, {"USD": Decimal("1.10")}), 2024: {date(2024, 1, 2)}, "$x": None},
+            [datetime(2024, 1, 2, 10, 30), ("B1", Decimal("-0")), 1.5, True, None],
+        )
+        restored = _from_stored(json.loads(json.dumps(_to_stored(value))))
+        self.assertEqual(restored, value)
+        self.assertEqual(str(restored[1][1][1]), "-0")
+        with self.assertRaises(TypeError):
+            _to_stored(object())
+
+    def test_compute_ndfl_command_writes_and_stores_results(self):
+        output_dir = os.path.join(self.media_root, "results")
+        stdout = StringIO()
+        call_command("compute_ndfl", user=["all_years_user"], broker=["ib"], output_dir=output_dir, stdout=stdout)
+
+        self.assertEqual(YearlyReportResult.objects.filter(user=self.user, broker_type='ib').count(), 2)
+        with open(os.path.join(output_dir, "all_years_user", "ib_2022.json"), encoding="utf-8") as stored_file:
+            payload = json.load(stored_file)
+        self.assertEqual(payload["result"]["total_sales_profit_rub"], "78.60")
+        self.assertEqual(payload["result"]["total_sales_profit_rub"], str(load_year_result(self.user, 'ib', 2022)[3]))
+        self.assertTrue(os.path.exists(os.path.join(output_dir, "all_years_user", "ib_2023.json")))
+        self.assertIn("расчётов: 2, с ошибкой: 0", stdout.getvalue())
+
+        with self.assertRaises(CommandError):
+            call_command("compute_ndfl", user=["missing_user"], output_dir=output_dir, stdout=StringIO())
+
+    def test_compute_ndfl_reports_pool_failures_without_rerunning(self):
+        other = User.objects.create_user(username="pool_victim")
+        user_pk = self.user.pk
+
+        class PoolWithKilledWorker:
+            def __init__(self, *args, **kwargs):
+                pass
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc_info):
+                return False
+
+            def submit(self, func, *args):
+                future = Future()
+                if args[0] == user_pk:
+                    future.set_result(func(*args))
+                else:
+                    future.set_exception(BrokenProcessPool("worker killed"))
+                return future
+
+        output_dir = os.path.join(self.media_root, "results")
+        stderr = StringIO()
+        command = "reports_to_ndfl.management.commands.compute_ndfl"
+        with mock.patch(f"{command}.ProcessPoolExecutor", PoolWithKilledWorker), \
+                mock.patch(f"{command}.close_connections_before_fork", return_value=True), \
+                mock.patch(f"{command}.compute_user", wraps=compute_user) as wrapped_compute_user:
+            with self.assertRaises(CommandError):
+                call_command("compute_ndfl", "--user", "all_years_user", "--user", other.username, broker=["ib"],
+                             workers=2, output_dir=output_dir, stdout=StringIO(), stderr=stderr)
+
+        self.assertEqual(wrapped_compute_user.call_count, 1)
+        self.assertIn("pool_victim ib -: расчёт не выполнен: BrokenProcessPool('worker killed')", stderr.getvalue())
+        self.assertTrue(os.path.exists(os.path.join(output_dir, "all_years_user", "ib_2022.json")))
+
+    def test_failed_recompute_drops_stored_year_result(self):
+        process_all_years(None, self.user, 'ib')
+        failed_run = load_year_run(self.user, 'ib', 2022)
+        failed_run = failed_run._replace(result=failed_run.result[:4] + (True,) + failed_run.result[5:])
+
+        store_year_results(self.user, 'ib', {2022: failed_run})
+
+        self.assertIsNone(load_year_run(self.user, 'ib', 2022))
+        self.assertIsNotNone(load_year_run(self.user, 'ib', 2023))
+
+    def test_stored_result_is_stale_after_rates_or_code_change(self):
+        process_all_years(None, self.user, 'ib')
+
+        # Новые курсы после расчётного года не затрагивают результат, курсы за сам год — делают его устаревшим
+        bump_rates_revision([date(2025, 1, 15)])
+        self.assertIsNotNone(load_year_run(self.user, 'ib', 2022))
+        bump_rates_revision([date(2022, 6, 1)])
+        self.assertIsNone(load_year_run(self.user, 'ib', 2022))
+        self.assertIsNone(load_year_run(self.user, 'ib', 2023))
+
+        process_all_years(None, self.user, 'ib')
+        self.assertIsNotNone(load_year_run(self.user, 'ib', 2023))
+        with mock.patch("reports_to_ndfl.yearly_results.CALCULATOR_VERSION", "redeployed"):
+            self.assertIsNone(load_year_run(self.user, 'ib', 2023))
+
+    def test_instrument_history_fragment_is_served_from_stored_result(self):
+        process_all_years(None, self.user, 'ib')
+        self.client.force_login(self.user)
+        url = reverse('instrument_history')
+
+        response = self.client.get(url, {'year': 2023, 'broker': 'ib', 'key': 'AAA'})
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, '<table', count=1)
+        self.assertContains(response, 'Продажа')
+        self.assertEqual(self.client.get(url, {'year': 2023, 'broker': 'ib', 'key': 'ZZZ'}).status_code, 404)
+        self.assertEqual(self.client.get(url, {'year': 2021, 'broker': 'ib', 'key': 'AAA'}).status_code, 404)
+
+    def test_pdf_backends_have_same_sections_and_totals(self):
+        process_all_years(None, self.user, 'ib')
+        context = pdf_report_context(self.user, 'ib', 2023, load_year_result(self.user, 'ib', 2023), user_comment="Тест")
+        outline = report_outline(context)
+        self.assertIn("Финансовый результат: -51,60 RUB (-51.60 RUB)", outline)
+
+        for backend in PDF_BACKENDS:
+            output = BytesIO()
+            self.assertTrue(write_pdf(context, output, backend=backend))
+            output.seek(0)
+            self.assertEqual(missing_outline_lines(output, outline), [], backend)
+
+        self.client.force_login(self.user)
+        session = self.client.session
+        session['last_broker_type'] = 'ib'
+        session.save()
+        with override_settings(NDFL_PDF_BACKEND='reportlab'):
+            response = self.client.get(reverse('download_pdf'), {'year': 2023})
+        self.assertTrue(response.streaming)
+        self.assertTrue(b''.join(response.streaming_content).startswith(b'%PDF'))
+
+        with override_settings(NDFL_PDF_BACKEND='reportlab'), \
+                mock.patch('reports_to_ndfl.views.write_pdf', return_value=False):
+            response = self.client.get(reverse('download_pdf'), {'year': 2023})
+        self.assertRedirects(response, reverse('upload_xml_file'), fetch_redirect_response=False)
+
+
+@override_settings(NDFL_API_PROCESSING_WORKERS=0)
+class ReportsApiTests(TestCase):
+    CSV_ROWS = AllYearsProcessingTests.CSV_ROWS
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+        self.user = User.objects.create_user(username="api_user", password="api-password")
+        self.client = APIClient()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def _authenticate(self):
+        response = self.client.post(
+            reverse("api_token"), {"username": "api_user", "password": "api-password"}, format="json",
+        )
+        self.assertEqual(response.status_code, 200)
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {response.json()['access']}")
+
+    def test_requires_token(self):
+        self.assertEqual(self.client.get(reverse("api_reports")).status_code, 401)
+
+    def test_upload_run_and_fetch_result(self):
+        self._authenticate()
+        content = ("\n".join(self.CSV_ROWS) + "\n").encode("utf-8")
+        response = self.client.post(reverse("api_reports"), {
+            "broker_type": "ib", "report_file": [SimpleUploadedFile("ib_2023.csv", content)],
+        }, format="multipart")
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertEqual(response.json()["files"][0]["status"], "created")
+        self.assertEqual(response.json()["reports"][0]["year"], 2023)
+
+        response = self.client.post(reverse("api_runs"), {"broker_type": "ib", "year": 2022}, format="json")
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(reverse("api_runs"), {"broker_type": "ib", "year": 2023}, format="json")
+        self.assertEqual(response.status_code, 202, response.content)
+        run_url = response["Location"]
+        run = self.client.get(run_url).json()
+        self.assertEqual((run["status"], run["error"]), (ProcessingRun.STATUS_DONE, ""))
+
+        response = self.client.get(run["result_url"])
+        self.assertEqual(response.status_code, 200)
+        payload = response.json()
+        stored = load_year_result(self.user, "ib", 2023)
+        self.assertEqual(payload["result"]["total_sales_profit_rub"], str(stored[3]))
+        self.assertIsInstance(payload["result"]["income_by_income_code"]["1530"], str)
+        self.assertEqual(sorted(payload["result"]["instrument_event_history"]), sorted(stored[0]))
+        self.assertFalse(payload["result"]["parsing_error"])
+
+        self.assertEqual(self.client.get(reverse("api_year_result", args=["ib", 2021])).status_code, 404)
+        other_client = APIClient()
+        other_client.force_authenticate(User.objects.create_user(username="other_api_user"))
+        self.assertEqual(other_client.get(run_url).status_code, 404)
+        self.assertEqual(other_client.get(run["result_url"]).status_code, 404)
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        self.metrics_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.metrics_dir, ignore_errors=True)
+        self.user = User.objects.create_user(username="metrics_user", password="metrics-password")
+
+    def test_staff_only(self):
+        self.assertEqual(self.client.get(reverse("metrics")).status_code, 403)
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(reverse("metrics")).status_code, 403)
+
+    def test_staff_view_reports_parser_runs(self):
+        labels = {"broker": "ib", "mode": "year", "outcome": "ok"}
+        runs_before = REGISTRY.get_sample_value("ndfl_parser_runs_total", labels) or 0
+        IBParser(None, self.user, 2023).process()  # отчётов нет — пустой результат без ошибки
+        runs = REGISTRY.get_sample_value("ndfl_parser_runs_total", labels)
+        self.assertEqual(runs, runs_before + 1)
+
+        self.user.is_staff = True
+        self.user.save()
+        self.client.force_login(self.user)
+        response = self.client.get(reverse("metrics"))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], CONTENT_TYPE_LATEST)
+        body = response.content.decode()
+        self.assertIn("# TYPE ndfl_parser_run_seconds histogram", body)
+        self.assertIn(f'ndfl_parser_runs_total{{broker="ib",mode="year",outcome="ok"}} {runs}', body)
+        self.assertIn('ndfl_parser_run_seconds_bucket{broker="ib",le="+Inf",mode="year"}', body)
+
+    def test_multiprocess_values_summed_across_processes(self):
+        # Два процесса в многопроцессном режиме пишут значения в общий каталог
+        script = (
+            "import django; django.setup()\n"
+            "from NDFL.metrics import PARSER_RUNS\n"
+            "PARSER_RUNS.labels(broker='ib', mode='year', outcome='ok').inc(500)\n"
+        )
+        env = dict(os.environ, PROMETHEUS_MULTIPROC_DIR=self.metrics_dir, DJANGO_SETTINGS_MODULE="NDFL.settings")
+        for _ in range(2):
+            subprocess.run([sys.executable, "-c", script], env=env, cwd=settings.BASE_DIR, check=True)
+
+        self.user.is_staff = True
+        self.user.save()
+        self.client.force_login(self.user)
+        with mock.patch.dict(os.environ, PROMETHEUS_MULTIPROC_DIR=self.metrics_dir):
+            response = self.client.get(reverse("metrics"))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('ndfl_parser_runs_total{broker="ib",mode="year",outcome="ok"} 1000.0', response.content.decode())
@@ -0,0 +1,256 @@
+# reports_to_ndfl/uploads.py
+"""
+Потоковое извлечение метаданных (год, номер счёта) из загружаемых отчётов.
+Файл читается порциями по UPLOAD_CHUNK_SIZE, чтение прекращается, как только
+найдены все нужные поля, — целиком в память отчёт не загружается.
+"""
+import codecs
+import csv
+import re
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+
+from .models import BrokerReport
+
+# Размер порции чтения загружаемого файла
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+_LEADING_YEAR_RE = re.compile(r"(\d{4})")
+_ANY_YEAR_RE = re.compile(r"\b(\d{4})\b")
+
+
+def _iter_chunks(uploaded_file, chunk_size=UPLOAD_CHUNK_SIZE):
+    if hasattr(uploaded_file, 'chunks'):
+        # File.chunks сам перематывает файл в начало
+        yield from uploaded_file.chunks(chunk_size)
+        return
+    uploaded_file.seek(0)
+    while True:
+        chunk = uploaded_file.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+
+def _leading_year(value):
+    match = _LEADING_YEAR_RE.match((value or '').strip())
+    return int(match.group(1)) if match else None
+
+
+def _sniff_ffg(uploaded_file, text_decoder=None):
+    found = {'year': None, 'account_number': None, 'parse_error': False}
+    parser = ET.XMLPullParser(events=('start', 'end'))
+    tag_path = []
+    try:
+        for chunk in _iter_chunks(uploaded_file):
+            parser.feed(text_decoder.decode(chunk) if text_decoder else chunk)
+            for event, element in parser.read_events():
+                if event == 'start':
+                    tag_path.append(element.tag)
+                    if element.tag == 'broker_report' and found['year'] is None:
+                        found['year'] = _leading_year(element.get('date_end'))
+                    continue
+                tag_path.pop()
+                if element.tag == 'date_end' and found['year'] is None:
+                    found['year'] = _leading_year(element.text)
+                elif element.tag == 'client_code' and found['account_number'] is None \
+                        and tag_path and tag_path[-1] == 'plainAccountInfoData':
+                    found['account_number'] = (element.text or '').strip() or None
+                # Обработанные элементы не нужны — не даем дереву расти
+                element.clear()
+            if found['year'] is not None and found['account_number'] is not None:
+                break
+    except ET.ParseError:
+        found['parse_error'] = True
+    return found
+
+
+def sniff_ffg_report_metadata(uploaded_file):
+    """
+    Возвращает (year, account_number) отчёта FFG.
+    Год — из атрибута date_end корневого broker_report либо из первого тега date_end,
+    номер счёта — из plainAccountInfoData/client_code. XML читается инкрементальным
+    pull-парсером; файл в windows-1251 без объявления кодировки перечитывается с явным декодированием.
+    """
+    found = _sniff_ffg(uploaded_file)
+    if found['parse_error'] and (found['year'] is None or found['account_number'] is None):
+        found_1251 = _sniff_ffg(uploaded_file, codecs.getincrementaldecoder('windows-1251')(errors='replace'))
+        found['year'] = found['year'] or found_1251['year']
+        found['account_number'] = found['account_number'] or found_1251['account_number']
+    uploaded_file.seek(0)
+    return found['year'], found['account_number']
+
+
+def parse_year_from_ib_filename(filename):
+    matches = re.findall(r'(\d{4})', filename or '')
+    if matches:
+        try:
+            return int(matches[-1])
+        except ValueError:
+            return None
+    return None
+
+
+def _account_number_from_ib_row(row):
+    if len(row) < 4 or row[1].strip() != 'Data':
+        return None
+    # Нормализуем ё -> е для корректного сравнения
+    col0 = row[0].strip().replace('ё', 'е').replace('Ё', 'Е')
+    col2 = row[2].strip().replace('ё', 'е').replace('Ё', 'Е')
+    # "Информация о счете,Data,Счет,НОМЕР" (с е или ё) или "Account Information,Data,Account,NUMBER"
+    if (col0 == 'Информация о счете' and col2 == 'Счет') or (col0 == 'Account Information' and col2 == 'Account'):
+        return row[3].strip() or None
+    return None
+
+
+def _period_year_from_ib_row(row):
+    # "Отчет,Data,Период,"Январь 1, 2023 - Декабрь 31, 2023"" или "Statement,Data,Period,..."
+    if len(row) < 4 or row[1].strip() != 'Data' or row[2].strip() not in ('Период', 'Period'):
+        return None
+    years = _ANY_YEAR_RE.findall(row[3])
+    return int(years[-1]) if years else None
+
+
+def sniff_ib_report_metadata(uploaded_file, original_filename=''):
+    """
+    Возвращает (year, account_number) отчёта IB.
+    Год — из имени файла, а если его там нет — из периода в заголовочной секции отчёта.
+    Номер счёта — из секции «Информация о счете» / «Account Information».
+    CSV декодируется и разбирается построчно по мере чтения порций.
+    """
+    year = parse_year_from_ib_filename(original_filename)
+    period_year = None
+    account_number = None
+    decoder = codecs.getincrementaldecoder('utf-8-sig')(errors='replace')
+    pending_text = ''
+    for chunk in _iter_chunks(uploaded_file):
+        pending_text += decoder.decode(chunk)
+        lines = pending_text.split('\n')
+        pending_text = lines.pop()
+        for row in csv.reader(line.rstrip('\r') for line in lines):
+            account_number = account_number or _account_number_from_ib_row(row)
+            period_year = period_year or _period_year_from_ib_row(row)
+        if account_number and (year or period_year):
+            break
+    else:
+        for row in csv.reader([pending_text + decoder.decode(b'', final=True)]):
+            account_number = account_number or _account_number_from_ib_row(row)
+            period_year = period_year or _period_year_from_ib_row(row)
+    uploaded_file.seek(0)
+    return year or period_year, account_number
+
+
+def sniff_report_metadata(uploaded_file, broker_type):
+    """Возвращает (year, account_number) загруженного отчёта указанного брокера."""
+    if broker_type == 'ffg':
+        return sniff_ffg_report_metadata(uploaded_file)
+    return sniff_ib_report_metadata(uploaded_file, uploaded_file.name)
+
+
+def _run_in_pool(func, items, max_workers=None):
+    max_workers = max_workers or getattr(settings, 'REPORT_UPLOAD_WORKERS', 4)
+    if len(items) <= 1 or max_workers <= 1:
+        return [func(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items)), thread_name_prefix='report-upload') as executor:
+        return list(executor.map(func, items))
+
+
+def extract_uploads_metadata(uploaded_files, broker_type, max_workers=None):
+    """
+    Параллельно (пул потоков по временным файлам загрузки) извлекает год и номер счёта.
+    Возвращает список результатов в порядке файлов:
+    {'file', 'original_filename', 'year', 'account_number', 'status', 'error'},
+    где status — None для годных файлов или 'error'.
+    """
+    def _extract(uploaded_file):
+        result = {
+            'file': uploaded_file, 'original_filename': uploaded_file.name,
+            'year': None, 'account_number': None, 'status': None, 'error': '',
+        }
+        try:
+            result['year'], result['account_number'] = sniff_report_metadata(uploaded_file, broker_type)
+            if result['year'] is None:
+                result['status'] = 'error'
+                result['error'] = "не удалось определить год отчета"
+        except Exception as e:
+            result['status'] = 'error'
+            result['error'] = f"ошибка при первичной обработке: {e}"
+        return result
+
+    return _run_in_pool(_extract, list(uploaded_files), max_workers)
+
+
+def save_uploaded_reports(user, broker_type, upload_results, max_workers=None):
+    """
+    Сохраняет годные файлы из extract_uploads_metadata:
+    один запрос на проверку дубликатов (имя файла + год), параллельная запись файлов
+    в хранилище и один bulk_create (при конфликте с параллельной загрузкой — вставка по одному). Проставляет каждому результату status:
+    'created', 'duplicate' или 'error'. Возвращает список созданных BrokerReport.
+    """
+    candidates = [result for result in upload_results if result['status'] is None]
+    if not candidates:
+        return []
+
+    existing_keys = set(
+        BrokerReport.objects.filter(
+            user=user, broker_type=broker_type,
+            original_filename__in={result['original_filename'] for result in candidates},
+        ).values_list('original_filename', 'year')
+    )
+    new_results = []
+    for result in candidates:
+        key = (result['original_filename'], result['year'])
+        if key in existing_keys:
+            result['status'] = 'duplicate'
+            continue
+        # Один и тот же файл, выбранный дважды в одной загрузке, тоже дубликат
+        existing_keys.add(key)
+        new_results.append(result)
+
+    def _store(result):
+        instance = BrokerReport(
+            user=user,
+            broker_type=broker_type,
+            year=result['year'],
+            original_filename=result['original_filename'],
+            account_number=result['account_number'] or '',
+        )
+        try:
+            # Хранилище записывает файл порциями (File.chunks)
+            instance.report_file.save(result['original_filename'], result['file'], save=False)
+        except Exception as e:
+            result['status'] = 'error'
+            result['error'] = f"не удалось сохранить файл: {e}"
+            return None
+        return instance
+
+    stored = [(result, instance) for result, instance in zip(new_results, _run_in_pool(_store, new_results, max_workers)) if instance]
+    instances = [instance for _, instance in stored]
+    try:
+        with transaction.atomic():
+            BrokerReport.objects.bulk_create(instances)
+    except IntegrityError:
+        # Параллельная загрузка тех же файлов в другом запросе: вставляем по одному (каждый в своей
+        # точке сохранения), дубликатами помечаем и удаляем из хранилища только конфликтующие
+        return _create_one_by_one(stored)
+    for result, _ in stored:
+        result['status'] = 'created'
+    return instances
+
+
+def _create_one_by_one(stored):
+    created = []
+    for result, instance in stored:
+        try:
+            with transaction.atomic():
+                instance.save(force_insert=True)
+        except IntegrityError:
+            instance.report_file.delete(save=False)
+            result['status'] = 'duplicate'
+            continue
+        result['status'] = 'created'
+        created.append(instance)
+    return created
@@ -2,58 +2,28 @@
 
 from django.shortcuts import render, redirect
 from django.contrib import messages
-from django.http import HttpResponse
+from django.http import FileResponse, Http404, HttpResponse
 from django.template.loader import render_to_string
-import xml.etree.ElementTree as ET
 from datetime import datetime, date
 from collections import defaultdict, Counter
 from decimal import Decimal
 from django.contrib.auth.decorators import login_required
 from .models import BrokerReport
+from .uploads import extract_uploads_metadata, save_uploaded_reports
+from .dividend_index import DateBuckets
+from .report_templates import INSTRUMENT_EVENTS_TEMPLATE, render_report_fragment
+from .yearly_results import (
+    invalidate_year_results, load_year_result, process_all_years, year_run_for,
+)
 import json
 import re
 import io
+import tempfile
 
-from xhtml2pdf import pisa, default
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
-import os
 from django.conf import settings
-from django.contrib.staticfiles import finders
-
-# Регистрируем шрифты DejaVu для поддержки кириллицы в PDF
-_fonts_registered = False
-def register_fonts():
-    global _fonts_registered
-    if not _fonts_registered:
-        font_path = os.path.join(settings.BASE_DIR, 'reports_to_ndfl', 'static', 'fonts')
-        pdfmetrics.registerFont(TTFont('DejaVuSans', os.path.join(font_path, 'DejaVuSans.ttf')))
-        pdfmetrics.registerFont(TTFont('DejaVuSans-Bold', os.path.join(font_path, 'DejaVuSans-Bold.ttf')))
-        pdfmetrics.registerFont(TTFont('DejaVuSans-Oblique', os.path.join(font_path, 'DejaVuSans-Oblique.ttf')))
-        pdfmetrics.registerFont(TTFont('DejaVuSans-BoldOblique', os.path.join(font_path, 'DejaVuSans-BoldOblique.ttf')))
-        pdfmetrics.registerFontFamily(
-            'DejaVuSans',
-            normal='DejaVuSans',
-            bold='DejaVuSans-Bold',
-            italic='DejaVuSans-Oblique',
-            boldItalic='DejaVuSans-BoldOblique',
-        )
-        default.DEFAULT_FONT['dejavusans'] = 'DejaVuSans'
-        default.DEFAULT_FONT['dejavu sans'] = 'DejaVuSans'
-        default.DEFAULT_FONT['dejavusans-bold'] = 'DejaVuSans-Bold'
-        default.DEFAULT_FONT['dejavu sans bold'] = 'DejaVuSans-Bold'
-        _fonts_registered = True
-
-
-def _pisa_link_callback(uri, _rel):
-    if uri.startswith(('http://', 'https://', 'file://')):
-        return uri
-    result = finders.find(uri)
-    if result:
-        if isinstance(result, (list, tuple)):
-            result = result[0]
-        return result
-    return uri
+from NDFL.metrics import PDF_RENDER_SECONDS
+
+from .pdf_report import pdf_backend, pdf_filename, pdf_report_context, write_pdf
 
 # Импортируем функцию из нового файла
 from .parsers import FFGParser, IBParser
@@ -91,11 +61,16 @@ def _attach_dividend_fees(dividend_events, dividend_commissions_data):
             report['issues'].append('Найдены комиссии FEE, но дивиденды за год не найдены — сопоставление невозможно.')
         return report
 
+    # Кандидаты упорядочены по дате: ближайший дивиденд ищется bisect, а не перебором
     dividends_by_match_key = {}
-    dividends_by_dividend_key_currency = defaultdict(list)
-    dividends_by_ticker_currency = defaultdict(list)
+    dividends_by_dividend_key_currency = DateBuckets()
+    dividends_by_ticker_currency = DateBuckets()
+    all_dividends = DateBuckets()
 
     for div_event in dividend_events:
+        div_date = div_event.get('date')
+        all_dividends.add(None, div_date, div_event)
+
         dividend_match_key = div_event.get('dividend_match_key')
         if dividend_match_key:
             dividends_by_match_key[dividend_match_key] = div_event
@@ -103,28 +78,11 @@ def _attach_dividend_fees(dividend_events, dividend_commissions_data):
         dividend_key = div_event.get('dividend_key')
         currency = (div_event.get('currency') or '').upper()
         if dividend_key and currency:
-            dividends_by_dividend_key_currency[(dividend_key, currency)].append(div_event)
+            dividends_by_dividend_key_currency.add((dividend_key, currency), div_date, div_event)
 
         ticker = (div_event.get('ticker') or '').upper()
         if ticker and currency:
-            dividends_by_ticker_currency[(ticker, currency)].append(div_event)
-
-    def _nearest_by_date(candidates, target_date):
-        if not candidates:
-            return None
-        if not target_date:
-            return candidates[0]
-        best = None
-        best_delta = None
-        for candidate in candidates:
-            d = candidate.get('date')
-            if not d:
-                continue
-            delta = abs((d - target_date).days)
-            if best is None or delta < best_delta or (delta == best_delta and d < best.get('date')):
-                best = candidate
-                best_delta = delta
-        return best or candidates[0]
+            dividends_by_ticker_currency.add((ticker, currency), div_date, div_event)
 
     def _fee_date(detail):
         d = detail.get('date_obj')
@@ -153,8 +111,7 @@ def _attach_dividend_fees(dividend_events, dividend_commissions_data):
                 dividend_key = detail.get('dividend_key')
                 currency = (detail.get('currency') or '').upper()
                 if dividend_key and currency:
-                    candidates = dividends_by_dividend_key_currency.get((dividend_key, currency), [])
-                    matched_div = _nearest_by_date(candidates, _fee_date(detail))
+                    matched_div = dividends_by_dividend_key_currency.nearest((dividend_key, currency), _fee_date(detail))
 
             # 3) Fallback: по тикеру (из дивиденда) + валюта + ближайшая дата
             if matched_div is None:
@@ -165,12 +122,11 @@ def _attach_dividend_fees(dividend_events, dividend_commissions_data):
                     ticker = m.group(1)
                 currency = (detail.get('currency') or '').upper()
                 if ticker and currency:
-                    candidates = dividends_by_ticker_currency.get((ticker, currency), [])
-                    matched_div = _nearest_by_date(candidates, _fee_date(detail))
+                    matched_div = dividends_by_ticker_currency.nearest((ticker, currency), _fee_date(detail))
 
             # 4) Последний шанс: ближайшая дата по всем дивидендам (чтобы не терять FEE)
             if matched_div is None:
-                matched_div = _nearest_by_date(dividend_events, _fee_date(detail))
+                matched_div = all_dividends.nearest(None, _fee_date(detail))
 
             if matched_div is None:
                 report['unmatched_fee_details'] += 1
@@ -192,68 +148,6 @@ def _attach_dividend_fees(dividend_events, dividend_commissions_data):
     return report
 
 
-# parse_year_from_date_end остается здесь, так как используется для первичного чтения файла
-def parse_year_from_date_end(xml_string_content):
-    try:
-        match_attr = re.search(r'<broker_report[^>]*date_end="(\d{4})-\d{2}-\d{2}', xml_string_content)
-        if match_attr: return int(match_attr.group(1))
-        root = ET.fromstring(xml_string_content)
-        date_end_el = root.find('.//date_end')
-        if date_end_el is not None and date_end_el.text:
-            match_tag = re.match(r"(\d{4})", date_end_el.text.strip())
-            if match_tag: return int(match_tag.group(1))
-    except ET.ParseError: pass
-    except Exception as e: pass
-    return None
-
-
-def parse_year_from_ib_filename(filename):
-    matches = re.findall(r'(\d{4})', filename or '')
-    if matches:
-        try:
-            return int(matches[-1])
-        except ValueError:
-            return None
-    return None
-
-
-def parse_account_number_from_ffg_xml(xml_string_content):
-    """Извлекает номер счёта (client_code) из XML отчёта FFG."""
-    try:
-        root = ET.fromstring(xml_string_content)
-        client_code_el = root.find('.//plainAccountInfoData/client_code')
-        if client_code_el is not None and client_code_el.text:
-            return client_code_el.text.strip()
-    except ET.ParseError:
-        pass
-    except Exception:
-        pass
-    return None
-
-
-def parse_account_number_from_ib_csv(file_path):
-    """Извлекает номер счёта из CSV отчёта Interactive Brokers."""
-    import csv
-    try:
-        with open(file_path, 'r', encoding='utf-8-sig', newline='') as f:
-            reader = csv.reader(f)
-            for row in reader:
-                if len(row) >= 4:
-                    # Нормализуем ё -> е для корректного сравнения
-                    col0 = row[0].strip().replace('ё', 'е').replace('Ё', 'Е')
-                    col2 = row[2].strip().replace('ё', 'е').replace('Ё', 'Е')
-
-                    # Ищем строку "Информация о счете,Data,Счет,НОМЕР" (с е или ё)
-                    if col0 == 'Информация о счете' and row[1].strip() == 'Data' and col2 == 'Счет':
-                        return row[3].strip()
-                    # Также проверяем английский вариант "Account Information,Data,Account,NUMBER"
-                    if row[0].strip() == 'Account Information' and row[1].strip() == 'Data' and row[2].strip() == 'Account':
-                        return row[3].strip()
-    except Exception:
-        pass
-    return None
-
-
 def _remove_reports_for_other_broker(user, broker_type):
     other_broker = 'ib' if broker_type == 'ffg' else 'ffg'
     other_reports = BrokerReport.objects.filter(user=user, broker_type=other_broker)
@@ -261,6 +155,7 @@ def _remove_reports_for_other_broker(user, broker_type):
         if report.report_file:
             report.report_file.delete(save=False)
     other_reports.delete()
+    invalidate_year_results(user, other_broker)
 
 @login_required
 def delete_xml_file(request, file_id):
@@ -275,6 +170,7 @@ def delete_xml_file(request, file_id):
         
         # Удаляем запись из БД
         file_to_delete.delete()
+        invalidate_year_results(request.user, file_to_delete.broker_type)
         
         messages.success(request, f"Файл '{file_name}' (отчет за {file_year} год) успешно удален.")
     except BrokerReport.DoesNotExist:
@@ -349,6 +245,7 @@ def upload_xml_file(request):
                     report.report_file.delete(save=False)
             count = reports.count()
             reports.delete()
+            invalidate_year_results(user)
             messages.success(request, f"Удалено отчетов: {count}.")
             return redirect('upload_xml_file')
         if action == 'process_trades':
@@ -384,6 +281,26 @@ def upload_xml_file(request):
             except ValueError:
                 messages.error(request, 'Некорректный формат целевого года в форме.')
             return redirect('upload_xml_file')
+        elif action == 'process_all_years':
+            broker_type = request.POST.get('broker_type', 'ffg')
+            valid_years = sorted(
+                BrokerReport.objects.filter(user=user, broker_type=broker_type).values_list('year', flat=True).distinct()
+            )
+            if not valid_years:
+                broker_display = 'Freedom Finance Global' if broker_type == 'ffg' else 'Interactive Brokers'
+                messages.error(request, f'Нет загруженных отчётов для брокера {broker_display}. Сначала загрузите отчёты.')
+                return redirect('upload_xml_file')
+            # После расчета показываем выбранный год (или последний, если выбран год другого брокера)
+            year_str_from_form = request.POST.get('year_for_process')
+            target_report_year = int(year_str_from_form) if (year_str_from_form or '').isdigit() else None
+            if target_report_year not in valid_years:
+                target_report_year = valid_years[-1]
+            request.session['last_target_year'] = target_report_year
+            request.session['run_processing_for_year'] = target_report_year
+            request.session['last_broker_type'] = broker_type
+            request.session['run_processing_broker_type'] = broker_type
+            request.session['run_processing_all_years'] = True
+            return redirect('upload_xml_file')
         elif action == 'upload_reports':
             broker_type = request.POST.get('broker_type', 'ffg')
             uploaded_files_from_form = request.FILES.getlist('report_file')
@@ -404,57 +321,19 @@ def upload_xml_file(request):
 
             _remove_reports_for_other_broker(user, broker_type)
             request.session['last_broker_type'] = broker_type
+            upload_results = extract_uploads_metadata(uploaded_files_from_form, broker_type)
+            if save_uploaded_reports(user, broker_type, upload_results):
+                invalidate_year_results(user, broker_type)
+
             parsing_error_in_upload_phase = False
-            for uploaded_file_from_form in uploaded_files_from_form:
-                original_name = uploaded_file_from_form.name; xml_string = ""; file_year_from_xml = None
-                try:
-                    content_bytes = uploaded_file_from_form.read(); uploaded_file_from_form.seek(0)
-                    if broker_type == 'ffg':
-                        try: xml_string = content_bytes.decode('utf-8')
-                        except UnicodeDecodeError:
-                            try: xml_string = content_bytes.decode('windows-1251', errors='replace')
-                            except UnicodeDecodeError:
-                                messages.error(request, f"Файл {original_name}: не удалось определить кодировку. Файл пропущен.")
-                                parsing_error_in_upload_phase = True;
-                                continue
-                        if xml_string:
-                            file_year_from_xml = parse_year_from_date_end(xml_string)
-                    else:
-                        file_year_from_xml = parse_year_from_ib_filename(original_name)
-
-                    if file_year_from_xml is None:
-                        messages.error(request, f"Файл {original_name}: не удалось определить год отчета. Файл пропущен.")
-                        parsing_error_in_upload_phase = True;
-                        continue
-                    if BrokerReport.objects.filter(user=user, broker_type=broker_type, original_filename=original_name, year=file_year_from_xml).exists():
-                        messages.warning(request, f"Файл '{original_name}' для {file_year_from_xml} года уже был загружен. Пропуск.")
-                        continue
-
-                    # Извлекаем номер счёта из отчёта
-                    account_number = None
-                    if broker_type == 'ffg' and xml_string:
-                        account_number = parse_account_number_from_ffg_xml(xml_string)
-
-                    instance = BrokerReport(
-                        user=user,
-                        broker_type=broker_type,
-                        report_file=uploaded_file_from_form,
-                        year=file_year_from_xml,
-                        original_filename=original_name,
-                        account_number=account_number or '',
-                    )
-                    instance.save()
-
-                    # Для IB извлекаем номер счёта после сохранения файла
-                    if broker_type == 'ib' and instance.report_file:
-                        ib_account = parse_account_number_from_ib_csv(instance.report_file.path)
-                        if ib_account:
-                            instance.account_number = ib_account
-                            instance.save(update_fields=['account_number'])
-
-                    messages.success(request, f"Файл {original_name} (отчет за {file_year_from_xml} год) успешно загружен.")
-                except Exception as e:
-                    messages.error(request, f"Ошибка при первичной обработке файла {original_name}: {e}. Файл пропущен.")
+            for result in upload_results:
+                original_name = result['original_filename']
+                if result['status'] == 'created':
+                    messages.success(request, f"Файл {original_name} (отчет за {result['year']} год) успешно загружен.")
+                elif result['status'] == 'duplicate':
+                    messages.warning(request, f"Файл '{original_name}' для {result['year']} года уже был загружен. Пропуск.")
+                else:
+                    messages.error(request, f"Файл {original_name}: {result['error']}. Файл пропущен.")
                     parsing_error_in_upload_phase = True
             if parsing_error_in_upload_phase: messages.warning(request, "При загрузке некоторых файлов возникли ошибки.")
             return redirect('upload_xml_file')
@@ -464,6 +343,7 @@ def upload_xml_file(request):
     else: # GET request
         year_to_process = request.session.pop('run_processing_for_year', None)
         broker_type_to_process = request.session.pop('run_processing_broker_type', None)
+        all_years_to_process = request.session.pop('run_processing_all_years', False)
         if year_to_process is not None:
             # Важно: сохраняем сессию ДО тяжёлого парсинга.
             # Если запрос оборвётся по таймауту (nginx/gunicorn), Django может не успеть
@@ -479,10 +359,18 @@ def upload_xml_file(request):
             if broker_type_to_process:
                 context['selected_broker_type'] = broker_type_to_process
 
-            if broker_type_to_process == 'ib':
-                parser = IBParser(request, user, year_to_process)
-            else:
-                parser = FFGParser(request, user, year_to_process)
+            year_run = None
+            if all_years_to_process:
+                year_run = process_all_years(request, user, broker_type_to_process).get(year_to_process)
+            if year_run is None:
+                # Явный запуск расчёта пересчитывает год, не доверяя сохранённому результату;
+                # новый расчёт сохраняется: из него подгружаются операции инструментов и строится PDF
+                year_run = year_run_for(request, user, broker_type_to_process, year_to_process, refresh=True)
+            processing_result = year_run.result
+            # Предупреждения расчёта показываются сгруппированными и не попадают в сессию
+            context['run_diagnostics'] = year_run.diagnostics
+            # Расчёт с ошибкой не сохраняется — тогда операции выводятся сразу, без подгрузки
+            context['lazy_instrument_history'] = not processing_result[4]
 
             instrument_event_history, dividend_events, total_dividends_rub, \
             total_sales_profit, parsing_error_current_run, \
@@ -493,7 +381,7 @@ def upload_xml_file(request):
             cost_by_income_code, cost_by_income_code_currencies, \
             total_dividends_tax_rub, dividends_tax_by_currency, \
             dividend_commissions_by_currency, \
-            repo_events, total_repo_profit_rub, repo_profit_by_currency = parser.process()
+            repo_events, total_repo_profit_rub, repo_profit_by_currency = processing_result
 
             # Явное преобразование defaultdict в обычные dict
             # Это должно гарантировать, что в шаблон попадут стандартные dict,
@@ -607,6 +495,32 @@ def upload_xml_file(request):
     return render(request, 'reports_to_ndfl/upload.html', context)
 
 
+@login_required
+def instrument_history(request):
+    """
+    HTML-фрагмент с таблицей операций одного инструмента из сохранённого расчёта за год.
+    Страница отчёта выводит только заголовки инструментов и запрашивает операции при раскрытии.
+    """
+    try:
+        target_year = int(request.GET.get('year') or request.session.get('last_target_year'))
+    except (TypeError, ValueError):
+        raise Http404("Некорректный год.")
+    broker_type = request.GET.get('broker') or request.session.get('last_broker_type', 'ffg')
+    grouping_key = request.GET.get('key', '')
+
+    stored_result = load_year_result(request.user, broker_type, target_year)
+    if stored_result is None:
+        raise Http404("Расчёт за год не найден. Пересчитайте отчёт.")
+    event_list = stored_result[0].get(grouping_key)
+    if event_list is None:
+        raise Http404("Инструмент не найден в расчёте.")
+
+    income_code = '1532' if grouping_key.startswith(('OPTION_', 'WARRANT_')) else '1530'
+    return HttpResponse(render_report_fragment(
+        INSTRUMENT_EVENTS_TEMPLATE, {'event_list': event_list, 'income_code': income_code}, request=request,
+    ))
+
+
 @login_required
 def download_pdf(request):
     """Генерация PDF-отчета с расчетами (без информации о пользователе)."""
@@ -626,145 +540,41 @@ def download_pdf(request):
     # Определяем тип брокера из сессии
     broker_type = request.session.get('last_broker_type', 'ffg')
 
-    # Запускаем парсер для получения данных
-    if broker_type == 'ib':
-        parser = IBParser(request, user, target_year)
-    else:
-        parser = FFGParser(request, user, target_year)
-
-    instrument_event_history, dividend_events, total_dividends_rub, \
-    total_sales_profit, parsing_error, \
-    dividend_commissions_data, other_commissions_data, total_other_commissions_rub_val, \
-    profit_by_income_code, profit_by_income_code_currencies, \
-    dividends_by_currency, other_commissions_by_currency, \
-    income_by_income_code, income_by_income_code_currencies, \
-    cost_by_income_code, cost_by_income_code_currencies, \
-    total_dividends_tax_rub, dividends_tax_by_currency, \
-    dividend_commissions_by_currency, \
-    repo_events, total_repo_profit_rub, repo_profit_by_currency = parser.process()
-
-    # Преобразуем defaultdict в обычные dict
-    if isinstance(dividend_commissions_data, defaultdict):
-        temp_div_comm = {}
-        for category_key, data_dict_item in dividend_commissions_data.items():
-            temp_div_comm[category_key] = {
-                'amount_by_currency': dict(data_dict_item['amount_by_currency']),
-                'amount_rub': data_dict_item['amount_rub'],
-                'details': data_dict_item['details']
-            }
-        dividend_commissions_data = temp_div_comm
-
-    if isinstance(other_commissions_data, defaultdict):
-        converted_other_commissions = {}
-        for category, data_dict in other_commissions_data.items():
-            converted_other_commissions[category] = {
-                'currencies': dict(data_dict['currencies']),
-                'total_rub': data_dict['total_rub'],
-                'raw_events': data_dict['raw_events']
-            }
-        other_commissions_data = converted_other_commissions
-
-    # Разделяем историю операций по кодам дохода: 1530 (акции) и 1532 (опционы/ПФИ)
-    instrument_history_1530 = {}  # Ценные бумаги
-    instrument_history_1532 = {}  # ПФИ / опционы
-
-    for key in sorted(instrument_event_history.keys()):
-        events = instrument_event_history[key]
-        is_pfi = key.startswith('OPTION_') or key.startswith('WARRANT_')
-        if is_pfi:
-            instrument_history_1532[key] = events
+    # Берём сохранённый результат за год, иначе запускаем парсер
+    processing_result = load_year_result(user, broker_type, target_year)
+    if processing_result is None:
+        if broker_type == 'ib':
+            parser = IBParser(request, user, target_year)
         else:
-            instrument_history_1530[key] = events
-
-    # Регистрируем шрифты для кириллицы
-    register_fonts()
-
-    # Получаем название брокера для отображения в PDF
-    broker_display_name = 'Freedom Finance Global' if broker_type == 'ffg' else 'Interactive Brokers'
+            parser = FFGParser(request, user, target_year)
+        processing_result = parser.process()
 
-    # Получаем номер счёта из отчёта за целевой год
-    account_number = None
-    report_with_account = BrokerReport.objects.filter(
-        user=user, broker_type=broker_type, year=target_year
-    ).exclude(account_number='').first()
-    if report_with_account:
-        account_number = report_with_account.account_number
-
-    # Получаем комментарий пользователя
-    user_comment = request.GET.get('comment', '').strip()
-
-    # Вычисляем сумму комиссий, связанных с дивидендами
-    total_dividend_commissions_rub = sum(
-        (data.get('amount_rub', Decimal(0)) for data in dividend_commissions_data.values()),
-        Decimal(0)
+    context = pdf_report_context(
+        user, broker_type, target_year, processing_result, user_comment=request.GET.get('comment', '').strip(),
     )
+    filename = pdf_filename(context)
+
+    backend = pdf_backend()
+    if backend == 'reportlab':
+        # PDF пишется во временный файл (в памяти до NDFL_PDF_SPOOL_MAX_SIZE) и отдаётся частями
+        output = tempfile.SpooledTemporaryFile(max_size=getattr(settings, 'NDFL_PDF_SPOOL_MAX_SIZE', 5 * 1024 * 1024))
+        with PDF_RENDER_SECONDS.labels(backend=backend).time():
+            pdf_written = write_pdf(context, output, backend='reportlab')
+        if not pdf_written:
+            output.close()
+            messages.error(request, 'Ошибка при генерации PDF.')
+            return redirect('upload_xml_file')
+        output.seek(0)
+        response = FileResponse(output, content_type='application/pdf')
+    else:
+        result = io.BytesIO()
+        with PDF_RENDER_SECONDS.labels(backend=backend).time():
+            pdf_written = write_pdf(context, result, backend='xhtml2pdf')
+        if not pdf_written:
+            messages.error(request, 'Ошибка при генерации PDF.')
+            return redirect('upload_xml_file')
+        response = HttpResponse(result.getvalue(), content_type='application/pdf')
 
-    fee_matching_report = None
-
-    # Контекст для PDF шаблона (БЕЗ информации о пользователе)
-    context = {
-        'target_report_year_for_title': target_year,
-        'broker_name': broker_display_name,
-        'account_number': account_number,
-        'user_comment': user_comment,
-        'instrument_history_1530': instrument_history_1530,
-        'instrument_history_1532': instrument_history_1532,
-        'dividend_history': dividend_events,
-        'total_dividends_rub': total_dividends_rub,
-        'total_sales_profit_rub': total_sales_profit,
-        'profit_by_income_code': profit_by_income_code,
-        'profit_by_income_code_currencies': profit_by_income_code_currencies,
-        'income_by_income_code': income_by_income_code,
-        'income_by_income_code_currencies': income_by_income_code_currencies,
-        'cost_by_income_code': cost_by_income_code,
-        'cost_by_income_code_currencies': cost_by_income_code_currencies,
-        'total_dividends_tax_rub': total_dividends_tax_rub,
-        'dividends_tax_by_currency': dividends_tax_by_currency,
-        'dividend_commissions_by_currency': dividend_commissions_by_currency,
-        'dividends_by_currency': dividends_by_currency,
-        'other_commissions_by_currency': other_commissions_by_currency,
-        'dividend_commissions': dividend_commissions_data,
-        'other_commissions': other_commissions_data,
-        'total_dividend_commissions_rub': total_dividend_commissions_rub,
-        'total_other_commissions_rub': total_other_commissions_rub_val,
-        'dividend_fee_matching_report': fee_matching_report,
-        'generation_date': datetime.now().strftime('%d.%m.%Y %H:%M'),
-        # РЕПО-данные
-        'repo_events': repo_events,
-        'total_repo_profit_rub': total_repo_profit_rub,
-        'repo_profit_by_currency': repo_profit_by_currency,
-    }
-
-    # Рендерим HTML для PDF
-    html_string = render_to_string('reports_to_ndfl/pdf_report.html', context)
-
-    # Генерируем PDF
-    result = io.BytesIO()
-    pdf = pisa.pisaDocument(
-        io.BytesIO(html_string.encode('utf-8')),
-        result,
-        encoding='utf-8',
-        link_callback=_pisa_link_callback,
-    )
-
-    if pdf.err:
-        messages.error(request, 'Ошибка при генерации PDF.')
-        return redirect('upload_xml_file')
-
-    # Возвращаем PDF как файл для скачивания
-    response = HttpResponse(result.getvalue(), content_type='application/pdf')
-    # Формируем имя файла: Расчет_КодБрокера_НомерСчета_Год
-    broker_code_map = {
-        'Freedom Finance Global': 'FFG',
-        'Interactive Brokers': 'IB',
-    }
-    broker_code = broker_code_map.get(broker_display_name, broker_display_name.replace(' ', '') if broker_display_name else 'Broker')
-    account_safe = account_number.replace(' ', '_') if account_number else ''
-    filename_parts = ['Расчет', broker_code]
-    if account_safe:
-        filename_parts.append(account_safe)
-    filename_parts.append(str(target_year))
-    filename = '_'.join(filename_parts) + '.pdf'
     # Кодируем имя файла для поддержки кириллицы (RFC 5987)
     from urllib.parse import quote
     filename_encoded = quote(filename)
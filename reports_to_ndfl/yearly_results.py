@@ -0,0 +1,246 @@
+# reports_to_ndfl/yearly_results.py
+"""
+Обработка отчётов сразу за все годы и хранение результатов по годам.
+
+process_all_years считает результаты для всех лет, за которые загружены отчёты брокера,
+и сохраняет их в YearlyReportResult. Общий прогон (один разбор отчётов и один FIFO на все годы)
+есть только у IB; у FFG годы считаются по очереди полными расчётами (см. compute_year_runs).
+Переключение года на странице и выгрузка PDF затем берут готовый результат из БД без повторного
+разбора отчётов. Вместе с результатом хранится
+сгруппированная диагностика расчёта (Diagnostics.as_list()). Сохранённые результаты
+сбрасываются при любом изменении набора отчётов (загрузка, удаление), а результат с версией
+(result_version), отличной от текущей, — после обновления кода расчёта или курсов ЦБ —
+считается отсутствующим и пересчитывается.
+"""
+import hashlib
+from collections import namedtuple
+from datetime import date, datetime
+from decimal import Decimal
+from pathlib import Path
+
+from django.conf import settings
+from django.db import transaction
+
+from currency_CBRF.services import rates_revision
+
+from .models import BrokerReport, YearlyReportResult
+from .parsers import FFGParser, IBParser
+
+# Расчёт за год: кортеж parser.process() и диагностика (список групп Diagnostics.as_list())
+YearRun = namedtuple('YearRun', ['result', 'diagnostics'])
+
+# Поля кортежа parser.process() по порядку
+RESULT_FIELDS = (
+    'instrument_event_history', 'dividend_events', 'total_dividends_rub',
+    'total_sales_profit_rub', 'parsing_error',
+    'dividend_commissions', 'other_commissions', 'total_other_commissions_rub',
+    'profit_by_income_code', 'profit_by_income_code_currencies',
+    'dividends_by_currency', 'other_commissions_by_currency',
+    'income_by_income_code', 'income_by_income_code_currencies',
+    'cost_by_income_code', 'cost_by_income_code_currencies',
+    'total_dividends_tax_rub', 'dividends_tax_by_currency',
+    'dividend_commissions_by_currency',
+    'repo_events', 'total_repo_profit_rub', 'repo_profit_by_currency',
+)
+
+
+# Типы результата, которых нет в JSON, хранятся объектом с одним ключом-тегом: {'$decimal': '1.50'}
+_STORED_TYPES = {
+    '$decimal': Decimal,
+    '$date': date.fromisoformat,
+    '$datetime': datetime.fromisoformat,
+    '$tuple': lambda items: tuple(_from_stored(item) for item in items),
+    '$set': lambda items: {_from_stored(item) for item in items},
+    '$dict': lambda items: {_from_stored(key): _from_stored(item) for key, item in items},
+}
+
+
+def _to_stored(value):
+    """
+    Значение результата для JSONField YearlyReportResult.result: Decimal — строкой, даты — в ISO 8601,
+    кортежи, множества и словари с нестроковыми ключами — с тегом типа (см. _STORED_TYPES).
+    """
+    if isinstance(value, dict):
+        if all(isinstance(key, str) and not key.startswith('$') for key in value):
+            return {key: _to_stored(item) for key, item in value.items()}
+        return {'$dict': [[_to_stored(key), _to_stored(item)] for key, item in value.items()]}
+    if isinstance(value, list):
+        return [_to_stored(item) for item in value]
+    if isinstance(value, tuple):
+        return {'$tuple': [_to_stored(item) for item in value]}
+    if isinstance(value, (set, frozenset)):
+        return {'$set': [_to_stored(item) for item in value]}
+    if isinstance(value, Decimal):
+        return {'$decimal': str(value)}
+    if isinstance(value, datetime):
+        return {'$datetime': value.isoformat()}
+    if isinstance(value, date):
+        return {'$date': value.isoformat()}
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    raise TypeError(f"Значение типа {type(value).__name__} нельзя сохранить в результате расчёта")
+
+
+def _from_stored(value):
+    """Обратное _to_stored: значение JSONField с исходными типами (defaultdict возвращается обычным dict)."""
+    if isinstance(value, dict):
+        if len(value) == 1:
+            tag, payload = next(iter(value.items()))
+            if tag in _STORED_TYPES:
+                return _STORED_TYPES[tag](payload)
+        return {key: _from_stored(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_from_stored(item) for item in value]
+    return value
+
+
+def jsonable(value):
+    """Значение результата в виде для JSON: Decimal — строкой, даты — в ISO 8601, множества — списком."""
+    if isinstance(value, dict):
+        return {str(key): jsonable(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [jsonable(item) for item in value]
+    if isinstance(value, (set, frozenset)):
+        return sorted(jsonable(item) for item in value)
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    return str(value)
+
+
+def result_payload(result):
+    """Результат parser.process() как словарь {поле: значение} для JSON (API, compute_ndfl)."""
+    return {field: jsonable(value) for field, value in zip(RESULT_FIELDS, result)}
+
+
+# Исходники, от которых зависит результат расчёта (кроме тестов и миграций)
+_CALCULATOR_SOURCES = ('reports_to_ndfl/*.py', 'reports_to_ndfl/parsers/*.py', 'currency_CBRF/services.py')
+
+
+def _calculator_sources_digest():
+    """Хэш исходников расчёта: меняется при выкладке новой версии кода."""
+    root = Path(__file__).resolve().parent.parent
+    digest = hashlib.sha256()
+    for pattern in _CALCULATOR_SOURCES:
+        for path in sorted(root.glob(pattern)):
+            if path.name != 'tests.py':
+                digest.update(path.relative_to(root).as_posix().encode())
+                digest.update(path.read_bytes())
+    return digest.hexdigest()[:16]
+
+
+# Версия кода расчёта — NDFL_CALCULATOR_VERSION (например, тег релиза) или хэш исходников;
+# считается один раз при импорте модуля
+CALCULATOR_VERSION = getattr(settings, 'NDFL_CALCULATOR_VERSION', None) or _calculator_sources_digest()
+
+
+def result_version(year):
+    """Текущая версия расчёта за год: версия кода и версия курсов ЦБ (rates_revision)."""
+    return f'{CALCULATOR_VERSION}:{rates_revision(year)}'
+
+
+def load_year_run(user, broker_type, year):
+    """Сохранённый расчёт за год (YearRun) или None, если его нет или он посчитан по старому коду либо курсам."""
+    stored = YearlyReportResult.objects.filter(
+        user=user, broker_type=broker_type, year=year, version=result_version(year),
+    ).values_list('result', 'diagnostics').first()
+    if stored is None:
+        return None
+    result, diagnostics = stored
+    return YearRun(_from_stored(result), diagnostics)
+
+
+def load_year_result(user, broker_type, year):
+    """Сохранённый результат parser.process() за год или None."""
+    year_run = load_year_run(user, broker_type, year)
+    return year_run.result if year_run is not None else None
+
+
+def store_year_results(user, broker_type, runs_by_year):
+    """
+    Сохраняет расчёты {год: YearRun}. Годы с ошибкой разбора не сохраняются, а ранее сохранённый
+    результат за такой год удаляется, чтобы страница и API не отдавали устаревшие суммы.
+    """
+    with transaction.atomic():
+        for year, year_run in runs_by_year.items():
+            if year_run.result[4]:
+                YearlyReportResult.objects.filter(user=user, broker_type=broker_type, year=year).delete()
+                continue
+            YearlyReportResult.objects.update_or_create(
+                user=user, broker_type=broker_type, year=year,
+                defaults={
+                    'result': _to_stored(tuple(year_run.result)),
+                    'diagnostics': year_run.diagnostics,
+                    'version': result_version(year),
+                },
+            )
+
+
+def year_run_for(request, user, broker_type, year, refresh=False):
+    """
+    Расчёт за год: сохранённый (если есть и не refresh), иначе parser.process() с сохранением.
+    Из сохранённого результата подгружаются операции инструментов, строится PDF и отдаётся API.
+    """
+    year_run = None if refresh else load_year_run(user, broker_type, year)
+    if year_run is None:
+        parser = IBParser(request, user, year) if broker_type == 'ib' else FFGParser(request, user, year)
+        year_run = YearRun(parser.process(), parser.context.diagnostics.as_list())
+        store_year_results(user, 'ib' if broker_type == 'ib' else 'ffg', {year: year_run})
+    return year_run
+
+
+def invalidate_year_results(user, broker_type=None):
+    stored = YearlyReportResult.objects.filter(user=user)
+    if broker_type:
+        stored = stored.filter(broker_type=broker_type)
+    stored.delete()
+
+
+def report_years(user, broker_type):
+    """Годы загруженных отчётов брокера по возрастанию."""
+    # order_by('year'): сортировка модели по uploaded_at попала бы в SELECT DISTINCT и дала повторы лет
+    return list(
+        BrokerReport.objects.filter(user=user, broker_type=broker_type)
+        .order_by('year').values_list('year', flat=True).distinct()
+    )
+
+
+def compute_year_runs(request, user, broker_type, years):
+    """
+    Считает (без сохранения) результаты за годы years. Возвращает {год: YearRun}.
+    request может быть None: предупреждения расчёта собираются в диагностику (RunContext).
+
+    IB: отчёты разбираются и FIFO прогоняется один раз (IBParser.process_all_years).
+    FFG: общего прогона нет — process_and_get_trade_data завязан на целевой год (отбор инструментов
+    для FIFO, РЕПО, дивиденды и комиссии), поэтому FFGParser.process() вызывается для каждого года
+    и разбирает отчёты заново. Для FFG режим «все годы» ускоряет только переключение лет и PDF
+    (результаты берутся из YearlyReportResult), но не сам расчёт.
+    """
+    years = sorted(years)
+    if broker_type == 'ib' and len(years) > 1:
+        # Общий прогон; диагностика у каждого года своя (IBParser.year_contexts)
+        parser = IBParser(request, user, years[-1])
+        results_by_year = parser.process_all_years(years)
+        return {
+            year: YearRun(result, parser.year_contexts[year].diagnostics.as_list())
+            for year, result in results_by_year.items()
+        }
+    runs_by_year = {}
+    for year in years:
+        parser = IBParser(request, user, year) if broker_type == 'ib' else FFGParser(request, user, year)
+        runs_by_year[year] = YearRun(parser.process(), parser.context.diagnostics.as_list())
+    return runs_by_year
+
+
+def process_all_years(request, user, broker_type):
+    """Считает и сохраняет результаты за все годы загруженных отчётов брокера. Возвращает {год: YearRun}."""
+    years = report_years(user, broker_type)
+    if not years:
+        return {}
+    runs_by_year = compute_year_runs(request, user, broker_type, years)
+    invalidate_year_results(user, broker_type)
+    store_year_results(user, broker_type, runs_by_year)
+    return runs_by_year